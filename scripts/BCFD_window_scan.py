@@ -0,0 +1,99 @@
+import argparse
+import os
+import numpy as np
+from data_format import OUTPUT_DTYPE, DATA_DIRECTORY, open_data_file, as_array, make_rows
+from OF_calibration import get_OF_calibration
+from get_OF_coefficients import CALIBRATION_PARAMETERS, get_delta_BCFD_window_mean
+from emulate_VHDL import coefficients_from_calibration, run_pipeline_segmented
+from reconstruct_A_and_T import reconstruct_pulses, get_true_pulses, match_pulses
+from design_sweep import estimate_cost
+
+## Time (and amplitude) resolution versus the number of BCFD windows, N_BCFD_WINDOWS = 2^k. With more windows, the BCFD time estimate is finer and the OF only has to correct a smaller time shift (tau), but the bank of coefficients and templates (one set of a, b, g and d_g per window, stored in ROM in the FPGA) grows in proportion. For every k, the calibration is calculated (the fits are cached and shared, see get_OF_coefficients.py), the pulse train is processed by emulate_VHDL.py with a k-step bisection and that calibration, and the output is reconstructed and matched to the MC truth as in reconstruct_A_and_T.py.
+
+
+## Run the emulator with the calibration and compare the reconstructed pulses with the MC truth. Returns a dictionary with the efficiency, the fake rate and the mean and standard deviation of the time difference and the relative amplitude difference, for the first pulse in each waveform and for the following (pile-up) pulses.
+def evaluate_calibration(calibration, input_data, MC_truth_data, N_EMPTY_WAVEFORMS, N_REAL_WAVEFORMS, N_SAMPLES_PER_WAVEFORM):
+    output_data = make_rows(run_pipeline_segmented(input_data, coefficients=coefficients_from_calibration(calibration)), OUTPUT_DTYPE)
+
+    trigger_timestamps, Reconstructed_A, Reconstructed_T = reconstruct_pulses(output_data, N_EMPTY_WAVEFORMS*N_SAMPLES_PER_WAVEFORM, (N_EMPTY_WAVEFORMS + N_REAL_WAVEFORMS)*N_SAMPLES_PER_WAVEFORM, calibration)
+    true_waveform, true_position, True_A, True_T = get_true_pulses(MC_truth_data, N_EMPTY_WAVEFORMS, N_EMPTY_WAVEFORMS + N_REAL_WAVEFORMS, N_SAMPLES_PER_WAVEFORM)
+    matched, match = match_pulses(Reconstructed_T, True_T)
+
+    delta_A = (Reconstructed_A[matched] - True_A[match[matched]])/True_A[match[matched]]
+    delta_T = Reconstructed_T[matched] - True_T[match[matched]]
+    first_pulse = (true_position[match[matched]] == 0)
+
+    result = {'efficiency': np.count_nonzero(matched)/max(len(True_T), 1), 'fake_rate': np.count_nonzero(~matched)/max(len(Reconstructed_T), 1)}
+    for name, selection in [('first', first_pulse), ('pileup', ~first_pulse)]:
+        result['T_mean_' + name] = np.mean(delta_T[selection])
+        result['T_resolution_' + name] = np.std(delta_T[selection])
+        result['A_mean_' + name] = np.mean(delta_A[selection])
+        result['A_resolution_' + name] = np.std(delta_A[selection])
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time and amplitude resolution versus the number of BCFD windows.')
+    parser.add_argument('--data-dir', default=DATA_DIRECTORY, help='the directory with input_data.bin, input_data_no_pileup.bin and MC_truth_data.bin')
+    parser.add_argument('--no-plot', action='store_true')
+    args = parser.parse_args(argv)
+
+    header, input_data = open_data_file(os.path.join(args.data_dir, 'input_data.bin'))
+    no_pileup_header, pulse_train_no_pileup = open_data_file(os.path.join(args.data_dir, 'input_data_no_pileup.bin'))
+    MC_truth_header, MC_truth_data = open_data_file(os.path.join(args.data_dir, 'MC_truth_data.bin'))
+    MC_truth_data = as_array(MC_truth_data)
+
+    N_SAMPLES_PER_WAVEFORM = header['N_SAMPLES_PER_WAVEFORM']
+    N_REAL_WAVEFORMS = header['N_REAL_WAVEFORMS']
+    N_EMPTY_WAVEFORMS = header['N_EMPTY_WAVEFORMS']
+
+    ## The number of BCFD windows is 2^k, for these k:
+    K_VALUES = [2, 3, 4, 5, 6]
+
+    ## The other parameters, from get_OF_coefficients.py:
+    mu, sigma, CFD_delay, CFD_attenuation, OF_START, OF_LENGTH, g_PRECISION, d_g_PRECISION, M_A, M_B = [CALIBRATION_PARAMETERS[name] for name in ('mu', 'sigma', 'CFD_delay', 'CFD_attenuation', 'OF_START', 'OF_LENGTH', 'g_PRECISION', 'd_g_PRECISION', 'M_A', 'M_B')]
+
+
+    t_waveform = np.linspace(1, N_SAMPLES_PER_WAVEFORM, N_SAMPLES_PER_WAVEFORM)
+    waveforms = pulse_train_no_pileup['sample'][N_EMPTY_WAVEFORMS*N_SAMPLES_PER_WAVEFORM:(N_EMPTY_WAVEFORMS + N_REAL_WAVEFORMS)*N_SAMPLES_PER_WAVEFORM].astype(float).reshape(N_REAL_WAVEFORMS, N_SAMPLES_PER_WAVEFORM)
+    input_data = input_data['sample'].astype(np.int64)
+
+    results = []
+    for k in K_VALUES:
+        N_BCFD_WINDOWS = 2**k
+        delta_BCFD_window_mean = get_delta_BCFD_window_mean(waveforms, t_waveform, mu, sigma, CFD_delay, CFD_attenuation, N_BCFD_WINDOWS)
+        calibration = get_OF_calibration(delta_BCFD_window_mean, mu, sigma, CFD_delay, CFD_attenuation, OF_START, OF_LENGTH, M_A, M_B, g_PRECISION, d_g_PRECISION, N_SAMPLES_PER_WAVEFORM)
+
+        result = {'k': k, 'N_BCFD_WINDOWS': N_BCFD_WINDOWS}
+        result.update(evaluate_calibration(calibration, input_data, MC_truth_data, N_EMPTY_WAVEFORMS, N_REAL_WAVEFORMS, N_SAMPLES_PER_WAVEFORM))
+
+        ## The size of the bank: the ROM depth (number of template values, one set per window) and the total number of bits of coefficients and templates.
+        cost = estimate_cost(M_A, M_B, g_PRECISION, d_g_PRECISION, OF_LENGTH, N_BCFD_WINDOWS, np.shape(calibration['g_values'])[1])
+        result['ROM_depth'] = N_BCFD_WINDOWS*np.shape(calibration['g_values'])[1]
+        result['stored_bits'] = cost['coefficient_bits'] + cost['template_bits']
+        results.append(result)
+
+    print('  k  windows  ROM depth  stored bits  efficiency  T res. (first)  T res. (pile-up)  A res. (first)  A res. (pile-up)')
+    for result in results:
+        print('{k:3d}{N_BCFD_WINDOWS:9d}{ROM_depth:11d}{stored_bits:13d}{efficiency:12.4f}{T_resolution_first:16.4f}{T_resolution_pileup:18.4f}{A_resolution_first:16.4f}{A_resolution_pileup:18.4f}'.format(**result))
+
+    if not args.no_plot:
+        ## Plot the time resolution against the size of the bank:
+        import matplotlib.pyplot as plt
+
+        stored_bits = [result['stored_bits'] for result in results]
+        plt.plot(stored_bits, [result['T_resolution_first'] for result in results], 'go-', label='First pulse')
+        plt.plot(stored_bits, [result['T_resolution_pileup'] for result in results], 'ro-', label='Following pulses (pile-up)')
+        for result in results:
+            plt.annotate(str(result['N_BCFD_WINDOWS']) + ' windows', (result['stored_bits'], result['T_resolution_first']))
+        plt.xscale('log')
+        plt.xlabel('Stored bits (coefficients + templates)')
+        plt.ylabel(r'Time resolution ($\sigma_T$) [samples]')
+        plt.legend()
+
+        plt.show()
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+import hashlib
+import json
+import os
+import numpy as np
+from data_format import DATA_DIRECTORY
+from fixed_point import fixed_format, quantise
+
+## The OF calibration: the OF coefficients (a and b), the quantised pulse templates (g and d_g), the scalings and the BCFD time offsets (delta_BCFD_window_mean), calculated from the pulse-shape and algorithm parameters. The calibration is written to two files that are always generated together, so that the VHDL code and the Python scripts use the same numbers:
+## - a VHDL package (vhdl/OF_coefficients.vhd) with the constants used by optimal_filter.vhd,
+## - a JSON file (data/OF_calibration.json), read by emulate_VHDL.py and reconstruct_A_and_T.py.
+##
+## Calculations are cached on disk (CACHE_DIRECTORY), in files named by a hash of everything the result depends on. Running get_OF_coefficients.py again with parameters (and data) that have been used before therefore takes no time, and changing e.g. only M_A does not require the pulses to be fitted again.
+
+SCRIPTS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+CALIBRATION_FILE = os.path.join(DATA_DIRECTORY, 'OF_calibration.json')
+VHDL_PACKAGE_FILE = os.path.join(SCRIPTS_DIRECTORY, '..', 'vhdl', 'OF_coefficients.vhd')
+CACHE_DIRECTORY = os.path.join(DATA_DIRECTORY, 'OF_cache')
+
+## The VHDL types in my_types.vhd fix the number of BCFD windows (t_cfd_window), the number of OF coefficients (t_fir_coefficients) and the number of template values (t_pulse_shape_values):
+VHDL_N_BCFD_WINDOWS = 4
+VHDL_OF_LENGTH = 4
+VHDL_N_TEMPLATE_VALUES = 100
+
+
+## Define the lognormal function (the pulse shape). The function is evaluated for all t at once: t is a numpy array (of any shape), and the parameters are numbers or arrays that are broadcast against t.
+def lognormal_fcn(t, A, T0, mu, sigma, baseline):
+    t_since_T0 = t - T0
+    after_T0 = (t_since_T0 > 0.)
+    t_since_T0 = np.where(after_T0, t_since_T0, 1.)                     ## avoid taking the log of values <= 0 (the function is equal to the baseline there anyway)
+
+    return np.where(after_T0, A*np.exp(mu - np.power(sigma, 2)/2.)*(1./t_since_T0)*np.exp(-np.power(np.log(t_since_T0)-mu, 2)/(2.*sigma*sigma)), 0.) + baseline
+
+## Define the (time-)derivative of the lognormal function (used to produce the OF coefficients). Note that the baseline is not included, for the OF we assume that it has already been subtracted by other means
+def d_lognormal_fcn(t, A, T0, mu, sigma):
+    t_since_T0 = t - T0
+    after_T0 = (t_since_T0 > 0.)
+    t_since_T0 = np.where(after_T0, t_since_T0, 1.)
+
+    return np.where(after_T0, A*np.exp(mu - np.power(sigma, 2)/2.)*(1./np.power(t_since_T0, 2))*np.exp(-np.power(np.log(t_since_T0)-mu, 2)/(2.*sigma*sigma))*((mu - np.log(t_since_T0))/np.power(sigma, 2) - 1.), 0.)
+
+## Define the constant fraction discriminator (CFD) signal corresponding to the lognormal function. The CFD signal is the sum of the delayed raw signal and an inverted and attenuated copy of that same signal.
+def lognormal_fcn_CFD(t, A, T0, mu, sigma, CFD_delay, CFD_attenuation):
+    return np.where(t > T0 + CFD_delay, lognormal_fcn(t, A, T0 + CFD_delay, mu, sigma, 0.) - CFD_attenuation*lognormal_fcn(t, A, T0, mu, sigma, 0.), 0.)
+
+
+## Return the result of calculate() for the given parameters (a dictionary of numbers, strings and lists), from the cache if it has been calculated before. The result must be a dictionary that can be stored as JSON.
+def cached(stage, parameters, calculate):
+    key = hashlib.sha256(json.dumps({'stage': stage, 'parameters': parameters}, sort_keys=True).encode('ascii')).hexdigest()
+    path = os.path.join(CACHE_DIRECTORY, stage + '_' + key + '.json')
+
+    if os.path.exists(path):
+        with open(path, 'r') as cache_file:
+            return json.load(cache_file)
+
+    result = calculate()
+
+    os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+    with open(path + '.tmp', 'w') as cache_file:                ## write to a temporary file first, so that an interrupted run does not leave a broken cache entry
+        json.dump(result, cache_file)
+    os.replace(path + '.tmp', path)
+
+    return result
+
+
+## Calculate the OF calibration for the given delta_BCFD_window_mean (one value per BCFD window, from the fits in get_OF_coefficients.py) and parameters. The result is a dictionary (with lists instead of arrays, so it can be stored as JSON) holding the parameters, delta_BCFD_window_mean, FIR_coefficients_a/b, g_values/d_g_values, a_scaling and b_scaling.
+## By default, the pulse templates are the lognormal with the fixed mu and sigma. Instead, templates measured from the data can be passed in (see pulse_templates.py): a dictionary with g and d_g (one row of N_SAMPLES_PER_WAVEFORM values per BCFD window, with the first sample after the CFD crossing at sample_above_zero in every row).
+def calculate_OF_calibration(delta_BCFD_window_mean, mu, sigma, CFD_delay, CFD_attenuation, OF_START, OF_LENGTH, M_A, M_B, g_PRECISION, d_g_PRECISION, N_SAMPLES_PER_WAVEFORM, templates=None, noise_autocorrelation=None):
+    delta_BCFD_window_mean = np.asarray(delta_BCFD_window_mean, dtype=float)
+    N_BCFD_WINDOWS = len(delta_BCFD_window_mean)
+
+    ## samples run between 1, 2, 3, ..., N_SAMPLES_PER_WAVEFORM. Produce a vector of these values denoting the times in each waveform.
+    t_waveform = np.linspace(1, N_SAMPLES_PER_WAVEFORM, N_SAMPLES_PER_WAVEFORM)
+
+    ## Each BCFD window now has an associated delta_BCFD_window_mean value. For the OF, we instead need to find a "best guess" on T_0 (i.e. the lognormal start time). To get that, take the BCFD "best estimate" (the midpoint of the window) minus the delta_BCFD_window_mean values. Note that we also shift the time estimate right by 6 samples, just to get a positive T0_assumed for all BCFD windows. This shift is in that sense arbitrary, but can of course be accounted for later since it is known and fixed.
+    T0_assumed = (6. + (np.arange(N_BCFD_WINDOWS) + 0.5)/N_BCFD_WINDOWS) - delta_BCFD_window_mean
+
+    ### Now, ready to calculate the OF parameters. This is done for all BCFD windows at once (one row per window). For the calculations of the actual coefficients, the methodology in Cleland & Stern (https://doi.org/10.1016/0168-9002(94)91332-3) is used.
+    if templates is None:
+        g = lognormal_fcn(t_waveform, 1, T0_assumed[:, np.newaxis], mu, sigma, 0)             ## produce a lognormal function (i. e. the "pulse template" g) with T0 = T0_assumed (for each BCFD window), mu and sigma from the fixed lognormal shape and a baseline of zero (in the VHDL code, the baseline will be subtracted in a different way before applying the OF). Note also that the amplitude A is set to 1 (the amplitude is a scaling factor applied on the template in the OF algorithm)
+        d_g = d_lognormal_fcn(t_waveform, 1, T0_assumed[:, np.newaxis], mu, sigma)             ## for the OF to work, we also need the time-derivative of the pulse template (i. e. g', or d_g as denoted here). Luckily, the derivative of the lognormal is available analytically, so we may get it directly.
+
+        ## In the on-line processing of signals, the BCFD algorithm will first run to determine the BCFD window. We therefore need a way to 'align' the BCFD algorithm and the OF algorithm (the BCFD zero-crossing time is used as a reference in time). The way this is done is by looking at the timing of the first sample in the CFD data that is *above zero* (i. e. after the zero crossing). We approximate that here by looking at the CFD signal corresponding to pulse template (which should describe the data well):
+        lognormal_CFD = lognormal_fcn_CFD(t_waveform, 1, T0_assumed[:, np.newaxis], mu, sigma, CFD_delay, CFD_attenuation)
+        sample_above_zero = np.argmax(lognormal_CFD > 0., axis=1)
+    else:
+        ## Templates measured from the data (see pulse_templates.py), which are aligned on the CFD crossing by construction.
+        g = np.asarray(templates['g'], dtype=float)
+        d_g = np.asarray(templates['d_g'], dtype=float)
+        sample_above_zero = np.full(N_BCFD_WINDOWS, templates['sample_above_zero'], dtype=int)
+        if (np.shape(g) != (N_BCFD_WINDOWS, N_SAMPLES_PER_WAVEFORM)) or (np.shape(d_g) != np.shape(g)):
+            raise ValueError('The templates must have one row of ' + str(N_SAMPLES_PER_WAVEFORM) + ' values for each of the ' + str(N_BCFD_WINDOWS) + ' BCFD windows')
+
+    ## Calculate the quantised pulse template (and derivative), truncated to g_PRECISION (d_g_PRECISION) fraction bits plus a sign bit (see fixed_point.py). Needed for the tail reconstruction later on.
+    g_quantised = quantise(g, fixed_format(g_PRECISION + 1, fraction_bits=g_PRECISION, rounding='truncate', overflow='error'), name='g')
+    d_g_quantised = quantise(d_g, fixed_format(d_g_PRECISION + 1, fraction_bits=d_g_PRECISION, rounding='truncate', overflow='error'), name='d_g')
+
+    ## The OF uses the samples [OF_START, OF_START + OF_LENGTH) relative to the first CFD sample above zero (as defined in Preston, M. "Developments for the FPGA-Based Digitiser in the PANDA Electromagnetic Calorimeters", four samples [-3, -2, -1, 0] are used).
+    OF_samples = sample_above_zero[:, np.newaxis] + OF_START + np.arange(OF_LENGTH)
+    g_OF = np.take_along_axis(g, OF_samples, axis=1)
+    d_g_OF = np.take_along_axis(d_g, OF_samples, axis=1)
+
+    ## With white noise (no noise_autocorrelation), the noise covariance matrix R is the identity. Otherwise, R is the Toeplitz matrix of the measured autocorrelation (see noise_autocorrelation.py; the normalisation does not matter, since the a and b coefficients do not depend on it), and g and d_g are replaced by R^-1 g and R^-1 d_g where they appear in Cleland & Stern (Eqs. 37-40 with the full covariance matrix).
+    if noise_autocorrelation is None:
+        Rg_OF = g_OF
+        Rd_g_OF = d_g_OF
+    else:
+        noise_autocorrelation = np.asarray(noise_autocorrelation, dtype=float)
+        if (len(noise_autocorrelation) < OF_LENGTH):
+            raise ValueError('The noise autocorrelation must be given for lags 0 to ' + str(OF_LENGTH - 1) + ' (at least)')
+        lag = np.abs(np.arange(OF_LENGTH)[:, np.newaxis] - np.arange(OF_LENGTH))
+        R_inverse = np.linalg.inv(noise_autocorrelation[lag])
+        Rg_OF = g_OF @ R_inverse                    ## R is symmetric, so each row is R^-1 g for its BCFD window
+        Rd_g_OF = d_g_OF @ R_inverse
+
+    ## The Q_1, Q_2 and Q_3 coefficients and Delta (see Cleland & Stern). The sums are done sample by sample, in the same order as the original loop, so that the (quantised) results do not depend on the summation order.
+    Q_1 = np.zeros(N_BCFD_WINDOWS)
+    Q_2 = np.zeros(N_BCFD_WINDOWS)
+    Q_3 = np.zeros(N_BCFD_WINDOWS)
+    for OF_index in range(OF_LENGTH):
+        Q_1 += g_OF[:, OF_index]*Rg_OF[:, OF_index]
+        Q_2 += d_g_OF[:, OF_index]*Rd_g_OF[:, OF_index]
+        Q_3 += d_g_OF[:, OF_index]*Rg_OF[:, OF_index]
+
+    Delta = Q_1*Q_2 - np.power(Q_3, 2)
+
+    # The following parameters are needed for the OF. Defined in Cleland and Stern Eqs. 39 and 40
+    lambda_OF = (Q_2/Delta)[:, np.newaxis]
+    kappa_OF = (-Q_3/Delta)[:, np.newaxis]
+    mu_OF = (Q_3/Delta)[:, np.newaxis]
+    rho_OF = (-Q_1/Delta)[:, np.newaxis]
+
+    ## The a and b coefficients (according to Eqs. 37 and 38 in Cleland/Stern):
+    a = lambda_OF*Rg_OF + kappa_OF*Rd_g_OF
+    b = mu_OF*Rg_OF + rho_OF*Rd_g_OF
+
+    ## Quantise the coefficients to wordlengths M_A and M_B (signed). The scaling is the largest power of two for which the largest coefficient (in absolute value, over all BCFD windows) still fits (see get_OF_coefficients.py for a detailed description):
+    a_scaling = int(np.floor(np.log2((np.power(2, M_A-1) - 1)/np.max(np.abs(a)))))
+    b_scaling = int(np.floor(np.log2((np.power(2, M_B-1) - 1)/np.max(np.abs(b)))))
+
+    a_quantised = quantise(a, fixed_format(M_A, fraction_bits=a_scaling, rounding='round', overflow='error'), name='a')
+    b_quantised = quantise(b, fixed_format(M_B, fraction_bits=b_scaling, rounding='round', overflow='error'), name='b')
+
+    parameters = {'mu': mu, 'sigma': sigma, 'CFD_delay': CFD_delay, 'CFD_attenuation': CFD_attenuation, 'OF_START': OF_START, 'OF_LENGTH': OF_LENGTH, 'M_A': M_A, 'M_B': M_B, 'g_PRECISION': g_PRECISION, 'd_g_PRECISION': d_g_PRECISION, 'N_SAMPLES_PER_WAVEFORM': N_SAMPLES_PER_WAVEFORM}
+    if templates is not None:
+        parameters['templates'] = 'data (' + str(int(np.sum(templates['n_pulses']))) + ' pulses)'
+    if noise_autocorrelation is not None:
+        parameters['noise_autocorrelation'] = [float(value) for value in noise_autocorrelation[:OF_LENGTH]]
+
+    return {'parameters': parameters,
+            'delta_BCFD_window_mean': delta_BCFD_window_mean.tolist(),
+            'FIR_coefficients_a': a_quantised.tolist(),
+            'FIR_coefficients_b': b_quantised.tolist(),
+            'g_values': g_quantised.tolist(),
+            'd_g_values': d_g_quantised.tolist(),
+            'a_scaling': a_scaling,
+            'b_scaling': b_scaling}
+
+## Same as calculate_OF_calibration, but cached (measured templates and noise autocorrelation are part of the cache key).
+def get_OF_calibration(delta_BCFD_window_mean, mu, sigma, CFD_delay, CFD_attenuation, OF_START, OF_LENGTH, M_A, M_B, g_PRECISION, d_g_PRECISION, N_SAMPLES_PER_WAVEFORM, templates=None, noise_autocorrelation=None):
+    parameters = {'delta_BCFD_window_mean': [float(delta) for delta in delta_BCFD_window_mean], 'mu': mu, 'sigma': sigma, 'CFD_delay': CFD_delay, 'CFD_attenuation': CFD_attenuation, 'OF_START': OF_START, 'OF_LENGTH': OF_LENGTH, 'M_A': M_A, 'M_B': M_B, 'g_PRECISION': g_PRECISION, 'd_g_PRECISION': d_g_PRECISION, 'N_SAMPLES_PER_WAVEFORM': N_SAMPLES_PER_WAVEFORM}
+    if templates is not None:
+        parameters['templates'] = {'g': np.asarray(templates['g']).tolist(), 'd_g': np.asarray(templates['d_g']).tolist(), 'sample_above_zero': int(templates['sample_above_zero']), 'n_pulses': np.asarray(templates['n_pulses']).tolist()}
+    if noise_autocorrelation is not None:
+        parameters['noise_autocorrelation'] = [float(value) for value in noise_autocorrelation]
+    return cached('OF_calibration', parameters, lambda: calculate_OF_calibration(**parameters))
+
+
+## Write the calibration to a JSON file (for the Python scripts) and read it back. Lists are converted back to numpy arrays when reading.
+def write_calibration_file(calibration, path=CALIBRATION_FILE):
+    with open(path, 'w') as calibration_file:
+        calibration_file.write('{\n' + ',\n'.join(' ' + json.dumps(name) + ': ' + json.dumps(value) for name, value in calibration.items()) + '\n}\n')          ## one line per entry
+
+def load_calibration(path=CALIBRATION_FILE):
+    with open(path, 'r') as calibration_file:
+        calibration = json.load(calibration_file)
+
+    for name in ['delta_BCFD_window_mean', 'FIR_coefficients_a', 'FIR_coefficients_b', 'g_values', 'd_g_values']:
+        calibration[name] = np.array(calibration[name])
+    return calibration
+
+
+## Format a list of integers as a VHDL aggregate, with n_per_line values per line.
+def VHDL_aggregate(values, n_per_line=12):
+    width = max(len(str(int(value))) for value in values)
+    lines = [', '.join(str(int(value)).rjust(width) for value in values[line_start:line_start + n_per_line]) for line_start in range(0, len(values), n_per_line)]
+    return '(' + ',\n        '.join(lines) + ')'
+
+## Write the calibration as a VHDL package (used by optimal_filter.vhd). The constants are named after the signals they initialise in optimal_filter.vhd.
+def write_VHDL_package(calibration, path=VHDL_PACKAGE_FILE):
+    a = np.asarray(calibration['FIR_coefficients_a'])
+    if (a.shape != (VHDL_N_BCFD_WINDOWS, VHDL_OF_LENGTH)) or (np.shape(calibration['g_values']) != (VHDL_N_BCFD_WINDOWS, VHDL_N_TEMPLATE_VALUES)):
+        raise ValueError('The VHDL code (my_types.vhd) expects ' + str(VHDL_N_BCFD_WINDOWS) + ' BCFD windows, ' + str(VHDL_OF_LENGTH) + ' OF coefficients and ' + str(VHDL_N_TEMPLATE_VALUES) + ' template values')
+
+    parameters = calibration['parameters']
+
+    lines = ['-- Copyright (C) 2021 Markus Preston',
+             '-- This source describes Open Hardware and is licensed under the CERN-OHL-W v2 or later',
+             '-- You may redistribute and modify this documentation and make products',
+             '-- using it under the terms of the CERN-OHL-W v2 or later (https:/cern.ch/cern-ohl).',
+             '--',
+             '-- This documentation is distributed WITHOUT ANY EXPRESS OR IMPLIED',
+             '-- WARRANTY, INCLUDING OF MERCHANTABILITY, SATISFACTORY QUALITY',
+             '-- AND FITNESS FOR A PARTICULAR PURPOSE. Please see the CERN-OHL-W v2',
+             '-- for applicable conditions.',
+             '--',
+             '-- Source location: https://github.com/markuspreston/FeatureExtraction/',
+             '',
+             '',
+             '-- THIS FILE IS GENERATED by scripts/get_OF_coefficients.py (see scripts/OF_calibration.py). Do not edit it by hand: change the parameters in get_OF_coefficients.py and run it again.',
+             '-- The same calibration is written to data/OF_calibration.json, which is used by the Python scripts.',
+             '--',
+             '-- Parameters: ' + ', '.join(name + ' = ' + str(value) for name, value in parameters.items()),
+             '-- delta_BCFD_window_mean: ' + ', '.join(str(delta) for delta in calibration['delta_BCFD_window_mean']),
+             '',
+             'library IEEE;',
+             'use IEEE.STD_LOGIC_1164.ALL;',
+             'use IEEE.NUMERIC_STD.ALL;',
+             '',
+             'use work.my_types.all;',
+             '',
+             'package OF_coefficients is',
+             '',
+             '-- Scalings (number of bits) of the quantised values. u and v are shifted right by A_SCALING. The b coefficients have TAU_SCALING more bits than the a coefficients (the precision on tau). G_PRECISION and D_G_PRECISION are the precisions of the templates g and d_g.',
+             'constant A_SCALING : integer := ' + str(calibration['a_scaling']) + ';',
+             'constant TAU_SCALING : integer := ' + str(calibration['b_scaling'] - calibration['a_scaling']) + ';',
+             'constant G_PRECISION : integer := ' + str(parameters['g_PRECISION']) + ';',
+             'constant D_G_PRECISION : integer := ' + str(parameters['d_g_PRECISION']) + ';',
+             '',
+             '-- The OF coefficients a and b, one set for each BCFD window (listed starting with the earliest sample).']
+    for name, values in [('FIR_COEFFICIENTS_A', calibration['FIR_coefficients_a']), ('FIR_COEFFICIENTS_B', calibration['FIR_coefficients_b'])]:
+        for window_no, window_values in enumerate(values):
+            lines.append('constant ' + name + '_' + str(window_no + 1) + ' : t_fir_coefficients := ' + VHDL_aggregate(window_values) + ';')
+        lines.append('')
+
+    lines.append('-- The quantised pulse template g and its derivative d_g, one for each BCFD window. Needed for reconstructing the pulse tail.')
+    for name, values in [('G_VALUES', calibration['g_values']), ('D_G_VALUES', calibration['d_g_values'])]:
+        for window_no, window_values in enumerate(values):
+            lines.append('constant ' + name + '_' + str(window_no + 1) + ' : t_pulse_shape_values := ' + VHDL_aggregate(window_values) + ';')
+            lines.append('')
+
+    lines += ['end package OF_coefficients;', '']
+
+    with open(path, 'w') as package_file:
+        package_file.write('\n'.join(lines))
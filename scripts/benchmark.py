@@ -0,0 +1,179 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import numpy as np
+from data_format import OUTPUT_DTYPE, DATA_DIRECTORY, open_data_file, as_array, make_rows
+from OF_calibration import calculate_OF_calibration, load_calibration
+from get_OF_coefficients import CALIBRATION_PARAMETERS, get_delta_BCFD_window_mean
+from generate_pulse_data import generate_pulse_data
+from emulate_VHDL import coefficients_from_calibration, run_pipeline_segmented
+from feature_records import make_feature_records
+from reconstruct_A_and_T import reconstruct_pulses, get_true_pulses, match_pulses
+from BCFD_window_scan import evaluate_calibration
+
+## Benchmarks of the processing speed and of the physics performance, written to a JSON file (by default data/benchmark.json), so that changes in either between versions of the code can be found by comparing two files (--compare).
+##
+## 1. Throughput: the data are generated (generate_pulse_data.py) for several numbers of waveforms, and every stage of the processing is timed: the generation, the calibration (the fits and the OF coefficients, with the same functions as get_OF_coefficients.py, but without the cache), the emulation of the pipeline (emulate_VHDL.py) and the reconstruction (the feature records, reconstruct_A_and_T.py and the matching to the MC truth). The result is the number of samples and of pulses (events) per second for each stage.
+## 2. Physics: the data are generated for a range of settings of generate_pulse_data.py (the distance Delta_T0 between the pulses, the amplitude range and the pulse rate, one at a time, with the other settings at their defaults), processed with the calibration in data/OF_calibration.json (the one in the VHDL code) and compared with the MC truth: the efficiency, the fake rate and the time and amplitude resolution, for the first pulse in each waveform and for the following (pile-up) pulses (see BCFD_window_scan.py).
+##
+## The data are generated in a temporary directory, so the data in the data directory are left alone.
+
+## The numbers of waveforms for the throughput benchmark:
+THROUGHPUT_N_WAVEFORMS = [1000, 10000, 100000]
+
+## The settings for the physics benchmark (the options of generate_pulse_data.py), and the number of waveforms for each:
+PHYSICS_SETTINGS = [{'delta_t0': [5., 10.]}, {'delta_t0': [10., 20.]}, {'delta_t0': [20., 35.]}, {'delta_t0': [35., 50.]},
+                    {'amplitude': [50., 200.]}, {'amplitude': [200., 500.]}, {'amplitude': [500., 1000.]},
+                    {'rate': 0.005}, {'rate': 0.01}, {'rate': 0.02}, {'rate': 0.04}]
+PHYSICS_N_WAVEFORMS = 5000
+
+## In --compare, a change of a throughput by more than THROUGHPUT_TOLERANCE (relative) or of an efficiency or resolution by more than PHYSICS_TOLERANCE (relative) is reported.
+THROUGHPUT_TOLERANCE = 0.2
+PHYSICS_TOLERANCE = 0.05
+
+
+## Generate the data (generate_pulse_data.py) with the given settings (a dictionary of its keyword arguments), writing the data to data_dir. Returns the time it took.
+def generate_data(data_dir, n_waveforms, settings={}):
+    start_time = time.perf_counter()
+    generate_pulse_data(data_dir, n_waveforms, **settings)
+    return time.perf_counter() - start_time
+
+
+## The number of pulses in the real waveforms of the MC truth data.
+def count_pulses(MC_truth_data, N_EMPTY_WAVEFORMS):
+    return int(np.count_nonzero(MC_truth_data[N_EMPTY_WAVEFORMS:, 0::2] >= 0))
+
+
+## Time the stages of the processing for data with n_waveforms waveforms. Returns a dictionary with, for each stage, the time and the throughput in samples/s and in pulses (events)/s.
+def benchmark_throughput(n_waveforms, data_dir, parameters=CALIBRATION_PARAMETERS):
+    result = {'n_waveforms': n_waveforms}
+    times = {'generation': generate_data(data_dir, n_waveforms)}
+
+    header, input_data = open_data_file(os.path.join(data_dir, 'input_data.bin'))
+    no_pileup_header, pulse_train_no_pileup = open_data_file(os.path.join(data_dir, 'input_data_no_pileup.bin'))
+    MC_truth_header, MC_truth_data = open_data_file(os.path.join(data_dir, 'MC_truth_data.bin'))
+    MC_truth_data = as_array(MC_truth_data)
+    N_SAMPLES_PER_WAVEFORM = header['N_SAMPLES_PER_WAVEFORM']
+    N_EMPTY_WAVEFORMS = header['N_EMPTY_WAVEFORMS']
+    N_REAL_WAVEFORMS = header['N_REAL_WAVEFORMS']
+
+    ## The calibration, as in get_OF_coefficients.py (without the cache, which would make it instant):
+    start_time = time.perf_counter()
+    t_waveform = np.linspace(1, N_SAMPLES_PER_WAVEFORM, N_SAMPLES_PER_WAVEFORM)
+    waveforms = pulse_train_no_pileup['sample'][N_EMPTY_WAVEFORMS*N_SAMPLES_PER_WAVEFORM:(N_EMPTY_WAVEFORMS + N_REAL_WAVEFORMS)*N_SAMPLES_PER_WAVEFORM].astype(float).reshape(N_REAL_WAVEFORMS, N_SAMPLES_PER_WAVEFORM)
+    delta_BCFD_window_mean = get_delta_BCFD_window_mean(waveforms, t_waveform, parameters['mu'], parameters['sigma'], parameters['CFD_delay'], parameters['CFD_attenuation'], parameters['N_BCFD_WINDOWS'], use_cache=False)
+    calibration = calculate_OF_calibration(delta_BCFD_window_mean, parameters['mu'], parameters['sigma'], parameters['CFD_delay'], parameters['CFD_attenuation'], parameters['OF_START'], parameters['OF_LENGTH'], parameters['M_A'], parameters['M_B'], parameters['g_PRECISION'], parameters['d_g_PRECISION'], N_SAMPLES_PER_WAVEFORM)
+    times['calibration'] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    output_data = make_rows(run_pipeline_segmented(input_data['sample'].astype(np.int64), coefficients=coefficients_from_calibration(calibration)), OUTPUT_DTYPE)
+    times['emulation'] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    records = make_feature_records(output_data)[0]
+    trigger_timestamps, Reconstructed_A, Reconstructed_T = reconstruct_pulses(records, N_EMPTY_WAVEFORMS*N_SAMPLES_PER_WAVEFORM, (N_EMPTY_WAVEFORMS + N_REAL_WAVEFORMS)*N_SAMPLES_PER_WAVEFORM, calibration)
+    true_waveform, true_position, True_A, True_T = get_true_pulses(MC_truth_data, N_EMPTY_WAVEFORMS, N_EMPTY_WAVEFORMS + N_REAL_WAVEFORMS, N_SAMPLES_PER_WAVEFORM)
+    matched, match = match_pulses(Reconstructed_T, True_T)
+    times['reconstruction'] = time.perf_counter() - start_time
+
+    ## The calibration only uses the isolated pulses (one per waveform):
+    n_samples = len(input_data)
+    n_pulses = {'generation': count_pulses(MC_truth_data, N_EMPTY_WAVEFORMS), 'calibration': N_REAL_WAVEFORMS, 'emulation': len(True_T), 'reconstruction': len(True_T)}
+    for stage, stage_time in times.items():
+        result[stage + '_time'] = stage_time
+        result[stage + '_samples_per_s'] = n_samples/stage_time
+        result[stage + '_events_per_s'] = n_pulses[stage]/stage_time
+    return result
+
+
+## Generate the data with the given settings and measure the physics performance with the calibration. Returns the settings and the results of evaluate_calibration (see BCFD_window_scan.py).
+def benchmark_physics(settings, n_waveforms, data_dir, calibration):
+    generate_data(data_dir, n_waveforms, settings)
+
+    header, input_data = open_data_file(os.path.join(data_dir, 'input_data.bin'))
+    MC_truth_header, MC_truth_data = open_data_file(os.path.join(data_dir, 'MC_truth_data.bin'))
+
+    result = dict(settings)
+    result['n_waveforms'] = n_waveforms
+    result['n_pulses'] = count_pulses(as_array(MC_truth_data), header['N_EMPTY_WAVEFORMS'])
+    result.update(evaluate_calibration(calibration, input_data['sample'].astype(np.int64), as_array(MC_truth_data), header['N_EMPTY_WAVEFORMS'], header['N_REAL_WAVEFORMS'], header['N_SAMPLES_PER_WAVEFORM']))
+    return result
+
+
+## The version of the code (the git commit, if available) and of the environment, stored with the results.
+def get_environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'date': datetime.datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(), 'cpu_count': os.cpu_count()}
+
+
+## List the differences between two benchmark files: throughputs that changed by more than THROUGHPUT_TOLERANCE and efficiencies and resolutions that changed by more than PHYSICS_TOLERANCE (relative). Results are compared by their settings (the number of waveforms, or the physics settings).
+def compare_results(reference, results):
+    differences = []
+    for part, keys, tolerance in [('throughput', ('_samples_per_s',), THROUGHPUT_TOLERANCE), ('physics', ('efficiency', 'fake_rate', '_resolution_'), PHYSICS_TOLERANCE)]:
+        setting_names = ['n_waveforms'] + [option for settings in PHYSICS_SETTINGS for option in settings]
+        for result in results.get(part, []):
+            settings = {name: result[name] for name in setting_names if name in result}
+            for reference_result in reference.get(part, []):
+                if ({name: reference_result.get(name) for name in settings} != settings):
+                    continue
+                for name, value in result.items():
+                    reference_value = reference_result.get(name)
+                    if any(key in name for key in keys) and isinstance(reference_value, (int, float)) and (reference_value != 0) and (abs(value/reference_value - 1) > tolerance):
+                        differences.append('{}: {} {:.4g} -> {:.4g} ({:+.1%})'.format(json.dumps(settings), name, reference_value, value, value/reference_value - 1))
+    return differences
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the processing speed and the physics performance, and write the results to a JSON file.')
+    parser.add_argument('--part', choices=['throughput', 'physics', 'all'], default='all')
+    parser.add_argument('--n-waveforms', type=int, nargs='+', default=THROUGHPUT_N_WAVEFORMS, help='the numbers of waveforms for the throughput benchmark')
+    parser.add_argument('--physics-n-waveforms', type=int, default=PHYSICS_N_WAVEFORMS)
+    parser.add_argument('--output-file', default=os.path.join(DATA_DIRECTORY, 'benchmark.json'))
+    parser.add_argument('--compare', default=None, metavar='REFERENCE', help='compare the results with an earlier benchmark file')
+    args = parser.parse_args(argv)
+
+    results = {'environment': get_environment()}
+    with tempfile.TemporaryDirectory() as data_dir:
+        if (args.part in ['throughput', 'all']):
+            results['throughput'] = []
+            print('waveforms  ' + ''.join('{:>28s}'.format(stage) for stage in ['generation', 'calibration', 'emulation', 'reconstruction']))
+            print('           ' + 4*'{:>17s}{:>11s}'.format('samples/s', 'events/s'))
+            for n_waveforms in args.n_waveforms:
+                result = benchmark_throughput(n_waveforms, data_dir)
+                results['throughput'].append(result)
+                print('{:9d}  '.format(n_waveforms) + ''.join('{:>17.3g}{:>11.3g}'.format(result[stage + '_samples_per_s'], result[stage + '_events_per_s']) for stage in ['generation', 'calibration', 'emulation', 'reconstruction']))
+
+        if (args.part in ['physics', 'all']):
+            results['physics'] = []
+            calibration = load_calibration()
+            print('setting                        efficiency  fake rate  T res. (first)  T res. (pile-up)  A res. (first)  A res. (pile-up)')
+            for settings in PHYSICS_SETTINGS:
+                result = benchmark_physics(settings, args.physics_n_waveforms, data_dir, calibration)
+                results['physics'].append(result)
+                print('{:30s}{efficiency:11.4f}{fake_rate:11.4f}{T_resolution_first:16.4f}{T_resolution_pileup:18.4f}{A_resolution_first:16.4f}{A_resolution_pileup:18.4f}'.format(json.dumps(settings), **result))
+
+    with open(args.output_file, 'w') as output_file:
+        json.dump(results, output_file, indent=1)
+    print('Results written to ' + args.output_file)
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as reference_file:
+            reference = json.load(reference_file)
+        differences = compare_results(reference, results)
+        print(str(len(differences)) + ' differences from ' + args.compare + ' (commit ' + str(reference.get('environment', {}).get('commit')) + '):')
+        for difference in differences:
+            print('  ' + difference)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+import argparse
+import sys
+import time
+import warnings
+import numpy as np
+from data_format import OUTPUT_DTYPE, open_data_file, make_rows
+
+## Compare two outputs of the feature extraction cycle by cycle (the 10 columns written by main_tb.vhd for every clock cycle, or by emulate_VHDL.py), e.g. a VHDL simulation after a change of the VHDL code against a reference run, or the VHDL simulation against the emulator. The rows are aligned on the counter column, so the two runs may start and end at different clock cycles (cycles found in only one of them are counted). For each column, the number of cycles that differ and the first difference are reported, and the differences are grouped into events: cycles that differ, in any of the compared columns, less than EVENT_GAP cycles apart belong to the same event (typically one pulse or one pile-up chain).
+##
+## The files are read in chunks of CHUNK_SIZE rows (the binary files are memory-mapped, .csv files are read with np.loadtxt), and each chunk is compared with vectorised operations, so files of any size can be compared: a run of 10^6 cycles takes well below a second in the binary format. The exit code is 1 if the outputs differ, so the comparison can be used directly in regression checks.
+
+CHUNK_SIZE = 1 << 22
+EVENT_GAP = 100                     ## cycles (one waveform)
+COMPARED_COLUMNS = [name for name in OUTPUT_DTYPE.names if (name != 'counter')]
+
+
+## The rows of an output file (binary or .csv, as written by main_tb.vhd) in chunks, as OUTPUT_DTYPE records.
+def read_chunks(path, chunk_size=CHUNK_SIZE):
+    if path.endswith('.csv'):
+        with open(path, 'r') as csv_file:
+            while True:
+                with warnings.catch_warnings():
+                    warnings.filterwarnings('ignore', message='loadtxt: input contained no data')          ## expected at the end of the file
+                    chunk = np.loadtxt(csv_file, delimiter=',', max_rows=chunk_size, ndmin=2, dtype=np.int64)
+                if (len(chunk) == 0):
+                    return
+                yield make_rows(chunk, OUTPUT_DTYPE)
+    else:
+        header, rows = open_data_file(path)
+        for chunk_start in range(0, len(rows), chunk_size):
+            yield rows[chunk_start:chunk_start + chunk_size]
+
+
+## The result of the comparison so far: the numbers of rows compared and found in only one of the outputs, for each column the number of differences and the first one (counter, reference value, new value), and the events (start and end counter, and the columns that differ), of which the first max_events are kept. last_difference is the counter of the last difference (in any column), to continue an event in the next chunk, and last_counter the last counter read from each output.
+def initial_comparison(columns, max_events):
+    return {'columns': columns, 'max_events': max_events, 'n_compared': 0, 'n_only_reference': 0, 'n_only_new': 0,
+            'n_differences': {name: 0 for name in columns}, 'first_difference': {name: None for name in columns},
+            'n_events': 0, 'events': [], 'last_difference': None, 'last_counter': [None, None]}
+
+
+## Compare the rows with the same counter in two blocks of rows (each sorted by counter), and add the result to the comparison (in place).
+def compare_rows(comparison, reference, new):
+    position = np.searchsorted(new['counter'], reference['counter'])
+    found = (position < len(new))
+    found[found] = (new['counter'][position[found]] == reference['counter'][found])
+    comparison['n_only_reference'] += len(reference) - int(np.count_nonzero(found))
+    comparison['n_only_new'] += len(new) - int(np.count_nonzero(found))
+    reference = reference[found]
+    new = new[position[found]]
+    comparison['n_compared'] += len(reference)
+
+    differs = np.zeros((len(reference), len(comparison['columns'])), dtype=bool)
+    for column_index, name in enumerate(comparison['columns']):
+        differs[:, column_index] = (reference[name] != new[name])
+        n_differences = int(np.count_nonzero(differs[:, column_index]))
+        if (n_differences > 0) and (comparison['first_difference'][name] is None):
+            first = int(np.argmax(differs[:, column_index]))
+            comparison['first_difference'][name] = (int(reference['counter'][first]), int(reference[name][first]), int(new[name][first]))
+        comparison['n_differences'][name] += n_differences
+
+    ## Group the cycles that differ into events: a new event starts where the gap to the previous difference is at least EVENT_GAP. Segment 0 holds the differences that continue the last event of the previous block.
+    rows = np.flatnonzero(differs.any(axis=1))
+    if (len(rows) == 0):
+        return
+    counters = reference['counter'][rows].astype(np.int64)
+    previous = np.concatenate([[-EVENT_GAP if (comparison['last_difference'] is None) else comparison['last_difference']], counters[:-1]])
+    new_event = (counters - previous >= EVENT_GAP)
+    segment = np.cumsum(new_event)
+    segment_starts = np.flatnonzero(np.diff(np.concatenate([[-1], segment])) != 0)
+    segment_columns = np.logical_or.reduceat(differs[rows], segment_starts, axis=0)
+    segment_ends = counters[np.concatenate([segment_starts[1:], [len(counters)]]) - 1]
+    comparison['last_difference'] = int(counters[-1])
+
+    names = np.array(comparison['columns'])
+    listed_last = (len(comparison['events']) == comparison['n_events'])          ## the last event is in the list
+    comparison['n_events'] += int(np.count_nonzero(new_event))
+    for start_row, end, columns in zip(segment_starts, segment_ends, segment_columns):
+        if (segment[start_row] == 0):
+            if listed_last and (len(comparison['events']) > 0):
+                comparison['events'][-1]['end'] = int(end)
+                comparison['events'][-1]['columns'] |= set(names[columns].tolist())
+        elif (len(comparison['events']) < comparison['max_events']):
+            comparison['events'].append({'start': int(counters[start_row]), 'end': int(end), 'columns': set(names[columns].tolist())})
+        else:
+            break
+
+
+## Compare two output files (the reference and the new output), chunk by chunk. Both are read in the order of the counter: the rows of both up to the smaller of their last counters read so far are compared, and the rest is kept for the next step. Returns the comparison (see initial_comparison).
+def compare_outputs(reference_path, new_path, columns=COMPARED_COLUMNS, chunk_size=CHUNK_SIZE, max_events=20):
+    comparison = initial_comparison(columns, max_events)
+    paths = [reference_path, new_path]
+    readers = [read_chunks(path, chunk_size) for path in paths]
+    pending = [np.zeros(0, dtype=OUTPUT_DTYPE), np.zeros(0, dtype=OUTPUT_DTYPE)]
+    finished = [False, False]
+
+    while True:
+        for index in range(2):
+            if (len(pending[index]) == 0) and not finished[index]:
+                chunk = next(readers[index], None)
+                if chunk is None:
+                    finished[index] = True
+                elif np.any(np.diff(chunk['counter'].astype(np.int64)) <= 0) or ((comparison['last_counter'][index] is not None) and (chunk['counter'][0] <= comparison['last_counter'][index])):
+                    raise ValueError(paths[index] + ': the counter column is not increasing')
+                else:
+                    comparison['last_counter'][index] = int(chunk['counter'][-1])
+                    pending[index] = chunk
+        if finished[0] and finished[1] and (len(pending[0]) == 0) and (len(pending[1]) == 0):
+            return comparison
+
+        ## An output that has been read to the end does not limit the comparison.
+        limit = min([int(pending[index]['counter'][-1]) for index in range(2) if not finished[index]], default=np.iinfo(np.int64).max)
+        n_now = [int(np.searchsorted(pending[index]['counter'], limit, side='right')) for index in range(2)]
+        compare_rows(comparison, pending[0][:n_now[0]], pending[1][:n_now[1]])
+        pending = [pending[0][n_now[0]:], pending[1][n_now[1]:]]
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare two outputs of the feature extraction (VHDL simulation or emulate_VHDL.py) cycle by cycle, aligned on the counter. The exit code is 1 if they differ.')
+    parser.add_argument('reference', help='the reference output (output_data.bin, or output_data.csv as written by main_tb.vhd)')
+    parser.add_argument('new', help='the output to check')
+    parser.add_argument('--columns', nargs='+', default=COMPARED_COLUMNS, choices=COMPARED_COLUMNS)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='rows per chunk')
+    parser.add_argument('--max-events', type=int, default=20, help='the number of events to list')
+    args = parser.parse_args(argv)
+
+    start_time = time.perf_counter()
+    comparison = compare_outputs(args.reference, args.new, args.columns, args.chunk_size, args.max_events)
+    print('{} cycles compared in {:.2f} s, {} only in the reference, {} only in the new output'.format(comparison['n_compared'], time.perf_counter() - start_time, comparison['n_only_reference'], comparison['n_only_new']))
+    print('{:<16}{:>14}{:>16}{:>14}{:>14}'.format('column', 'differences', 'first (counter)', 'reference', 'new'))
+    for name in args.columns:
+        first = comparison['first_difference'][name]
+        print('{:<16}{:>14}{:>16}{:>14}{:>14}'.format(name, comparison['n_differences'][name], *(first if (first is not None) else ('', '', ''))))
+    print(str(comparison['n_events']) + ' events with differences' + (' (the first ' + str(len(comparison['events'])) + ':)' if (comparison['n_events'] > len(comparison['events'])) else (':' if (comparison['n_events'] > 0) else '')))
+    for event in comparison['events']:
+        print('  counter ' + str(event['start']) + ' to ' + str(event['end']) + ': ' + ', '.join(name for name in args.columns if name in event['columns']))
+
+    identical = (comparison['n_events'] == 0) and (comparison['n_only_reference'] == 0) and (comparison['n_only_new'] == 0)
+    sys.exit(0 if identical else 1)
+
+
+
+if __name__ == '__main__':
+    main()
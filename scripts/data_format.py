@@ -0,0 +1,192 @@
+import argparse
+import json
+import os
+import warnings
+import numpy as np
+
+## Binary data format for the pulse trains (input_data, input_data_no_pileup), the MC truth data and the output of the VHDL simulation (or of emulate_VHDL.py). It replaces the .csv text files, which are slow to write and to parse for long pulse trains.
+##
+## A file consists of a fixed-size header (HEADER_SIZE bytes) followed by the data, stored as fixed-size records: one record per sample (clock cycle) for the pulse trains and the output data, and one record per waveform for the MC truth data. The header holds a magic string, the format version, N_EMPTY_WAVEFORMS, N_REAL_WAVEFORMS, N_SAMPLES_PER_WAVEFORM and a description of the record (the column names and types, as JSON). The number of records follows from the file size, so files can be written chunk by chunk.
+##
+## The data are opened with np.memmap, which means that nothing is parsed and only the parts of the file that are actually used are read from disk. Columns are accessed by name, e.g. output_data['final_trigger'].
+
+MAGIC = b'FEXDATA\x00'
+FORMAT_VERSION = 1
+HEADER_SIZE = 4096
+
+## The data directory of the repository (data/ next to scripts/), the default location of the data files. Paths are resolved from this file, so the scripts can be run (or imported) from any working directory.
+DATA_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+
+HEADER_DTYPE = np.dtype([('magic', 'S8'), ('version', '<u4'), ('description_length', '<u4'), ('n_empty_waveforms', '<i8'), ('n_real_waveforms', '<i8'), ('n_samples_per_waveform', '<i8')])
+
+## The record types. Samples are 16-bit unsigned (like the data_in port of main.vhd), the OF outputs and other integer signals are 32-bit signed and flags are 8-bit unsigned.
+INPUT_DTYPE = np.dtype([('sample', '<u2')])
+
+## The output data has the same 10 columns as output_data.csv (see main_tb.vhd):
+OUTPUT_DTYPE = np.dtype([('counter', '<i8'), ('data_in', '<u2'), ('average', '<u2'), ('baseline', '<i4'), ('trigger', 'u1'), ('cfd', '<i4'), ('cfd_time', 'u1'), ('u', '<i4'), ('v', '<i4'), ('final_trigger', 'u1')])
+
+## The zero-suppressed output (see feature_records.py) has one record per final trigger: the timestamp (the clock-cycle counter, as in the output data), the BCFD window, the OF outputs u and v and the pile-up flag.
+FEATURE_RECORD_DTYPE = np.dtype([('timestamp', '<i8'), ('cfd_time', 'u1'), ('u', '<i4'), ('v', '<i4'), ('pileup', 'u1')])
+
+## The merged output of a multi-channel dataset (see multichannel.py): the channel number, the fields of the feature record and the reconstructed amplitude and time (as in reconstruct_A_and_T.py, with the calibration of the channel).
+CHANNEL_RECORD_DTYPE = np.dtype([('channel', '<u2')] + FEATURE_RECORD_DTYPE.descr + [('A', '<f8'), ('T', '<f8')])
+
+## A raw-sample snapshot around a final trigger: the timestamp of the final trigger and of the first sample in the snapshot, followed by the n_samples raw samples.
+def snapshot_dtype(n_samples):
+    return np.dtype([('timestamp', '<i8'), ('first_timestamp', '<i8')] + [('sample_' + str(i), '<u2') for i in range(n_samples)])
+
+## The MC truth data has one record per waveform: [A_0, T_0_0, A_1, T_0_1, ...], with -1 where there is no pulse.
+def MC_truth_dtype(max_pulses_per_waveform):
+    return np.dtype([(name + '_' + str(pulse_no), '<f8') for pulse_no in range(max_pulses_per_waveform) for name in ('A', 'T_0')])
+
+
+## Write the header to an open file.
+def write_header(data_file, dtype, n_empty_waveforms, n_real_waveforms, n_samples_per_waveform):
+    description = json.dumps(np.lib.format.dtype_to_descr(dtype)).encode('ascii')
+    if (HEADER_DTYPE.itemsize + len(description) > HEADER_SIZE):
+        raise ValueError('Too many columns to describe in the header')
+
+    header = np.zeros(1, dtype=HEADER_DTYPE)
+    header['magic'] = MAGIC
+    header['version'] = FORMAT_VERSION
+    header['description_length'] = len(description)
+    header['n_empty_waveforms'] = n_empty_waveforms
+    header['n_real_waveforms'] = n_real_waveforms
+    header['n_samples_per_waveform'] = n_samples_per_waveform
+
+    data_file.write((header.tobytes() + description).ljust(HEADER_SIZE, b'\x00'))
+
+
+## Read the header of a file. Returns a dictionary with N_EMPTY_WAVEFORMS, N_REAL_WAVEFORMS, N_SAMPLES_PER_WAVEFORM, the record type ('dtype') and the number of records ('n_rows').
+def read_header(path):
+    with open(path, 'rb') as data_file:
+        header_bytes = data_file.read(HEADER_SIZE)
+
+    header = np.frombuffer(header_bytes[:HEADER_DTYPE.itemsize], dtype=HEADER_DTYPE)[0]
+    if (header['magic'] != MAGIC.rstrip(b'\x00')):
+        raise ValueError(path + ' is not a feature-extraction data file')
+    if (header['version'] != FORMAT_VERSION):
+        raise ValueError(path + ' has format version ' + str(header['version']) + ', expected ' + str(FORMAT_VERSION))
+
+    description = header_bytes[HEADER_DTYPE.itemsize:HEADER_DTYPE.itemsize + header['description_length']]
+    dtype = np.lib.format.descr_to_dtype([tuple(field) for field in json.loads(description)])
+
+    return {'N_EMPTY_WAVEFORMS': int(header['n_empty_waveforms']),
+            'N_REAL_WAVEFORMS': int(header['n_real_waveforms']),
+            'N_SAMPLES_PER_WAVEFORM': int(header['n_samples_per_waveform']),
+            'dtype': dtype,
+            'n_rows': (os.path.getsize(path) - HEADER_SIZE)//dtype.itemsize}
+
+
+## Open a data file as a memory-mapped record array (no data are read until used). Returns the header (see read_header) and the records. Use mode='r+' to modify the data in place.
+def open_data_file(path, mode='r'):
+    header = read_header(path)
+
+    if (header['n_rows'] == 0):                 ## np.memmap cannot map an empty file
+        return header, np.zeros(0, dtype=header['dtype'])
+
+    return header, np.memmap(path, dtype=header['dtype'], mode=mode, offset=HEADER_SIZE, shape=(header['n_rows'],))
+
+
+## Create a new data file and write the header. Returns the open file, to which records are then appended (in chunks) with append_rows. Close the file when done.
+def create_data_file(path, dtype, n_empty_waveforms, n_real_waveforms, n_samples_per_waveform):
+    data_file = open(path, 'wb')
+    write_header(data_file, dtype, n_empty_waveforms, n_real_waveforms, n_samples_per_waveform)
+    return data_file
+
+def append_rows(data_file, rows):
+    data_file.write(np.ascontiguousarray(rows).tobytes())
+
+
+## Write a complete data file in one go. rows is a record array (or anything that can be converted to one, e.g. a list of columns in the order of dtype).
+def write_data_file(path, rows, dtype, n_empty_waveforms, n_real_waveforms, n_samples_per_waveform):
+    with create_data_file(path, dtype, n_empty_waveforms, n_real_waveforms, n_samples_per_waveform) as data_file:
+        append_rows(data_file, make_rows(rows, dtype))
+
+
+## Build a record array of type dtype from a record array, or from a 2-D array / list of columns (in the order of the fields in dtype).
+def make_rows(data, dtype):
+    if (isinstance(data, np.ndarray) and data.dtype.names is not None):
+        return data.astype(dtype, copy=False)
+
+    if isinstance(data, (list, tuple)):
+        columns = [np.asarray(column) for column in data]
+    else:
+        data = np.asarray(data)
+        columns = list((data if (data.ndim == 2) else data.reshape(len(data), -1)).T)               ## 2-D arrays as they are, also when empty
+    rows = np.zeros(len(columns[0]), dtype=dtype)
+    for name, column in zip(dtype.names, columns):
+        rows[name] = column
+    return rows
+
+
+## View records whose fields all have the same type (e.g. the MC truth data) as an ordinary 2-D array, without copying.
+def as_array(rows):
+    field_type = rows.dtype[0]
+    return rows.view(field_type).reshape(len(rows), len(rows.dtype.names))
+
+
+## Convert a .csv file from the old text format to the binary format, chunk by chunk (so also very large files can be converted). The MC truth csv has a header row (N_EMPTY_WAVEFORMS, N_REAL_WAVEFORMS, N_SAMPLES_PER_WAVEFORM), which is then used for the header of the binary file. For the other files, these numbers need to be given.
+def convert_csv_to_binary(csv_path, path, dtype=None, n_empty_waveforms=0, n_real_waveforms=0, n_samples_per_waveform=0, chunk_size=1000000):
+    with open(csv_path, 'r') as csv_file:
+        if (dtype is None):                     ## MC truth data
+            header_row = np.loadtxt(csv_file, delimiter=',', max_rows=1, ndmin=1)
+            n_empty_waveforms, n_real_waveforms, n_samples_per_waveform = int(header_row[0]), int(header_row[1]), int(header_row[2])
+            dtype = MC_truth_dtype(len(header_row)//2)
+
+        with create_data_file(path, dtype, n_empty_waveforms, n_real_waveforms, n_samples_per_waveform) as data_file:
+            while True:
+                with warnings.catch_warnings():
+                    warnings.filterwarnings('ignore', message='loadtxt: input contained no data')          ## expected at the end of the file
+                    chunk = np.loadtxt(csv_file, delimiter=',', max_rows=chunk_size, ndmin=2)
+                if (len(chunk) == 0):
+                    break
+                append_rows(data_file, make_rows(chunk, dtype))
+
+
+## Export a binary file to the old text format. For the pulse trains, this gives one sample per line, which is the input format read by the VHDL testbench (main_tb.vhd). For the MC truth data, the header row is written first (as in the old MC_truth_data.csv).
+def export_binary_to_csv(path, csv_path, chunk_size=1000000):
+    header, rows = open_data_file(path)
+    is_MC_truth = all(rows.dtype[name].kind == 'f' for name in rows.dtype.names)
+    formats = ['%f' if rows.dtype[name].kind == 'f' else '%i' for name in rows.dtype.names]
+
+    with open(csv_path, 'w') as csv_file:
+        if is_MC_truth:
+            header_row = -np.ones((1, max(3, len(rows.dtype.names))))            ## the header row has (at least) 3 values, also for a single pulse per waveform (2 columns)
+            header_row[0, :3] = [header['N_EMPTY_WAVEFORMS'], header['N_REAL_WAVEFORMS'], header['N_SAMPLES_PER_WAVEFORM']]
+            np.savetxt(csv_file, header_row, fmt='%f', delimiter=',')
+
+        for chunk_start in range(0, len(rows), chunk_size):
+            chunk = rows[chunk_start:chunk_start + chunk_size]
+            np.savetxt(csv_file, np.column_stack([chunk[name] for name in rows.dtype.names]), fmt=formats, delimiter=',')
+
+
+
+def main(argv=None):
+    ## Convert between the binary files and the .csv files in the data directory. 'to_binary' converts existing .csv files (e.g. the output_data.csv from a Vivado simulation). 'to_text' writes the .csv files, e.g. input_data.csv for the VHDL testbench.
+    parser = argparse.ArgumentParser(description='Convert the data files between the binary format and the old .csv text format.')
+    parser.add_argument('direction', choices=['to_binary', 'to_text'])
+    parser.add_argument('--data-dir', default=DATA_DIRECTORY)
+    args = parser.parse_args(argv)
+
+    names = ['MC_truth_data', 'input_data', 'input_data_no_pileup', 'output_data', 'feature_records']           ## MC_truth_data first, the other files get their header from it
+    dtypes = {'MC_truth_data': None, 'input_data': INPUT_DTYPE, 'input_data_no_pileup': INPUT_DTYPE, 'output_data': OUTPUT_DTYPE, 'feature_records': FEATURE_RECORD_DTYPE}
+
+    header = {'N_EMPTY_WAVEFORMS': 0, 'N_REAL_WAVEFORMS': 0, 'N_SAMPLES_PER_WAVEFORM': 0}
+    for name in names:
+        csv_path = os.path.join(args.data_dir, name + '.csv')
+        path = os.path.join(args.data_dir, name + '.bin')
+
+        if (args.direction == 'to_binary') and os.path.exists(csv_path):
+            print('Converting ' + csv_path)
+            convert_csv_to_binary(csv_path, path, dtypes[name], header['N_EMPTY_WAVEFORMS'], header['N_REAL_WAVEFORMS'], header['N_SAMPLES_PER_WAVEFORM'])
+            if (name == 'MC_truth_data'):
+                header = read_header(path)
+        elif (args.direction == 'to_text') and os.path.exists(path):
+            print('Exporting ' + path)
+            export_binary_to_csv(path, csv_path)
+
+
+
+if __name__ == '__main__':
+    main()
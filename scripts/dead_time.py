@@ -0,0 +1,198 @@
+import argparse
+import json
+import os
+import tempfile
+import numpy as np
+from data_format import OUTPUT_DTYPE, DATA_DIRECTORY, open_data_file, as_array, make_rows
+from OF_calibration import load_calibration
+from emulate_VHDL import COUNTER_NAMES, MAX_PILEUP_PULSES, THRESHOLD_NAMES, coefficients_from_calibration, default_thresholds, initial_counters, run_pipeline_segmented
+from reconstruct_A_and_T import reconstruct_pulses, get_true_pulses, match_pulses
+from benchmark import generate_data, count_pulses
+
+## Dead time and losses of the feature extraction, from the instrumentation counters (see initial_counters in emulate_VHDL.py, and the debug_counters output of main.vhd, which main_tb.vhd writes to debug_counters.csv). The counters show where pulses are lost in each stage of the pipeline: CFD zero crossings rejected by THRESHOLD_CFD, pulses rejected by the OF (OF_AMPLITUDE_THRESHOLD or OF_AMPLITUDE_THRESHOLD_FRACTION) or lost because the pile-up chain was full (MAX_PILEUP_PULSES), and the time the baseline_calculator is 'sleeping' (locked, until the average falls below THRESHOLD_FALLING) or cannot update the baseline (PULSE_WIDTH_BEFORE_RESET after a final trigger).
+##
+## The live time is the fraction of clock cycles in which a new pulse can give a final trigger: all cycles except the 'setup' period and the cycles in which the OF is in its last state (a further pulse in the chain is lost). The histograms are made from the output data: the length of the 'sleeping' periods (trigger = 1), the number of final triggers in each of them (the pile-up chains) and the time between consecutive final triggers.
+##
+## By default, the pulse train in input_data.bin is analysed. With --rates, data are generated (generate_pulse_data.py --rate, in a temporary directory) for each pulse rate, to get the live time and the losses versus the input rate. With --scan, one of the thresholds (the generics of the VHDL components, THRESHOLD_NAMES in emulate_VHDL.py, which are passed to the emulator for each run) is varied, to see what it costs in efficiency and what it gains in fake rate. The results are written to data/dead_time.json. With --vhdl-counters, the counters of the VHDL simulation (debug_counters.csv, written by main_tb.vhd for the same input_data.csv) are compared with those of the model.
+
+## The number of waveforms generated for each rate (--rates), and the longest 'sleeping' period and largest interval between final triggers in the histograms (longer ones go into the last bin):
+RATE_SCAN_N_WAVEFORMS = 5000
+MAX_SLEEPING_LENGTH = 500
+MAX_TRIGGER_INTERVAL = 1000
+
+
+## Run the pipeline over input_data with the instrumentation counters and the given thresholds (see run_pipeline in emulate_VHDL.py; None for the defaults). Returns the output (as records) and the counters of the whole pulse train.
+def count_events(input_data, coefficients, max_pileup_pulses=MAX_PILEUP_PULSES, thresholds=None):
+    counters = initial_counters(1, max_pileup_pulses)
+    output_data = run_pipeline_segmented(np.asarray(input_data, dtype=np.int64), coefficients=coefficients, max_pileup_pulses=max_pileup_pulses, counters=counters, thresholds=thresholds)
+    return make_rows(output_data, OUTPUT_DTYPE), {key: value[0] for key, value in counters.items()}
+
+
+## The dead time per state, as fractions of all clock cycles, and the live time (see above).
+def dead_time_fractions(counters):
+    n_cycles = counters['cycles_setup'] + counters['cycles_awake'] + counters['cycles_sleeping']
+    cycles_OF_state = counters['cycles_OF_state']
+    result = {'n_cycles': int(n_cycles),
+              'setup': counters['cycles_setup']/n_cycles,
+              'awake': counters['cycles_awake']/n_cycles,
+              'sleeping': counters['cycles_sleeping']/n_cycles,
+              'update_blocked': counters['cycles_update_blocked']/n_cycles}
+    for state in range(len(cycles_OF_state)):
+        result['OF_state_' + str(state)] = cycles_OF_state[state]/n_cycles
+    result['live_time'] = 1. - (counters['cycles_setup'] + cycles_OF_state[-1])/n_cycles
+    return result
+
+
+## The histograms (see above) from the output data: the length of each complete 'sleeping' period, the number of final triggers in it and the number of clock cycles between consecutive final triggers.
+def dead_time_histograms(output_data):
+    trigger = np.concatenate([[0], np.asarray(output_data['trigger'], dtype=np.int64), [0]])
+    starts = np.where(np.diff(trigger) == 1)[0]
+    ends = np.where(np.diff(trigger) == -1)[0]
+    complete = (starts > 0) & (ends < len(output_data))                 ## periods cut off by the start or end of the data are left out
+    starts, ends = starts[complete], ends[complete]
+
+    final_trigger_times = np.where(np.asarray(output_data['final_trigger']) == 1)[0]
+    pulses_per_chain = np.searchsorted(final_trigger_times, ends) - np.searchsorted(final_trigger_times, starts)
+
+    return {'sleeping_length': np.bincount(np.minimum(ends - starts, MAX_SLEEPING_LENGTH), minlength=MAX_SLEEPING_LENGTH + 1).tolist(),
+            'pulses_per_chain': np.bincount(pulses_per_chain).tolist(),
+            'final_trigger_interval': np.bincount(np.minimum(np.diff(final_trigger_times), MAX_TRIGGER_INTERVAL), minlength=MAX_TRIGGER_INTERVAL + 1).tolist()}
+
+
+## Analyse one pulse train (with the given thresholds, see count_events): the counters, the dead time, the histograms, and (from the MC truth) the efficiency and fake rate of the real waveforms. The counters are also given per true pulse, to show which stage loses how many pulses.
+def analyse(input_data, MC_truth_data, header, calibration, max_pileup_pulses=MAX_PILEUP_PULSES, thresholds=None):
+    N_EMPTY_WAVEFORMS = header['N_EMPTY_WAVEFORMS']
+    N_REAL_WAVEFORMS = header['N_REAL_WAVEFORMS']
+    N_SAMPLES_PER_WAVEFORM = header['N_SAMPLES_PER_WAVEFORM']
+
+    output_data, counters = count_events(input_data, coefficients_from_calibration(calibration), max_pileup_pulses, thresholds)
+
+    trigger_timestamps, Reconstructed_A, Reconstructed_T = reconstruct_pulses(output_data, N_EMPTY_WAVEFORMS*N_SAMPLES_PER_WAVEFORM, (N_EMPTY_WAVEFORMS + N_REAL_WAVEFORMS)*N_SAMPLES_PER_WAVEFORM, calibration)
+    True_T = get_true_pulses(MC_truth_data, N_EMPTY_WAVEFORMS, N_EMPTY_WAVEFORMS + N_REAL_WAVEFORMS, N_SAMPLES_PER_WAVEFORM)[3]
+    matched = match_pulses(Reconstructed_T, True_T)[0]
+    n_true_pulses = count_pulses(MC_truth_data, N_EMPTY_WAVEFORMS)
+
+    return {'input_rate': n_true_pulses/(N_REAL_WAVEFORMS*N_SAMPLES_PER_WAVEFORM),
+            'n_true_pulses': n_true_pulses,
+            'efficiency': np.count_nonzero(matched)/max(len(True_T), 1),
+            'fake_rate': np.count_nonzero(~matched)/max(len(Reconstructed_T), 1),
+            'counters': {key: np.asarray(value).tolist() for key, value in counters.items()},
+            'per_true_pulse': {name: counters[name]/max(n_true_pulses, 1) for name in COUNTER_NAMES if not name.startswith('cycles')},
+            'dead_time': dead_time_fractions(counters),
+            'histograms': dead_time_histograms(output_data)}
+
+
+def load_data(data_dir):
+    header, input_data = open_data_file(os.path.join(data_dir, 'input_data.bin'))
+    MC_truth_header, MC_truth_data = open_data_file(os.path.join(data_dir, 'MC_truth_data.bin'))
+    return input_data['sample'], as_array(MC_truth_data), header
+
+
+## Read the counters written by main_tb.vhd (one 'name,value' line per counter, with cycles_OF_state_0, cycles_OF_state_1, ... for the OF states) into the same form as the counters of count_events.
+def read_VHDL_counters(path):
+    with open(path, 'r') as counters_file:
+        values = dict((name.strip(), int(value)) for name, value in (line.split(',') for line in counters_file if line.strip()))
+    counters = {name: values[name] for name in COUNTER_NAMES}
+    counters['cycles_OF_state'] = np.array([values[name] for name in sorted((name for name in values if name.startswith('cycles_OF_state_')), key=lambda name: int(name.rsplit('_', 1)[1]))])
+    return counters
+
+
+## Print the main numbers of an analysis:
+def print_result(result):
+    dead_time = result['dead_time']
+    print('  input rate {:.4f} pulses/sample, efficiency {:.4f}, fake rate {:.4f}, live time {:.4f}'.format(result['input_rate'], result['efficiency'], result['fake_rate'], dead_time['live_time']))
+    print('  time in state: setup {:.4f}, awake {:.4f} (update blocked {:.4f}), sleeping {:.4f}'.format(dead_time['setup'], dead_time['awake'], dead_time['update_blocked'], dead_time['sleeping']))
+    print('  per true pulse: ' + ', '.join('{} {:.4f}'.format(name, value) for name, value in result['per_true_pulse'].items()))
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Dead time, live time and losses of the feature extraction, from the instrumentation counters of the pipeline.')
+    parser.add_argument('--rates', type=float, nargs='+', default=None, help='generate data at these pulse rates (pulses per sample) instead of using input_data.bin')
+    parser.add_argument('--n-waveforms', type=int, default=RATE_SCAN_N_WAVEFORMS, help='the number of waveforms generated for each rate')
+    parser.add_argument('--scan', nargs='+', default=None, metavar=('THRESHOLD', 'VALUE'), help='scan one of ' + ', '.join(THRESHOLD_NAMES) + ' over the given values')
+    parser.add_argument('--max-pileup-pulses', type=int, default=MAX_PILEUP_PULSES)
+    parser.add_argument('--vhdl-counters', default=None, metavar='DEBUG_COUNTERS_CSV', help='compare the counters with those written by the VHDL simulation of input_data.csv')
+    parser.add_argument('--data-dir', default=DATA_DIRECTORY, help='the directory with input_data.bin and MC_truth_data.bin (without --rates)')
+    parser.add_argument('--output-file', default=os.path.join(DATA_DIRECTORY, 'dead_time.json'))
+    parser.add_argument('--no-plot', action='store_true')
+    args = parser.parse_args(argv)
+
+    calibration = load_calibration()
+
+    ## The threshold settings to run: the defaults, or each value of the scanned threshold. The values are converted to the type of the default value of that threshold.
+    thresholds = default_thresholds()
+    if args.scan is None:
+        settings = [{}]
+    else:
+        if (args.scan[0] not in THRESHOLD_NAMES) or (len(args.scan) < 2):
+            parser.error('--scan needs one of ' + ', '.join(THRESHOLD_NAMES) + ' and at least one value')
+        threshold_type = type(thresholds[args.scan[0]])
+        try:
+            settings = [{args.scan[0]: threshold_type(value)} for value in args.scan[1:]]
+        except ValueError:
+            parser.error('the values of ' + args.scan[0] + ' must be of type ' + threshold_type.__name__)
+
+    def run(input_data, MC_truth_data, header):
+        results = []
+        for setting in settings:
+            results.append(dict(setting, **analyse(input_data, MC_truth_data, header, calibration, args.max_pileup_pulses, dict(thresholds, **setting))))
+            print(', '.join(name + ' = ' + str(value) for name, value in setting.items()) or 'Default thresholds')
+            print_result(results[-1])
+        return results
+
+    results = []
+    if args.rates is None:
+        results += run(*load_data(args.data_dir))
+
+        if args.vhdl_counters is not None:
+            VHDL_counters = read_VHDL_counters(args.vhdl_counters)
+            model_counters = results[0]['counters']
+            differences = [name for name in model_counters if not np.array_equal(model_counters[name], VHDL_counters[name])]
+            for name in differences:
+                print('  ' + name + ': model ' + str(model_counters[name]) + ', VHDL ' + str(np.asarray(VHDL_counters[name]).tolist()))
+            print('The counters of the model and the VHDL simulation ' + ('differ' if differences else 'agree'))
+    else:
+        for rate in args.rates:
+            with tempfile.TemporaryDirectory() as data_dir:
+                generate_data(data_dir, args.n_waveforms, {'rate': rate})
+                print('Pulse rate ' + str(rate) + ':')
+                results += [dict(result, rate=rate) for result in run(*load_data(data_dir))]
+
+    with open(args.output_file, 'w') as output_file:
+        json.dump({'thresholds': thresholds, 'max_pileup_pulses': args.max_pileup_pulses, 'results': results}, output_file, indent=1)
+    print('Results written to ' + args.output_file)
+
+    if not args.no_plot:
+        import matplotlib.pyplot as plt
+
+        fig, ax = plt.subplots(1, 3, figsize=(15, 4))
+        for result in results:
+            label = ', '.join(name + ' = ' + str(result[name]) for name in ['rate'] + THRESHOLD_NAMES if name in result) or None
+            for axis, name in zip(ax, ['sleeping_length', 'pulses_per_chain', 'final_trigger_interval']):
+                histogram = result['histograms'][name]
+                axis.step(np.arange(len(histogram)), histogram, where='mid', label=label)
+                axis.set_title(name.replace('_', ' '))
+                axis.set_yscale('log')
+        ax[0].set_xlabel('Clock cycles')
+        ax[1].set_xlabel('Final triggers')
+        ax[2].set_xlabel('Clock cycles')
+        if (len(results) > 1):
+            ax[0].legend()
+
+        ## Live time and efficiency versus the input rate:
+        if args.rates is not None:
+            fig, ax = plt.subplots()
+            input_rate = [result['input_rate'] for result in results]
+            ax.plot(input_rate, [result['dead_time']['live_time'] for result in results], 'o-', label='Live time')
+            ax.plot(input_rate, [result['efficiency'] for result in results], 's-', label='Efficiency')
+            ax.plot(input_rate, [result['dead_time']['sleeping'] for result in results], '^-', label='Baseline sleeping')
+            ax.set_xlabel('Input rate [pulses/sample]')
+            ax.legend()
+
+        plt.show()
+
+
+
+if __name__ == '__main__':
+    main()
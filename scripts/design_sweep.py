@@ -0,0 +1,244 @@
+import argparse
+import itertools
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from data_format import DATA_DIRECTORY, open_data_file, as_array
+from OF_calibration import lognormal_fcn, lognormal_fcn_CFD, calculate_OF_calibration
+from get_OF_coefficients import CALIBRATION_PARAMETERS, get_delta_BCFD_window_mean
+from emulate_VHDL import THRESHOLD_CFD, BCFD_bisection
+from fixed_point import fixed_format, resize
+
+## Design-space sweep over the precision choices of the OF (the parameters in get_OF_coefficients.py: M_A, M_B, g_PRECISION, d_g_PRECISION, OF_LENGTH and N_BCFD_WINDOWS). These set the number of multipliers and the word widths in optimal_filter.vhd. For every point of the grid, the OF calibration is calculated (as in get_OF_coefficients.py) and a software model of the BCFD + OF is run over the isolated pulses in input_data_no_pileup.bin, giving the amplitude and time resolution and the accuracy of the tail reconstruction. Together with an estimate of the FPGA cost (DSP slices and bits of coefficient/template storage), this shows which is the cheapest configuration that meets the requirements (and so how many channels fit in one Kintex-7). The grid points are evaluated in parallel, on all CPUs.
+##
+## The model follows the integer arithmetic of the VHDL code (16-sample baseline, CFD with shifts, quantised coefficients, u and v shifted right by a_scaling, tail reconstruction with the quantised templates), but it is *not* bit-exact (use emulate_VHDL.py for that, which is limited to the configuration in my_types.vhd). The signals that are resized in the VHDL code wrap in the same way (see fixed_point.py), and the values that do not fit are counted: a configuration with overflows is not accepted, whatever its resolution. Each pulse is processed on its own and the template is aligned to the pulse exactly. The BCFD window is determined by the bisection in emulate_VHDL.py, which works for any power of two windows.
+
+## Kintex-7 DSP48E1 slices have a 25 x 18 bit signed multiplier. A wider multiplication needs several slices.
+DSP_MULTIPLIER_WIDTHS = (25, 18)
+KINTEX7_DSP_SLICES = 840                    ## XC7K325T. Other devices in the family: XC7K160T 600, XC7K410T 1540, XC7K480T 1920.
+
+## Word widths that do not depend on the swept parameters (see optimal_filter.vhd):
+FIR_DATA_WIDTH = 16                         ## FIR_data, the baseline-subtracted samples going into the OF multipliers
+RECONSTRUCTION_SUM_WIDTH = 20               ## SUM_A_pulse(p)(19 downto 0), SUM_B_pulse(p)(19 downto 0) going into the tail-reconstruction multipliers
+RECONSTRUCTION_WIDTH = 38                   ## the reconstructed tail of a pulse
+OUTPUT_WIDTH = 32                           ## u_out and v_out (VHDL integers)
+
+N_BASELINE_SAMPLES = 16                     ## the baseline is the average of 16 samples (baseline_calculator.vhd)
+TAIL_LENGTH = 20                            ## the tail reconstruction is checked over this many samples after the OF samples, where a pile-up pulse would be analysed
+
+
+## The baseline of each waveform, as the baseline_calculator would determine it: the (truncated) average of the N_BASELINE_SAMPLES samples before the waveform (i.e. the end of the preceding waveform, where the tail of the preceding pulse is negligible). pulse_train holds all waveforms, starting with the empty one(s).
+def get_baselines(pulse_train, first_waveform, n_waveforms, N_SAMPLES_PER_WAVEFORM):
+    waveform_starts = (first_waveform + np.arange(n_waveforms))*N_SAMPLES_PER_WAVEFORM
+    baseline_samples = pulse_train[waveform_starts[:, np.newaxis] - N_BASELINE_SAMPLES + np.arange(N_BASELINE_SAMPLES)].astype(np.int64)
+    return baseline_samples.sum(axis=1) >> 4
+
+
+## Find the CFD zero crossing of each (baseline-subtracted) waveform, like constant_fraction.vhd: the CFD signal is the delayed sample minus the attenuated current sample, and a crossing is accepted if the CFD signal rises by more than THRESHOLD_CFD. In the VHDL code, crossings caused by noise are rejected by the OF amplitude threshold. Here, the crossing belonging to the pulse is simply the first one after the minimum of the CFD signal (as in get_BCFD_deltas). Returns the first sample after the crossing, the CFD values before and after the crossing and whether a crossing was found.
+def find_CFD_crossings(data, CFD_delay, CFD_attenuation):
+    n_samples = data.shape[1]
+    CFD = np.zeros(data.shape, dtype=np.int64)
+    CFD[:, CFD_delay:] = data[:, :n_samples - CFD_delay] - np.floor(CFD_attenuation*data[:, CFD_delay:]).astype(np.int64)          ## for CFD_attenuation = 0.5, the same as the shift right by one in constant_fraction.vhd
+
+    after_minimum = (np.arange(n_samples - 1) >= np.argmin(CFD, axis=1)[:, np.newaxis])
+    crossing = after_minimum & (CFD[:, :-1] < 0) & (CFD[:, 1:] >= 0) & (CFD[:, 1:] - CFD[:, :-1] > THRESHOLD_CFD)
+    found = crossing.any(axis=1)
+    sample_no = 1 + np.argmax(crossing, axis=1)
+
+    rows = np.arange(len(data))
+    return sample_no, CFD[rows, sample_no - 1], CFD[rows, sample_no], found
+
+
+## Run the model of the BCFD + OF with the given calibration (see OF_calibration.py) over the isolated pulses. data holds the baseline-subtracted waveforms (one per row), True_A and True_T_0 the true amplitude and start time of the pulse in each. Returns the relative amplitude error, the time error (in samples) and the relative RMS error of the reconstructed tail for each reconstructed pulse, the fraction of pulses that were reconstructed and the number of values that overflowed (and wrapped).
+def run_OF_model(data, crossings, True_A, True_T_0, calibration, OF_START, mu, sigma, CFD_delay, CFD_attenuation):
+    sample_no, y_0, y_1, found = crossings
+    n_samples = data.shape[1]
+    delta_BCFD_window_mean = np.asarray(calibration['delta_BCFD_window_mean'])
+    N_BCFD_WINDOWS = len(delta_BCFD_window_mean)
+    a = np.asarray(calibration['FIR_coefficients_a'], dtype=np.int64)
+    b = np.asarray(calibration['FIR_coefficients_b'], dtype=np.int64)
+    g = np.asarray(calibration['g_values'], dtype=np.int64)
+    d_g = np.asarray(calibration['d_g_values'], dtype=np.int64)
+    OF_LENGTH = a.shape[1]
+    a_scaling = calibration['a_scaling']
+    tau_scaling = calibration['b_scaling'] - calibration['a_scaling']
+    g_precision = calibration['parameters']['g_PRECISION']
+    d_g_precision = calibration['parameters']['d_g_PRECISION']
+
+    ## The pulses that can be reconstructed: a CFD crossing is found, and all OF samples and the tail samples are within the waveform.
+    OF_samples = sample_no[:, np.newaxis] + OF_START + np.arange(OF_LENGTH)
+    tail_samples = OF_samples[:, -1:] + 1 + np.arange(TAIL_LENGTH)
+    valid = found & (True_A > 0) & (OF_samples[:, 0] >= 0) & (tail_samples[:, -1] < n_samples)
+
+    rows = np.flatnonzero(valid)
+    overflow_counters = {}
+    window = BCFD_bisection(y_0[rows], y_1[rows], N_BCFD_WINDOWS, overflow_counters)
+
+    ## The OF: u = SUM_A >> a_scaling (the amplitude), v = SUM_B >> a_scaling (amplitude times tau, scaled up by tau_scaling bits).
+    FIR_data = resize(data[rows[:, np.newaxis], OF_samples[rows]], fixed_format(FIR_DATA_WIDTH), overflow_counters, 'FIR_data')
+    u = resize((a[window - 1]*FIR_data).sum(axis=1) >> a_scaling, fixed_format(OUTPUT_WIDTH), overflow_counters, 'u')
+    v = resize((b[window - 1]*FIR_data).sum(axis=1) >> a_scaling, fixed_format(OUTPUT_WIDTH), overflow_counters, 'v')
+    tau = (v/np.where(u != 0, u, 1))/np.power(2., tau_scaling)
+
+    ## The time, as in reconstruct_A_and_T.py: the sample before the crossing plus the midpoint of the BCFD window, minus delta_BCFD_window_mean, plus tau (t_waveform starts at 1, so sample number s is at time s + 1).
+    Reconstructed_T_0 = sample_no[rows] + (window - 0.5)/N_BCFD_WINDOWS - delta_BCFD_window_mean[window - 1] + tau
+    delta_A = (u - True_A[rows])/True_A[rows]
+    delta_T = Reconstructed_T_0 - True_T_0[rows]
+
+    ## The tail reconstruction (as in optimal_filter.vhd): A*g - A*tau*d_g with the quantised templates. The template sample corresponding to a sample of the pulse follows from the sample after the CFD crossing of the template (as in calculate_OF_calibration).
+    T0_assumed = (6. + (np.arange(N_BCFD_WINDOWS) + 0.5)/N_BCFD_WINDOWS) - delta_BCFD_window_mean
+    t_template = np.linspace(1, g.shape[1], g.shape[1])
+    template_sample_above_zero = np.argmax(lognormal_fcn_CFD(t_template, 1, T0_assumed[:, np.newaxis], mu, sigma, CFD_delay, CFD_attenuation) > 0., axis=1)
+    template_index = np.clip(tail_samples[rows] - sample_no[rows, np.newaxis] + template_sample_above_zero[window - 1, np.newaxis], 0, g.shape[1] - 1)
+
+    ## Only the low RECONSTRUCTION_SUM_WIDTH bits of u and v go into the multipliers, so a large v (many bits of tau precision) wraps.
+    u_pulse = resize(u, fixed_format(RECONSTRUCTION_SUM_WIDTH), overflow_counters, 'SUM_A_pulse')
+    v_pulse = resize(v, fixed_format(RECONSTRUCTION_SUM_WIDTH), overflow_counters, 'SUM_B_pulse')
+    g_part = (u_pulse[:, np.newaxis]*g[window[:, np.newaxis] - 1, template_index]) >> (g_precision - tau_scaling)
+    d_g_part = (v_pulse[:, np.newaxis]*d_g[window[:, np.newaxis] - 1, template_index]) >> d_g_precision
+    reconstructed_tail = resize(g_part - d_g_part, fixed_format(RECONSTRUCTION_WIDTH), overflow_counters, 'Reconstructed_part') >> tau_scaling
+    true_tail = lognormal_fcn(tail_samples[rows] + 1., True_A[rows, np.newaxis], True_T_0[rows, np.newaxis], mu, sigma, 0.)
+    tail_error = np.sqrt(np.mean(np.power(reconstructed_tail - true_tail, 2), axis=1))/True_A[rows]
+
+    return delta_A, delta_T, tail_error, len(rows)/max(np.count_nonzero(True_A > 0), 1), sum(counter['n_overflows'] for counter in overflow_counters.values())
+
+
+## The number of DSP slices needed for a signed multiplication of width_1 x width_2 bits (the inputs can be swapped to fit the 25 x 18 multiplier best).
+def DSP_slices(width_1, width_2):
+    return min(int(np.ceil(width_1/DSP_MULTIPLIER_WIDTHS[0]))*int(np.ceil(width_2/DSP_MULTIPLIER_WIDTHS[1])), int(np.ceil(width_1/DSP_MULTIPLIER_WIDTHS[1]))*int(np.ceil(width_2/DSP_MULTIPLIER_WIDTHS[0])))
+
+## Estimate the FPGA cost of one channel: the multipliers (OF_LENGTH each for the a and b coefficients, and OF_LENGTH each for the g and d_g parts of the tail reconstruction of each of the first MAX_PILEUP_PULSES - 1 pulses of a pile-up chain, i.e. 16 with the current parameters, see optimal_filter.vhd), the DSP slices these need and the number of bits of coefficients and templates to be stored (g is unsigned, but is stored as a signed number like d_g, so both need one bit more than their precision). Also the width of the OF sums, and how many channels fit in a Kintex-7 (KINTEX7_DSP_SLICES), if DSP slices are the limiting resource.
+def estimate_cost(M_A, M_B, g_PRECISION, d_g_PRECISION, OF_LENGTH, N_BCFD_WINDOWS, N_TEMPLATE_VALUES, MAX_PILEUP_PULSES=2):
+    n_tails = MAX_PILEUP_PULSES - 1
+    n_DSP = OF_LENGTH*(DSP_slices(M_A, FIR_DATA_WIDTH) + DSP_slices(M_B, FIR_DATA_WIDTH) + n_tails*(DSP_slices(RECONSTRUCTION_SUM_WIDTH, g_PRECISION + 1) + DSP_slices(RECONSTRUCTION_SUM_WIDTH, d_g_PRECISION + 1)))
+
+    return {'n_multipliers': 2*OF_LENGTH*(1 + n_tails),
+            'n_DSP': n_DSP,
+            'coefficient_bits': N_BCFD_WINDOWS*OF_LENGTH*(M_A + M_B),
+            'template_bits': N_BCFD_WINDOWS*N_TEMPLATE_VALUES*(g_PRECISION + 1 + d_g_PRECISION + 1),
+            'SUM_B_width': M_B + FIR_DATA_WIDTH + int(np.ceil(np.log2(OF_LENGTH))),
+            'channels_per_device': KINTEX7_DSP_SLICES//n_DSP}
+
+
+## The data shared by all grid points (set once in each worker process, see evaluate_point):
+sweep_data = {}
+
+def init_worker(data):
+    sweep_data.update(data)
+
+## Evaluate one point of the grid (a dictionary with M_A, M_B_EXTRA, g_PRECISION, d_g_PRECISION, OF_LENGTH and N_BCFD_WINDOWS, where M_B = M_A + M_B_EXTRA as in get_OF_coefficients.py): calculate the calibration, run the model and estimate the cost. Returns the point, extended with M_B and the results.
+def evaluate_point(point):
+    parameters = sweep_data['parameters']
+    M_B = point['M_A'] + point['M_B_EXTRA']
+    calibration = calculate_OF_calibration(sweep_data['delta_BCFD_window_mean'][point['N_BCFD_WINDOWS']], parameters['mu'], parameters['sigma'], parameters['CFD_delay'], parameters['CFD_attenuation'], parameters['OF_START'], point['OF_LENGTH'], point['M_A'], M_B, point['g_PRECISION'], point['d_g_PRECISION'], parameters['N_SAMPLES_PER_WAVEFORM'])
+
+    delta_A, delta_T, tail_error, efficiency, n_overflows = run_OF_model(sweep_data['data'], sweep_data['crossings'], sweep_data['True_A'], sweep_data['True_T_0'], calibration, parameters['OF_START'], parameters['mu'], parameters['sigma'], parameters['CFD_delay'], parameters['CFD_attenuation'])
+
+    result = dict(point, M_B=M_B)
+    result.update({'a_scaling': calibration['a_scaling'], 'b_scaling': calibration['b_scaling'], 'efficiency': efficiency, 'n_overflows': n_overflows,
+                   'A_bias': np.mean(delta_A), 'A_resolution': np.std(delta_A), 'T_bias': np.mean(delta_T), 'T_resolution': np.std(delta_T), 'tail_error': np.mean(tail_error)})
+    result.update(estimate_cost(point['M_A'], M_B, point['g_PRECISION'], point['d_g_PRECISION'], point['OF_LENGTH'], point['N_BCFD_WINDOWS'], np.shape(calibration['g_values'])[1]))
+    return result
+
+
+## Evaluate all points of the grid (one point per combination of the values in grid, a dictionary of lists), in n_processes processes (None: one per CPU). Returns a list with the result for each point (see evaluate_point).
+def run_sweep(grid, data, n_processes=None, chunksize=8):
+    points = [dict(zip(grid.keys(), values)) for values in itertools.product(*grid.values())]
+
+    with ProcessPoolExecutor(n_processes, initializer=init_worker, initargs=(data,)) as pool:
+        return list(pool.map(evaluate_point, points, chunksize=chunksize))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Design-space sweep over the precision choices of the OF.')
+    parser.add_argument('--data-dir', default=DATA_DIRECTORY, help='the directory with input_data_no_pileup.bin and MC_truth_data.bin')
+    parser.add_argument('--output-file', default=os.path.join(DATA_DIRECTORY, 'design_sweep.csv'), help='the results, one line per grid point')
+    parser.add_argument('--no-plot', action='store_true')
+    args = parser.parse_args(argv)
+
+    ## Isolated pulses (input_data_no_pileup.bin, from generate_pulse_data.py) and the MC truth data. In the pile-up free data, every waveform holds the first pulse of the corresponding waveform in the MC truth data.
+    header, pulse_train = open_data_file(os.path.join(args.data_dir, 'input_data_no_pileup.bin'))
+    MC_truth_header, MC_truth_data = open_data_file(os.path.join(args.data_dir, 'MC_truth_data.bin'))
+    MC_truth_data = as_array(MC_truth_data)
+
+    N_SAMPLES_PER_WAVEFORM = header['N_SAMPLES_PER_WAVEFORM']
+    N_REAL_WAVEFORMS = header['N_REAL_WAVEFORMS']
+    N_EMPTY_WAVEFORMS = header['N_EMPTY_WAVEFORMS']
+
+    ## The sweep runs in this many processes (None: one per CPU)
+    N_PROCESSES = None
+
+    ## The parameters that are not swept, from get_OF_coefficients.py:
+    mu, sigma, CFD_delay, CFD_attenuation, OF_START = [CALIBRATION_PARAMETERS[name] for name in ('mu', 'sigma', 'CFD_delay', 'CFD_attenuation', 'OF_START')]
+
+    ## The grid. M_B is given as M_A plus the extra bits for the tau estimate (M_B_EXTRA), as in get_OF_coefficients.py (M_B = M_A + 10). The grid includes the current configuration (CALIBRATION_PARAMETERS in get_OF_coefficients.py).
+    GRID = {'M_A': [8, 10, 12, 14],
+            'M_B_EXTRA': [6, 8, 10, 12],
+            'g_PRECISION': [10, 12, 14, 16],
+            'd_g_PRECISION': [8, 10, 12, 14],
+            'OF_LENGTH': [3, 4, 5, 6],
+            'N_BCFD_WINDOWS': [2, 4, 8]}
+
+    ## The requirements. The cheapest configurations meeting them are listed. The resolutions are standard deviations (the amplitude relative to the true amplitude, the time in samples), the tail error is the RMS error of the reconstructed tail relative to the amplitude.
+    SPEC_A_RESOLUTION = 0.008
+    SPEC_T_RESOLUTION = 0.02
+    SPEC_TAIL_ERROR = 0.003
+    N_TO_LIST = 20
+
+    ## The results are written to this file (one line per grid point):
+    OUTPUT_FILE = args.output_file
+
+
+    t_waveform = np.linspace(1, N_SAMPLES_PER_WAVEFORM, N_SAMPLES_PER_WAVEFORM)
+    waveforms = pulse_train['sample'][N_EMPTY_WAVEFORMS*N_SAMPLES_PER_WAVEFORM:(N_EMPTY_WAVEFORMS + N_REAL_WAVEFORMS)*N_SAMPLES_PER_WAVEFORM].astype(float).reshape(N_REAL_WAVEFORMS, N_SAMPLES_PER_WAVEFORM)
+
+    ## The BCFD time offsets for each number of BCFD windows, from the fits (the same, cached, calculation as in get_OF_coefficients.py, so the pulses are only fitted once):
+    delta_BCFD_window_mean = {N_BCFD_WINDOWS: get_delta_BCFD_window_mean(waveforms, t_waveform, mu, sigma, CFD_delay, CFD_attenuation, N_BCFD_WINDOWS, N_PROCESSES) for N_BCFD_WINDOWS in GRID['N_BCFD_WINDOWS']}
+
+    ## The baseline-subtracted waveforms and the CFD crossings do not depend on the swept parameters, so they are calculated once:
+    baselines = get_baselines(pulse_train['sample'], N_EMPTY_WAVEFORMS, N_REAL_WAVEFORMS, N_SAMPLES_PER_WAVEFORM)
+    data = waveforms.astype(np.int64) - baselines[:, np.newaxis]
+    crossings = find_CFD_crossings(data, CFD_delay, CFD_attenuation)
+
+    sweep_input = {'data': data, 'crossings': crossings,
+                   'True_A': MC_truth_data[N_EMPTY_WAVEFORMS:N_EMPTY_WAVEFORMS + N_REAL_WAVEFORMS, 0], 'True_T_0': MC_truth_data[N_EMPTY_WAVEFORMS:N_EMPTY_WAVEFORMS + N_REAL_WAVEFORMS, 1],
+                   'delta_BCFD_window_mean': delta_BCFD_window_mean,
+                   'parameters': {'mu': mu, 'sigma': sigma, 'CFD_delay': CFD_delay, 'CFD_attenuation': CFD_attenuation, 'OF_START': OF_START, 'N_SAMPLES_PER_WAVEFORM': N_SAMPLES_PER_WAVEFORM}}
+
+    results = run_sweep(GRID, sweep_input, N_PROCESSES)
+    print('Evaluated ' + str(len(results)) + ' configurations')
+
+    ## Write all results:
+    columns = list(results[0].keys())
+    np.savetxt(OUTPUT_FILE, np.array([[result[column] for column in columns] for result in results], dtype=float), delimiter=',', header=','.join(columns), comments='', fmt='%.6g')
+
+    ## List the cheapest configurations that meet the requirements (fewest DSP slices first, then the fewest stored bits):
+    meets_spec = [result for result in results if (result['A_resolution'] <= SPEC_A_RESOLUTION) and (result['T_resolution'] <= SPEC_T_RESOLUTION) and (result['tail_error'] <= SPEC_TAIL_ERROR) and (result['n_overflows'] == 0)]
+    meets_spec.sort(key=lambda result: (result['n_DSP'], result['coefficient_bits'] + result['template_bits'], result['T_resolution']))
+
+    print(str(len(meets_spec)) + ' configurations meet the requirements (A resolution <= ' + str(SPEC_A_RESOLUTION) + ', T resolution <= ' + str(SPEC_T_RESOLUTION) + ' samples, tail error <= ' + str(SPEC_TAIL_ERROR) + ', no overflows). The cheapest:')
+    print('  M_A  M_B  g_PREC  d_g_PREC  OF_LENGTH  N_BCFD   A res.   T res.   tail err.  DSP  stored bits  channels/device')
+    for result in meets_spec[:N_TO_LIST]:
+        print('{M_A:5d}{M_B:5d}{g_PRECISION:8d}{d_g_PRECISION:10d}{OF_LENGTH:11d}{N_BCFD_WINDOWS:8d}{A_resolution:9.4f}{T_resolution:9.4f}{tail_error:11.5f}{n_DSP:5d}'.format(**result) + '{:13d}'.format(result['coefficient_bits'] + result['template_bits']) + '{:17d}'.format(result['channels_per_device']))
+
+    if not args.no_plot:
+        ## Plot the resolutions against the cost:
+        import matplotlib.pyplot as plt
+
+        fig, ax = plt.subplots(1, 2)
+        n_DSP = np.array([result['n_DSP'] for result in results])
+        stored_bits = np.array([result['coefficient_bits'] + result['template_bits'] for result in results])
+        for axis, name, label, spec in [(ax[0], 'A_resolution', r'Amplitude resolution ($\sigma_A/A$)', SPEC_A_RESOLUTION), (ax[1], 'T_resolution', r'Time resolution ($\sigma_T$) [samples]', SPEC_T_RESOLUTION)]:
+            scatter = axis.scatter(n_DSP + np.random.default_rng(0).uniform(-0.3, 0.3, len(results)), [result[name] for result in results], c=stored_bits, s=4)
+            axis.axhline(spec, color='r', linestyle='--')
+            axis.set_xlabel('DSP slices per channel')
+            axis.set_ylabel(label)
+            axis.set_yscale('log')
+        fig.colorbar(scatter, ax=ax[1], label='Stored bits (coefficients + templates)')
+
+        plt.show()
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,578 @@
+import argparse
+import os
+import numpy as np
+from OF_calibration import load_calibration
+from data_format import OUTPUT_DTYPE, FEATURE_RECORD_DTYPE, DATA_DIRECTORY, open_data_file, write_data_file, make_rows
+from feature_records import make_feature_records
+from fixed_point import fixed_format, resize, to_unsigned, print_overflow_report
+
+## Bit-exact software model of the VHDL feature-extraction pipeline (vhdl/main.vhd, as driven by vhdl/main_tb.vhd). The model reproduces the baseline_calculator, the baseline_selector, the constant_fraction (BCFD) and the optimal_filter (including the reconstruction of the pulse tails) clock cycle by clock cycle, using the same integer widths, shifts and truncations as the VHDL code. The output has the same 10 columns as the output_data.csv file written by main_tb.vhd, so that firmware changes can be checked without running a Vivado simulation.
+##
+## The model is written for many independent data streams ('lanes') at once: every signal in the VHDL code is represented by a numpy array with one element per lane, and all lanes are clocked together. A single long pulse train is processed quickly by cutting it into segments that are run as parallel lanes (see run_pipeline_segmented below). The segments are stitched together in a way that keeps the result identical to processing the pulse train in one go.
+##
+## NOTE: in the VHDL code the baseline buffer (t_baseline_buffer) is not initialised, so the first ~20 clock cycles of the 'setup' period depend on how the simulator handles the uninitialised integers. Here, the buffer is initialised to zero. From the end of the setup period (i.e. well within the first, empty, waveform) the model is bit-exact.
+
+
+## Generics of the VHDL components (see the respective .vhd files):
+THRESHOLD_RISING = 3                        ## baseline_calculator.vhd
+THRESHOLD_FALLING = 3                       ## baseline_calculator.vhd
+PULSE_WIDTH_BEFORE_RESET = 50               ## baseline_calculator.vhd
+BASELINE_SETUP_SAMPLES = 25                 ## baseline_calculator.vhd, the number of clock cycles in the 'setup' state
+CFD_DELAY = 2                               ## constant_fraction.vhd
+THRESHOLD_CFD = 5                           ## constant_fraction.vhd
+FIR_LENGTH = 4                              ## optimal_filter.vhd
+OF_AMPLITUDE_THRESHOLD = 15                 ## optimal_filter.vhd
+OF_AMPLITUDE_THRESHOLD_FRACTION = 5         ## optimal_filter.vhd
+OF_ALIGNMENT_N_SAMPLES = 7                  ## optimal_filter.vhd
+MAX_PILEUP_PULSES = 2                       ## my_types.vhd, the maximum number of overlapping pulses (N) handled by the OF: the tails of the first N - 1 pulses are reconstructed and subtracted
+
+## The thresholds among these generics, which can be set for a run (the thresholds argument of run_pipeline, e.g. to scan them, see dead_time.py); the values above are the defaults:
+THRESHOLD_NAMES = ['THRESHOLD_RISING', 'THRESHOLD_FALLING', 'PULSE_WIDTH_BEFORE_RESET', 'THRESHOLD_CFD', 'OF_AMPLITUDE_THRESHOLD', 'OF_AMPLITUDE_THRESHOLD_FRACTION']
+
+def default_thresholds():
+    return {'THRESHOLD_RISING': THRESHOLD_RISING, 'THRESHOLD_FALLING': THRESHOLD_FALLING, 'PULSE_WIDTH_BEFORE_RESET': PULSE_WIDTH_BEFORE_RESET,
+            'THRESHOLD_CFD': THRESHOLD_CFD, 'OF_AMPLITUDE_THRESHOLD': OF_AMPLITUDE_THRESHOLD, 'OF_AMPLITUDE_THRESHOLD_FRACTION': OF_AMPLITUDE_THRESHOLD_FRACTION}
+
+## State encodings (the enumeration types in my_types.vhd):
+BASELINE_SETUP, BASELINE_AWAKE, BASELINE_SLEEPING = 0, 1, 2                                     ## t_baseline_state
+CFD_WAITING, CFD_TRIGGERED = 0, 1                                                               ## t_cfd_state
+OF_WAITING, OF_TRIGGERED_PULSE_0, OF_TRIGGERED_PULSE_1 = 0, 1, 2                              ## t_OF_state: 'triggered_pulse_p' is p + 1, up to MAX_PILEUP_PULSES
+FINAL_TRIGGER_COUNTER_IDLE, FINAL_TRIGGER_COUNTER_COUNTING = 0, 1                               ## t_final_trigger_counter_state (baseline_calculator.vhd)
+
+## The columns of output_data.csv, as written by main_tb.vhd:
+OUTPUT_COLUMNS = ['counter', 'data_in', 'average', 'baseline', 'trigger', 'cfd', 'cfd_time', 'u', 'v', 'final_trigger']
+
+
+## The fixed-point formats of the signals that are resized (and may wrap) in the VHDL code, see fixed_point.py. They all wrap, like to_signed/to_unsigned in numeric_std. u_out and v_out are VHDL integers, i.e. 32 bits.
+SIGNAL_FORMATS = {
+    'average_sum': fixed_format(17, signed=False),              ## baseline_calculator.vhd, the sum of two samples
+    'baseline_sum': fixed_format(20, signed=False),             ## baseline_calculator.vhd, the sum of 16 samples
+    'baseline_from_average': fixed_format(16, signed=False),    ## baseline_selector.vhd
+    'cfd_attenuated': fixed_format(17),                         ## constant_fraction.vhd, the undelayed sample minus baseline
+    'bisection': fixed_format(16),                              ## constant_fraction.vhd
+    'FIR_coefficients': fixed_format(25),                       ## optimal_filter.vhd, the a and b coefficients
+    'templates': fixed_format(18),                              ## optimal_filter.vhd, g and d_g
+    'FIR_data': fixed_format(16),                               ## optimal_filter.vhd
+    'SUM_pulse': fixed_format(20),                              ## optimal_filter.vhd, the OF sums of a pulse, for the tail reconstruction
+    'Reconstructed_part': fixed_format(38),                     ## optimal_filter.vhd, the reconstructed tail of a pulse
+    'Reconstructed': fixed_format(38),                          ## optimal_filter.vhd, the sum over the pulses
+    'u_v': fixed_format(32),                                    ## optimal_filter.vhd, u_out and v_out
+}
+
+
+## The BCFD bisection (constant_fraction.vhd), generalised to N_BCFD_WINDOWS = 2^k windows: the linear interpolation between the CFD samples before (y_0 < 0) and after (y_1 >= 0) the zero crossing is evaluated at the midpoint of the current interval, and the half containing the zero crossing is kept, k times (in 16-bit signed arithmetic, like the VHDL code). Each step gives one bit of the window number. Returns the BCFD window (1, ..., N_BCFD_WINDOWS, window 1 being the earliest). For 4 windows, this is the two-step bisection in constant_fraction.vhd.
+def BCFD_bisection(y_0, y_1, N_BCFD_WINDOWS, overflow_counters=None):
+    n_steps = int(np.log2(N_BCFD_WINDOWS))
+    if ((1 << n_steps) != N_BCFD_WINDOWS):
+        raise ValueError('The number of BCFD windows must be a power of two, not ' + str(N_BCFD_WINDOWS))
+
+    y_low = resize(y_0, SIGNAL_FORMATS['bisection'], overflow_counters, 'bisection')
+    y_high = resize(y_1, SIGNAL_FORMATS['bisection'], overflow_counters, 'bisection')
+    window = np.zeros(np.shape(y_low), dtype=np.int64)
+    for step in range(n_steps):
+        y_mid = resize(y_low + y_high, SIGNAL_FORMATS['bisection'], overflow_counters, 'bisection') >> 1
+        later = (y_mid < 0)                                 ## the zero crossing is in the later half
+        y_low = np.where(later, y_mid, y_low)
+        y_high = np.where(later, y_high, y_mid)
+        window = 2*window + later
+
+    return window + 1
+
+
+## The OF coefficients, the quantised pulse templates and the shifts used in optimal_filter.vhd, from an OF calibration (see OF_calibration.py; by default the one in data/OF_calibration.json, which is the calibration in the generated vhdl/OF_coefficients.vhd). a_scaling is the precision of the a coefficients, tau_scaling is the remaining precision on tau (b_scaling - a_scaling), g_precision and d_g_precision are the precisions of the quantised pulse template and its derivative. The coefficients are listed starting with the earliest of the OF_LENGTH samples, one row per BCFD window.
+def coefficients_from_calibration(calibration):
+    return {'FIR_coefficients_a': np.asarray(calibration['FIR_coefficients_a']), 'FIR_coefficients_b': np.asarray(calibration['FIR_coefficients_b']), 'g_values': np.asarray(calibration['g_values']), 'd_g_values': np.asarray(calibration['d_g_values']),
+            'a_scaling': calibration['a_scaling'], 'tau_scaling': calibration['b_scaling'] - calibration['a_scaling'], 'g_precision': calibration['parameters']['g_PRECISION'], 'd_g_precision': calibration['parameters']['d_g_PRECISION']}
+
+def default_coefficients():
+    return coefficients_from_calibration(load_calibration())
+
+
+## The state of all registers in the design, for n_lanes independent data streams. The keys are the signal names used in the VHDL code. Signals that are calculated combinatorially from other signals are included when they are needed on the next clock edge (SUM_A, SUM_B) or when the VHDL code reacts to changes in them (Reconstructed). The per-pulse registers of the OF have one column per pulse in a pile-up chain: max_pileup_pulses counters, and max_pileup_pulses - 1 sets of OF sums, BCFD windows and aligned templates for the pulses whose tails are reconstructed.
+def initial_state(n_lanes, max_pileup_pulses=MAX_PILEUP_PULSES):
+    def zeros(*shape):
+        return np.zeros((n_lanes,) + shape, dtype=np.int64)
+
+    return {
+        ## main_tb.vhd
+        'counter': zeros(),
+        'data_from_file': zeros(),
+        ## main.vhd
+        'r_sample_buffer': zeros(17),
+        ## baseline_calculator.vhd
+        'r_current_average': zeros(),
+        'r_current_baseline': zeros(),
+        'r_baseline_state': zeros(),
+        'r_baseline_setup_counter': zeros(),
+        'r_baseline_buffer': zeros(21),
+        'trigger': zeros(),
+        'r_final_trigger_counter': zeros(),
+        'r_final_trigger_counter_state': zeros(),
+        ## baseline_selector.vhd
+        'baseline_temp': zeros(9),
+        ## constant_fraction.vhd
+        'r_cfd': zeros(),
+        'r_cfd_buffer': zeros(2),
+        'r_bisection': zeros(),
+        'r_cfd_state': zeros(),
+        ## optimal_filter.vhd
+        'SUM_A': zeros(),
+        'SUM_B': zeros(),
+        'r_OF_state': zeros(),
+        'r_final_trigger': zeros(),
+        'r_chain_overflow': zeros(),
+        'r_cfd_window_pulse': zeros(max_pileup_pulses - 1),
+        'pulse_counter': zeros(max_pileup_pulses),
+        'SUM_A_pulse': zeros(max_pileup_pulses - 1),
+        'SUM_B_pulse': zeros(max_pileup_pulses - 1),
+        'r_Amplitude_previous_pulse': zeros(),
+        'g_value_aligned_pulse': zeros(max_pileup_pulses - 1, FIR_LENGTH),
+        'd_g_value_aligned_pulse': zeros(max_pileup_pulses - 1, FIR_LENGTH),
+        'Reconstructed': zeros(FIR_LENGTH),
+        'r_reconstructed_pulse_temp': zeros(9),
+    }
+
+
+## The instrumentation counters (the debug_counters output of main.vhd), for n_lanes independent data streams. Each counter is incremented on the rising clock edge, from the values of the signals just before the edge (like the count_events process in main.vhd):
+##   cycles_setup, cycles_awake, cycles_sleeping: clock cycles spent in each state of the baseline_calculator (while 'sleeping', the baseline is locked until the average falls below THRESHOLD_FALLING).
+##   cycles_update_blocked: clock cycles in state 'awake' in which the baseline was not updated because the final-trigger counter was running (PULSE_WIDTH_BEFORE_RESET after a final trigger).
+##   baseline_triggers, baseline_releases: the transitions 'awake' -> 'sleeping' (THRESHOLD_RISING) and 'sleeping' -> 'awake' (THRESHOLD_FALLING).
+##   cfd_crossings, cfd_rejected_threshold, cfd_triggers: zero crossings of the CFD signal while the BCFD is armed, those rejected because the slope was not above THRESHOLD_CFD, and those accepted (giving a BCFD window).
+##   of_candidates, of_rejected_amplitude, of_rejected_fraction: BCFD windows seen by the OF while the baseline is 'sleeping', and those rejected because u was not above OF_AMPLITUDE_THRESHOLD, or not above the fraction (OF_AMPLITUDE_THRESHOLD_FRACTION) of the amplitude of the preceding pulse.
+##   final_triggers, chain_overflows: accepted pulses giving a final trigger, and accepted pulses that were lost because the pile-up chain was already MAX_PILEUP_PULSES long.
+##   cycles_OF_state: clock cycles spent in each OF state (one column per state, 'waiting' first).
+COUNTER_NAMES = ['cycles_setup', 'cycles_awake', 'cycles_sleeping', 'cycles_update_blocked', 'baseline_triggers', 'baseline_releases', 'cfd_crossings', 'cfd_rejected_threshold', 'cfd_triggers', 'of_candidates', 'of_rejected_amplitude', 'of_rejected_fraction', 'final_triggers', 'chain_overflows']
+
+def initial_counters(n_lanes, max_pileup_pulses=MAX_PILEUP_PULSES):
+    counters = {name: np.zeros(n_lanes, dtype=np.int64) for name in COUNTER_NAMES}
+    counters['cycles_OF_state'] = np.zeros((n_lanes, max_pileup_pulses + 1), dtype=np.int64)
+    return counters
+
+
+## Pick out (or overwrite) the state of a subset of the lanes:
+def select_lanes(state, lanes):
+    return {key: value[lanes] for key, value in state.items()}
+
+def replace_lanes(state, lanes, new_state):
+    for key in state:
+        state[key][lanes] = new_state[key]
+
+
+## Run the pipeline over input_data, which is either a single pulse train (1-D) or one pulse train per lane (2-D, n_lanes x n_cycles). Every element of input_data corresponds to one line of input_data.csv, i.e. one clock cycle in main_tb.vhd. Returns the output (same 10 columns as output_data.csv, one row per clock cycle) and the state after the last clock cycle. By passing the returned state back in, a long pulse train can be processed block by block with the same result as processing it in one go. max_pileup_pulses is MAX_PILEUP_PULSES in my_types.vhd (if a state is passed in, it is taken from the shape of the state instead). If counters (from initial_counters, one lane per lane of input_data) is passed in, the instrumentation counters are incremented in place; this makes the model somewhat slower. Likewise, with overflow_counters (a dictionary, see fixed_point.py), every value that is resized to one of the SIGNAL_FORMATS is checked and counted, per format, so that values that wrap (which the VHDL code would silently do) show up. thresholds (a dictionary with some or all of THRESHOLD_NAMES) replaces the default values of these generics.
+def run_pipeline(input_data, state=None, coefficients=None, max_pileup_pulses=MAX_PILEUP_PULSES, counters=None, overflow_counters=None, thresholds=None):
+    input_data = np.asarray(input_data, dtype=np.int64)
+    single_lane = (input_data.ndim == 1)
+    if single_lane:
+        input_data = input_data[np.newaxis, :]
+    n_lanes, n_cycles = input_data.shape
+
+    if state is None:
+        state = initial_state(n_lanes, max_pileup_pulses)
+    max_pileup_pulses = state['pulse_counter'].shape[1]
+    if (max_pileup_pulses < 2):
+        raise ValueError('The OF handles at least 2 overlapping pulses, not ' + str(max_pileup_pulses))
+    if coefficients is None:
+        coefficients = default_coefficients()
+
+    ## Look-up tables for the coefficients and templates (the bank of a, b, g and d_g, indexed by the BCFD window). The number of BCFD windows follows from the coefficients (constant_fraction.vhd and optimal_filter.vhd use 4, but the model works for any power of two). Row 0 corresponds to 'no BCFD window' (cfd_time = 0), for which optimal_filter.vhd uses all-zero coefficients and templates. The templates are padded with zeros, because the VHDL code reads beyond the 100 stored template values (OF_ALIGNMENT_N_SAMPLES + pulse_counter + i) if a pulse is followed for a long time.
+    n_windows = len(coefficients['FIR_coefficients_a'])
+    coefficients_a = resize(np.vstack([np.zeros(FIR_LENGTH, dtype=np.int64), coefficients['FIR_coefficients_a']]), SIGNAL_FORMATS['FIR_coefficients'], overflow_counters, 'FIR_coefficients')
+    coefficients_b = resize(np.vstack([np.zeros(FIR_LENGTH, dtype=np.int64), coefficients['FIR_coefficients_b']]), SIGNAL_FORMATS['FIR_coefficients'], overflow_counters, 'FIR_coefficients')
+    n_template = np.shape(coefficients['g_values'])[1]
+    g_table = np.zeros((n_windows + 1, n_template + OF_ALIGNMENT_N_SAMPLES + FIR_LENGTH), dtype=np.int64)
+    d_g_table = np.zeros((n_windows + 1, n_template + OF_ALIGNMENT_N_SAMPLES + FIR_LENGTH), dtype=np.int64)
+    g_table[1:, :n_template] = resize(coefficients['g_values'], SIGNAL_FORMATS['templates'], overflow_counters, 'templates')
+    d_g_table[1:, :n_template] = resize(coefficients['d_g_values'], SIGNAL_FORMATS['templates'], overflow_counters, 'templates')
+    template_offsets = OF_ALIGNMENT_N_SAMPLES + np.arange(FIR_LENGTH)
+    A_SCALING = coefficients['a_scaling']
+    TAU_SCALING = coefficients['tau_scaling']
+    G_PRECISION = coefficients['g_precision']
+    D_G_PRECISION = coefficients['d_g_precision']
+
+    ## The thresholds of this run:
+    thresholds = dict(default_thresholds(), **({} if (thresholds is None) else thresholds))
+    if (len(thresholds) > len(THRESHOLD_NAMES)):
+        raise ValueError('Unknown threshold(s): ' + ', '.join(sorted(set(thresholds) - set(THRESHOLD_NAMES))) + '. The thresholds are ' + ', '.join(THRESHOLD_NAMES))
+    THRESHOLD_RISING = thresholds['THRESHOLD_RISING']
+    THRESHOLD_FALLING = thresholds['THRESHOLD_FALLING']
+    PULSE_WIDTH_BEFORE_RESET = thresholds['PULSE_WIDTH_BEFORE_RESET']
+    THRESHOLD_CFD = thresholds['THRESHOLD_CFD']
+    OF_AMPLITUDE_THRESHOLD = thresholds['OF_AMPLITUDE_THRESHOLD']
+    OF_AMPLITUDE_THRESHOLD_FRACTION = thresholds['OF_AMPLITUDE_THRESHOLD_FRACTION']
+
+    ## Copy the state into local variables (faster, and makes sure that the state passed in is left untouched):
+    counter = state['counter'].copy()
+    data_from_file = state['data_from_file'].copy()
+    r_sample_buffer = state['r_sample_buffer'].copy()
+    r_current_average = state['r_current_average'].copy()
+    r_current_baseline = state['r_current_baseline'].copy()
+    r_baseline_state = state['r_baseline_state'].copy()
+    r_baseline_setup_counter = state['r_baseline_setup_counter'].copy()
+    r_baseline_buffer = state['r_baseline_buffer'].copy()
+    trigger = state['trigger'].copy()
+    r_final_trigger_counter = state['r_final_trigger_counter'].copy()
+    r_final_trigger_counter_state = state['r_final_trigger_counter_state'].copy()
+    baseline_temp = state['baseline_temp'].copy()
+    r_cfd = state['r_cfd'].copy()
+    r_cfd_buffer = state['r_cfd_buffer'].copy()
+    r_bisection = state['r_bisection'].copy()
+    r_cfd_state = state['r_cfd_state'].copy()
+    SUM_A = state['SUM_A'].copy()
+    SUM_B = state['SUM_B'].copy()
+    r_OF_state = state['r_OF_state'].copy()
+    r_final_trigger = state['r_final_trigger'].copy()
+    r_chain_overflow = state['r_chain_overflow'].copy()
+    r_cfd_window_pulse = state['r_cfd_window_pulse'].copy()
+    pulse_counter = state['pulse_counter'].copy()
+    SUM_A_pulse = state['SUM_A_pulse'].copy()
+    SUM_B_pulse = state['SUM_B_pulse'].copy()
+    r_Amplitude_previous_pulse = state['r_Amplitude_previous_pulse'].copy()
+    g_value_aligned_pulse = state['g_value_aligned_pulse'].copy()
+    d_g_value_aligned_pulse = state['d_g_value_aligned_pulse'].copy()
+    Reconstructed = state['Reconstructed'].copy()
+    r_reconstructed_pulse_temp = state['r_reconstructed_pulse_temp'].copy()
+
+    ## Pulse p of a pile-up chain is followed from state 'triggered_pulse_p' (= p + 1) onwards. The tails of pulses 0, ..., max_pileup_pulses - 2 are reconstructed.
+    pulse_index = np.arange(max_pileup_pulses)
+    tail_index = np.arange(max_pileup_pulses - 1)
+
+    output_data = np.zeros((n_lanes, n_cycles, len(OUTPUT_COLUMNS)), dtype=np.int64)
+
+    for cycle in range(n_cycles):
+        ## main_tb.vhd writes the output line right at the rising clock edge, i.e. before any of the registers have been updated. So, what is written is the state after the *previous* clock edge, together with the input sample read on this clock edge.
+        output_data[:, cycle, 0] = counter
+        output_data[:, cycle, 1] = input_data[:, cycle]
+        output_data[:, cycle, 2] = to_unsigned(r_current_average, 16)
+        output_data[:, cycle, 3] = baseline_temp[:, 0]
+        output_data[:, cycle, 4] = trigger
+        output_data[:, cycle, 5] = r_cfd
+        output_data[:, cycle, 6] = r_bisection
+        output_data[:, cycle, 7] = resize(SUM_A >> A_SCALING, SIGNAL_FORMATS['u_v'], overflow_counters, 'u_v')
+        output_data[:, cycle, 8] = resize(SUM_B >> A_SCALING, SIGNAL_FORMATS['u_v'], overflow_counters, 'u_v')
+        output_data[:, cycle, 9] = r_final_trigger
+
+        ###### The rising clock edge. All clocked processes see the values from before the edge. ######
+
+        ## baseline_calculator.vhd, process final_trigger_count:
+        idle = (r_final_trigger_counter_state == FINAL_TRIGGER_COUNTER_IDLE)
+        new_r_final_trigger_counter = np.where(idle | (r_final_trigger == 1), 0, r_final_trigger_counter + 1)
+        new_r_final_trigger_counter_state = np.where(idle, np.where(r_final_trigger == 1, FINAL_TRIGGER_COUNTER_COUNTING, FINAL_TRIGGER_COUNTER_IDLE), np.where(r_final_trigger_counter > PULSE_WIDTH_BEFORE_RESET, FINAL_TRIGGER_COUNTER_IDLE, FINAL_TRIGGER_COUNTER_COUNTING))
+
+        ## baseline_calculator.vhd, process sequential:
+        average_minus_baseline = r_current_average - r_current_baseline
+        setup = (r_baseline_state == BASELINE_SETUP)
+        awake = (r_baseline_state == BASELINE_AWAKE)
+        sleeping = (r_baseline_state == BASELINE_SLEEPING)
+        rising = awake & (average_minus_baseline > THRESHOLD_RISING)                     ## baseline trigger: lock the baseline
+        falling = sleeping & (average_minus_baseline < THRESHOLD_FALLING)                ## trigger released
+        update = setup | (awake & ~rising & idle)                                        ## new data goes into the baseline buffer
+
+        new_r_current_average = resize(r_sample_buffer[:, 0] + r_sample_buffer[:, 1], SIGNAL_FORMATS['average_sum'], overflow_counters, 'average_sum') >> 1
+        new_r_current_baseline = np.where(update, resize(r_baseline_buffer[:, 0:16].sum(axis=1), SIGNAL_FORMATS['baseline_sum'], overflow_counters, 'baseline_sum') >> 4, np.where(rising, resize(r_baseline_buffer[:, 5:21].sum(axis=1), SIGNAL_FORMATS['baseline_sum'], overflow_counters, 'baseline_sum') >> 4, r_current_baseline))
+        new_r_baseline_buffer = np.where(update[:, np.newaxis], np.concatenate([r_sample_buffer[:, 0:1], r_baseline_buffer[:, 0:20]], axis=1), np.where(rising[:, np.newaxis], np.concatenate([r_baseline_buffer[:, 5:21], r_baseline_buffer[:, 16:21]], axis=1), r_baseline_buffer))
+        new_r_baseline_setup_counter = np.where(setup, r_baseline_setup_counter + 1, r_baseline_setup_counter)
+        new_r_baseline_state = np.where(setup & (r_baseline_setup_counter == BASELINE_SETUP_SAMPLES), BASELINE_AWAKE, np.where(rising, BASELINE_SLEEPING, np.where(falling, BASELINE_AWAKE, r_baseline_state)))
+        new_trigger = np.where(rising, 1, np.where(falling, 0, trigger))
+
+        ## baseline_selector.vhd: the 16-sample MA baseline, plus the reconstructed tails in the states 'triggered_pulse_0', ..., 'triggered_pulse_(N-2)' (i.e. while another pulse can still be accepted).
+        baseline_from_average = resize(r_current_baseline, SIGNAL_FORMATS['baseline_from_average'], overflow_counters, 'baseline_from_average')
+        subtract_tail = (r_OF_state != OF_WAITING) & (r_OF_state < max_pileup_pulses)
+        new_baseline_temp = baseline_from_average[:, np.newaxis] + np.where(subtract_tail[:, np.newaxis], r_reconstructed_pulse_temp, 0)
+
+        ## constant_fraction.vhd:
+        new_r_cfd_buffer = np.stack([r_cfd, r_cfd_buffer[:, 0]], axis=1)
+        new_r_cfd = r_sample_buffer[:, CFD_DELAY] - baseline_temp[:, CFD_DELAY] - (resize(r_sample_buffer[:, 0] - baseline_temp[:, 0], SIGNAL_FORMATS['cfd_attenuated'], overflow_counters, 'cfd_attenuated') >> 1)
+
+        armed = (r_cfd_state == CFD_WAITING) & (r_baseline_state == BASELINE_SLEEPING) & (r_bisection == 0)
+        found = armed & (r_cfd_buffer[:, 0] < 0) & (r_cfd >= 0) & (r_cfd - r_cfd_buffer[:, 0] > THRESHOLD_CFD)
+
+        ## main.vhd, process count_events (the instrumentation counters). The OF decision is combinatorial, so the OF counters see the decision made after the previous clock edge.
+        if counters is not None:
+            crossing = armed & (r_cfd_buffer[:, 0] < 0) & (r_cfd >= 0)
+            candidate = sleeping & (r_bisection > 0)
+            u = SUM_A >> A_SCALING
+            counters['cycles_setup'] += setup
+            counters['cycles_awake'] += awake
+            counters['cycles_sleeping'] += sleeping
+            counters['cycles_update_blocked'] += awake & ~rising & ~idle
+            counters['baseline_triggers'] += rising
+            counters['baseline_releases'] += falling
+            counters['cfd_crossings'] += crossing
+            counters['cfd_rejected_threshold'] += crossing & ~found
+            counters['cfd_triggers'] += found
+            counters['of_candidates'] += candidate
+            counters['of_rejected_amplitude'] += candidate & (u <= OF_AMPLITUDE_THRESHOLD)
+            counters['of_rejected_fraction'] += candidate & (u > OF_AMPLITUDE_THRESHOLD) & (u <= (r_Amplitude_previous_pulse >> OF_AMPLITUDE_THRESHOLD_FRACTION))
+            counters['final_triggers'] += r_final_trigger
+            counters['chain_overflows'] += r_chain_overflow
+            counters['cycles_OF_state'] += (r_OF_state[:, np.newaxis] == np.arange(max_pileup_pulses + 1))
+
+        ## The bisection into the BCFD windows, evaluating the linear interpolation between the two CFD samples at 50% and then at 25% or 75% (for four windows, as in constant_fraction.vhd), and so on:
+        bisection = BCFD_bisection(r_cfd_buffer[:, 0], r_cfd, n_windows, overflow_counters)
+
+        new_r_cfd_state = np.where(r_cfd_state == CFD_TRIGGERED, CFD_WAITING, np.where(found, CFD_TRIGGERED, r_cfd_state))
+        new_r_bisection = np.where(r_cfd_state == CFD_TRIGGERED, 0, np.where(found, bisection, r_bisection))
+
+        ## optimal_filter.vhd, process align_g. On the first clock cycle of pulse p, the OF sums are latched (for the tail reconstruction, if p < N - 1) and the amplitude is kept for the threshold on the next pulse. While another pulse can still be accepted, the templates of all pulses so far are aligned to their own counters; in the last state they are frozen (as the tails are no longer subtracted).
+        no_pulse = (r_OF_state == OF_WAITING)
+        followed = (r_OF_state[:, np.newaxis] > pulse_index)                 ## pulse p has been accepted in the current chain
+        first_sample = (r_OF_state[:, np.newaxis] == pulse_index + 1) & (pulse_counter == 0)
+
+        new_SUM_A_pulse = np.where(first_sample[:, :-1], (SUM_A >> A_SCALING)[:, np.newaxis], SUM_A_pulse)
+        new_SUM_B_pulse = np.where(first_sample[:, :-1], (SUM_B >> A_SCALING)[:, np.newaxis], SUM_B_pulse)
+        new_r_Amplitude_previous_pulse = np.where(first_sample.any(axis=1), SUM_A >> A_SCALING, np.where(no_pulse, 0, r_Amplitude_previous_pulse))
+
+        align = (followed[:, :-1] & subtract_tail[:, np.newaxis])[:, :, np.newaxis]
+        template_index = np.where((pulse_counter[:, :-1] < 100)[:, :, np.newaxis], np.minimum(pulse_counter[:, :-1, np.newaxis] + template_offsets, g_table.shape[1] - 1), g_table.shape[1] - 1)
+        new_g_value_aligned_pulse = np.where(align, g_table[r_cfd_window_pulse[:, :, np.newaxis], template_index], np.where(no_pulse[:, np.newaxis, np.newaxis], 0, g_value_aligned_pulse))
+        new_d_g_value_aligned_pulse = np.where(align, d_g_table[r_cfd_window_pulse[:, :, np.newaxis], template_index], np.where(no_pulse[:, np.newaxis, np.newaxis], 0, d_g_value_aligned_pulse))
+
+        new_pulse_counter = np.where(no_pulse[:, np.newaxis], 0, np.where(followed, pulse_counter + 1, pulse_counter))
+
+        ## main.vhd: push the sample from the file into the sample buffer.
+        new_r_sample_buffer = np.concatenate([data_from_file[:, np.newaxis], r_sample_buffer[:, 0:16]], axis=1)
+
+        ## main_tb.vhd: the sample read on this clock edge is seen by main.vhd on the next one.
+        data_from_file = input_data[:, cycle]
+        counter = counter + 1
+
+        ## Update all registers:
+        r_final_trigger_counter = new_r_final_trigger_counter
+        r_final_trigger_counter_state = new_r_final_trigger_counter_state
+        r_current_average = new_r_current_average
+        r_current_baseline = new_r_current_baseline
+        r_baseline_buffer = new_r_baseline_buffer
+        r_baseline_setup_counter = new_r_baseline_setup_counter
+        r_baseline_state = new_r_baseline_state
+        trigger = new_trigger
+        baseline_temp = new_baseline_temp
+        r_cfd_buffer = new_r_cfd_buffer
+        r_cfd = new_r_cfd
+        r_cfd_state = new_r_cfd_state
+        r_bisection = new_r_bisection
+        SUM_A_pulse = new_SUM_A_pulse
+        SUM_B_pulse = new_SUM_B_pulse
+        r_Amplitude_previous_pulse = new_r_Amplitude_previous_pulse
+        g_value_aligned_pulse = new_g_value_aligned_pulse
+        d_g_value_aligned_pulse = new_d_g_value_aligned_pulse
+        pulse_counter = new_pulse_counter
+        r_sample_buffer = new_r_sample_buffer
+
+        ###### The combinatorial logic, settling after the clock edge. ######
+
+        ## optimal_filter.vhd: the OF sums, using the coefficients of the BCFD window in cfd_time (all zero if cfd_time = 0). The FIR data are the 4 samples (minus baseline) delayed by 2 samples, oldest sample first.
+        FIR_data = resize(r_sample_buffer[:, 2 + FIR_LENGTH - 1:1:-1] - baseline_temp[:, 2 + FIR_LENGTH - 1:1:-1], SIGNAL_FORMATS['FIR_data'], overflow_counters, 'FIR_data')
+        SUM_A = (coefficients_a[r_bisection] * FIR_data).sum(axis=1)
+        SUM_B = (coefficients_b[r_bisection] * FIR_data).sum(axis=1)
+
+        ## optimal_filter.vhd, the process determining the OF state and the final trigger. In the VHDL code this is a combinatorial process, so the state changes as soon as the OF sums are available (and not on the next clock edge).
+        u = SUM_A >> A_SCALING
+        accepted = (r_baseline_state == BASELINE_SLEEPING) & (r_bisection > 0) & (u > OF_AMPLITUDE_THRESHOLD) & (u > (r_Amplitude_previous_pulse >> OF_AMPLITUDE_THRESHOLD_FRACTION))
+        ## A pulse accepted in state 'waiting' or 'triggered_pulse_p' (p < N - 1) is pulse p + 1 of the chain and gives a final trigger. In the last state ('triggered_pulse_(N-1)'), a further pulse cannot be handled: the OF returns to 'waiting' without a final trigger.
+        r_final_trigger = (accepted & (r_OF_state < max_pileup_pulses)).astype(np.int64)
+        r_chain_overflow = (accepted & (r_OF_state == max_pileup_pulses)).astype(np.int64)
+        r_cfd_window_pulse = np.where(accepted[:, np.newaxis] & (r_OF_state[:, np.newaxis] == tail_index), r_bisection[:, np.newaxis], r_cfd_window_pulse)
+        r_OF_state = np.where(r_baseline_state != BASELINE_SLEEPING, OF_WAITING, np.where(accepted, np.where(r_OF_state < max_pileup_pulses, r_OF_state + 1, OF_WAITING), r_OF_state))
+
+        ## optimal_filter.vhd, the tail reconstruction (the Reconstruction_mult_gen multipliers followed by the shifts, one set per pulse), summed over the pulses in the chain. Note the reversed order: Reconstructed(0) is calculated from the template values with index 3.
+        g_part = resize(SUM_A_pulse, SIGNAL_FORMATS['SUM_pulse'], overflow_counters, 'SUM_pulse')[:, :, np.newaxis] * g_value_aligned_pulse[:, :, ::-1]
+        d_g_part = resize(SUM_B_pulse, SIGNAL_FORMATS['SUM_pulse'], overflow_counters, 'SUM_pulse')[:, :, np.newaxis] * d_g_value_aligned_pulse[:, :, ::-1]
+        Reconstructed_part = resize((g_part >> (G_PRECISION - TAU_SCALING)) - (d_g_part >> D_G_PRECISION), SIGNAL_FORMATS['Reconstructed_part'], overflow_counters, 'Reconstructed_part')
+        new_Reconstructed = resize((Reconstructed_part >> TAU_SCALING).sum(axis=1), SIGNAL_FORMATS['Reconstructed'], overflow_counters, 'Reconstructed')
+
+        ## The process reconstruct_g only runs when Reconstructed *changes*. Each time, the four new values are pushed into r_reconstructed_pulse_temp and the old ones are pushed back. If Reconstructed does not change, the buffer is left as it is (also when a new pulse arrives, so old values can be used for the first clock cycles of a new pulse).
+        changed = np.any(new_Reconstructed != Reconstructed, axis=1)
+        r_reconstructed_pulse_temp = np.where(changed[:, np.newaxis], np.concatenate([new_Reconstructed, r_reconstructed_pulse_temp[:, 3:8]], axis=1), r_reconstructed_pulse_temp)
+        Reconstructed = new_Reconstructed
+
+    state = {
+        'counter': counter,
+        'data_from_file': data_from_file,
+        'r_sample_buffer': r_sample_buffer,
+        'r_current_average': r_current_average,
+        'r_current_baseline': r_current_baseline,
+        'r_baseline_state': r_baseline_state,
+        'r_baseline_setup_counter': r_baseline_setup_counter,
+        'r_baseline_buffer': r_baseline_buffer,
+        'trigger': trigger,
+        'r_final_trigger_counter': r_final_trigger_counter,
+        'r_final_trigger_counter_state': r_final_trigger_counter_state,
+        'baseline_temp': baseline_temp,
+        'r_cfd': r_cfd,
+        'r_cfd_buffer': r_cfd_buffer,
+        'r_bisection': r_bisection,
+        'r_cfd_state': r_cfd_state,
+        'SUM_A': SUM_A,
+        'SUM_B': SUM_B,
+        'r_OF_state': r_OF_state,
+        'r_final_trigger': r_final_trigger,
+        'r_chain_overflow': r_chain_overflow,
+        'r_cfd_window_pulse': r_cfd_window_pulse,
+        'pulse_counter': pulse_counter,
+        'SUM_A_pulse': SUM_A_pulse,
+        'SUM_B_pulse': SUM_B_pulse,
+        'r_Amplitude_previous_pulse': r_Amplitude_previous_pulse,
+        'g_value_aligned_pulse': g_value_aligned_pulse,
+        'd_g_value_aligned_pulse': d_g_value_aligned_pulse,
+        'Reconstructed': Reconstructed,
+        'r_reconstructed_pulse_temp': r_reconstructed_pulse_temp,
+    }
+
+    if single_lane:
+        output_data = output_data[0]
+
+    return output_data, state
+
+
+## Some registers keep old values that can no longer influence the output. The BCFD window and the OF sums of pulse p are always overwritten before they are used again if pulse p has not yet been accepted in the current chain (in particular, when the OF is in state 'waiting'), and in state 'waiting' only elements 0 to 3 of r_reconstructed_pulse_temp (which then hold zeros) can reach the CFD or the OF before they are overwritten. Set these registers to zero, so that states which behave identically also compare equal.
+def comparable_state(state):
+    waiting = (state['r_OF_state'] == OF_WAITING)
+    not_accepted = (state['r_OF_state'][:, np.newaxis] <= np.arange(state['SUM_A_pulse'].shape[1]))
+    comparable = dict(state)
+    comparable['r_cfd_window_pulse'] = np.where(not_accepted, 0, state['r_cfd_window_pulse'])
+    comparable['SUM_A_pulse'] = np.where(not_accepted, 0, state['SUM_A_pulse'])
+    comparable['SUM_B_pulse'] = np.where(not_accepted, 0, state['SUM_B_pulse'])
+    comparable['r_reconstructed_pulse_temp'] = state['r_reconstructed_pulse_temp'].copy()
+    comparable['r_reconstructed_pulse_temp'][waiting, 4:] = 0
+    return comparable
+
+
+## Run the pipeline over one long pulse train, by cutting it into segments that are processed in parallel (as lanes in run_pipeline). Each segment (except the first) is started warmup_length samples early from the initial state, so that it has time to settle. To make sure the result is *identical* to running the whole pulse train in one go, the state of each segment at the start of its own data is compared to the state at the end of the preceding segment. Since the design is deterministic, identical states mean identical outputs from then on. If the states differ (e.g. if a pulse tail was being reconstructed at the segment boundary), the segment is processed again, starting from the state at the end of the preceding segment.
+def run_pipeline_segmented(input_data, segment_length=2000, warmup_length=500, coefficients=None, max_pileup_pulses=MAX_PILEUP_PULSES, counters=None, overflow_counters=None, thresholds=None):
+    return run_segments(input_data, None, segment_length, warmup_length, coefficients, max_pileup_pulses, counters, overflow_counters, thresholds)[0]
+
+
+## Same as run_pipeline_segmented, but starting from state (a single-lane state from run_pipeline, or None for the initial state), and also returning the state at the end of the last segment. That is the state after the last sample of input_data (as returned by run_pipeline) if the last segment ends there, i.e. if len(input_data) is warmup_length + n*segment_length for some n >= 1, or at most warmup_length + segment_length (see run_pipeline_stream). Otherwise, the last segment runs on into zeros.
+##
+## thresholds are passed on to run_pipeline.
+##
+## With counters (a single-lane set from initial_counters), the instrumentation counters of the whole pulse train are added to it in place. Only the samples of each segment's own data are counted, and a segment that is processed again is counted again from zero. So that no zeros beyond the end are counted, the samples after the last complete segment are then processed as a single lane (which also makes the returned state exact). overflow_counters are passed on to run_pipeline as they are: the values of the warm-up and of segments that are processed again are checked as well, so the number of values checked is somewhat larger than the number of samples (but any overflow in the pulse train is counted).
+def run_segments(input_data, state=None, segment_length=2000, warmup_length=500, coefficients=None, max_pileup_pulses=MAX_PILEUP_PULSES, counters=None, overflow_counters=None, thresholds=None):
+    input_data = np.asarray(input_data, dtype=np.int64)
+    n_cycles = len(input_data)
+
+    if (n_cycles <= segment_length + warmup_length):
+        return run_pipeline(input_data, state, coefficients, max_pileup_pulses, counters, overflow_counters, thresholds)
+    if state is not None:
+        max_pileup_pulses = state['pulse_counter'].shape[1]
+
+    n_complete = warmup_length + segment_length*((n_cycles - warmup_length)//segment_length)
+    if (counters is not None) and (n_complete < n_cycles):
+        complete_output, state = run_segments(input_data[:n_complete], state, segment_length, warmup_length, coefficients, max_pileup_pulses, counters, overflow_counters, thresholds)
+        remaining_output, state = run_pipeline(input_data[n_complete:], state, coefficients, max_pileup_pulses, counters, overflow_counters, thresholds)
+        return np.concatenate([complete_output, remaining_output]), state
+
+    ## Segment 0 starts at 0 and runs for warmup_length + segment_length samples. Segment j > 0 covers samples [start_j, start_j + segment_length), and is started warmup_length samples earlier.
+    n_segments = 1 + int(np.ceil((n_cycles - (segment_length + warmup_length))/segment_length))
+    segment_starts = warmup_length + segment_length*np.arange(n_segments)
+    segment_starts[0] = 0
+    lane_starts = segment_starts - warmup_length
+    lane_starts[0] = 0
+
+    padded_data = np.concatenate([input_data, np.zeros(warmup_length + segment_length, dtype=np.int64)])
+    lane_data = padded_data[lane_starts[:, np.newaxis] + np.arange(warmup_length + segment_length)]
+
+    ## All segments are started from the initial state, except segment 0 if a state is passed in. Segment 0 then runs from that state (its 'warm-up' samples are real data), and the counter continues from it.
+    lane_state = initial_state(n_segments, max_pileup_pulses)
+    first_counter = 0 if (state is None) else state['counter'][0]
+    lane_state['counter'] = first_counter + lane_starts
+    if state is not None:
+        replace_lanes(lane_state, [0], state)
+
+    ## The warm-up is only counted for segment 0, for which it is real data.
+    warmup_counters = None if (counters is None) else initial_counters(n_segments, max_pileup_pulses)
+    segment_counters = None if (counters is None) else initial_counters(n_segments, max_pileup_pulses)
+
+    warmup_output, start_state = run_pipeline(lane_data[:, :warmup_length], lane_state, coefficients, counters=warmup_counters, overflow_counters=overflow_counters, thresholds=thresholds)
+    segment_output, end_state = run_pipeline(lane_data[:, warmup_length:], start_state, coefficients, counters=segment_counters, overflow_counters=overflow_counters, thresholds=thresholds)
+
+    ## Segment 0 starts from the true initial state, so it is correct by construction. Any segment that did not start from the state at the end of the preceding segment is processed again, starting from that state. All such segments are processed in parallel, and this is repeated until all segment boundaries agree (usually after one or two passes), at which point the result is the same as for one continuous run.
+    while True:
+        comparable_end_state = comparable_state(end_state)
+        comparable_start_state = comparable_state(start_state)
+        states_agree = np.ones(n_segments - 1, dtype=bool)
+        for key in end_state:
+            states_agree &= (comparable_end_state[key][:-1] == comparable_start_state[key][1:]).reshape(n_segments - 1, -1).all(axis=1)
+
+        redo = np.where(~states_agree)[0] + 1
+        if (len(redo) == 0):
+            break
+
+        redo_start_state = select_lanes(end_state, redo - 1)
+        redo_counters = None if (counters is None) else initial_counters(len(redo), max_pileup_pulses)
+        redo_output, redo_end_state = run_pipeline(lane_data[redo, warmup_length:], redo_start_state, coefficients, counters=redo_counters, overflow_counters=overflow_counters, thresholds=thresholds)
+        segment_output[redo] = redo_output
+        replace_lanes(start_state, redo, redo_start_state)
+        replace_lanes(end_state, redo, redo_end_state)
+        if counters is not None:
+            replace_lanes(segment_counters, redo, redo_counters)
+
+    if counters is not None:
+        for key in counters:
+            counters[key] += warmup_counters[key][0] + segment_counters[key].sum(axis=0)
+
+    output_data = np.concatenate([warmup_output[0], segment_output.reshape(-1, len(OUTPUT_COLUMNS))])
+
+    return output_data[:n_cycles], select_lanes(end_state, [n_segments - 1])
+
+
+## Process the next block of a continuous stream of samples (e.g. from a digitiser), continuing from stream_state (None at the start of the stream). As in run_pipeline_segmented, the block is cut into segments that are processed in parallel, but only as far as the segments end exactly at a sample boundary that the state is known for: the remaining samples (fewer than segment_length) are held back in stream_state and processed at the start of the next block, so the output lags the input by up to segment_length samples. Pass flush=True with the last block to process everything. Returns the output for the samples processed (same 10 columns as run_pipeline) and the new stream state: the state of the pipeline ('pipeline') and the samples held back ('pending'). counters, overflow_counters and thresholds are as in run_segments.
+def run_pipeline_stream(input_data, stream_state=None, coefficients=None, flush=False, segment_length=2000, warmup_length=500, max_pileup_pulses=MAX_PILEUP_PULSES, counters=None, overflow_counters=None, thresholds=None):
+    if stream_state is None:
+        stream_state = {'pipeline': initial_state(1, max_pileup_pulses), 'pending': np.zeros(0, dtype=np.int64)}
+    input_data = np.concatenate([stream_state['pending'], np.asarray(input_data, dtype=np.int64)])
+
+    if flush:
+        n_processed = len(input_data)
+    elif (len(input_data) < segment_length + warmup_length):
+        n_processed = 0
+    else:
+        n_processed = warmup_length + segment_length*((len(input_data) - warmup_length)//segment_length)
+
+    if (n_processed == 0):
+        return np.zeros((0, len(OUTPUT_COLUMNS)), dtype=np.int64), {'pipeline': stream_state['pipeline'], 'pending': input_data}
+
+    ## With flush, the state at the end is not needed, so the last segment may run on into zeros.
+    output_data, state = run_segments(input_data[:n_processed], stream_state['pipeline'], segment_length, warmup_length, coefficients, counters=counters, overflow_counters=overflow_counters, thresholds=thresholds)
+    return output_data, {'pipeline': state, 'pending': input_data[n_processed:]}
+
+
+## The default files: the input data (from generate_pulse_data.py) and the outputs, as written by main_tb.vhd.
+INPUT_FILE = os.path.join(DATA_DIRECTORY, 'input_data.bin')
+OUTPUT_FILE = os.path.join(DATA_DIRECTORY, 'output_data.bin')
+RECORDS_FILE = os.path.join(DATA_DIRECTORY, 'feature_records.bin')
+SNAPSHOTS_FILE = os.path.join(DATA_DIRECTORY, 'snapshots.bin')
+
+
+## Emulate the VHDL simulation: read the input data (from generate_pulse_data.py) and write the output in the same format as main_tb.vhd (to be analysed by reconstruct_A_and_T.py and visualise_data.py). With --feature-records, only the zero-suppressed feature records (one per final trigger, see feature_records.py) are written, like main_tb.vhd with FEATURE_RECORDS set, and optionally the raw samples around each final trigger.
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Bit-exact emulation of the VHDL feature extraction.')
+    parser.add_argument('--input-file', default=INPUT_FILE, help='the input data')
+    parser.add_argument('--output-file', default=OUTPUT_FILE, help='the 10 columns for every clock cycle')
+    parser.add_argument('--records-file', default=RECORDS_FILE, help='the feature records (with --feature-records)')
+    parser.add_argument('--snapshots-file', default=SNAPSHOTS_FILE, help='the raw-sample snapshots (with --snapshot)')
+    parser.add_argument('--feature-records', action='store_true', help='write the feature records (--records-file) instead of the 10 columns for every clock cycle (--output-file)')
+    parser.add_argument('--snapshot', nargs=2, type=int, default=(0, 0), metavar=('N_BEFORE', 'N_AFTER'), help='with --feature-records, also write N_BEFORE + N_AFTER raw samples around each final trigger (--snapshots-file)')
+    parser.add_argument('--check-overflows', action='store_true', help='check all resized signals for values that do not fit (and wrap), and print a report')
+    args = parser.parse_args(argv)
+
+    header, input_data = open_data_file(args.input_file)
+
+    overflow_counters = {} if args.check_overflows else None
+    output_data = run_pipeline_segmented(input_data['sample'].astype(np.int64), overflow_counters=overflow_counters)
+    if args.check_overflows:
+        print_overflow_report(overflow_counters, SIGNAL_FORMATS)
+
+    if args.feature_records:
+        n_before, n_after = args.snapshot
+        records, snapshots = make_feature_records(make_rows(output_data, OUTPUT_DTYPE), n_before, n_after)
+        write_data_file(args.records_file, records, FEATURE_RECORD_DTYPE, header['N_EMPTY_WAVEFORMS'], header['N_REAL_WAVEFORMS'], header['N_SAMPLES_PER_WAVEFORM'])
+        if snapshots is not None:
+            write_data_file(args.snapshots_file, snapshots, snapshots.dtype, header['N_EMPTY_WAVEFORMS'], header['N_REAL_WAVEFORMS'], header['N_SAMPLES_PER_WAVEFORM'])
+    else:
+        write_data_file(args.output_file, output_data, OUTPUT_DTYPE, header['N_EMPTY_WAVEFORMS'], header['N_REAL_WAVEFORMS'], header['N_SAMPLES_PER_WAVEFORM'])
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import numpy as np
+from numpy.lib import recfunctions
+from data_format import FEATURE_RECORD_DTYPE, snapshot_dtype
+
+## Zero-suppressed output of the feature extraction. The output data (OUTPUT_DTYPE, the 10 columns written by main_tb.vhd for every clock cycle) are mostly for debugging: only the rows with final_trigger = 1 carry the physics (the BCFD window and the OF outputs u and v). Here, one feature record (FEATURE_RECORD_DTYPE) is made per final trigger instead, which is ~100 times smaller and can be used directly by reconstruct_A_and_T.py. main_tb.vhd writes the same records if FEATURE_RECORDS is set.
+##
+## The pile-up flag is set if the pulse arrived on the tail of a preceding pulse, that is, if there has already been a final trigger since the baseline_calculator last triggered (so the OF has reconstructed the tail of the preceding pulse(s) when analysing this one).
+##
+## Optionally, a snapshot of the raw samples around each final trigger (n_before samples before it and n_after samples from it on) is kept for debugging. The samples are taken from a ring buffer holding the most recent n_before + n_after samples, so the data can be processed block by block, as in the firmware, where the raw data are gone once they have passed.
+
+
+## Make the feature records for the final triggers in a block of output rows (OUTPUT_DTYPE). in_chain says whether there was a final trigger in the preceding blocks since the baseline last triggered (False at the start of the data). Returns the records and in_chain at the end of the block, to be passed in with the next block.
+def extract_feature_records(output_rows, in_chain=False):
+    trigger_rows = np.flatnonzero(output_rows['final_trigger'] == 1)
+
+    ## The baseline trigger splits the data into runs: the run number counts the rows without baseline trigger so far. A final trigger is a pile-up if the preceding final trigger is in the same run (run 0 continues the run at the end of the preceding block).
+    run = np.cumsum(output_rows['trigger'] == 0)
+    trigger_run = run[trigger_rows]
+    pileup = np.zeros(len(trigger_rows), dtype=bool)
+    pileup[1:] = (trigger_run[1:] == trigger_run[:-1])
+    if (len(trigger_rows) > 0):
+        pileup[0] = in_chain and (trigger_run[0] == 0)
+        in_chain = (trigger_run[-1] == run[-1])
+    elif (len(run) > 0):
+        in_chain = in_chain and (run[-1] == 0)
+
+    records = np.zeros(len(trigger_rows), dtype=FEATURE_RECORD_DTYPE)
+    records['timestamp'] = output_rows['counter'][trigger_rows]
+    records['cfd_time'] = output_rows['cfd_time'][trigger_rows]
+    records['u'] = output_rows['u'][trigger_rows]
+    records['v'] = output_rows['v'][trigger_rows]
+    records['pileup'] = pileup
+
+    return records, bool(in_chain)
+
+
+## The state of the raw-sample ring buffer: the most recent n_before + n_after samples (zeros before the start of the data) and the timestamps of the final triggers for which not all n_after samples have arrived yet.
+def initial_snapshot_state(n_before, n_after):
+    return {'samples': np.zeros(n_before + n_after, dtype=np.uint16), 'pending': np.zeros(0, dtype=np.int64)}
+
+
+## Take the snapshots for a block of raw samples, starting at first_timestamp (the blocks must follow each other without gaps), and the timestamps of the final triggers in it. Returns the completed snapshots (snapshot_dtype) and the new state of the ring buffer.
+def take_snapshots(samples, first_timestamp, trigger_timestamps, state, n_before, n_after):
+    buffer = np.concatenate([state['samples'], np.asarray(samples, dtype=np.uint16)])
+    buffer_start = first_timestamp - len(state['samples'])
+    end = first_timestamp + len(samples)
+
+    timestamps = np.concatenate([state['pending'], np.asarray(trigger_timestamps, dtype=np.int64)])
+    complete = (timestamps + n_after <= end)
+
+    snapshots = np.zeros(np.count_nonzero(complete), dtype=snapshot_dtype(n_before + n_after))
+    snapshots['timestamp'] = timestamps[complete]
+    snapshots['first_timestamp'] = timestamps[complete] - n_before
+    window = buffer[snapshots['first_timestamp'][:, np.newaxis] - buffer_start + np.arange(n_before + n_after)]
+    for i in range(n_before + n_after):
+        snapshots['sample_' + str(i)] = window[:, i]
+
+    state = {'samples': buffer[len(buffer) - (n_before + n_after):], 'pending': timestamps[~complete]}
+    return snapshots, state
+
+
+## At the end of the data, complete the pending snapshots (the samples after the end of the data are set to zero).
+def finish_snapshots(end_timestamp, state, n_before, n_after):
+    return take_snapshots(np.zeros(n_after, dtype=np.uint16), end_timestamp, np.zeros(0, dtype=np.int64), state, n_before, n_after)[0]
+
+
+## The raw samples of the snapshots as a 2-D array (one row per snapshot).
+def snapshot_samples(snapshots):
+    return recfunctions.structured_to_unstructured(snapshots[[name for name in snapshots.dtype.names if name.startswith('sample_')]])
+
+
+## Feature records and (if n_before + n_after > 0) snapshots for a whole pulse train, from the output rows of the emulator (or of the VHDL simulation), processed in blocks of block_length clock cycles. The raw samples are the data_in column, and the timestamps are the counter column.
+def make_feature_records(output_rows, n_before=0, n_after=0, block_length=1000000):
+    in_chain = False
+    snapshot_state = initial_snapshot_state(n_before, n_after)
+    records = []
+    snapshots = []
+    for block_start in range(0, len(output_rows), block_length):
+        block = output_rows[block_start:block_start + block_length]
+        block_records, in_chain = extract_feature_records(block, in_chain)
+        records.append(block_records)
+        if (n_before + n_after > 0):
+            block_snapshots, snapshot_state = take_snapshots(block['data_in'], block['counter'][0], block_records['timestamp'], snapshot_state, n_before, n_after)
+            snapshots.append(block_snapshots)
+
+    records = np.concatenate(records) if records else np.zeros(0, dtype=FEATURE_RECORD_DTYPE)
+    if (n_before + n_after == 0):
+        return records, None
+
+    end_timestamp = output_rows['counter'][-1] + 1 if (len(output_rows) > 0) else 0
+    snapshots.append(finish_snapshots(end_timestamp, snapshot_state, n_before, n_after))
+    return records, np.concatenate(snapshots)
@@ -0,0 +1,129 @@
+import numpy as np
+
+## Fixed-point arithmetic on numpy arrays, shared by the calibration (OF_calibration.py), the bit-exact model of the VHDL code (emulate_VHDL.py) and the design-space exploration (design_sweep.py), so that all of them quantise, shift and resize in the same way as the VHDL code (numeric_std).
+##
+## A fixed-point format is a dictionary (see fixed_format) with the width in bits, whether the value is signed, the number of fraction bits (the stored integer is the real value times 2^fraction_bits), the rounding used when bits are dropped, and what happens to a value that does not fit in the width:
+##   rounding:  'floor' (towards minus infinity, like shift_right on a signed value in VHDL and >> in numpy), 'truncate' (towards zero, like int() or .astype(int)) or 'round' (to the nearest, halves to even, like np.round)
+##   overflow:  'wrap' (keep the least significant bits, like to_signed/to_unsigned/resize in numeric_std), 'saturate' (clip to the largest/smallest value) or 'error' (raise an OverflowError)
+##
+## The values themselves are ordinary int64 numpy arrays holding the stored integers, so that all numpy operations work on them, on millions of values at once. Whenever values are brought into a format (quantise, resize, shift_right), the values that do not fit can be counted in an overflow-counter dictionary: for each name, the number of values checked, the number of overflows and the smallest and largest value seen (so that the number of bits actually needed follows, see required_width and print_overflow_report).
+
+ROUNDING_MODES = ('floor', 'truncate', 'round')
+OVERFLOW_MODES = ('wrap', 'saturate', 'error')
+
+
+def fixed_format(width, signed=True, fraction_bits=0, rounding='floor', overflow='wrap'):
+    if not (1 <= width <= 63):
+        raise ValueError('The width must be between 1 and 63 bits (the values are stored as int64), not ' + str(width))
+    if rounding not in ROUNDING_MODES:
+        raise ValueError('Unknown rounding mode ' + repr(rounding) + ', expected one of ' + ', '.join(ROUNDING_MODES))
+    if overflow not in OVERFLOW_MODES:
+        raise ValueError('Unknown overflow mode ' + repr(overflow) + ', expected one of ' + ', '.join(OVERFLOW_MODES))
+    return {'width': width, 'signed': signed, 'fraction_bits': fraction_bits, 'rounding': rounding, 'overflow': overflow}
+
+
+## The smallest and largest stored integer of a format.
+def value_range(fmt):
+    if fmt['signed']:
+        return -(1 << (fmt['width'] - 1)), (1 << (fmt['width'] - 1)) - 1
+    return 0, (1 << fmt['width']) - 1
+
+
+## numeric_std conversions: to_signed/to_unsigned keep the n_bits least significant bits (which is what numeric_std does, apart from issuing a warning, if the value does not fit). Note that shift_right on a signed value is an arithmetic shift, which is what the >> operator does on numpy integers.
+def to_signed(x, n_bits):
+    return ((x + (1 << (n_bits - 1))) & ((1 << n_bits) - 1)) - (1 << (n_bits - 1))
+
+def to_unsigned(x, n_bits):
+    return x & ((1 << n_bits) - 1)
+
+
+## Add values to the overflow counters (if any) under name. overflowed marks the values that do not fit.
+def count_overflows(overflow_counters, name, values, overflowed):
+    if (overflow_counters is None) or (values.size == 0):
+        return
+    counter = overflow_counters.setdefault(name, {'n_values': 0, 'n_overflows': 0, 'min': int(values.min()), 'max': int(values.max())})
+    counter['n_values'] += values.size
+    counter['n_overflows'] += int(np.count_nonzero(overflowed))
+    counter['min'] = min(counter['min'], int(values.min()))
+    counter['max'] = max(counter['max'], int(values.max()))
+
+
+## Bring integer values into a format, according to its overflow mode (the fraction bits are not changed: the values must already have the fraction bits of the format). With overflow_counters, the overflows are counted under name. Without counters and with wrapping, nothing is checked, which is as fast as to_signed/to_unsigned.
+def resize(values, fmt, overflow_counters=None, name=None):
+    if (overflow_counters is not None) or (fmt['overflow'] != 'wrap'):
+        values = np.asarray(values, dtype=np.int64)
+        low, high = value_range(fmt)
+        overflowed = (values < low) | (values > high)
+        count_overflows(overflow_counters, name, values, overflowed)
+        if (fmt['overflow'] == 'error') and overflowed.any():
+            raise OverflowError(str(int(np.count_nonzero(overflowed))) + ' value(s) of ' + str(name) + ' do not fit in ' + describe_format(fmt) + ' (range ' + str(int(values.min())) + ' to ' + str(int(values.max())) + ')')
+        if (fmt['overflow'] == 'saturate'):
+            return np.clip(values, low, high)
+
+    if fmt['signed']:
+        return to_signed(values, fmt['width'])
+    return to_unsigned(values, fmt['width'])
+
+
+## Shift integer values right by n_bits (left if n_bits is negative), dropping the low bits with the given rounding.
+def round_shift(values, n_bits, rounding='floor'):
+    values = np.asarray(values, dtype=np.int64)
+    if (n_bits <= 0):
+        return values << -n_bits
+    if (rounding == 'floor'):
+        return values >> n_bits
+    if (rounding == 'truncate'):
+        return np.where(values < 0, -((-values) >> n_bits), values >> n_bits)
+    if (rounding == 'round'):
+        shifted = values >> n_bits
+        remainder = values - (shifted << n_bits)
+        half = 1 << (n_bits - 1)
+        return shifted + ((remainder > half) | ((remainder == half) & (shifted % 2 == 1)))
+    raise ValueError('Unknown rounding mode ' + repr(rounding))
+
+
+## shift_right followed by a resize to fmt (with the rounding of fmt), e.g. the OF sums shifted by a_scaling into the output width.
+def shift_right(values, n_bits, fmt, overflow_counters=None, name=None):
+    return resize(round_shift(values, n_bits, fmt['rounding']), fmt, overflow_counters, name)
+
+
+## Quantise real values to a format: scale by 2^fraction_bits, round, and resize (e.g. the OF coefficients and templates).
+def quantise(x, fmt, overflow_counters=None, name=None):
+    scaled = np.asarray(x, dtype=float)*np.power(2., fmt['fraction_bits'])
+    if (fmt['rounding'] == 'floor'):
+        rounded = np.floor(scaled)
+    elif (fmt['rounding'] == 'truncate'):
+        rounded = np.trunc(scaled)
+    else:
+        rounded = np.round(scaled)
+    return resize(rounded.astype(np.int64), fmt, overflow_counters, name)
+
+
+## The real values of stored integers with the given number of fraction bits (a format, or the number itself).
+def to_real(values, fraction_bits):
+    if isinstance(fraction_bits, dict):
+        fraction_bits = fraction_bits['fraction_bits']
+    return np.asarray(values)/np.power(2., fraction_bits)
+
+
+## The smallest width that holds the integers from low to high.
+def required_width(low, high, signed=True):
+    if signed:
+        return max(int(-low - 1).bit_length() if (low < 0) else 0, int(high).bit_length()) + 1
+    if (low < 0):
+        raise ValueError('An unsigned format cannot hold ' + str(low))
+    return max(int(high).bit_length(), 1)
+
+
+def describe_format(fmt):
+    return ('signed' if fmt['signed'] else 'unsigned') + '(' + str(fmt['width'] - 1) + ' downto 0)' + ((', ' + str(fmt['fraction_bits']) + ' fraction bits') if fmt['fraction_bits'] else '')
+
+
+## Print the overflow counters: per name, the values checked, the overflows and the range seen, with the width it needs (signed, unless formats says otherwise).
+def print_overflow_report(overflow_counters, formats=None):
+    print('{:<28}{:>14}{:>12}{:>16}{:>16}{:>8}{:>8}'.format('signal', 'values', 'overflows', 'min', 'max', 'width', 'needed'))
+    for name, counter in overflow_counters.items():
+        fmt = None if (formats is None) else formats.get(name)
+        signed = True if (fmt is None) else fmt['signed']
+        width = '' if (fmt is None) else str(fmt['width'])
+        print('{:<28}{:>14}{:>12}{:>16}{:>16}{:>8}{:>8}'.format(name, counter['n_values'], counter['n_overflows'], counter['min'], counter['max'], width, required_width(counter['min'], counter['max'], signed)))
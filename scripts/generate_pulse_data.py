@@ -1,18 +1,17 @@
+import argparse
+import os
 import numpy as np
-import matplotlib.pyplot as plt
+from data_format import INPUT_DTYPE, MC_truth_dtype, create_data_file, append_rows, make_rows, DATA_DIRECTORY
 
-## The lognormal function. Assumed to be the shape of the raw detector pulses in this example case.
-def generate_lognormal_signal(t, A, T0, mu, sigma, N_SAMPLES):
+## Generate the pulse trains and the MC truth data. The work is done by generate_pulse_data(), which takes the data directory and the settings as arguments, so it can be called from other code as well (benchmark.py and dead_time.py generate data for many settings this way). main() is the command-line entry point. Nothing is generated on import, and matplotlib is only imported to plot the pulse train (--plot).
 
-    signal = np.zeros(N_SAMPLES)                                                    ## will contain the actual signal (i. e. not including the baseline and baseline noise)
+## The lognormal function. Assumed to be the shape of the raw detector pulses in this example case. The inputs are numpy arrays that are broadcast against each other, so the signal for many pulses (and many samples) is calculated in one go. E.g. t with shape (1, N_SAMPLES) and A, T0 with shape (N_PULSES, 1) gives one row per pulse.
+def generate_lognormal_signal(t, A, T0, mu, sigma):
+    t_since_T0 = t - T0
+    after_T0 = (t_since_T0 > 0.)
+    t_since_T0 = np.where(after_T0, t_since_T0, 1.)                     ## avoid taking the log of values <= 0 (the signal is zero there anyway)
 
-    for sample_no in range(N_SAMPLES):
-        if (t[sample_no] > T0):
-            signal[sample_no] = A*np.exp(mu - np.power(sigma, 2)/2.)*(1./(t[sample_no]-T0))*np.exp(-np.power(np.log(t[sample_no]-T0)-mu, 2)/(2.*sigma*sigma))
-        else:
-            signal[sample_no] = 0.
-
-    return signal
+    return np.where(after_T0, A*np.exp(mu - np.power(sigma, 2)/2.)*(1./t_since_T0)*np.exp(-np.power(np.log(t_since_T0)-mu, 2)/(2.*sigma*sigma)), 0.)
 
 
 
@@ -20,35 +19,37 @@ N_SAMPLES_PER_WAVEFORM = 100                 ## each waveform should be 100 samp
 N_EMPTY_WAVEFORMS = 1                       ## because the VHDL algorithm needs some time for initialisation, the first waveforms (i. e. the first 100 samples are "empty", so just baseline and no signal). This will allow the VHDL algorithm to find an accurate baseline.
 N_REAL_WAVEFORMS = 10000               ## how many waveforms (with signals) to generate
 
+## The data are generated (and written to file) in chunks of this many waveforms, so that the full pulse train never has to be kept in memory. Each chunk uses its own random number generator, seeded with (SEED, chunk number), so the output is reproducible for a given SEED and CHUNK_N_WAVEFORMS.
+CHUNK_N_WAVEFORMS = 1000
+SEED = 1
+
+## By default, the data of a single ADC channel are written to DATA_DIR. With a channel number, the data of one channel of a multi-channel dataset (see multichannel.py) are written to the 'channels' directory in DATA_DIR instead, with the channel number appended to the file names (e.g. input_data_007.bin). Each channel gets its own random numbers, seeded with (SEED, chunk number, channel).
+DATA_DIR = DATA_DIRECTORY
+
 ## Set the properties of the baseline. Here, assumed to be a constant value with a Gaussian noise (with sigma = baseline_gen_sigma)
 baseline_gen_mu = 1000.
 baseline_gen_sigma = 2.
 
 
-## For each waveform (that is, each 100 samples), generate two pulses. This is done to test the pile-up reconstruction capabilities of the algorithm. Also, we want both the amplitude A and start time T0 of each of the two pulses to be generated randomly (within some ranges). This is done to get a good distribution with respect to the sampling clock (i.e. the algorithm should work independently of the phase of the pulse w.r.t. the sampling clock)
+## The pulses in the pulse train are generated in one of two ways:
+## 1. If PULSE_RATE is None: for each waveform (that is, each 100 samples), generate N_PULSES_PER_WAVEFORM pulses. The first pulse has a start time T0 in the range [T0_0_min, T0_0_max] (in the waveform), and each following pulse arrives a time Delta_T0 after the previous one. This is done to test the pile-up reconstruction capabilities of the algorithm (with N_PULSES_PER_WAVEFORM = 2, there is one pile-up pulse per waveform).
+## 2. If PULSE_RATE is set: the pulses arrive at random times (a Poisson process) with a mean rate of PULSE_RATE pulses per sample, independent of the waveform boundaries. This is used to test the algorithm at a given (high) rate. The pulses are stored in the MC truth data of the waveform in which they start.
+## In both cases, we want both the amplitude A and start time T0 of each pulse to be generated randomly (within some ranges). This is done to get a good distribution with respect to the sampling clock (i.e. the algorithm should work independently of the phase of the pulse w.r.t. the sampling clock). Pulse tails continue into the following waveform(s).
+N_PULSES_PER_WAVEFORM = 2               ## the default, can be set with --n-pulses (n_pulses_per_waveform)
+PULSE_RATE = None                       ## e.g. 0.02 pulses per sample, i.e. 2 pulses per waveform on average
 
 ## Specify the limits in amplitude:
 A_min = 50.
 A_max = 1000.
 
-# Generate amplitudes for the N_REAL_WAVEFORMS waveforms, one for each of the two signals per waveform:
-A_0_gen = np.random.uniform(A_min, A_max, N_REAL_WAVEFORMS)          ## the first of the two pulses
-A_1_gen = np.random.uniform(A_min, A_max, N_REAL_WAVEFORMS)          ## the second of the two pulses
-
-## Specify the limits in T0 for the *first* pulse (note: the time units here are *samples*, and one should convert to nanoseconds or similar when analysing the data in the end).
+## Specify the limits in T0 for the *first* pulse of each waveform (note: the time units here are *samples*, and one should convert to nanoseconds or similar when analysing the data in the end). Only used if PULSE_RATE is None.
 T0_0_min = 5.
 T0_0_max = 20.
 
-# Generate T0 for the N_REAL_WAVEFORMS waveforms, first for the first of the two signals per waveform:
-T0_0_gen = np.random.uniform(T0_0_min, T0_0_max, N_REAL_WAVEFORMS)
-
-# The second pulse should arrive a time Delta_T0 after the first pulse (here, one can change the range to test the performance under different degrees of pile-up). Specify the possible range of Delta_T0:
+## Each following pulse should arrive a time Delta_T0 after the preceding pulse (here, one can change the range to test the performance under different degrees of pile-up). Specify the possible range of Delta_T0. Only used if PULSE_RATE is None.
 Delta_T0_min = 5.
 Delta_T0_max = 50.
 
-# Generate Delta_T0 for the N_REAL_WAVEFORMS waveforms. In the end, the second pulse will have a T0 of T0_0 + Delta_T0 
-Delta_T0_gen = np.random.uniform(Delta_T0_min, Delta_T0_max, N_REAL_WAVEFORMS)                 ## for each waveform, generate a certain Delta_T0 (how far second pulse is to come after first), to get good distribution of pulse phase w.r.t. sampling
-
 
 ## These parameters determine the shape of the LogNormal. They were determined by fitting to simulated waveforms from a Geant4 simulation. Here, they are kept fixed to generate waveforms according to the LogNormal, just to demonstrate the principle of the algorithm.
 mu = 1.47515
@@ -58,65 +59,162 @@ sigma = 0.610874
 ## samples run between 1, 2, 3, ..., N_SAMPLES_PER_WAVEFORM. Produce a vector of these values denoting the times in each waveform.
 t_waveform = np.linspace(1, N_SAMPLES_PER_WAVEFORM, N_SAMPLES_PER_WAVEFORM)
 
-# This will hold the generated data:
-pulse_train = np.zeros((N_EMPTY_WAVEFORMS + N_REAL_WAVEFORMS)*N_SAMPLES_PER_WAVEFORM)
+## Each pulse is calculated over this many samples after its start time. The lognormal is negligible after that.
+PULSE_LENGTH = N_SAMPLES_PER_WAVEFORM
+
+
+def chunk_rng(seed, chunk_index, channel=None):
+    return np.random.default_rng([seed, chunk_index] if (channel is None) else [seed, chunk_index, channel])
+
+def data_path(data_dir, name, channel=None):
+    return os.path.join(data_dir, name + '.bin') if (channel is None) else os.path.join(data_dir, 'channels', name + '_{:03d}.bin'.format(channel))
+
+
+## Generate the pulses (waveform number, T0 within that waveform and amplitude) for the waveforms [first_waveform, first_waveform + n_waveforms), using the random number generator rng, for the pulse rate (or None, see above), the amplitude range, the range of Delta_T0 and the number of pulses per waveform (used if the rate is None). The pulses are sorted in time. Note that the pulses must be generated *first* from rng (see below), so that they can be regenerated without generating the rest of the chunk.
+def generate_pulses(rng, first_waveform, n_waveforms, rate=PULSE_RATE, amplitude=(A_min, A_max), delta_t0=(Delta_T0_min, Delta_T0_max), n_pulses_per_waveform=N_PULSES_PER_WAVEFORM):
+    first_real_waveform = max(first_waveform, N_EMPTY_WAVEFORMS)                ## no pulses in the empty waveforms
+    n_real_waveforms = max(first_waveform + n_waveforms - first_real_waveform, 0)
+
+    if (rate is None):
+        T0_gen = rng.uniform(T0_0_min, T0_0_max, (n_real_waveforms, 1)) + np.cumsum(np.hstack([np.zeros((n_real_waveforms, 1)), rng.uniform(delta_t0[0], delta_t0[1], (n_real_waveforms, n_pulses_per_waveform - 1))]), axis=1)
+        waveform_gen = np.repeat(np.arange(first_real_waveform, first_real_waveform + n_real_waveforms), n_pulses_per_waveform)
+        T0_gen = T0_gen.flatten()
+    else:
+        ## A Poisson process: the number of pulses in the interval is Poisson distributed, and given that number, the arrival times are uniformly distributed.
+        n_pulses = rng.poisson(rate*n_real_waveforms*N_SAMPLES_PER_WAVEFORM)
+        T0_global = np.sort(rng.uniform(0., n_real_waveforms*N_SAMPLES_PER_WAVEFORM, n_pulses))
+        waveform_gen = first_real_waveform + (T0_global // N_SAMPLES_PER_WAVEFORM).astype(int)
+        T0_gen = T0_global - (waveform_gen - first_real_waveform)*N_SAMPLES_PER_WAVEFORM
+
+    A_gen = rng.uniform(amplitude[0], amplitude[1], len(T0_gen))
+
+    return waveform_gen, T0_gen, A_gen
+
+
+## Generate the pulse trains and the MC truth data for n_waveforms real waveforms, and write them to data_dir (see DATA_DIR). The settings (rate, amplitude, delta_t0 and n_pulses_per_waveform, see generate_pulses, and the seed) have the names of the command-line options, so a dictionary of options can be passed as keyword arguments. Returns the first chunk of the pulse train (for the plot).
+def generate_pulse_data(data_dir=DATA_DIR, n_waveforms=N_REAL_WAVEFORMS, rate=PULSE_RATE, amplitude=(A_min, A_max), delta_t0=(Delta_T0_min, Delta_T0_max), n_pulses_per_waveform=N_PULSES_PER_WAVEFORM, seed=SEED, channel=None, verbose=False):
+    ## The chunks to generate:
+    N_REAL_WAVEFORMS = n_waveforms
+    N_WAVEFORMS = N_EMPTY_WAVEFORMS + N_REAL_WAVEFORMS
+    chunk_first_waveforms = np.arange(0, N_WAVEFORMS, CHUNK_N_WAVEFORMS)
+
+    def chunk_pulses(rng, first_waveform, n_chunk_waveforms):
+        return generate_pulses(rng, first_waveform, n_chunk_waveforms, rate, amplitude, delta_t0, n_pulses_per_waveform)
+
+    ## The MC truth data hold the amplitude and T0 of each pulse, so the number of columns is set by the largest number of pulses in any waveform. With Poisson-distributed arrivals, that is only known after all pulses have been generated. So, first generate the pulses only (this is fast, the chunks are generated again below):
+    if (rate is None):
+        MAX_PULSES_PER_WAVEFORM = n_pulses_per_waveform
+    else:
+        MAX_PULSES_PER_WAVEFORM = 1
+        for chunk_index, first_waveform in enumerate(chunk_first_waveforms):
+            waveform_gen, T0_gen, A_gen = chunk_pulses(chunk_rng(seed, chunk_index, channel), first_waveform, min(CHUNK_N_WAVEFORMS, N_WAVEFORMS - first_waveform))
+            if (len(waveform_gen) > 0):
+                MAX_PULSES_PER_WAVEFORM = max(MAX_PULSES_PER_WAVEFORM, np.bincount(waveform_gen).max())
+
+
+    os.makedirs(os.path.dirname(data_path(data_dir, 'input_data', channel)), exist_ok=True)
+
+    ## Open the output files (in the binary format, see data_format.py). 'input_data.bin' will be the input to the VHDL simulation (run 'python data_format.py to_text' to export it to input_data.csv, which is read by the VHDL testbench), 'input_data_no_pileup.bin' will be the input to the get_OF_coefficients.py script and 'MC_truth_data.bin' will be used when analysing the output from the VHDL simulation. The header of each file stores the number of empty waveforms, the number of real waveforms and the number of samples per waveform.
+    input_data_file = create_data_file(data_path(data_dir, "input_data", channel), INPUT_DTYPE, N_EMPTY_WAVEFORMS, N_REAL_WAVEFORMS, N_SAMPLES_PER_WAVEFORM)
+    input_data_no_pileup_file = create_data_file(data_path(data_dir, "input_data_no_pileup", channel), INPUT_DTYPE, N_EMPTY_WAVEFORMS, N_REAL_WAVEFORMS, N_SAMPLES_PER_WAVEFORM)
+
+    ## The MC truth file stores the following data (one record per waveform, including the empty ones): [A_0, T_0_0, A_1, T_0_1, ...]. Where there is no pulse, the values are -1.
+    MC_TRUTH_DTYPE = MC_truth_dtype(MAX_PULSES_PER_WAVEFORM)
+    MC_truth_data_file = create_data_file(data_path(data_dir, "MC_truth_data", channel), MC_TRUTH_DTYPE, N_EMPTY_WAVEFORMS, N_REAL_WAVEFORMS, N_SAMPLES_PER_WAVEFORM)
+
+    ## Pulses that start in one chunk but whose tails continue into the next chunk are carried over:
+    carried_T0 = np.zeros(0)
+    carried_A = np.zeros(0)
+
+    ## Now, start generating waveforms, one chunk at a time:
+    for chunk_index, first_waveform in enumerate(chunk_first_waveforms):
+        if verbose:
+            print('Waveform ' + str(first_waveform))
+
+        n_chunk_waveforms = min(CHUNK_N_WAVEFORMS, N_WAVEFORMS - first_waveform)
+        chunk_start = first_waveform*N_SAMPLES_PER_WAVEFORM                 ## the first sample of the chunk
+        chunk_length = n_chunk_waveforms*N_SAMPLES_PER_WAVEFORM
+
+        rng = chunk_rng(seed, chunk_index, channel)
+
+        waveform_gen, T0_gen, A_gen = chunk_pulses(rng, first_waveform, n_chunk_waveforms)
+
+        ## the baseline is generated for every waveform (also the empty ones), by generating gaussian noise with a certain mean and std dev.
+        baseline = rng.normal(baseline_gen_mu, baseline_gen_sigma, (n_chunk_waveforms, N_SAMPLES_PER_WAVEFORM))
+
+        ## Fill in the MC truth data. Each pulse gets a position in the row of its waveform, according to the order in which the pulses arrive.
+        MC_truth_data = -np.ones((n_chunk_waveforms, 2*MAX_PULSES_PER_WAVEFORM))
+        pulse_position = np.arange(len(waveform_gen)) - np.searchsorted(waveform_gen, waveform_gen)
+        MC_truth_data[waveform_gen - first_waveform, 2*pulse_position] = A_gen
+        MC_truth_data[waveform_gen - first_waveform, 2*pulse_position + 1] = T0_gen
 
-# This will hold the generated data (with no pile-up pulses, used for fitting in get_OF_coefficients.py):
-pulse_train_no_pileup = np.zeros((N_EMPTY_WAVEFORMS + N_REAL_WAVEFORMS)*N_SAMPLES_PER_WAVEFORM)
+        ## The signal: every pulse is calculated over PULSE_LENGTH samples after its start (one row per pulse), and then added to the pulse train. Times are counted from the start of the pulse train, such that sample number s (counting from 0) is at time s + 1 (like t_waveform).
+        T0_pulses = np.concatenate([carried_T0, waveform_gen*N_SAMPLES_PER_WAVEFORM + T0_gen])
+        A_pulses = np.concatenate([carried_A, A_gen])
+        sample_indices = np.floor(T0_pulses).astype(int)[:, np.newaxis] + np.arange(PULSE_LENGTH)
+        pulse_signals = generate_lognormal_signal(sample_indices + 1., A_pulses[:, np.newaxis], T0_pulses[:, np.newaxis], mu, sigma)
 
-# This will hold the (global) time, and is used for plotting only:
-t_pulse_train = np.linspace(1, (N_EMPTY_WAVEFORMS + N_REAL_WAVEFORMS)*N_SAMPLES_PER_WAVEFORM, (N_EMPTY_WAVEFORMS + N_REAL_WAVEFORMS)*N_SAMPLES_PER_WAVEFORM)
+        in_chunk = (sample_indices >= chunk_start) & (sample_indices < chunk_start + chunk_length)
+        signal = np.bincount(sample_indices[in_chunk] - chunk_start, weights=pulse_signals[in_chunk], minlength=chunk_length)
 
-# Simple data structure to hold the data that will be exported to a text file. These data will be used as Monte Carlo truth values when analysing the output of the VHDL simulation
-MC_truth_data = np.zeros(shape=(1+N_EMPTY_WAVEFORMS+N_REAL_WAVEFORMS, 4))           ## row 1: header, stores the number of empty waveforms, the number of real waveforms and the number of samples per waveform. The remaining rows store the following data: [A_0, T_0_0, A_1, T_0_1].
+        carried = (sample_indices[:, -1] >= chunk_start + chunk_length)
+        carried_T0 = T0_pulses[carried]
+        carried_A = A_pulses[carried]
 
-## Set the header of the MC truth file:
-MC_truth_data[0,0] = N_EMPTY_WAVEFORMS
-MC_truth_data[0,1] = N_REAL_WAVEFORMS
-MC_truth_data[0,2] = N_SAMPLES_PER_WAVEFORM
-MC_truth_data[0, 3] = -1            ## means no data
-for i in range(N_EMPTY_WAVEFORMS):
-    MC_truth_data[1+i,:] = -1               ## the rows where no pulses generated should be filled with -1.
+        ## Now, everything in place to produce the waveforms. The pulse train is the sum of the baseline (including noise) and the signals. Note that the data is rounded and converted to integer (to emulate dititisation in an ADC)
+        pulse_train = np.round(baseline.flatten() + signal).astype(int)
 
-## fill with truth data:
-MC_truth_data[1+N_EMPTY_WAVEFORMS:,0] = A_0_gen
-MC_truth_data[1+N_EMPTY_WAVEFORMS:,1] = T0_0_gen
-MC_truth_data[1+N_EMPTY_WAVEFORMS:,2] = A_1_gen
-MC_truth_data[1+N_EMPTY_WAVEFORMS:,3] = T0_0_gen + Delta_T0_gen
+        ## In the get_OF_coefficients.py script, you want to fit to well-isolated pulses to determine the parameters of the OF filter. In reality, you would select well-isolated pulses acquired with a detector for that. Here, we simply generate waveforms definitely pile-up free (so only the first pulse in each waveform is stored for these data, and it ends at the end of the waveform):
+        first_pulse = (pulse_position == 0)
+        A_first = np.zeros(n_chunk_waveforms)
+        T0_first = np.zeros(n_chunk_waveforms)
+        A_first[waveform_gen[first_pulse] - first_waveform] = A_gen[first_pulse]
+        T0_first[waveform_gen[first_pulse] - first_waveform] = T0_gen[first_pulse]
+        pulse_train_no_pileup = np.round(baseline + generate_lognormal_signal(t_waveform, A_first[:, np.newaxis], T0_first[:, np.newaxis], mu, sigma)).astype(int).flatten()
 
-## Now, start generating waveforms:
-for waveform_index in range(N_EMPTY_WAVEFORMS + N_REAL_WAVEFORMS):
-    if (waveform_index % 500 == 0):
-        print('Waveform ' + str(waveform_index))
+        ## Write the chunk to the output files:
+        append_rows(input_data_file, make_rows([pulse_train], INPUT_DTYPE))
+        append_rows(input_data_no_pileup_file, make_rows([pulse_train_no_pileup], INPUT_DTYPE))
+        append_rows(MC_truth_data_file, make_rows(MC_truth_data, MC_TRUTH_DTYPE))
 
-    baseline = np.random.normal(baseline_gen_mu, baseline_gen_sigma, N_SAMPLES_PER_WAVEFORM)            ## the baseline is generated for every waveform (also the empty ones), by generating gaussian noise with a certain mean and std dev.
+        ## For visualisation purposes, keep the first chunk:
+        if (chunk_index == 0):
+            pulse_train_to_plot = pulse_train
 
+    input_data_file.close()
+    input_data_no_pileup_file.close()
+    MC_truth_data_file.close()
 
-    if (waveform_index >= N_EMPTY_WAVEFORMS):           ## get the signal data from lognormal functions with the appropriate amplitudes and start times:
-        signal_0 = generate_lognormal_signal(t_waveform, A_0_gen[waveform_index - N_EMPTY_WAVEFORMS], T0_0_gen[waveform_index - N_EMPTY_WAVEFORMS], mu, sigma, N_SAMPLES_PER_WAVEFORM)
-        signal_1 = generate_lognormal_signal(t_waveform, A_1_gen[waveform_index - N_EMPTY_WAVEFORMS], T0_0_gen[waveform_index - N_EMPTY_WAVEFORMS]+Delta_T0_gen[waveform_index - N_EMPTY_WAVEFORMS], mu, sigma, N_SAMPLES_PER_WAVEFORM)
-    else:               ## empty waveform, so both signal 0 and 1 = zero:
-        signal_0 = np.zeros(N_SAMPLES_PER_WAVEFORM)
-        signal_1 = np.zeros(N_SAMPLES_PER_WAVEFORM)
+    return pulse_train_to_plot
 
 
-    ## Now, everything in place to produce the waveform. The waveform is the sum of the baseline (including noise) and the two signal shapes. Note that the data is rounded and converted to integer (to emulate dititisation in an ADC)
-    pulse_train[waveform_index*N_SAMPLES_PER_WAVEFORM:(waveform_index+1)*N_SAMPLES_PER_WAVEFORM] = np.round(baseline + signal_0 + signal_1).astype(int)
+## For visualisation purposes, plot (the first chunk of) the pulse train:
+def plot_pulse_train(pulse_train):
+    import matplotlib.pyplot as plt
 
-    ## In the get_OF_coefficients.py script, you want to fit to well-isolated pulses to determine the parameters of the OF filter. In reality, you would select well-isolated pulses acquired with a detector for that. Here, we simply generate waveforms definitely pile-up free (so only signal 0 is stored for these data):
-    pulse_train_no_pileup[waveform_index*N_SAMPLES_PER_WAVEFORM:(waveform_index+1)*N_SAMPLES_PER_WAVEFORM] = np.round(baseline + signal_0).astype(int)
+    t_pulse_train = np.linspace(1, len(pulse_train), len(pulse_train))
+    plt.plot(t_pulse_train, pulse_train)
+    plt.show()
 
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate the pulse trains and the MC truth data.')
+    parser.add_argument('--channel', type=int, default=None, help='generate the data of this channel of a multi-channel dataset (written to the channels directory in the data directory)')
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--n-waveforms', type=int, default=N_REAL_WAVEFORMS, help='N_REAL_WAVEFORMS')
+    parser.add_argument('--delta-t0', type=float, nargs=2, default=(Delta_T0_min, Delta_T0_max), metavar=('MIN', 'MAX'), help='Delta_T0_min and Delta_T0_max')
+    parser.add_argument('--amplitude', type=float, nargs=2, default=(A_min, A_max), metavar=('MIN', 'MAX'), help='A_min and A_max')
+    parser.add_argument('--n-pulses', type=int, default=N_PULSES_PER_WAVEFORM, help='N_PULSES_PER_WAVEFORM (without --rate)')
+    parser.add_argument('--rate', type=float, default=PULSE_RATE, help='PULSE_RATE (pulses per sample)')
+    parser.add_argument('--seed', type=int, default=SEED, help='SEED')
+    parser.add_argument('--plot', action='store_true', help='plot the first chunk of the pulse train')
+    args = parser.parse_args(argv)
 
-## Save the 'input_data.csv' file. This will be the input to the VHDL simulation
-np.savetxt("../data/input_data.csv", pulse_train, fmt='%i')
+    pulse_train = generate_pulse_data(args.data_dir, args.n_waveforms, args.rate, args.amplitude, args.delta_t0, args.n_pulses, args.seed, args.channel, verbose=True)
+    if args.plot:
+        plot_pulse_train(pulse_train)
 
-## Save the 'input_data_no_pileup.csv' file. This will be the input to the get_OF_coefficients.py script
-np.savetxt("../data/input_data_no_pileup.csv", pulse_train_no_pileup, fmt='%i')
 
-## Save the 'MC_truth_data.csv' file. This will be used when analysing the output from the VHDL simulation.
-np.savetxt("../data/MC_truth_data.csv", MC_truth_data, fmt='%f', delimiter=',')
 
-## For visualisation purposes, plot the entire pulse train:
-plt.plot(t_pulse_train, pulse_train)
-plt.show()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+import argparse
+import glob
+import os
+import re
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from data_format import OUTPUT_DTYPE, CHANNEL_RECORD_DTYPE, DATA_DIRECTORY, open_data_file, read_header, write_data_file, as_array, make_rows
+from OF_calibration import write_calibration_file, load_calibration
+from get_OF_coefficients import CALIBRATION_PARAMETERS, calibrate
+from emulate_VHDL import MAX_PILEUP_PULSES, coefficients_from_calibration, run_pipeline_segmented
+from feature_records import make_feature_records
+from reconstruct_A_and_T import reconstruct_pulses, get_true_pulses, match_pulses
+
+## Processing of a multi-channel dataset (the forward-spectrometer EMC has hundreds of channels, each with its own ADC and its own copy of the feature extraction). The other scripts handle a single channel; here, the channels are processed in parallel, one channel per task in a pool of processes (one per CPU by default): the pipeline (emulate_VHDL.py), the feature records (feature_records.py) and the reconstruction of A and T (reconstruct_A_and_T.py), each channel with its own calibration. The channels are independent, so the throughput grows with the number of processes, as long as there are more channels than processes. The results are merged into one file of CHANNEL_RECORD_DTYPE records (see data_format.py), sorted by timestamp and channel.
+##
+## The data of channel c are in CHANNEL_DIR: input_data_ccc.bin, and (optionally) input_data_no_pileup_ccc.bin for the calibration and MC_truth_data_ccc.bin for the comparison with the truth (run 'python generate_pulse_data.py --channel c' to generate them). The input samples of all channels are copied once into a block of shared memory, which the worker processes map, so the pulse trains are not pickled and sent to every process.
+##
+## Each channel uses the calibration in OF_calibration_ccc.json in CHANNEL_DIR if it exists, and otherwise the common calibration (data/OF_calibration.json). With --calibrate, the calibration of every channel with isolated pulses (input_data_no_pileup_ccc.bin) is first calculated as in get_OF_coefficients.py, also in parallel over the channels (the fits of each channel are done in one process).
+
+CHANNEL_DIR = os.path.join(DATA_DIRECTORY, 'channels')
+
+
+## The path of a file of channel c in channel_dir, e.g. channel_path('input_data', 7) = data/channels/input_data_007.bin
+def channel_path(name, channel, channel_dir=CHANNEL_DIR, extension='.bin'):
+    return os.path.join(channel_dir, name + '_{:03d}'.format(channel) + extension)
+
+## The channels for which there is input data in channel_dir, sorted.
+def find_channels(channel_dir=CHANNEL_DIR):
+    paths = glob.glob(os.path.join(channel_dir, 'input_data_*.bin'))
+    return sorted(int(match.group(1)) for match in (re.fullmatch(r'input_data_(\d+)\.bin', os.path.basename(path)) for path in paths) if match)
+
+## The calibration of a channel: its own calibration file if there is one, otherwise the common calibration.
+def load_channel_calibration(channel, channel_dir=CHANNEL_DIR):
+    path = channel_path('OF_calibration', channel, channel_dir, '.json')
+    return load_calibration(path) if os.path.exists(path) else load_calibration()
+
+
+## Calculate and write the calibration of one channel from its isolated pulses, as in get_OF_coefficients.py (the fits are done in this process only, since the channels are already calibrated in parallel). Returns the channel.
+def calibrate_channel(channel, channel_dir, parameters):
+    calibration = calibrate(channel_path('input_data_no_pileup', channel, channel_dir), parameters, n_processes=1)
+    write_calibration_file(calibration, channel_path('OF_calibration', channel, channel_dir, '.json'))
+    return channel
+
+## Calibrate the channels in parallel, in n_processes processes (None: one per CPU).
+def calibrate_channels(channels, channel_dir=CHANNEL_DIR, parameters=CALIBRATION_PARAMETERS, n_processes=None):
+    with ProcessPoolExecutor(n_processes) as pool:
+        for future in as_completed([pool.submit(calibrate_channel, channel, channel_dir, parameters) for channel in channels]):
+            print('Channel ' + str(future.result()) + ' calibrated')
+
+
+## Copy the input samples of the channels into a new block of shared memory, one row per channel (padded with zeros to the longest pulse train). Returns the shared memory (to be closed and unlinked by the caller), the shape of the array in it and the number of samples of each channel.
+def share_inputs(channels, channel_dir=CHANNEL_DIR):
+    n_samples = np.array([read_header(channel_path('input_data', channel, channel_dir))['n_rows'] for channel in channels], dtype=np.int64)
+    shape = (len(channels), int(n_samples.max(initial=0)))
+
+    inputs_memory = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape))*np.dtype(np.uint16).itemsize, 1))
+    inputs = np.ndarray(shape, dtype=np.uint16, buffer=inputs_memory.buf)
+    for row, channel in enumerate(channels):
+        inputs[row, :n_samples[row]] = open_data_file(channel_path('input_data', channel, channel_dir))[1]['sample']
+        inputs[row, n_samples[row]:] = 0
+    del inputs                                  ## the memory can only be closed when no array uses it
+    return inputs_memory, shape, n_samples
+
+
+## Each worker process maps the shared input samples once, when it starts.
+worker_data = {}
+
+def init_worker(shared_memory_name, shape):
+    worker_data['inputs_memory'] = shared_memory.SharedMemory(name=shared_memory_name)
+    worker_data['inputs'] = np.ndarray(shape, dtype=np.uint16, buffer=worker_data['inputs_memory'].buf)
+
+
+## Process one channel (row of the shared inputs): run the pipeline with the calibration of the channel, make the feature records and reconstruct A and T. If there is MC truth data for the channel, the reconstructed pulses are also compared with the truth. Returns the channel records (CHANNEL_RECORD_DTYPE) and a summary: the number of samples and of records, the CPU time and, with MC truth, the efficiency, fake rate and time and amplitude resolution.
+def process_channel(row, channel, n_samples, channel_dir, max_pileup_pulses, segment_length):
+    start_time = time.process_time()
+    calibration = load_channel_calibration(channel, channel_dir)
+    input_data = worker_data['inputs'][row, :n_samples].astype(np.int64)
+
+    output_rows = make_rows(run_pipeline_segmented(input_data, segment_length=segment_length, coefficients=coefficients_from_calibration(calibration), max_pileup_pulses=max_pileup_pulses), OUTPUT_DTYPE)
+    records = make_feature_records(output_rows)[0]
+    del output_rows
+    trigger_timestamps, Reconstructed_A, Reconstructed_T = reconstruct_pulses(records, 0, n_samples, calibration)
+
+    channel_records = np.zeros(len(records), dtype=CHANNEL_RECORD_DTYPE)
+    channel_records['channel'] = channel
+    for name in records.dtype.names:
+        channel_records[name] = records[name]
+    channel_records['A'] = Reconstructed_A
+    channel_records['T'] = Reconstructed_T
+
+    summary = {'channel': channel, 'n_samples': n_samples, 'n_records': len(records), 'n_pileup': int(np.count_nonzero(records['pileup'])), 'time': time.process_time() - start_time}
+
+    MC_truth_path = channel_path('MC_truth_data', channel, channel_dir)
+    if os.path.exists(MC_truth_path):
+        MC_truth_header, MC_truth_data = open_data_file(MC_truth_path)
+        N_EMPTY_WAVEFORMS = MC_truth_header['N_EMPTY_WAVEFORMS']
+        N_SAMPLES_PER_WAVEFORM = MC_truth_header['N_SAMPLES_PER_WAVEFORM']
+
+        ## Only the pulses in the real waveforms, as in reconstruct_A_and_T.py:
+        real = (trigger_timestamps >= N_EMPTY_WAVEFORMS*N_SAMPLES_PER_WAVEFORM)
+        true_waveform, true_position, True_A, True_T = get_true_pulses(as_array(MC_truth_data), N_EMPTY_WAVEFORMS, N_EMPTY_WAVEFORMS + MC_truth_header['N_REAL_WAVEFORMS'], N_SAMPLES_PER_WAVEFORM)
+        matched, match = match_pulses(Reconstructed_T[real], True_T)
+        delta_A = (Reconstructed_A[real][matched] - True_A[match[matched]])/True_A[match[matched]]
+        delta_T = Reconstructed_T[real][matched] - True_T[match[matched]]
+
+        summary['efficiency'] = np.count_nonzero(matched)/max(len(True_T), 1)
+        summary['fake_rate'] = np.count_nonzero(~matched)/max(len(matched), 1)
+        summary['T_resolution'] = np.std(delta_T) if (len(delta_T) > 0) else np.nan
+        summary['A_resolution'] = np.std(delta_A) if (len(delta_A) > 0) else np.nan
+
+    return channel_records, summary
+
+
+## Process the channels in parallel, in n_processes processes (None: one per CPU), and merge the records of all channels, sorted by timestamp and then channel. Returns the merged records and the summary of each channel (in the order of channels).
+def process_channels(channels, channel_dir=CHANNEL_DIR, n_processes=None, max_pileup_pulses=MAX_PILEUP_PULSES, segment_length=2000):
+    inputs_memory, shape, n_samples = share_inputs(channels, channel_dir)
+    try:
+        with ProcessPoolExecutor(n_processes, initializer=init_worker, initargs=(inputs_memory.name, shape)) as pool:
+            futures = [pool.submit(process_channel, row, channel, int(n_samples[row]), channel_dir, max_pileup_pulses, segment_length) for row, channel in enumerate(channels)]
+            results = [future.result() for future in futures]
+    finally:
+        inputs_memory.close()
+        inputs_memory.unlink()
+
+    records = np.concatenate([channel_records for channel_records, summary in results]) if results else np.zeros(0, dtype=CHANNEL_RECORD_DTYPE)
+    records = records[np.lexsort((records['channel'], records['timestamp']))]
+    return records, [summary for channel_records, summary in results]
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Process a multi-channel dataset in parallel: the pipeline, the feature records and the reconstruction of A and T, with the calibration of each channel. The records of all channels are merged into one file.')
+    parser.add_argument('--channel-dir', default=CHANNEL_DIR)
+    parser.add_argument('--channels', type=int, nargs='+', default=None, help='the channels to process (default: all channels in the channel directory)')
+    parser.add_argument('--processes', type=int, default=None, help='the number of processes (default: one per CPU)')
+    parser.add_argument('--calibrate', action='store_true', help='first calculate the calibration of each channel from its isolated pulses (input_data_no_pileup_ccc.bin)')
+    parser.add_argument('--max-pileup-pulses', type=int, default=MAX_PILEUP_PULSES)
+    parser.add_argument('--output-file', default=None, help='the merged records (default: channel_records.bin in the channel directory)')
+    args = parser.parse_args(argv)
+
+    channels = args.channels if (args.channels is not None) else find_channels(args.channel_dir)
+    output_file = args.output_file if (args.output_file is not None) else os.path.join(args.channel_dir, 'channel_records.bin')
+    if (len(channels) == 0):
+        raise SystemExit('No channels found in ' + args.channel_dir + ' (generate them with generate_pulse_data.py --channel c)')
+
+    if args.calibrate:
+        calibrate_channels([channel for channel in channels if os.path.exists(channel_path('input_data_no_pileup', channel, args.channel_dir))], args.channel_dir, n_processes=args.processes)
+
+    start_time = time.perf_counter()
+    records, summaries = process_channels(channels, args.channel_dir, args.processes, args.max_pileup_pulses)
+    wall_time = time.perf_counter() - start_time
+
+    header = read_header(channel_path('input_data', channels[0], args.channel_dir))
+    write_data_file(output_file, records, CHANNEL_RECORD_DTYPE, header['N_EMPTY_WAVEFORMS'], header['N_REAL_WAVEFORMS'], header['N_SAMPLES_PER_WAVEFORM'])
+
+    print('channel   samples  records  pile-up   CPU [s]  efficiency  fake rate  T res.  A res.')
+    for summary in summaries:
+        line = '{channel:7d}{n_samples:10d}{n_records:9d}{n_pileup:9d}{time:10.2f}'.format(**summary)
+        if ('efficiency' in summary):
+            line += '{efficiency:12.4f}{fake_rate:11.4f}{T_resolution:8.4f}{A_resolution:8.4f}'.format(**summary)
+        print(line)
+
+    ## The throughput, and how well the processes were used: the sum of the CPU times of the channels over the wall time is the effective number of processes working in parallel (at most the number of CPUs).
+    n_processes = args.processes if (args.processes is not None) else os.cpu_count()
+    busy_time = sum(summary['time'] for summary in summaries)
+    print()
+    print(str(len(records)) + ' records from ' + str(len(channels)) + ' channels written to ' + output_file)
+    print('Throughput: {:.3g} samples/s in {:.2f} s ({:.2f} of {:d} processes busy on average)'.format(sum(summary['n_samples'] for summary in summaries)/wall_time, wall_time, busy_time/wall_time, n_processes))
+
+
+
+if __name__ == '__main__':
+    main()
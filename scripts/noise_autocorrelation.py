@@ -0,0 +1,128 @@
+import argparse
+import os
+import time
+import numpy as np
+from data_format import DATA_DIRECTORY, open_data_file
+from OF_calibration import load_calibration, calculate_OF_calibration
+from emulate_VHDL import BASELINE_SETUP_SAMPLES, run_pipeline_stream
+
+## The autocorrelation of the baseline noise, as seen by the OF, for the noise-weighted OF coefficients (Cleland & Stern with the full noise covariance matrix, see calculate_OF_calibration). The OF sums OF_LENGTH samples minus one baseline value, so the noise it sees is (x_n - b)(x_(n+k) - b) for samples x and baseline b: the correlation between the samples plus the common fluctuation of the baseline.
+##
+## The noise is measured where there are no pulses, i.e. where the baseline_calculator is 'awake': for every such sample n, (x_n - b_n)(x_(n+k) - b_n) is summed for the lags k = 0, ..., max_lag, with b_n the baseline at sample n (the 16-sample average). Samples within GUARD_BEFORE samples before or GUARD_AFTER samples after a 'sleeping' period (the rising edge and the tail of a pulse) are not used. The sums are running sums, updated block by block as the samples arrive (see accumulate_noise), so the estimate can be refined with new data at any time, and runs of any length are processed without loading them into memory.
+##
+## The samples and the baseline state come from the output of the VHDL simulation or emulate_VHDL.py (the data_in, baseline and trigger columns), or, for a raw pulse train, from running the emulator over it block by block.
+
+MAX_LAG = 15
+GUARD_BEFORE = 4                            ## the baseline trigger fires within a few samples of the start of a pulse
+GUARD_AFTER = 30                            ## after the trigger is released, the tail of the pulse is still a few ADC counts high for a while
+BLOCK_SIZE = 1 << 20
+
+
+## The running sums: for each lag, the sum of the products and the number of pairs, and the sum and number of the noise values themselves. The samples still needed for the next block (pending) are kept too, starting with GUARD_AFTER samples that are not quiet (the start of the stream).
+def initial_noise_statistics(max_lag=MAX_LAG):
+    return {'products': np.zeros(max_lag + 1), 'n_pairs': np.zeros(max_lag + 1, dtype=np.int64), 'sum': 0., 'n': 0,
+            'pending_samples': np.zeros(GUARD_AFTER, dtype=np.int64), 'pending_baseline': np.zeros(GUARD_AFTER, dtype=np.int64), 'pending_quiet': np.zeros(GUARD_AFTER, dtype=bool)}
+
+
+## Add the next block of the stream to the statistics (in place): the samples, the baseline and whether the baseline_calculator is 'awake' (quiet) for each sample. A sample is used once it is known whether the GUARD_AFTER samples before it and the GUARD_BEFORE + max_lag samples after it are quiet, so the last samples of a block are kept for the next one. Pass flush=True with the last block (the stream is then taken to end with a pulse).
+def accumulate_noise(statistics, samples, baseline, quiet, flush=False):
+    max_lag = len(statistics['products']) - 1
+    samples = np.concatenate([statistics['pending_samples'], np.asarray(samples, dtype=np.int64)])
+    baseline = np.concatenate([statistics['pending_baseline'], np.asarray(baseline, dtype=np.int64)])
+    quiet = np.concatenate([statistics['pending_quiet'], np.asarray(quiet, dtype=bool)])
+    if flush:
+        samples, baseline, quiet = [np.concatenate([values, np.zeros(GUARD_BEFORE + max_lag, dtype=values.dtype)]) for values in (samples, baseline, quiet)]
+
+    ## usable[i]: samples i - GUARD_AFTER, ..., i + GUARD_BEFORE are all quiet. Pairs are counted for the first samples n in [GUARD_AFTER, end), for which samples n + k are known to be usable or not.
+    end = len(samples) - GUARD_BEFORE - max_lag
+    if (end > GUARD_AFTER):
+        quiet_count = np.concatenate([[0], np.cumsum(quiet)])
+        checked = np.arange(GUARD_AFTER, len(samples) - GUARD_BEFORE)
+        usable = np.zeros(len(samples), dtype=bool)
+        usable[checked] = (quiet_count[checked + GUARD_BEFORE + 1] - quiet_count[checked - GUARD_AFTER] == GUARD_AFTER + GUARD_BEFORE + 1)
+
+        first = np.arange(GUARD_AFTER, end)
+        first = first[usable[first]]
+        noise_first = samples[first] - baseline[first]
+        statistics['sum'] += float(noise_first.sum())
+        statistics['n'] += len(first)
+        for lag in range(max_lag + 1):
+            pairs = first[usable[first + lag]]
+            statistics['products'][lag] += float(((samples[pairs] - baseline[pairs])*(samples[pairs + lag] - baseline[pairs])).sum())
+            statistics['n_pairs'][lag] += len(pairs)
+        keep_from = end - GUARD_AFTER
+    else:
+        keep_from = 0
+
+    statistics['pending_samples'] = samples[keep_from:]
+    statistics['pending_baseline'] = baseline[keep_from:]
+    statistics['pending_quiet'] = quiet[keep_from:]
+
+
+## The samples, baseline and quiet flags from output data (records as in OUTPUT_DTYPE, from the VHDL simulation or emulate_VHDL.py). The baseline_calculator is 'awake' when the trigger is 0 after the setup period.
+def noise_input_from_output(output_data):
+    quiet = (output_data['trigger'] == 0) & (output_data['counter'] > BASELINE_SETUP_SAMPLES)
+    return output_data['data_in'], output_data['baseline'], quiet
+
+
+## The noise autocovariance (lags 0, ..., max_lag) from the statistics, and the autocorrelation (normalised to one at lag 0).
+def noise_autocovariance(statistics):
+    if (statistics['n_pairs'][0] == 0):
+        raise ValueError('No quiet baseline samples to estimate the noise from')
+    mean = statistics['sum']/statistics['n']
+    autocovariance = statistics['products']/np.maximum(statistics['n_pairs'], 1) - mean*mean
+    return autocovariance, autocovariance/autocovariance[0]
+
+
+## Estimate the noise from an output data file (see data_format.py), in blocks.
+def estimate_noise_from_output(path, max_lag=MAX_LAG, block_size=BLOCK_SIZE):
+    header, output_data = open_data_file(path)
+    statistics = initial_noise_statistics(max_lag)
+    for block_start in range(0, len(output_data), block_size):
+        accumulate_noise(statistics, *noise_input_from_output(output_data[block_start:block_start + block_size]), flush=(block_start + block_size >= len(output_data)))
+    return statistics
+
+
+## Estimate the noise from a raw pulse train (an input data file): the pulse train is processed by the emulator block by block (run_pipeline_stream), and the output is passed on as it comes.
+def estimate_noise_from_input(path, max_lag=MAX_LAG, block_size=BLOCK_SIZE, coefficients=None):
+    header, input_data = open_data_file(path)
+    statistics = initial_noise_statistics(max_lag)
+    stream_state = None
+    for block_start in range(0, max(len(input_data), 1), block_size):
+        flush = (block_start + block_size >= len(input_data))
+        output_data, stream_state = run_pipeline_stream(input_data['sample'][block_start:block_start + block_size].astype(np.int64), stream_state, coefficients, flush)
+        accumulate_noise(statistics, output_data[:, 1], output_data[:, 3], (output_data[:, 4] == 0) & (output_data[:, 0] > BASELINE_SETUP_SAMPLES), flush)
+    return statistics
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Estimate the autocorrelation of the baseline noise (where the baseline_calculator is awake) and calculate the noise-weighted OF coefficients.')
+    parser.add_argument('--input-file', default=os.path.join(DATA_DIRECTORY, 'input_data_no_pileup.bin'), help='a raw pulse train, processed by the emulator to find the quiet samples')
+    parser.add_argument('--output-file', default=None, help='use the output of a VHDL simulation or of emulate_VHDL.py instead (output_data.bin)')
+    parser.add_argument('--max-lag', type=int, default=MAX_LAG)
+    args = parser.parse_args(argv)
+
+    start_time = time.perf_counter()
+    if args.output_file is not None:
+        statistics = estimate_noise_from_output(args.output_file, args.max_lag)
+    else:
+        statistics = estimate_noise_from_input(args.input_file, args.max_lag)
+    autocovariance, autocorrelation = noise_autocovariance(statistics)
+    print('{} quiet samples in {:.1f} s. Noise RMS {:.3f} ADC counts'.format(statistics['n'], time.perf_counter() - start_time, np.sqrt(autocovariance[0])))
+    print('Autocorrelation: ' + ' '.join('{:.4f}'.format(value) for value in autocorrelation))
+
+    ## The OF coefficients of the current calibration, and the noise-weighted ones (same templates and word lengths):
+    calibration = load_calibration()
+    parameters = dict(calibration['parameters'])
+    parameters.pop('templates', None)
+    weighted = calculate_OF_calibration(calibration['delta_BCFD_window_mean'], noise_autocorrelation=autocorrelation, **parameters)
+    for name in ['FIR_coefficients_a', 'FIR_coefficients_b']:
+        print(name + ' (current, noise-weighted):')
+        for current, noise_weighted in zip(calibration[name], weighted[name]):
+            print('  ' + str(current.tolist()) + '  ' + str(noise_weighted))
+
+
+
+if __name__ == '__main__':
+    main()
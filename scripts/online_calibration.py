@@ -0,0 +1,222 @@
+import argparse
+import json
+import os
+import numpy as np
+from data_format import DATA_DIRECTORY, open_data_file, as_array
+from OF_calibration import load_calibration
+from reconstruct_A_and_T import MATCH_OFFSET, reconstruct_pulses, reconstructed_tau, get_true_pulses, match_pulses
+
+## Online recalibration of the reconstruction: the time offsets delta_BCFD_window_mean (one per BCFD window) and, optionally, an amplitude scale are updated from the stream of reconstructed events, so that a long run stays calibrated without stopping to re-fit (get_OF_coefficients.py). Only the reconstruction (reconstruct_A_and_T.py) changes: the OF coefficients in the FPGA stay as they are.
+##
+## For each event (only the first pulse of a pile-up chain, since the tail subtraction biases the later ones), the offset implied by the event is estimated, and running statistics per BCFD window give the new offsets:
+##   'self':       from the OF tau. tau is the time of the pulse relative to T_0_assumed of the OF coefficients, so if the pulse shape or timing drifts, the mean tau of a window moves by as much as its offset should: offset = delta_coefficients + tau - tau_reference, where tau_reference is the mean tau of the window when the coefficients were calibrated (taken from the first events of the run if the calibration does not have it).
+##   'reference':  from a reference time (and amplitude) per event, e.g. a pulser, or the MC truth for simulated data: offset = timestamp + T_0_BCFD + tau - (T_reference + time_offset), and amplitude scale = A_reference/u.
+##
+## The running statistics are either exponentially weighted ('ewma', with a half-life in events per BCFD window) or the mean of the last events ('window', a fixed number of events per BCFD window). Both are updated a block of events at a time.
+##
+## Whenever the offsets (or the amplitude scale) have moved by more than MIN_DELTA_CHANGE (MIN_SCALE_CHANGE), a new version of the calibration is written as a snapshot (OF_calibration_vNNNNNN.json in the snapshot directory, written to a temporary file first and then renamed, so a reader never sees half a file). The reconstruction follows the snapshot directory (see refresh_calibration) and picks up each new version between two blocks of events, without restarting.
+
+SNAPSHOT_DIRECTORY = os.path.join(DATA_DIRECTORY, 'calibration_snapshots')
+SNAPSHOT_PREFIX = 'OF_calibration_v'
+HALF_LIFE = 2000                                ## events per BCFD window
+WINDOW_LENGTH = 4000                            ## events per BCFD window
+MIN_EVENTS = 500                                ## per BCFD window, before the first snapshot and before tau_reference is set
+MIN_DELTA_CHANGE = 0.005                        ## samples (the statistical fluctuation of the offsets is ~0.002 with HALF_LIFE events)
+MIN_SCALE_CHANGE = 0.0002
+
+
+def snapshot_path(version, directory=SNAPSHOT_DIRECTORY):
+    return os.path.join(directory, SNAPSHOT_PREFIX + '{:06d}'.format(version) + '.json')
+
+
+## The version of the latest snapshot in the directory (0 if there is none).
+def latest_version(directory=SNAPSHOT_DIRECTORY):
+    if not os.path.isdir(directory):
+        return 0
+    versions = [int(name[len(SNAPSHOT_PREFIX):-len('.json')]) for name in os.listdir(directory) if name.startswith(SNAPSHOT_PREFIX) and name.endswith('.json')]
+    return max(versions, default=0)
+
+
+## Write a calibration as the next version in the directory. Returns the version.
+def write_snapshot(calibration, directory=SNAPSHOT_DIRECTORY):
+    os.makedirs(directory, exist_ok=True)
+    version = latest_version(directory) + 1
+    snapshot = {name: (value.tolist() if isinstance(value, np.ndarray) else value) for name, value in calibration.items()}
+    snapshot['online']['version'] = version
+    temporary_path = snapshot_path(version, directory) + '.tmp'
+    with open(temporary_path, 'w') as snapshot_file:
+        snapshot_file.write('{\n' + ',\n'.join(' ' + json.dumps(name) + ': ' + json.dumps(value) for name, value in snapshot.items()) + '\n}\n')          ## as write_calibration_file
+    os.replace(temporary_path, snapshot_path(version, directory))
+    return version
+
+
+## A reconstruction that follows the snapshot directory: the directory, the version in use and the calibration (calibration until the first snapshot).
+def follow_snapshots(calibration, directory=SNAPSHOT_DIRECTORY):
+    return {'directory': directory, 'version': 0, 'calibration': calibration}
+
+## If there is a newer snapshot than the one in use, load it (in place). Returns whether the calibration changed.
+def refresh_calibration(follower):
+    version = latest_version(follower['directory'])
+    if (version <= follower['version']):
+        return False
+    follower['calibration'] = load_calibration(snapshot_path(version, follower['directory']))
+    follower['version'] = version
+    return True
+
+
+## The state of the calibrator. calibration is the calibration at the start (e.g. data/OF_calibration.json, or a snapshot to continue from). statistics is 'ewma' or 'window', mode 'self' or 'reference' (see the top of the file).
+def initial_calibrator(calibration, mode='self', statistics='ewma', half_life=HALF_LIFE, window_length=WINDOW_LENGTH, time_offset=MATCH_OFFSET, update_amplitude=False):
+    online = dict(calibration.get('online', {}))
+    delta = np.array(calibration['delta_BCFD_window_mean'], dtype=float)
+    N_BCFD_WINDOWS = len(delta)
+    return {'mode': mode, 'statistics': statistics, 'alpha': 1. - np.power(0.5, 1./half_life), 'window_length': window_length, 'time_offset': time_offset, 'update_amplitude': update_amplitude,
+            'calibration': calibration,
+            'delta_coefficients': np.array(online.get('delta_coefficients', delta), dtype=float),          ## the offsets the OF coefficients were calculated with
+            'tau_reference': None if (online.get('tau_reference') is None) else np.array(online['tau_reference']),
+            'tau_sum': np.zeros(N_BCFD_WINDOWS), 'tau_n': np.zeros(N_BCFD_WINDOWS, dtype=np.int64),
+            'delta': delta, 'amplitude_scale': float(calibration.get('amplitude_scale', 1.)),
+            'delta_statistics': initial_statistics(N_BCFD_WINDOWS), 'scale_statistics': initial_statistics(1),
+            'published_delta': delta.copy(), 'published_scale': float(calibration.get('amplitude_scale', 1.)),
+            'n_events': np.zeros(N_BCFD_WINDOWS, dtype=np.int64), 'n_since_snapshot': np.zeros(N_BCFD_WINDOWS, dtype=np.int64), 'n_total': 0, 'n_amplitude': 0}
+
+
+## Running statistics for n_groups groups (the BCFD windows, or a single group for the amplitude scale): the exponentially weighted sums of the values and of the weights, and the last values (for 'window').
+def initial_statistics(n_groups):
+    return {'weighted_sum': np.zeros(n_groups), 'weight': np.zeros(n_groups), 'last_values': [np.zeros(0) for group in range(n_groups)]}
+
+
+## Add the values of one group (in the order of the events) to the statistics.
+def update_statistics(statistics, group, values, calibrator):
+    if (len(values) == 0):
+        return
+    if (calibrator['statistics'] == 'ewma'):
+        decay = np.power(1. - calibrator['alpha'], np.arange(len(values) - 1, -1, -1))          ## the last event has weight alpha, the one before alpha*(1 - alpha) etc.
+        statistics['weighted_sum'][group] = np.power(1. - calibrator['alpha'], len(values))*statistics['weighted_sum'][group] + calibrator['alpha']*np.dot(decay, values)
+        statistics['weight'][group] = np.power(1. - calibrator['alpha'], len(values))*statistics['weight'][group] + calibrator['alpha']*decay.sum()
+    else:
+        statistics['last_values'][group] = np.concatenate([statistics['last_values'][group], values])[-calibrator['window_length']:]
+
+
+def statistics_mean(statistics, group, calibrator):
+    if (calibrator['statistics'] == 'ewma'):
+        return statistics['weighted_sum'][group]/statistics['weight'][group]            ## normalised by the weights, so the start of the run is not biased towards zero
+    return statistics['last_values'][group].mean()
+
+
+## Update the calibrator with a block of feature records (in time order), reconstructed with the calibration then in use. With mode 'reference', T_reference and A_reference give the reference time and amplitude of each event (NaN where there is none).
+def update_calibrator(calibrator, records, T_reference=None, A_reference=None):
+    calibration = calibrator['calibration']
+    N_BCFD_WINDOWS = len(calibrator['delta'])
+    use = (records['pileup'] == 0) & (records['cfd_time'] > 0)
+    BCFD_window = records['cfd_time'].astype(int) - 1
+    tau = reconstructed_tau(records, calibration)
+
+    if (calibrator['mode'] == 'self'):
+        ## Until tau_reference is known (from the first MIN_EVENTS events of each window), the offsets stay at those of the coefficients.
+        if calibrator['tau_reference'] is None:
+            calibrator['tau_sum'] += np.bincount(BCFD_window[use], weights=tau[use], minlength=N_BCFD_WINDOWS)
+            calibrator['tau_n'] += np.bincount(BCFD_window[use], minlength=N_BCFD_WINDOWS)
+            if (calibrator['tau_n'].min() >= MIN_EVENTS):
+                calibrator['tau_reference'] = calibrator['tau_sum']/calibrator['tau_n']
+            return
+        implied_delta = calibrator['delta_coefficients'][BCFD_window] + tau - calibrator['tau_reference'][BCFD_window]
+    else:
+        use &= np.isfinite(T_reference)
+        T_0_BCFD = (BCFD_window + 0.5)/N_BCFD_WINDOWS
+        implied_delta = records['timestamp'] + T_0_BCFD + tau - (T_reference + calibrator['time_offset'])
+        if calibrator['update_amplitude']:
+            with_amplitude = use & np.isfinite(A_reference) & (records['u'] > 0)
+            update_statistics(calibrator['scale_statistics'], 0, A_reference[with_amplitude]/records['u'][with_amplitude], calibrator)
+            calibrator['n_amplitude'] += np.count_nonzero(with_amplitude)
+
+    for window in range(N_BCFD_WINDOWS):
+        in_window = use & (BCFD_window == window)
+        update_statistics(calibrator['delta_statistics'], window, implied_delta[in_window], calibrator)
+        calibrator['n_events'][window] += np.count_nonzero(in_window)
+        calibrator['n_since_snapshot'][window] += np.count_nonzero(in_window)
+    calibrator['n_total'] += np.count_nonzero(use)
+
+    if (calibrator['n_events'].min() > 0):
+        calibrator['delta'] = np.array([statistics_mean(calibrator['delta_statistics'], window, calibrator) for window in range(N_BCFD_WINDOWS)])
+    if (calibrator['n_amplitude'] > 0):
+        calibrator['amplitude_scale'] = float(statistics_mean(calibrator['scale_statistics'], 0, calibrator))
+
+
+## The calibration with the current offsets and amplitude scale, and the information needed to continue from it ('online').
+def current_calibration(calibrator, first_timestamp):
+    calibration = dict(calibrator['calibration'])
+    calibration['delta_BCFD_window_mean'] = calibrator['delta'].tolist()
+    calibration['amplitude_scale'] = calibrator['amplitude_scale']
+    calibration['online'] = {'version': None, 'first_timestamp': int(first_timestamp), 'mode': calibrator['mode'], 'statistics': calibrator['statistics'], 'n_events': int(calibrator['n_total']),
+                             'delta_coefficients': calibrator['delta_coefficients'].tolist(), 'tau_reference': None if (calibrator['tau_reference'] is None) else calibrator['tau_reference'].tolist()}
+    return calibration
+
+
+## Write a new snapshot if there are enough new events in every BCFD window and the offsets or the amplitude scale have moved enough since the last one. first_timestamp is the first sample the snapshot is meant for. Returns the version written, or None.
+def publish_if_changed(calibrator, first_timestamp, directory=SNAPSHOT_DIRECTORY):
+    if (calibrator['n_since_snapshot'].min() < MIN_EVENTS):
+        return None
+    if (np.max(np.abs(calibrator['delta'] - calibrator['published_delta'])) < MIN_DELTA_CHANGE) and (abs(calibrator['amplitude_scale'] - calibrator['published_scale']) < MIN_SCALE_CHANGE):
+        return None
+    version = write_snapshot(current_calibration(calibrator, first_timestamp), directory)
+    calibrator['published_delta'] = calibrator['delta'].copy()
+    calibrator['published_scale'] = calibrator['amplitude_scale']
+    calibrator['n_since_snapshot'][:] = 0
+    return version
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Reconstruct a run of feature records block by block while recalibrating the BCFD time offsets (and amplitude scale) online. New calibrations are written as versioned snapshots, which the reconstruction picks up between blocks.')
+    parser.add_argument('--records-file', default=os.path.join(DATA_DIRECTORY, 'feature_records.bin'), help='feature records (emulate_VHDL.py --feature-records or stream_processing.py)')
+    parser.add_argument('--mc-truth-file', default=os.path.join(DATA_DIRECTORY, 'MC_truth_data.bin'))
+    parser.add_argument('--mode', choices=['self', 'reference'], default='self', help="'reference' uses the MC truth as the reference time and amplitude")
+    parser.add_argument('--statistics', choices=['ewma', 'window'], default='ewma')
+    parser.add_argument('--half-life', type=int, default=HALF_LIFE)
+    parser.add_argument('--window-length', type=int, default=WINDOW_LENGTH)
+    parser.add_argument('--update-amplitude', action='store_true', help='with --mode reference, also update the amplitude scale')
+    parser.add_argument('--block-size', type=int, default=2000, help='records per block')
+    parser.add_argument('--snapshot-dir', default=SNAPSHOT_DIRECTORY)
+    parser.add_argument('--perturb', type=float, nargs=2, default=(0., 1.), metavar=('DELTA', 'SCALE'), help='start from a calibration with DELTA added to the offsets and the amplitude scale set to SCALE (to see the recalibration converge)')
+    args = parser.parse_args(argv)
+
+    header, records = open_data_file(args.records_file)
+    records = records[:]
+    calibration = load_calibration()
+    calibration['delta_BCFD_window_mean'] = calibration['delta_BCFD_window_mean'] + args.perturb[0]
+    calibration['amplitude_scale'] = args.perturb[1]
+    calibration['online'] = {'delta_coefficients': load_calibration()['delta_BCFD_window_mean'].tolist()}
+
+    ## The MC truth, for the reference mode and to follow the residuals during the run:
+    MC_truth_header, MC_truth_data = open_data_file(args.mc_truth_file)
+    N_SAMPLES_PER_WAVEFORM = MC_truth_header['N_SAMPLES_PER_WAVEFORM']
+    true_waveform, true_position, True_A, True_T = get_true_pulses(as_array(MC_truth_data), MC_truth_header['N_EMPTY_WAVEFORMS'], MC_truth_header['N_EMPTY_WAVEFORMS'] + MC_truth_header['N_REAL_WAVEFORMS'], N_SAMPLES_PER_WAVEFORM)
+
+    calibrator = initial_calibrator(calibration, args.mode, args.statistics, args.half_life, args.window_length, update_amplitude=args.update_amplitude)
+    follower = follow_snapshots(calibration, args.snapshot_dir)
+    first_version = latest_version(args.snapshot_dir)
+    follower['version'] = first_version                 ## older snapshots in the directory are not used
+
+    print('{:>8}{:>12}{:>10}  {:<44}{:>10}{:>14}{:>14}'.format('block', 'timestamp', 'version', 'delta_BCFD_window_mean', 'scale', 'T residual', 'A residual'))
+    for block_start in range(0, len(records), args.block_size):
+        block = records[block_start:block_start + args.block_size]
+        refresh_calibration(follower)
+        trigger_timestamps, Reconstructed_A, Reconstructed_T = reconstruct_pulses(block, block['timestamp'][0], block['timestamp'][-1] + 1, follower['calibration'])
+
+        matched, match = match_pulses(Reconstructed_T, True_T)
+        T_reference = np.where(matched, True_T[match], np.nan)
+        A_reference = np.where(matched, True_A[match], np.nan)
+        update_calibrator(calibrator, block, T_reference, A_reference)
+        version = publish_if_changed(calibrator, block['timestamp'][-1] + 1, args.snapshot_dir)
+
+        first_pulse = matched & (block['pileup'] == 0)
+        if (version is not None) or (block_start + args.block_size >= len(records)):
+            print('{:>8}{:>12}{:>10}  {:<44}{:>10.4f}{:>14.4f}{:>14.4f}'.format(block_start//args.block_size, int(block['timestamp'][0]), follower['version'] if (follower['version'] > first_version) else 'start', ' '.join('{:.4f}'.format(delta) for delta in follower['calibration']['delta_BCFD_window_mean']), follower['calibration'].get('amplitude_scale', 1.),
+                                                                      np.mean(Reconstructed_T[first_pulse] - T_reference[first_pulse]) - MATCH_OFFSET, np.mean(Reconstructed_A[first_pulse]/A_reference[first_pulse]) - 1.))
+
+    print(str(latest_version(args.snapshot_dir) - first_version) + ' snapshots written to ' + args.snapshot_dir)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import argparse
+import os
+import numpy as np
+from data_format import OUTPUT_DTYPE, DATA_DIRECTORY, open_data_file, as_array, make_rows
+from OF_calibration import load_calibration
+from emulate_VHDL import FIR_LENGTH, coefficients_from_calibration, run_pipeline_segmented
+from reconstruct_A_and_T import reconstruct_pulses, get_true_pulses, match_pulses
+from design_sweep import estimate_cost
+
+## Resolution and FPGA cost versus the maximum number of overlapping pulses handled by the OF (MAX_PILEUP_PULSES = N in my_types.vhd). In a pile-up chain, the tail of each of the first N - 1 pulses is reconstructed from its OF sums and template (one set of g and d_g multipliers per pulse, see optimal_filter.vhd), and the sum of the tails is subtracted from the baseline before the next pulse is analysed. Pulse N of a chain is still reported, but its tail is not reconstructed, and a further pulse sends the OF back to 'waiting' without a final trigger.
+##
+## The pulse train in input_data.bin is processed by emulate_VHDL.py for each N, and the output is reconstructed and matched to the MC truth as in reconstruct_A_and_T.py. To see an effect beyond N = 2, the pulse train should contain chains of more than two overlapping pulses: e.g. generate_pulse_data.py --n-pulses 4 --delta-t0 5 25, or with a high --rate.
+
+
+## Run the emulator with up to max_pileup_pulses overlapping pulses and compare the reconstructed pulses with the MC truth. Returns a dictionary with the efficiency, the fake rate and, for each position of the pulse in its waveform (0 = the first pulse, up to MAX_POSITION), the number of true pulses, the efficiency and the mean and standard deviation of the time difference and the relative amplitude difference.
+def evaluate_pileup_depth(max_pileup_pulses, coefficients, calibration, input_data, MC_truth_data, N_EMPTY_WAVEFORMS, N_REAL_WAVEFORMS, N_SAMPLES_PER_WAVEFORM, MAX_POSITION):
+    output_data = make_rows(run_pipeline_segmented(input_data, coefficients=coefficients, max_pileup_pulses=max_pileup_pulses), OUTPUT_DTYPE)
+
+    trigger_timestamps, Reconstructed_A, Reconstructed_T = reconstruct_pulses(output_data, N_EMPTY_WAVEFORMS*N_SAMPLES_PER_WAVEFORM, (N_EMPTY_WAVEFORMS + N_REAL_WAVEFORMS)*N_SAMPLES_PER_WAVEFORM, calibration)
+    true_waveform, true_position, True_A, True_T = get_true_pulses(MC_truth_data, N_EMPTY_WAVEFORMS, N_EMPTY_WAVEFORMS + N_REAL_WAVEFORMS, N_SAMPLES_PER_WAVEFORM)
+    matched, match = match_pulses(Reconstructed_T, True_T)
+
+    delta_A = (Reconstructed_A[matched] - True_A[match[matched]])/True_A[match[matched]]
+    delta_T = Reconstructed_T[matched] - True_T[match[matched]]
+    matched_position = true_position[match[matched]]
+
+    result = {'efficiency': np.count_nonzero(matched)/max(len(True_T), 1), 'fake_rate': np.count_nonzero(~matched)/max(len(Reconstructed_T), 1)}
+    for position in range(MAX_POSITION + 1):
+        selection = (matched_position == position)
+        n_true = np.count_nonzero(true_position == position)
+        result['n_true_' + str(position)] = n_true
+        result['efficiency_' + str(position)] = np.count_nonzero(selection)/max(n_true, 1)
+        result['T_mean_' + str(position)] = np.mean(delta_T[selection]) if np.any(selection) else np.nan
+        result['T_resolution_' + str(position)] = np.std(delta_T[selection]) if np.any(selection) else np.nan
+        result['A_mean_' + str(position)] = np.mean(delta_A[selection]) if np.any(selection) else np.nan
+        result['A_resolution_' + str(position)] = np.std(delta_A[selection]) if np.any(selection) else np.nan
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Efficiency and resolution versus the maximum number of overlapping pulses handled by the OF.')
+    parser.add_argument('--data-dir', default=DATA_DIRECTORY, help='the directory with input_data.bin and MC_truth_data.bin')
+    parser.add_argument('--no-plot', action='store_true')
+    args = parser.parse_args(argv)
+
+    header, input_data = open_data_file(os.path.join(args.data_dir, 'input_data.bin'))
+    MC_truth_header, MC_truth_data = open_data_file(os.path.join(args.data_dir, 'MC_truth_data.bin'))
+    MC_truth_data = as_array(MC_truth_data)
+
+    N_SAMPLES_PER_WAVEFORM = header['N_SAMPLES_PER_WAVEFORM']
+    N_REAL_WAVEFORMS = header['N_REAL_WAVEFORMS']
+    N_EMPTY_WAVEFORMS = header['N_EMPTY_WAVEFORMS']
+
+    ## The values of MAX_PILEUP_PULSES (N) to compare. N = 2 is the design in optimal_filter.vhd so far (the tail of the first pulse is reconstructed).
+    MAX_PILEUP_PULSES_VALUES = [2, 3, 4, 5]
+
+    ## The resolution is listed for the pulses at these positions in the waveform (0 = the first pulse in the waveform):
+    MAX_POSITION = 3
+
+    ## The calibration in vhdl/OF_coefficients.vhd (data/OF_calibration.json):
+    calibration = load_calibration()
+    coefficients = coefficients_from_calibration(calibration)
+    parameters = calibration['parameters']
+
+    input_data = input_data['sample'].astype(np.int64)
+
+    results = []
+    for max_pileup_pulses in MAX_PILEUP_PULSES_VALUES:
+        result = {'N': max_pileup_pulses}
+        result.update(evaluate_pileup_depth(max_pileup_pulses, coefficients, calibration, input_data, MC_truth_data, N_EMPTY_WAVEFORMS, N_REAL_WAVEFORMS, N_SAMPLES_PER_WAVEFORM, MAX_POSITION))
+
+        ## The multipliers needed (and the DSP slices these use), compared with N = 2:
+        cost = estimate_cost(parameters['M_A'], parameters['M_B'], parameters['g_PRECISION'], parameters['d_g_PRECISION'], FIR_LENGTH, len(calibration['FIR_coefficients_a']), np.shape(calibration['g_values'])[1], max_pileup_pulses)
+        reference_cost = estimate_cost(parameters['M_A'], parameters['M_B'], parameters['g_PRECISION'], parameters['d_g_PRECISION'], FIR_LENGTH, len(calibration['FIR_coefficients_a']), np.shape(calibration['g_values'])[1], 2)
+        result['n_multipliers'] = cost['n_multipliers']
+        result['extra_multipliers'] = cost['n_multipliers'] - reference_cost['n_multipliers']
+        result['n_DSP'] = cost['n_DSP']
+        results.append(result)
+
+    print('  N  multipliers (extra)  DSP  efficiency  fake rate')
+    for result in results:
+        print('{N:3d}{n_multipliers:13d}{extra_multipliers:8d}{n_DSP:5d}{efficiency:12.4f}{fake_rate:11.4f}'.format(**result))
+    print()
+    print('  N  position  true pulses  efficiency  T mean  T res.  A mean  A res.')
+    for result in results:
+        for position in range(MAX_POSITION + 1):
+            print('{:3d}{:10d}{:13d}{:12.4f}{:8.4f}{:8.4f}{:8.4f}{:8.4f}'.format(result['N'], position, result['n_true_' + str(position)], result['efficiency_' + str(position)], result['T_mean_' + str(position)], result['T_resolution_' + str(position)], result['A_mean_' + str(position)], result['A_resolution_' + str(position)]))
+
+    if not args.no_plot:
+        ## Plot the resolution of the pulses at each position against the number of multipliers:
+        import matplotlib.pyplot as plt
+
+        n_multipliers = [result['n_multipliers'] for result in results]
+        fig, (ax_T, ax_A) = plt.subplots(1, 2, figsize=(12, 5))
+        for position in range(1, MAX_POSITION + 1):
+            ax_T.plot(n_multipliers, [result['T_resolution_' + str(position)] for result in results], 'o-', label='Pulse ' + str(position) + ' in the waveform')
+            ax_A.plot(n_multipliers, [result['A_resolution_' + str(position)] for result in results], 'o-', label='Pulse ' + str(position) + ' in the waveform')
+        for result in results:
+            ax_T.annotate('N = ' + str(result['N']), (result['n_multipliers'], result['T_resolution_1']))
+        ax_T.set_xlabel('Multipliers in the optimal_filter')
+        ax_T.set_ylabel(r'Time resolution ($\sigma_T$) [samples]')
+        ax_A.set_xlabel('Multipliers in the optimal_filter')
+        ax_A.set_ylabel(r'Relative amplitude resolution ($\sigma_A/A$)')
+        ax_T.legend()
+
+        plt.show()
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+import argparse
+import os
+import time
+import numpy as np
+from data_format import DATA_DIRECTORY, open_data_file
+from OF_calibration import load_calibration
+from emulate_VHDL import THRESHOLD_CFD, BCFD_bisection
+
+## Pulse templates (g and its time-derivative d_g, one per BCFD window) measured from the data, instead of the lognormal with fixed mu and sigma. The isolated pulses in a pulse train are found with the CFD (as in constant_fraction.vhd), aligned on the first sample after the CFD zero crossing and normalised, and the average shape is accumulated per BCFD window. The pulse train is read in chunks from the memory-mapped file, and the averages are kept as running statistics (count, mean and sum of squared deviations for every template sample, merged chunk by chunk), so any amount of data is processed in one pass without keeping it in memory.
+##
+## The pulses in BCFD window w have their CFD crossing at (roughly) (w - 0.5)/N_BCFD_WINDOWS of a sample before the alignment sample, so the N_BCFD_WINDOWS averages are the same shape sampled at N_BCFD_WINDOWS different phases. Combined, they give the shape on a grid of about 1/N_BCFD_WINDOWS samples, from which the derivative d_g is calculated (by finite differences) and the peak is found (by a parabola through the highest three points). The templates are scaled to a peak of one, like the lognormal template (so that u is the amplitude).
+##
+## The templates are aligned like the lognormal templates in OF_calibration.py: the first sample after the CFD crossing is sample TEMPLATE_ALIGNMENT of the template, the point that T0_assumed is calculated from. So the same delta_BCFD_window_mean (the offset between the BCFD time and T_0) applies, and the result is passed directly to calculate_OF_calibration (see get_OF_coefficients.py).
+
+TEMPLATE_ALIGNMENT = 6                      ## the template sample that is the first sample after the CFD crossing (the 6 samples in T0_assumed, OF_calibration.py)
+N_BASELINE_SAMPLES = 16                     ## the baseline is the average of the 16 samples before the template (as in baseline_calculator.vhd)
+MIN_AMPLITUDE = 20                          ## the sample after a CFD crossing must be this far above the baseline (rejects crossings caused by noise)
+RISE_THRESHOLD = 12                         ## a rise by more than this from one sample to the next, outside the rising edge of the pulse itself, is taken as the start of another pulse (e.g. a pile-up pulse on the tail, too close to give its own CFD crossing). Well above the rises caused by the baseline noise.
+MIN_SEPARATION = 50                         ## a pulse is only used if no other pulse is found within this many samples before or after it. The pulse is normalised to the sum of its first MIN_SEPARATION template samples, and the template samples after the start of the next pulse are not used.
+CHUNK_SIZE = 1 << 22
+
+
+## The running statistics of the templates: for each BCFD window and template sample, the number of pulses, the mean and the sum of squared deviations from the mean (M2), and the number of pulses per window.
+def initial_statistics(N_BCFD_WINDOWS, n_template):
+    return {'n': np.zeros((N_BCFD_WINDOWS, n_template), dtype=np.int64),
+            'mean': np.zeros((N_BCFD_WINDOWS, n_template)),
+            'M2': np.zeros((N_BCFD_WINDOWS, n_template)),
+            'n_pulses': np.zeros(N_BCFD_WINDOWS, dtype=np.int64)}
+
+
+## Find the isolated pulses in samples (a stretch of the pulse train). For every candidate sample s (with enough samples before it for the baseline), the baseline is the average of the N_BASELINE_SAMPLES samples before template sample 0 (i.e. before s - TEMPLATE_ALIGNMENT) and the CFD is calculated as in constant_fraction.vhd. A pulse is a CFD zero crossing between s - 1 and s that rises by more than THRESHOLD_CFD, with sample s more than MIN_AMPLITUDE above the baseline. Returns the first sample after each crossing, the baseline, the CFD values before and after the crossing, the distance to the previous and next pulse (a large number where there is none) and whether there is no other rising edge (see RISE_THRESHOLD) in the baseline samples or in the first MIN_SEPARATION template samples.
+def find_pulses(samples, CFD_delay, CFD_attenuation):
+    first = TEMPLATE_ALIGNMENT + N_BASELINE_SAMPLES
+    if (len(samples) <= first):
+        return tuple(np.zeros(0, dtype=np.int64) for _ in range(7))
+
+    cumulative = np.concatenate([[0], np.cumsum(samples)])
+    s = np.arange(first, len(samples))
+    baseline = (cumulative[s - TEMPLATE_ALIGNMENT] - cumulative[s - TEMPLATE_ALIGNMENT - N_BASELINE_SAMPLES]) >> 4
+    y_0 = (samples[s - 1 - CFD_delay] - baseline) - np.floor(CFD_attenuation*(samples[s - 1] - baseline)).astype(np.int64)
+    y_1 = (samples[s - CFD_delay] - baseline) - np.floor(CFD_attenuation*(samples[s] - baseline)).astype(np.int64)
+    pulse = (y_0 < 0) & (y_1 >= 0) & (y_1 - y_0 > THRESHOLD_CFD) & (samples[s] - baseline > MIN_AMPLITUDE)
+
+    positions = s[pulse]
+    gaps = np.diff(positions)
+    no_pulse = np.iinfo(np.int64).max
+    previous_distance = np.concatenate([[no_pulse], gaps])
+    next_distance = np.concatenate([gaps, [no_pulse]])
+
+    ## The rising edge of the pulse itself is in template samples 1 to TEMPLATE_ALIGNMENT (the CFD crosses zero just after the peak).
+    rises = np.concatenate([[0], np.cumsum(np.diff(samples) > RISE_THRESHOLD)])                ## rises[n]: the number of rises up to sample n
+    end = np.minimum(positions - TEMPLATE_ALIGNMENT + MIN_SEPARATION, len(samples) - 1)
+    clean = (rises[positions - TEMPLATE_ALIGNMENT] - rises[positions - first] == 0) & (rises[end] - rises[positions] == 0)
+    return positions, baseline[pulse], y_0[pulse], y_1[pulse], previous_distance, next_distance, clean
+
+
+## Add the isolated pulses in samples to the statistics (in place). Only the pulses with the first sample after the crossing in [own_start, own_stop) are used (samples must reach far enough before and after these for the baseline, the isolation and the template, see build_templates).
+def accumulate_templates(statistics, samples, own_start, own_stop, CFD_delay, CFD_attenuation):
+    N_BCFD_WINDOWS, n_template = statistics['mean'].shape
+    positions, baseline, y_0, y_1, previous_distance, next_distance, clean = find_pulses(samples, CFD_delay, CFD_attenuation)
+
+    use = clean & (positions >= own_start) & (positions < own_stop) & (previous_distance >= MIN_SEPARATION) & (next_distance >= MIN_SEPARATION) & (positions - TEMPLATE_ALIGNMENT + MIN_SEPARATION <= len(samples))
+    positions, baseline, y_0, y_1, next_distance = positions[use], baseline[use], y_0[use], y_1[use], next_distance[use]
+    if (len(positions) == 0):
+        return
+
+    ## The template samples of each pulse, minus the baseline, normalised to the sum of the first MIN_SEPARATION samples. Samples from the start of the next pulse on, or beyond the end of the data, are not used.
+    indices = positions[:, np.newaxis] - TEMPLATE_ALIGNMENT + np.arange(n_template)
+    valid = (np.arange(n_template) < next_distance[:, np.newaxis]) & (indices < len(samples))
+    pulses = samples[np.minimum(indices, len(samples) - 1)] - baseline[:, np.newaxis]
+    pulses = pulses/pulses[:, :MIN_SEPARATION].sum(axis=1)[:, np.newaxis]
+    window = BCFD_bisection(y_0, y_1, N_BCFD_WINDOWS)
+
+    ## Merge the statistics of this chunk into the running statistics, window by window (Chan et al.: the means are combined weighted by the counts, and M2 gets an extra term for the difference of the means).
+    for window_no in range(N_BCFD_WINDOWS):
+        rows = (window == window_no + 1)
+        chunk_valid = valid[rows]
+        chunk_n = chunk_valid.sum(axis=0)
+        chunk_mean = np.where(chunk_valid, pulses[rows], 0.).sum(axis=0)/np.maximum(chunk_n, 1)
+        chunk_M2 = np.where(chunk_valid, np.power(pulses[rows] - chunk_mean, 2), 0.).sum(axis=0)
+
+        n = statistics['n'][window_no]
+        total_n = n + chunk_n
+        delta = chunk_mean - statistics['mean'][window_no]
+        statistics['mean'][window_no] += delta*chunk_n/np.maximum(total_n, 1)
+        statistics['M2'][window_no] += chunk_M2 + np.power(delta, 2)*n*chunk_n/np.maximum(total_n, 1)
+        statistics['n'][window_no] = total_n
+        statistics['n_pulses'][window_no] += np.count_nonzero(rows)
+
+
+## Calculate the templates from the statistics: combine the averages of the BCFD windows into the shape on a finer grid, take the derivative and scale to a peak of one. Returns a dictionary with g, d_g, the statistical uncertainty of g (g_error), the alignment sample (sample_above_zero, see calculate_OF_calibration) and the number of pulses per window.
+def finish_templates(statistics):
+    N_BCFD_WINDOWS, n_template = statistics['mean'].shape
+    if np.any(statistics['n_pulses'] == 0):
+        raise ValueError('No isolated pulses found in BCFD window(s) ' + ', '.join(str(window_no + 1) for window_no in np.flatnonzero(statistics['n_pulses'] == 0)))
+
+    ## The later the crossing within the sample, the earlier the pulse is sampled. The time shift between the windows is not exactly 1/N_BCFD_WINDOWS (the linear interpolation of the crossing is biased, which is what delta_BCFD_window_mean corrects for), so it is measured: the centroid of the average shape (over the first MIN_SEPARATION samples, which are used for every pulse) moves with the shift. Template sample i of window w is then at time i - centroid_w with respect to the pulse, and the derivative is taken over all windows together, with the samples in time order.
+    template_samples = np.arange(n_template)
+    head = statistics['mean'][:, :MIN_SEPARATION]
+    centroid = (head*template_samples[:MIN_SEPARATION]).sum(axis=1)/head.sum(axis=1)
+    times = (template_samples - centroid[:, np.newaxis]).flatten()
+    order = np.argsort(times, kind='stable')
+    fine_shape = statistics['mean'].flatten()[order]
+    fine_derivative = np.zeros(len(times))
+    fine_derivative[order] = np.gradient(fine_shape, times[order])
+
+    ## The peak: a parabola through the highest point and its two neighbours.
+    peak_index = int(np.clip(np.argmax(fine_shape), 1, len(fine_shape) - 2))
+    curvature, slope, peak = np.polyfit(times[order][peak_index - 1:peak_index + 2] - times[order][peak_index], fine_shape[peak_index - 1:peak_index + 2], 2)
+    if (curvature < 0):
+        peak -= np.power(slope, 2)/(4*curvature)
+
+    n = statistics['n']
+    g_error = np.sqrt(np.where(n > 1, statistics['M2']/np.maximum(n*(n - 1), 1), 0.))/peak
+    return {'g': statistics['mean']/peak, 'd_g': fine_derivative.reshape(N_BCFD_WINDOWS, n_template)/peak, 'g_error': g_error,
+            'sample_above_zero': TEMPLATE_ALIGNMENT, 'n_pulses': statistics['n_pulses'].copy()}
+
+
+## Measure the templates from the pulse train in a data file (see data_format.py), in one pass over chunks of chunk_size samples. n_template is the template length (N_SAMPLES_PER_WAVEFORM, the number of template values in the VHDL code). Returns the templates (see finish_templates).
+def build_templates(path, N_BCFD_WINDOWS, CFD_delay, CFD_attenuation, n_template=100, chunk_size=CHUNK_SIZE):
+    header, pulse_train = open_data_file(path)
+    samples = pulse_train['sample']
+    statistics = initial_statistics(N_BCFD_WINDOWS, n_template)
+
+    ## Each chunk is read with enough samples before it for the baseline and the isolation of its first pulses, and enough after it for the template and the isolation of its last pulses.
+    margin_before = MIN_SEPARATION + TEMPLATE_ALIGNMENT + N_BASELINE_SAMPLES + CFD_delay + 1
+    margin_after = n_template + MIN_SEPARATION
+    for chunk_start in range(0, len(samples), chunk_size):
+        read_start = max(chunk_start - margin_before, 0)
+        read_stop = min(chunk_start + chunk_size + margin_after, len(samples))
+        accumulate_templates(statistics, np.asarray(samples[read_start:read_stop], dtype=np.int64), chunk_start - read_start, chunk_start + chunk_size - read_start, CFD_delay, CFD_attenuation)
+
+    return finish_templates(statistics)
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure the pulse templates (g and d_g per BCFD window) from the isolated pulses in a pulse train, and compare them with the lognormal templates of the current calibration.')
+    parser.add_argument('--input-file', default=os.path.join(DATA_DIRECTORY, 'input_data_no_pileup.bin'))
+    parser.add_argument('--n-bcfd-windows', type=int, default=4)
+    parser.add_argument('--no-plot', action='store_true')
+    args = parser.parse_args(argv)
+
+    calibration = load_calibration()
+    parameters = calibration['parameters']
+
+    start_time = time.perf_counter()
+    templates = build_templates(args.input_file, args.n_bcfd_windows, parameters['CFD_delay'], parameters['CFD_attenuation'], parameters['N_SAMPLES_PER_WAVEFORM'])
+    elapsed = time.perf_counter() - start_time
+    print('Templates from ' + str(templates['n_pulses'].sum()) + ' isolated pulses (per BCFD window: ' + ', '.join(str(n) for n in templates['n_pulses']) + ') in {:.2f} s'.format(elapsed))
+
+    ## The (quantised) lognormal templates of the current calibration, for comparison:
+    if (len(calibration['g_values']) == args.n_bcfd_windows):
+        g_lognormal = calibration['g_values']/np.power(2., parameters['g_PRECISION'])
+        d_g_lognormal = calibration['d_g_values']/np.power(2., parameters['d_g_PRECISION'])
+        for window_no in range(args.n_bcfd_windows):
+            print('BCFD window {}: max. difference from the lognormal g {:.4f} (statistical uncertainty {:.4f}), d_g {:.4f}'.format(window_no + 1, np.max(np.abs(templates['g'][window_no] - g_lognormal[window_no])), np.max(templates['g_error'][window_no]), np.max(np.abs(templates['d_g'][window_no] - d_g_lognormal[window_no]))))
+
+    if not args.no_plot:
+        import matplotlib.pyplot as plt
+
+        fig, ax = plt.subplots(1, 2)
+        for window_no in range(args.n_bcfd_windows):
+            ax[0].plot(templates['g'][window_no], label='window ' + str(window_no + 1))
+            ax[1].plot(templates['d_g'][window_no], label='window ' + str(window_no + 1))
+            if (len(calibration['g_values']) == args.n_bcfd_windows):
+                ax[0].plot(g_lognormal[window_no], 'k:')
+                ax[1].plot(d_g_lognormal[window_no], 'k:')
+        ax[0].set_xlabel('Template sample')
+        ax[0].set_ylabel('g')
+        ax[1].set_xlabel('Template sample')
+        ax[1].set_ylabel('d_g')
+        ax[0].legend()
+        plt.show()
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+import numpy as np
+import emulate_VHDL
+from data_format import DATA_DIRECTORY
+from OF_calibration import load_calibration, lognormal_fcn
+from emulate_VHDL import MAX_PILEUP_PULSES
+
+## A fast, semi-analytical model of the dead time and the pile-up losses of the feature extraction versus the input rate, to see how many pulses per second a channel can handle without generating and simulating a full dataset for each rate (as dead_time.py --rates does). Only the arrival times and amplitudes of the pulses are drawn (a Poisson process with uniform amplitudes, as in generate_pulse_data.py --rate); no waveforms are generated. The pulse shape enters through a few functions of the template (amplitude 1), tabulated once: the 2-sample average that the baseline_calculator compares with its thresholds, its running integral, and the CFD signal. Everything else is vectorised arithmetic on the pulse times, with the thresholds and latencies of the design (the module constants of emulate_VHDL.py):
+##   - the 'sleeping' period of the baseline_calculator: it starts when the pulse rises THRESHOLD_RISING above the baseline (the time follows from the amplitude, by inverting the rising edge of the template), and ends when the sum of the pulse and the tails of the N_PREVIOUS pulses before it falls below THRESHOLD_FALLING again (found by bisection on the falling edges). A pulse that starts before the period of the pulses before it has ended extends that period. The baseline locked at the start of a period is the 16-sample average (BASELINE_AVERAGE_LENGTH) of the signal BASELINE_LOCK_OFFSET samples before the rise, i.e. the integral of the preceding tails over that interval. The baseline buffer is not updated for PULSE_WIDTH_BEFORE_RESET cycles after a final trigger, so only the part of the interval after that contributes (the rest of the buffer holds the true baseline). Pulses that arrive in the BASELINE_SETUP_SAMPLES setup period are lost.
+##   - the CFD zero crossing of the pulse (CFD_DELAY, attenuation 1/2, THRESHOLD_CFD): the CFD signal of the pulse, the preceding tails and the locked baseline is evaluated at the few samples between the minimum of the CFD signal of the pulse and its zero crossing. While the OF can still accept a pulse in the chain, the tail of the preceding pulse is subtracted by the baseline_selector from TAIL_DELAY cycles after its crossing onwards (the alignment of the template with OF_ALIGNMENT_N_SAMPLES is taken as exact). The crossing must be at least CFD_RE_ARM cycles after the crossing of the preceding pulse (the CFD is armed again only then), otherwise the pulses are merged.
+##   - the OF chain of each sleeping period: the OF accepts a pulse with a CFD crossing if its amplitude is above OF_AMPLITUDE_THRESHOLD and above the fraction (OF_AMPLITUDE_THRESHOLD_FRACTION) of the preceding pulse, and a pulse accepted when the chain is already max_pileup_pulses long is lost (a chain overflow, after which the OF starts a new chain). The state of the chain when a pulse arrives follows from the number of accepted and overflowing pulses before it in its period, so the chain is solved for all pulses at once, repeating until the states no longer change (the state of a pulse depends only on the pulses before it, so this converges). The time the OF spends in its last state and the time the baseline cannot be updated after the last final trigger of a period (PULSE_WIDTH_BEFORE_RESET) give the dead time.
+##
+## Each pulse is classified as recorded (the only pulse in its sleeping period), piled up and recovered (accepted in a period with other pulses), or lost: not resolved (no CFD crossing of its own), rejected by the OF amplitude thresholds, lost because the pile-up chain was full, or lost in the setup period. A rate point of N_PULSES pulses takes 10 to 40 ms (more for higher rates, with longer chains), against minutes for the full simulation. The model is noiseless: the amplitude estimate of the OF is taken to be the true amplitude, and the noise periods of the baseline_calculator (the noise alone crossing THRESHOLD_RISING) are not modelled, so the sleeping fraction is that of the pulses only. With --validate, the model is compared with the full simulation (dead_time.py: generated data, run through emulate_VHDL.py and the reconstruction) at a few rates.
+
+## The rates scanned by default (pulses per sample), the number of pulses drawn for each rate and the amplitude range (as in generate_pulse_data.py):
+RATES = [0.001, 0.002, 0.005, 0.01, 0.02, 0.03, 0.05, 0.07, 0.1, 0.15, 0.2]
+N_PULSES = 10000
+AMPLITUDE_RANGE = (50., 1000.)
+
+## The number of preceding pulses whose tails are included:
+N_PREVIOUS = 3
+
+## The template functions are tabulated with TEMPLATE_RESOLUTION points per sample, from one sample before to TEMPLATE_LENGTH samples after the start of the pulse (after which the tail of even the largest pulse is far below 1 ADC count, so older pulses are ignored). The end of a sleeping period is found with END_BISECTION_STEPS bisection steps.
+TEMPLATE_RESOLUTION = 64
+TEMPLATE_LENGTH = 100
+END_BISECTION_STEPS = 8
+
+## The times at which the average of the template rises above and falls below a level (relative to the amplitude) are tabulated on a grid of INVERSE_POINTS values of the log of the level, from INVERSE_MIN_LOG_LEVEL up to the peak:
+INVERSE_POINTS = 4096
+INVERSE_MIN_LOG_LEVEL = -20.
+
+## The design latencies used by the model (see above). TAIL_DELAY and CFD_RE_ARM are in clock cycles after a CFD crossing; with them, the model gives the same minimum separation of two resolved pulses as emulate_VHDL.py for noiseless pulse pairs (about 4.5 samples, or 3 if the second pulse is much larger).
+BASELINE_AVERAGE_LENGTH = 16
+BASELINE_LOCK_OFFSET = 5
+TAIL_DELAY = 4
+CFD_RE_ARM = 3
+
+## The fate of each pulse:
+OUTCOMES = ['accepted', 'lost_unresolved', 'lost_rejected', 'lost_chain_full', 'lost_setup']
+ACCEPTED, LOST_UNRESOLVED, LOST_REJECTED, LOST_CHAIN_FULL, LOST_SETUP = range(len(OUTCOMES))
+
+## The validation points (--validate) are simulated with this many waveforms each:
+VALIDATION_N_WAVEFORMS = 2000
+
+
+## The functions of the template (amplitude 1, starting at t = 0) used by the model, tabulated at TEMPLATE_RESOLUTION points per sample: the 2-sample average ('average'), its integral from t = 0 ('integral', per sample) and the CFD signal ('cfd'). The first and last values hold the values before and after the table (0, or the total integral). Also the peak of the average, the times at which it rises above and falls below a level ('rise_time' and 'fall_time', see INVERSE_POINTS), the minimum of the CFD signal ('t_dip') and its zero crossing after that ('t_crossing').
+def template_functions(mu, sigma):
+    t = np.arange(-TEMPLATE_RESOLUTION, TEMPLATE_LENGTH*TEMPLATE_RESOLUTION + 1)/TEMPLATE_RESOLUTION
+    g = lognormal_fcn(t, 1., 0., mu, sigma, 0.)
+    delayed = lambda n_samples: np.concatenate([np.zeros(n_samples*TEMPLATE_RESOLUTION), g[:len(g) - n_samples*TEMPLATE_RESOLUTION]])
+
+    average = (g + delayed(1))/2.
+    cfd = delayed(emulate_VHDL.CFD_DELAY) - g/2.
+    integral = np.concatenate([[0.], np.cumsum(average[1:] + average[:-1])/(2.*TEMPLATE_RESOLUTION)])
+    average[-1], cfd[-1] = 0., 0.
+    peak = np.argmax(average)
+    dip = np.argmin(cfd)
+    crossing = dip + np.argmax(cfd[dip:] >= 0.)
+    log_level = np.linspace(INVERSE_MIN_LOG_LEVEL, np.log(average[peak]), INVERSE_POINTS)
+    return {'average': average, 'integral': integral, 'cfd': cfd, 't_peak': t[peak], 't_dip': t[dip], 't_crossing': t[crossing], 'log_level': log_level,
+            'rise_time': np.interp(np.exp(log_level), average[:peak + 1], t[:peak + 1]), 'fall_time': np.interp(np.exp(log_level), average[-2:peak - 1:-1], t[-2:peak - 1:-1])}
+
+
+## The values of a tabulated function at the times t since the start of a pulse.
+def lookup(values, t):
+    index = t*TEMPLATE_RESOLUTION
+    index += TEMPLATE_RESOLUTION + 0.5
+    return values.take(np.clip(index, 0, len(values) - 1, out=index).astype(np.intp))
+
+
+## Draw n_pulses pulses of a Poisson process with the given rate (pulses per sample), starting at sample 0, with uniform amplitudes. Returns the start times T0 (in the time units of generate_pulse_data.py, in which sample s is at time s + 1) and the amplitudes.
+def draw_pulses(rng, rate, n_pulses, amplitude_range=AMPLITUDE_RANGE):
+    T0 = np.cumsum(rng.exponential(1./rate, n_pulses))
+    return T0, rng.uniform(amplitude_range[0], amplitude_range[1], n_pulses)
+
+
+## The start times and amplitudes of each pulse (row 0) and of the N_PREVIOUS pulses before it (rows 1, ...). Missing pulses, and pulses more than TEMPLATE_LENGTH samples before, have amplitude 0 and lie far in the past.
+def preceding_pulses(T0, A):
+    T0_padded, A_padded = np.concatenate([np.full(N_PREVIOUS, -10.*TEMPLATE_LENGTH), T0]), np.concatenate([np.zeros(N_PREVIOUS), A])
+    T0_previous = np.stack([T0_padded[N_PREVIOUS - n_back:N_PREVIOUS - n_back + len(T0)] for n_back in range(N_PREVIOUS + 1)])
+    A_previous = np.stack([A_padded[N_PREVIOUS - n_back:N_PREVIOUS - n_back + len(A)] for n_back in range(N_PREVIOUS + 1)])
+    far = (T0_previous[0] - T0_previous >= TEMPLATE_LENGTH)
+    T0_previous[far], A_previous[far] = -10.*TEMPLATE_LENGTH, 0.
+    return T0_previous, A_previous
+
+
+## The sleeping periods: a pulse starts a new period if it rises after all the periods of the pulses before it have ended. Returns whether each pulse starts a new period, and the index of the first pulse of its period.
+def sleeping_periods(rise, end):
+    previous_end = np.concatenate([[-np.inf], np.maximum.accumulate(end)[:-1]])
+    new_period = (rise >= previous_end)
+    return new_period, np.maximum.accumulate(np.where(new_period, np.arange(len(rise)), 0))
+
+
+## The time after the start of a pulse with amplitude A at which the average of the template rises above level (name = 'rise_time') or falls below it for the last time ('fall_time'), from the tables of template_functions. If the pulse never exceeds level, this is the time of its peak.
+def inverse(template, name, A, level):
+    log_level = template['log_level']
+    index = (np.log(level/A) - log_level[0])*((len(log_level) - 1)/(log_level[-1] - log_level[0])) + 0.5
+    return template[name].take(np.clip(index, 0, len(log_level) - 1, out=index).astype(np.intp))
+
+## The end of the sleeping period of each pulse: the time at which the 2-sample average of the pulse and the preceding tails falls below THRESHOLD_FALLING above the baseline. All pulses are past their peak after the peak of the last one, so the sum falls monotonically. The end comes after the pulse alone falls below this level, and before it falls below the level minus the preceding tails at that time (the tails only fall further). In between, where the preceding tails matter, it is found by bisection.
+def period_end(template, T0_previous, A_previous, baseline):
+    level = emulate_VHDL.THRESHOLD_FALLING + baseline
+    low = T0_previous[0] + inverse(template, 'fall_time', A_previous[0], level)
+    tails_at_low = (A_previous[1:]*lookup(template['average'], low - T0_previous[1:])).sum(axis=0)
+    high = T0_previous[0] + inverse(template, 'fall_time', A_previous[0], np.maximum(level - tails_at_low, level/(N_PREVIOUS + 1)))
+    high = np.where(tails_at_low < level*N_PREVIOUS/(N_PREVIOUS + 1), high, T0_previous[0] + inverse(template, 'fall_time', A_previous.sum(axis=0), level))
+    tails = np.flatnonzero(high - low > 1./TEMPLATE_RESOLUTION)
+    T0_tails, A_tails, level_tails, low_tails, high_tails = T0_previous[:, tails], A_previous[:, tails], level[tails], low[tails], high[tails]
+    for step in range(END_BISECTION_STEPS):
+        middle = (low_tails + high_tails)/2.
+        above = ((A_tails*lookup(template['average'], middle - T0_tails)).sum(axis=0) >= level_tails)
+        low_tails, high_tails = np.where(above, middle, low_tails), np.where(above, high_tails, middle)
+    low[tails], high[tails] = low_tails, high_tails
+    return (low + high)/2.
+
+
+## The first valid CFD zero crossing of each pulse at or after the sample earliest, from the CFD signal at the samples around the zero crossing of the pulse alone (one row per pulse). Returns whether a crossing was found, and its sample.
+def cfd_crossing(cfd, samples, earliest):
+    valid = np.zeros(cfd.shape, dtype=bool)
+    valid[:, 1:] = (cfd[:, :-1] < 0.) & (cfd[:, 1:] >= 0.) & (cfd[:, 1:] - cfd[:, :-1] > emulate_VHDL.THRESHOLD_CFD) & (samples[:, 1:] >= earliest[:, np.newaxis])
+    column = np.argmax(valid, axis=1)
+    return valid.any(axis=1), samples[np.arange(len(samples)), column]
+
+
+## Solve the OF chain (see model_pulses) for the candidates and the state when each pulse arrives, starting from the given candidates, in place. Only the periods in which a candidate changed are solved again (the chain starts again in every period).
+def solve_chain(candidate, state, new_period, A, raw_found, subtracted_found, in_setup, max_pileup_pulses):
+    starts = np.flatnonzero(new_period)
+    lengths = np.diff(np.append(starts, len(candidate)))
+    active_starts, active_lengths = starts, lengths
+    while len(active_starts):
+        active = np.repeat(active_starts - np.cumsum(active_lengths) + active_lengths, active_lengths) + np.arange(active_lengths.sum())
+        first = np.repeat(np.cumsum(active_lengths) - active_lengths, active_lengths)
+        active_candidate = candidate[active]
+        n_before = np.cumsum(active_candidate) - active_candidate
+        active_state = (n_before - n_before[first]) % (max_pileup_pulses + 1)
+        previous_candidate = active[np.concatenate([[0], np.maximum.accumulate(np.where(active_candidate, np.arange(len(active)), 0))[:-1]])]
+        found = np.where((active_state > 0) & (active_state < max_pileup_pulses), subtracted_found[active], raw_found[active])
+        rejected_fraction = (active_state > 0) & (A[active] <= A[previous_candidate]/(1 << emulate_VHDL.OF_AMPLITUDE_THRESHOLD_FRACTION))
+        new_candidate = ~in_setup[active] & (A[active] > emulate_VHDL.OF_AMPLITUDE_THRESHOLD) & found & ~rejected_fraction
+
+        state[active] = active_state
+        changed = np.unique(np.searchsorted(starts, active[new_candidate != active_candidate], side='right') - 1)
+        candidate[active] = new_candidate
+        active_starts, active_lengths = starts[changed], lengths[changed]
+
+
+## Model the fate of the pulses with start times T0 (sorted) and amplitudes A. Returns the outcome of each pulse (see OUTCOMES), the index of the first pulse of its sleeping period, and the dead time in clock cycles: the length of the stream, and the cycles spent in setup, sleeping, in the last OF state and with the baseline update blocked.
+def model_pulses(T0, A, template, max_pileup_pulses=MAX_PILEUP_PULSES):
+    n_pulses = len(T0)
+    index = np.arange(n_pulses)
+    T0_previous, A_previous = preceding_pulses(T0, A)
+
+    ## The rise of each pulse, from the rising edge of the average (pulses that never exceed THRESHOLD_RISING are taken to 'rise' at their peak):
+    rise = T0 + inverse(template, 'rise_time', A, emulate_VHDL.THRESHOLD_RISING)
+
+    ## The CFD signal of each pulse and of the tails of the preceding pulses at the samples around the zero crossing of the pulse alone (from one sample before its minimum to two samples after the crossing). The baseline is subtracted below.
+    crossing_sample = np.ceil(T0 + template['t_crossing'])
+    samples = crossing_sample[:, np.newaxis] + np.arange(-int(np.ceil(template['t_crossing'] - template['t_dip'])) - 1, 3)
+    cfd_pulses = np.zeros((N_PREVIOUS + 1,) + samples.shape)
+    for n_back in range(N_PREVIOUS + 1):
+        pulses = np.flatnonzero(A_previous[n_back] > 0.)
+        cfd_pulses[n_back, pulses] = A_previous[n_back, pulses, np.newaxis]*lookup(template['cfd'], samples[pulses] - T0_previous[n_back, pulses, np.newaxis])
+    cfd = cfd_pulses.sum(axis=0)
+
+    ## The periods and the final triggers are first estimated without a baseline offset. The baseline locked by a pulse that starts a period is then the average of the tails over the 16 samples BASELINE_LOCK_OFFSET samples before its rise that were shifted into the baseline buffer, i.e. taken while awake and more than PULSE_WIDTH_BEFORE_RESET cycles after the last final trigger.
+    end = period_end(template, T0_previous, A_previous, np.zeros(n_pulses))
+    new_period, period_start = sleeping_periods(rise, end)
+    found, crossing = cfd_crossing(cfd, samples, np.where(new_period, rise, -np.inf))
+    last_crossing = np.maximum.accumulate(np.where(found, crossing, -np.inf))
+    updated_from = np.maximum(np.concatenate([[-np.inf], np.maximum.accumulate(end)[:-1]]), np.concatenate([[-np.inf], last_crossing[:-1]]) + emulate_VHDL.PULSE_WIDTH_BEFORE_RESET + 2)
+    lock_end = rise - BASELINE_LOCK_OFFSET
+    lock_start = np.minimum(np.maximum(lock_end - BASELINE_AVERAGE_LENGTH, updated_from), lock_end)
+    locked_baseline = (A_previous[1:]*(lookup(template['integral'], lock_end - T0_previous[1:]) - lookup(template['integral'], lock_start - T0_previous[1:]))).sum(axis=0)/BASELINE_AVERAGE_LENGTH
+
+    end = period_end(template, T0_previous, A_previous, locked_baseline[period_start])
+    new_period, period_start = sleeping_periods(rise, end)
+    baseline = locked_baseline[period_start]
+
+    ## The CFD crossing of each pulse, on the signal with all tails (raw) and with the tail of the preceding pulse subtracted from TAIL_DELAY cycles after its crossing. The crossing must come after the rise of a new period (the CFD is only armed while sleeping), and at least CFD_RE_ARM cycles after the crossing of the preceding pulse.
+    earliest = np.where(new_period, rise, -np.inf)
+    cfd = cfd - baseline[:, np.newaxis]/2.
+    found, crossing = cfd_crossing(cfd, samples, earliest)
+    previous_crossing = np.concatenate([[-np.inf], np.where(found, crossing, -np.inf)[:-1]])
+    re_armed = np.maximum(earliest, previous_crossing + CFD_RE_ARM)
+    raw_found, raw_crossing = cfd_crossing(cfd, samples, re_armed)
+    subtracted_found, subtracted_crossing = cfd_crossing(cfd - np.where(samples >= previous_crossing[:, np.newaxis] + TAIL_DELAY, cfd_pulses[1], 0.), samples, re_armed)
+
+    ## The OF chain. The state when a pulse arrives (0 is 'waiting', p means p pulses accepted) is the number of candidates (pulses with a crossing that pass the amplitude thresholds) before it in its period, modulo max_pileup_pulses + 1: after max_pileup_pulses accepted pulses, the next candidate overflows the chain and the OF returns to 'waiting'. Whether a pulse is a candidate depends on the state (the subtraction of the preceding tail, the threshold on the fraction of the preceding amplitude), so this is repeated until nothing changes.
+    in_setup = (rise < emulate_VHDL.BASELINE_SETUP_SAMPLES)
+    candidate = ~in_setup & (A > emulate_VHDL.OF_AMPLITUDE_THRESHOLD) & raw_found
+    state = np.zeros(n_pulses, dtype=np.int64)
+    solve_chain(candidate, state, new_period, A, raw_found, subtracted_found, in_setup, max_pileup_pulses)
+    subtract = (state > 0) & (state < max_pileup_pulses)
+    found = np.where(subtract, subtracted_found, raw_found)
+    crossing = np.where(subtract, subtracted_crossing, raw_crossing)
+
+    outcome = np.select([in_setup, ~found, ~candidate, state == max_pileup_pulses], [LOST_SETUP, LOST_UNRESOLVED, LOST_REJECTED, LOST_CHAIN_FULL], ACCEPTED)
+    final_trigger = np.where(outcome == ACCEPTED, crossing, -1)
+
+    ## The last sample of the period of each pulse, and the dead time of the setup period:
+    period_last = np.maximum.reduceat(end, np.flatnonzero(new_period))[np.cumsum(new_period) - 1]
+    n_cycles = int(np.ceil(max(end.max(), T0[-1] + TEMPLATE_LENGTH)))
+
+    ## The time in the last OF state: from the crossing of the pulse that fills the chain to the crossing of the next candidate in the period (which overflows the chain), or to the end of the period.
+    next_candidate = np.concatenate([np.minimum.accumulate(np.where(candidate, index, n_pulses)[::-1])[::-1][1:], [n_pulses]])
+    next_in_period = (next_candidate < n_pulses) & (period_start[np.minimum(next_candidate, n_pulses - 1)] == period_start)
+    fills_chain = (outcome == ACCEPTED) & (state == max_pileup_pulses - 1)
+    cycles_last_state = np.where(fills_chain, np.where(next_in_period, crossing[np.minimum(next_candidate, n_pulses - 1)], period_last) - crossing, 0.).sum()
+
+    ## The sleeping cycles (the union of the periods), and the awake cycles within PULSE_WIDTH_BEFORE_RESET after the last final trigger of a period (up to the rise of the next period):
+    starts = np.flatnonzero(new_period)
+    period_rise, period_end_time = rise[starts], period_last[starts]
+    next_rise = np.concatenate([period_rise[1:], [n_cycles]])
+    last_final_trigger = np.maximum.reduceat(final_trigger, starts)
+    cycles_update_blocked = np.where(last_final_trigger >= 0, np.clip(last_final_trigger + emulate_VHDL.PULSE_WIDTH_BEFORE_RESET + 2 - period_end_time, 0, next_rise - period_end_time), 0).sum()
+
+    return outcome, period_start, {'n_cycles': n_cycles, 'setup': emulate_VHDL.BASELINE_SETUP_SAMPLES, 'sleeping': float((period_end_time - period_rise).sum()),
+                                   'OF_last_state': float(cycles_last_state), 'update_blocked': float(cycles_update_blocked)}
+
+
+## The model at one rate: the fractions of the pulses recorded, piled up and recovered, and lost (per cause), the efficiency (recorded or recovered), the pile-up chain overflows per pulse, and the dead time as fractions of all clock cycles (as in dead_time.py). The live time is the fraction of cycles in which a new pulse can give a final trigger (all but the setup period and the last OF state).
+def model_rate(rate, template, rng, n_pulses=N_PULSES, max_pileup_pulses=MAX_PILEUP_PULSES, amplitude_range=AMPLITUDE_RANGE):
+    T0, A = draw_pulses(rng, rate, n_pulses, amplitude_range)
+    outcome, period_start, cycles = model_pulses(T0, A, template, max_pileup_pulses)
+    alone = (np.bincount(period_start, minlength=n_pulses)[period_start] == 1)
+    accepted = (outcome == ACCEPTED)
+
+    result = {'rate': rate, 'n_pulses': n_pulses,
+              'recorded': np.count_nonzero(accepted & alone)/n_pulses,
+              'piled_up_recovered': np.count_nonzero(accepted & ~alone)/n_pulses}
+    for index, name in enumerate(OUTCOMES[1:], 1):
+        result[name] = np.count_nonzero(outcome == index)/n_pulses
+    result['efficiency'] = np.count_nonzero(accepted)/n_pulses
+    result['chain_overflows'] = result['lost_chain_full']
+    result['dead_time'] = {name: cycles[name]/cycles['n_cycles'] for name in ['setup', 'sleeping', 'OF_last_state', 'update_blocked']}
+    result['dead_time']['live_time'] = 1. - (cycles['setup'] + cycles['OF_last_state'])/cycles['n_cycles']
+    return result
+
+
+## Run the model over the rates. The same seed is used for each rate, so the curves are smooth.
+def rate_scan(rates, calibration, n_pulses=N_PULSES, max_pileup_pulses=MAX_PILEUP_PULSES, amplitude_range=AMPLITUDE_RANGE, seed=1):
+    template = template_functions(calibration['parameters']['mu'], calibration['parameters']['sigma'])
+    return [model_rate(rate, template, np.random.default_rng(seed), n_pulses, max_pileup_pulses, amplitude_range) for rate in rates]
+
+
+## The full simulation at the given rates (see dead_time.py), for the validation of the model.
+def simulate_rates(rates, calibration, n_waveforms=VALIDATION_N_WAVEFORMS, max_pileup_pulses=MAX_PILEUP_PULSES):
+    from benchmark import generate_data
+    from dead_time import analyse, load_data
+
+    results = []
+    for rate in rates:
+        with tempfile.TemporaryDirectory() as data_dir:
+            generate_data(data_dir, n_waveforms, {'rate': rate})
+            result = analyse(*load_data(data_dir), calibration, max_pileup_pulses)
+        results.append({'rate': rate, 'efficiency': result['efficiency'], 'chain_overflows': result['per_true_pulse']['chain_overflows'],
+                        'dead_time': {name: result['dead_time'][name] for name in ['sleeping', 'update_blocked', 'live_time']}})
+    return results
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Model the dead time and the pile-up losses of the feature extraction versus the input rate, from the arrival times of the pulses only.')
+    parser.add_argument('--rates', type=float, nargs='+', default=RATES, help='the input rates (pulses per sample)')
+    parser.add_argument('--n-pulses', type=int, default=N_PULSES, help='the number of pulses drawn for each rate')
+    parser.add_argument('--amplitude', type=float, nargs=2, default=AMPLITUDE_RANGE, metavar=('A_MIN', 'A_MAX'))
+    parser.add_argument('--max-pileup-pulses', type=int, default=MAX_PILEUP_PULSES)
+    parser.add_argument('--validate', type=float, nargs='*', default=None, metavar='RATE', help='compare with the full simulation at these rates (by default 0.005, 0.02 and 0.1)')
+    parser.add_argument('--n-waveforms', type=int, default=VALIDATION_N_WAVEFORMS, help='the number of waveforms simulated for each validation rate')
+    parser.add_argument('--output-file', default=os.path.join(DATA_DIRECTORY, 'rate_model.json'))
+    parser.add_argument('--no-plot', action='store_true')
+    args = parser.parse_args(argv)
+
+    calibration = load_calibration()
+
+    start_time = time.perf_counter()
+    results = rate_scan(args.rates, calibration, args.n_pulses, args.max_pileup_pulses, args.amplitude)
+    print('{} rates modelled in {:.0f} ms'.format(len(args.rates), 1000.*(time.perf_counter() - start_time)))
+    print('{:>8}{:>11}{:>10}{:>10}{:>12}{:>10}{:>12}{:>11}{:>10}'.format('rate', 'efficiency', 'recorded', 'piled up', 'unresolved', 'rejected', 'chain full', 'live time', 'sleeping'))
+    for result in results:
+        print('{:>8.4f}{:>11.4f}{:>10.4f}{:>10.4f}{:>12.4f}{:>10.4f}{:>12.4f}{:>11.4f}{:>10.4f}'.format(result['rate'], result['efficiency'], result['recorded'], result['piled_up_recovered'], result['lost_unresolved'], result['lost_rejected'], result['lost_chain_full'], result['dead_time']['live_time'], result['dead_time']['sleeping']))
+
+    output = {'parameters': {'n_pulses': args.n_pulses, 'amplitude_range': list(args.amplitude), 'max_pileup_pulses': args.max_pileup_pulses}, 'results': results}
+    if args.validate is not None:
+        validation_rates = args.validate or [0.005, 0.02, 0.1]
+        start_time = time.perf_counter()
+        simulated = simulate_rates(validation_rates, calibration, args.n_waveforms, args.max_pileup_pulses)
+        print('Full simulation of {} rates in {:.0f} s (model, simulation):'.format(len(validation_rates), time.perf_counter() - start_time))
+        modelled = rate_scan(validation_rates, calibration, args.n_pulses, args.max_pileup_pulses, args.amplitude)
+        print('{:>8}{:>20}{:>20}{:>20}{:>20}'.format('rate', 'efficiency', 'chain overflows', 'live time', 'sleeping'))
+        for model, simulation in zip(modelled, simulated):
+            print('{:>8.4f}'.format(model['rate']) + ''.join('{:>10.4f}{:>10.4f}'.format(*values) for values in [(model['efficiency'], simulation['efficiency']), (model['chain_overflows'], simulation['chain_overflows']),
+                                                                                                                (model['dead_time']['live_time'], simulation['dead_time']['live_time']), (model['dead_time']['sleeping'], simulation['dead_time']['sleeping'])]))
+        output['validation'] = {'model': modelled, 'simulation': simulated}
+
+    with open(args.output_file, 'w') as output_file:
+        json.dump(output, output_file, indent=1)
+    print('Results written to ' + args.output_file)
+
+    if not args.no_plot:
+        import matplotlib.pyplot as plt
+
+        fig, ax = plt.subplots()
+        rates = [result['rate'] for result in results]
+        ax.plot(rates, [result['efficiency'] for result in results], '-', label='Efficiency')
+        ax.plot(rates, [result['recorded'] for result in results], '--', label='Recorded (isolated)')
+        ax.plot(rates, [result['piled_up_recovered'] for result in results], '--', label='Piled up and recovered')
+        ax.plot(rates, [result['lost_unresolved'] for result in results], ':', label='Lost: not resolved')
+        ax.plot(rates, [result['lost_chain_full'] for result in results], ':', label='Lost: chain full')
+        ax.plot(rates, [result['dead_time']['live_time'] for result in results], '-.', label='Live time')
+        if args.validate is not None:
+            ax.plot([result['rate'] for result in simulated], [result['efficiency'] for result in simulated], 'ko', label='Efficiency (full simulation)')
+        ax.set_xlabel('Input rate [pulses/sample]')
+        ax.set_xscale('log')
+        ax.legend()
+        plt.show()
+
+
+if __name__ == '__main__':
+    main()
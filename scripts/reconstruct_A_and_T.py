@@ -1,123 +1,197 @@
+import argparse
+import os
 import numpy as np
-import matplotlib.pyplot as plt
+from data_format import open_data_file, as_array, DATA_DIRECTORY
+from OF_calibration import load_calibration
+from feature_records import extract_feature_records
+from fixed_point import to_real
 
-MC_truth_data = np.genfromtxt('../data/MC_truth_data.csv', delimiter=',')               ## the data we want to compare with (the amplitudes and times of the pulses originally generated)
-VHDL_output_data = np.genfromtxt('../data/output_data.csv', delimiter=',', dtype='int') ## what has now been output from the VHDL simulation
+## A reconstructed pulse is matched to the true pulse for which Reconstructed_T - True_T is closest to MATCH_OFFSET (the reconstructed time is delayed by ~4 samples w.r.t. the true T_0, see the histograms below). The match is only accepted if the difference is within MATCH_WINDOW of MATCH_OFFSET.
+MATCH_OFFSET = 4.
+MATCH_WINDOW = 1.
 
-## Header data read from the MC truth file
-N_EMPTY_WAVEFORMS = int(MC_truth_data[0,0])
-N_REAL_WAVEFORMS = int(MC_truth_data[0,1])
-N_SAMPLES_PER_WAVEFORM = int(MC_truth_data[0,2])
+## The default files: the output of the VHDL simulation or of emulate_VHDL.py, and the MC truth data to compare with (from generate_pulse_data.py).
+OUTPUT_FILE = os.path.join(DATA_DIRECTORY, 'output_data.bin')
+MC_TRUTH_FILE = os.path.join(DATA_DIRECTORY, 'MC_truth_data.bin')
 
-## These values have been copied/pasted from the output of get_OF_coefficients.py. For each BCFD window, this value is the average time difference between the BCFD zero crossing time and the assumed T_0 (i.e. the T_0 of the lognormal in the current implementation). The tau value calculated by the OF will be a small deviation in time from that assumed T_0 (which in itself has an accuracy of ~1/4 samples because we use four BCFD windows).
-delta_BCFD_window_mean = [3.46268184, 3.47873633, 3.42513086, 3.47061768]
 
-N_WF_TO_PROCESS = N_REAL_WAVEFORMS                 ## the number of waveforms to process in this script. Set equal to N_REAL_WAVEFORMS to process all data.
+## The OF tau of each feature record (the shift in time from T_0_assumed, in samples): v/u has b_scaling - a_scaling fraction bits.
+def reconstructed_tau(triggers, calibration):
+    OF_u = triggers['u'].astype(float)
+    OF_v = triggers['v'].astype(float)
+    return to_real(OF_v/np.where(OF_u != 0, OF_u, 1.), calibration['b_scaling'] - calibration['a_scaling'])          ## e.g. divide by 512 = 2^9 for b_scaling - a_scaling = 20 - 11 (that is, after dividing OF_v by OF_u we have a number scaled up by (20-11) = 9 bits). Need to scale the quantised value down to a fraction of a sample. (OF_u is never zero at a final trigger, the check is just to be safe)
 
 
-delta_A_0 = np.zeros(N_WF_TO_PROCESS)           ### difference between reconstructed and true amplitude for the first pulse in each waveform
-delta_A_1 = np.zeros(N_WF_TO_PROCESS)           ### The same for the second pulse in each waveform
+## Reconstruct the amplitudes and times of all pulses in the VHDL output data between the samples first_sample and last_sample, using the OF calibration (see OF_calibration.py; by default data/OF_calibration.json, the calibration used by the VHDL code). The output data are either the feature records (one per final trigger, see feature_records.py) or the 10 columns for every clock cycle (a record array, see data_format.py), from which the feature records are made first (the final trigger signals that readout should take place since a signal has been identified). The reconstruction is done for all final triggers in one go. Returns the timestamp (sample) of each final trigger, the reconstructed amplitudes and the reconstructed times.
+def reconstruct_pulses(VHDL_output_data, first_sample, last_sample, calibration=None):
+    if calibration is None:
+        calibration = load_calibration()
 
-delta_T_0 = np.zeros(N_WF_TO_PROCESS)           ### difference between reconstructed and true time for the first pulse in each waveform
-delta_T_1 = np.zeros(N_WF_TO_PROCESS)           ### The same for the second pulse in each waveform
+    ## For each BCFD window, delta_BCFD_window_mean is the average time difference between the BCFD zero crossing time and the assumed T_0 (i.e. the T_0 of the lognormal in the current implementation), determined by get_OF_coefficients.py. The tau value calculated by the OF will be a small deviation in time from that assumed T_0 (which in itself has an accuracy of ~1/4 samples because we use four BCFD windows).
+    delta_BCFD_window_mean = np.asarray(calibration['delta_BCFD_window_mean'])
+    N_BCFD_WINDOWS = len(delta_BCFD_window_mean)
+    amplitude_scale = calibration.get('amplitude_scale', 1.)            ## 1, unless the calibration was updated online (see online_calibration.py)
 
+    if ('timestamp' in VHDL_output_data.dtype.names):               ## feature records, sorted in time
+        triggers = VHDL_output_data[np.searchsorted(VHDL_output_data['timestamp'], first_sample):np.searchsorted(VHDL_output_data['timestamp'], last_sample)]
+    else:
+        triggers = extract_feature_records(VHDL_output_data[first_sample:last_sample])[0]
+    trigger_timestamps = np.asarray(triggers['timestamp'])
 
-for waveform_index in range(N_EMPTY_WAVEFORMS, N_EMPTY_WAVEFORMS + N_WF_TO_PROCESS):         ## start after the empty waveform(s)
-    print('Processing waveform ' + str(waveform_index))
+    VHDL_sample_no = trigger_timestamps.astype(float)
+    BCFD_window = triggers['cfd_time'].astype(int)
+    OF_u = triggers['u'].astype(float)
+    OF_tau = reconstructed_tau(triggers, calibration)
 
-    MC_truth_data_for_wf = MC_truth_data[1+waveform_index]      ## skip the header row
+    T_0_BCFD = (BCFD_window - 0.5)/N_BCFD_WINDOWS                                  ## we define four BCFD windows. For each, the best estimate of the zero crossing time is the midpoint of that window (so 0.125, 0.375, 0.625 and 0.875).
+    T_0_assumed = T_0_BCFD - delta_BCFD_window_mean[BCFD_window - 1]    ## T_0_assumed is the best guess on the lognormal T_0 *given* the BCFD window.
 
-    VHDL_data_for_wf = VHDL_output_data[waveform_index*N_SAMPLES_PER_WAVEFORM:(waveform_index+1)*N_SAMPLES_PER_WAVEFORM]                ## Get the VHDL output for the current waveform.
+    Reconstructed_A = amplitude_scale*OF_u
+    Reconstructed_T = VHDL_sample_no + T_0_assumed + OF_tau            ## To finally get the time, add VHDL_sample_no (for global time synchronisation, this would have to come from some external source such as readout in real life), the assumed T_0 (resolution ~1/4 sample due to BCFD algorithm) and the OF tau (the small shift in time from T_0_assumed to get best fit of lognormal to data)
 
-    ## the structure of the VHDL_data_for_wf vector will be determined by the output from the VHDL simulation. This is described in the main_tb.vhd file:
-    # Column 0: the clock cycle number
-    # Column 1: the raw input data
-    # Column 2: the 2-sample MA (used to issue the baseline trigger)
-    # Column 3: the calculated baseline (note: the output data is not necessarily correctly shifted in time, but this is handled internally in the VHDL code. Outputs such as this was just included for debugging)
-    # Column 4: the baseline trigger (if the 2-sample MA goes above some threshold)
-    # Column 5: the CFD signal
-    # Column 6: the BCFD window found
-    # Column 7: OF u (the first result of the OF: u = A)
-    # Column 8: OF v (the second result of the OF: v = A*tau)
-    # Column 9: the 'final trigger' - signals that readout should take place since a signal has been identified
+    return trigger_timestamps, Reconstructed_A, Reconstructed_T
 
-    pulse_no = 0                ## keep track of whether first or second pulse (in each waveform) is analysed
 
-    for sample_no in range(0, N_SAMPLES_PER_WAVEFORM):
-        final_trigger = VHDL_data_for_wf[sample_no,9]
-        if (final_trigger == 1):                                ## read out the data when we see the final trigger
-            VHDL_sample_no = VHDL_data_for_wf[sample_no,0]
-            BCFD_window = VHDL_data_for_wf[sample_no,6]
-            OF_u = VHDL_data_for_wf[sample_no,7]
-            OF_v = VHDL_data_for_wf[sample_no,8]
+## Get all true pulses in the waveforms [first_waveform, last_waveform) from the MC truth data (one row per waveform: [A_0, T_0_0, A_1, T_0_1, ...], -1 where there is no pulse). Any number of pulses per waveform is allowed. Returns the waveform number, the position in the waveform (0 for the first pulse, 1 for the second etc), the amplitude and the global time of each pulse, sorted in time.
+def get_true_pulses(MC_truth_data, first_waveform, last_waveform, N_SAMPLES_PER_WAVEFORM):
+    A = MC_truth_data[first_waveform:last_waveform, 0::2]
+    T_0 = MC_truth_data[first_waveform:last_waveform, 1::2]
+
+    true_waveform, true_position = np.nonzero(A >= 0)
+    True_A = A[true_waveform, true_position]
+    True_T = (first_waveform + true_waveform)*N_SAMPLES_PER_WAVEFORM + T_0[true_waveform, true_position]
 
-            OF_tau = (OF_v/OF_u)/512.              ## divide by 512 (= 2^9), because b_scaling - a_scaling = 20 - 11 (that is, after dividing OF_v by OF_u we have a number scaled up by (20-11) = 9 bits). Need to scale the quantised value down to a fraction of a sample. The required scaling here should correspond to what was done in get_OF_coefficients.py.
+    order = np.argsort(True_T, kind='stable')               ## pulses following the first in a waveform may arrive after the next waveform has started
+    return first_waveform + true_waveform[order], true_position[order], True_A[order], True_T[order]
 
-            T_0_BCFD = 0.125 + 0.25*(BCFD_window - 1)                           ## we define four BCFD windows. For each, the best estimate of the zero crossing time is the midpoint of that window (so 0.125, 0.375, 0.625 and 0.875).
-            T_0_assumed = T_0_BCFD - delta_BCFD_window_mean[BCFD_window - 1]    ## T_0_assumed is the best guess on the lognormal T_0 *given* the BCFD window.
 
+## Match the reconstructed pulses to the true pulses (True_T must be sorted). For each reconstructed pulse, the nearest true pulse (taking MATCH_OFFSET into account) is found by a binary search in the true times. Each true pulse is matched to at most one reconstructed pulse (the nearest). Returns, for each reconstructed pulse, whether it was matched and the index of the matched true pulse.
+def match_pulses(Reconstructed_T, True_T):
+    if (len(True_T) == 0):
+        return np.zeros(len(Reconstructed_T), dtype=bool), np.zeros(len(Reconstructed_T), dtype=int)
 
-            Reconstructed_A = OF_u
-            Reconstructed_T = VHDL_sample_no + T_0_assumed + OF_tau             ## To finally get the time, add VHDL_sample_no (for global time synchronisation, this would have to come from some external source such as readout in real life), the assumed T_0 (resolution ~1/4 sample due to BCFD algorithm) and the OF tau (the small shift in time from T_0_assumed to get best fit of lognormal to data)
+    expected_T = Reconstructed_T - MATCH_OFFSET
+    right = np.clip(np.searchsorted(True_T, expected_T), 0, len(True_T) - 1)
+    left = np.clip(right - 1, 0, len(True_T) - 1)
+    distance_left = np.abs(expected_T - True_T[left])
+    distance_right = np.abs(expected_T - True_T[right])
 
-            ## store reconstructed data in arrays:
-            if (pulse_no == 0):
-                True_A = MC_truth_data_for_wf[0]
-                True_T = waveform_index*N_SAMPLES_PER_WAVEFORM + MC_truth_data_for_wf[1]
-            elif (pulse_no == 1):
-                True_A = MC_truth_data_for_wf[2]
-                True_T = waveform_index*N_SAMPLES_PER_WAVEFORM + MC_truth_data_for_wf[3]
-            else:
-                print('Something went wrong (only 2 pulses allowed per wf)!')
-                exit()
+    match = np.where(distance_right < distance_left, right, left)
+    distance = np.minimum(distance_left, distance_right)
+    matched = (distance < MATCH_WINDOW)
 
-            ## Calculate some metrics: for time, just the difference of the reconstructed w.r.t. the true. For amplitude, the relative difference of the reconstructed from the true (because we generate pulses with many different amplitudes)
-            if (pulse_no == 0):
-                delta_A_0[waveform_index - N_EMPTY_WAVEFORMS] = (Reconstructed_A - True_A)/True_A
-                delta_T_0[waveform_index - N_EMPTY_WAVEFORMS] = Reconstructed_T - True_T
-            elif (pulse_no == 1):
-                delta_A_1[waveform_index - N_EMPTY_WAVEFORMS] = (Reconstructed_A - True_A)/True_A
-                delta_T_1[waveform_index - N_EMPTY_WAVEFORMS] = Reconstructed_T - True_T
+    ## If several reconstructed pulses are matched to the same true pulse, keep the nearest one (the others count as fakes):
+    candidates = np.flatnonzero(matched)
+    candidates = candidates[np.lexsort((distance[candidates], match[candidates]))]
+    duplicate = np.zeros(len(candidates), dtype=bool)
+    duplicate[1:] = (match[candidates[1:]] == match[candidates[:-1]])
+    matched[candidates[duplicate]] = False
 
+    return matched, match
+
+
+## Reconstruct the pulses in the VHDL output data (output_path) and compare them with the MC truth data (MC_truth_path). Returns a dictionary with the numbers of true and reconstructed pulses, for each true pulse its position in the waveform and whether it was matched, for each reconstructed pulse whether it was matched and mis-assigned, and the relative amplitude and the time differences (delta_A_0, delta_T_0 for the first pulse in each waveform and delta_A_1, delta_T_1 for the following pulses).
+def compare_with_truth(output_path=OUTPUT_FILE, MC_truth_path=MC_TRUTH_FILE, calibration=None):
+    header, MC_truth_data = open_data_file(MC_truth_path)                       ## the data we want to compare with (the amplitudes and times of the pulses originally generated)
+    MC_truth_data = as_array(MC_truth_data)                                     ## one row per waveform: [A_0, T_0_0, A_1, T_0_1, ...]
+    VHDL_output_header, VHDL_output_data = open_data_file(output_path)              ## what has now been output from the VHDL simulation (converted with 'python data_format.py to_binary') or from emulate_VHDL.py. The columns are described in main_tb.vhd (the names are given in data_format.py).
 
-            pulse_no += 1
+    ## Header data read from the MC truth file
+    N_EMPTY_WAVEFORMS = header['N_EMPTY_WAVEFORMS']
+    N_REAL_WAVEFORMS = header['N_REAL_WAVEFORMS']
+    N_SAMPLES_PER_WAVEFORM = header['N_SAMPLES_PER_WAVEFORM']
 
+    N_WF_TO_PROCESS = N_REAL_WAVEFORMS                 ## the number of waveforms to process in this script. Set equal to N_REAL_WAVEFORMS to process all data.
 
+    trigger_timestamps, Reconstructed_A, Reconstructed_T = reconstruct_pulses(VHDL_output_data, N_EMPTY_WAVEFORMS*N_SAMPLES_PER_WAVEFORM, (N_EMPTY_WAVEFORMS + N_WF_TO_PROCESS)*N_SAMPLES_PER_WAVEFORM, calibration)          ## start after the empty waveform(s)
+    true_waveform, true_position, True_A, True_T = get_true_pulses(MC_truth_data, N_EMPTY_WAVEFORMS, N_EMPTY_WAVEFORMS + N_WF_TO_PROCESS, N_SAMPLES_PER_WAVEFORM)
 
-## plot the results:
-fig, ax = plt.subplots(2, 1, sharex=True)
-n, bins, patches = ax[0].hist(delta_T_0, bins=1000, range=(3, 5), facecolor='g', alpha=0.75)
-n, bins, patches = ax[1].hist(delta_T_1, bins=1000, range=(3, 5), facecolor='r', alpha=0.75)
-plt.xlabel(r'Reconstructed $T_0$ - True $T_0$ [samples]')
-ax[1].set_xlim(3, 5)
-ax[0].set_yscale('log')
-ax[1].set_yscale('log')
+    matched, match = match_pulses(Reconstructed_T, True_T)
+    true_matched = np.zeros(len(True_T), dtype=bool)
+    true_matched[match[matched]] = True
 
-ax[0].text(0.55, 0.8, 'First pulse', horizontalalignment='left', verticalalignment='center', weight='bold', transform = ax[0].transAxes)
-ax[0].text(0.55, 0.7, 'Distribution mean: ' + "{:.3f}".format(np.mean(delta_T_0)) + ' ns', horizontalalignment='left', verticalalignment='center', transform = ax[0].transAxes)
-ax[0].text(0.55, 0.6, 'Distribution std dev: ' + "{:.3f}".format(np.std(delta_T_0)) + ' ns', horizontalalignment='left', verticalalignment='center', transform = ax[0].transAxes)
-ax[1].text(0.55, 0.8, 'Second pulse (pile-up)', horizontalalignment='left', verticalalignment='center', transform = ax[1].transAxes)
-ax[1].text(0.55, 0.7, 'Distribution mean: ' + "{:.3f}".format(np.mean(delta_T_1)) + ' ns', horizontalalignment='left', verticalalignment='center', transform = ax[1].transAxes)
-ax[1].text(0.55, 0.6, 'Distribution std dev: ' + "{:.3f}".format(np.std(delta_T_1)) + ' ns', horizontalalignment='left', verticalalignment='center', transform = ax[1].transAxes)
+    ## A matched pulse is mis-assigned if it would have been compared to another true pulse by simply counting the final triggers in each waveform (i.e. the n-th final trigger in a waveform is assumed to be the n-th pulse of that waveform):
+    reconstructed_waveform = trigger_timestamps//N_SAMPLES_PER_WAVEFORM
+    reconstructed_position = np.arange(len(trigger_timestamps)) - np.searchsorted(reconstructed_waveform, reconstructed_waveform)
+    misassigned = matched & ((true_waveform[match] != reconstructed_waveform) | (true_position[match] != reconstructed_position))
 
+    ## Calculate some metrics: for time, just the difference of the reconstructed w.r.t. the true. For amplitude, the relative difference of the reconstructed from the true (because we generate pulses with many different amplitudes)
+    delta_A = (Reconstructed_A[matched] - True_A[match[matched]])/True_A[match[matched]]
+    delta_T = Reconstructed_T[matched] - True_T[match[matched]]
+    first_pulse = (true_position[match[matched]] == 0)
 
+    delta_A_0 = delta_A[first_pulse]            ### difference between reconstructed and true amplitude for the first pulse in each waveform
+    delta_A_1 = delta_A[~first_pulse]           ### The same for the following (pile-up) pulses in each waveform
+    delta_T_0 = delta_T[first_pulse]            ### difference between reconstructed and true time for the first pulse in each waveform
+    delta_T_1 = delta_T[~first_pulse]           ### The same for the following (pile-up) pulses in each waveform
 
-fig, ax = plt.subplots(2, 1, sharex=True)
-n, bins, patches = ax[0].hist(delta_A_0, bins=500, range=(0, 1), facecolor='g', alpha=0.75)
-n, bins, patches = ax[1].hist(delta_A_1, bins=500, range=(0, 1), facecolor='r', alpha=0.75)
-plt.xlabel(r'(Reconstructed $A$ - True $A$)/(True $A$)')
-ax[1].set_xlim(0, 0.5)
-ax[0].set_yscale('log')
-ax[1].set_yscale('log')
+    return {'n_true': len(True_T), 'n_reconstructed': len(Reconstructed_T), 'true_position': true_position, 'true_matched': true_matched, 'matched': matched, 'misassigned': misassigned,
+            'delta_A_0': delta_A_0, 'delta_A_1': delta_A_1, 'delta_T_0': delta_T_0, 'delta_T_1': delta_T_1}
 
-ax[0].text(0.55, 0.8, 'First pulse', horizontalalignment='left', verticalalignment='center', weight='bold', transform = ax[0].transAxes)
-ax[0].text(0.55, 0.7, 'Distribution mean: ' + "{:.3f}".format(np.mean(delta_A_0)), horizontalalignment='left', verticalalignment='center', transform = ax[0].transAxes)
-ax[0].text(0.55, 0.6, 'Distribution std dev: ' + "{:.3f}".format(np.std(delta_A_0)), horizontalalignment='left', verticalalignment='center', transform = ax[0].transAxes)
-ax[1].text(0.55, 0.8, 'Second pulse (pile-up)', horizontalalignment='left', verticalalignment='center', transform = ax[1].transAxes)
-ax[1].text(0.55, 0.7, 'Distribution mean: ' + "{:.3f}".format(np.mean(delta_A_1)), horizontalalignment='left', verticalalignment='center', transform = ax[1].transAxes)
-ax[1].text(0.55, 0.6, 'Distribution std dev: ' + "{:.3f}".format(np.std(delta_A_1)), horizontalalignment='left', verticalalignment='center', transform = ax[1].transAxes)
 
+## Print the efficiency, the fake rate and the mis-assignment rate (see compare_with_truth):
+def print_results(results):
+    print('True pulses: ' + str(results['n_true']) + ', reconstructed pulses: ' + str(results['n_reconstructed']))
+    print('Efficiency (matched true pulses / true pulses): ' + "{:.4f}".format(np.count_nonzero(results['true_matched'])/max(results['n_true'], 1)))
+    for position in range(results['true_position'].max() + 1 if len(results['true_position']) > 0 else 0):
+        at_position = (results['true_position'] == position)
+        print('    pulse ' + str(position) + ' in waveform: ' + "{:.4f}".format(np.count_nonzero(results['true_matched'][at_position])/max(np.count_nonzero(at_position), 1)) + ' (' + str(np.count_nonzero(at_position)) + ' pulses)')
+    print('Fake rate (unmatched reconstructed pulses / reconstructed pulses): ' + "{:.4f}".format(np.count_nonzero(~results['matched'])/max(results['n_reconstructed'], 1)))
+    print('Mis-assignment rate (matched pulses not in the expected position in the waveform / matched pulses): ' + "{:.4f}".format(np.count_nonzero(results['misassigned'])/max(np.count_nonzero(results['matched']), 1)))
 
 
+## Plot the time and amplitude differences (see compare_with_truth):
+def plot_results(results):
+    import matplotlib.pyplot as plt
 
-plt.show()
+    fig, ax = plt.subplots(2, 1, sharex=True)
+    n, bins, patches = ax[0].hist(results['delta_T_0'], bins=1000, range=(3, 5), facecolor='g', alpha=0.75)
+    n, bins, patches = ax[1].hist(results['delta_T_1'], bins=1000, range=(3, 5), facecolor='r', alpha=0.75)
+    plt.xlabel(r'Reconstructed $T_0$ - True $T_0$ [samples]')
+    ax[1].set_xlim(3, 5)
+    ax[0].set_yscale('log')
+    ax[1].set_yscale('log')
+
+    ax[0].text(0.55, 0.8, 'First pulse', horizontalalignment='left', verticalalignment='center', weight='bold', transform = ax[0].transAxes)
+    ax[0].text(0.55, 0.7, 'Distribution mean: ' + "{:.3f}".format(np.mean(results['delta_T_0'])) + ' ns', horizontalalignment='left', verticalalignment='center', transform = ax[0].transAxes)
+    ax[0].text(0.55, 0.6, 'Distribution std dev: ' + "{:.3f}".format(np.std(results['delta_T_0'])) + ' ns', horizontalalignment='left', verticalalignment='center', transform = ax[0].transAxes)
+    ax[1].text(0.55, 0.8, 'Following pulses (pile-up)', horizontalalignment='left', verticalalignment='center', transform = ax[1].transAxes)
+    ax[1].text(0.55, 0.7, 'Distribution mean: ' + "{:.3f}".format(np.mean(results['delta_T_1'])) + ' ns', horizontalalignment='left', verticalalignment='center', transform = ax[1].transAxes)
+    ax[1].text(0.55, 0.6, 'Distribution std dev: ' + "{:.3f}".format(np.std(results['delta_T_1'])) + ' ns', horizontalalignment='left', verticalalignment='center', transform = ax[1].transAxes)
+
+
+
+    fig, ax = plt.subplots(2, 1, sharex=True)
+    n, bins, patches = ax[0].hist(results['delta_A_0'], bins=500, range=(0, 1), facecolor='g', alpha=0.75)
+    n, bins, patches = ax[1].hist(results['delta_A_1'], bins=500, range=(0, 1), facecolor='r', alpha=0.75)
+    plt.xlabel(r'(Reconstructed $A$ - True $A$)/(True $A$)')
+    ax[1].set_xlim(0, 0.5)
+    ax[0].set_yscale('log')
+    ax[1].set_yscale('log')
+
+    ax[0].text(0.55, 0.8, 'First pulse', horizontalalignment='left', verticalalignment='center', weight='bold', transform = ax[0].transAxes)
+    ax[0].text(0.55, 0.7, 'Distribution mean: ' + "{:.3f}".format(np.mean(results['delta_A_0'])), horizontalalignment='left', verticalalignment='center', transform = ax[0].transAxes)
+    ax[0].text(0.55, 0.6, 'Distribution std dev: ' + "{:.3f}".format(np.std(results['delta_A_0'])), horizontalalignment='left', verticalalignment='center', transform = ax[0].transAxes)
+    ax[1].text(0.55, 0.8, 'Following pulses (pile-up)', horizontalalignment='left', verticalalignment='center', transform = ax[1].transAxes)
+    ax[1].text(0.55, 0.7, 'Distribution mean: ' + "{:.3f}".format(np.mean(results['delta_A_1'])), horizontalalignment='left', verticalalignment='center', transform = ax[1].transAxes)
+    ax[1].text(0.55, 0.6, 'Distribution std dev: ' + "{:.3f}".format(np.std(results['delta_A_1'])), horizontalalignment='left', verticalalignment='center', transform = ax[1].transAxes)
+
+    plt.show()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare the reconstructed pulses with the MC truth.')
+    parser.add_argument('--output-file', default=OUTPUT_FILE, help='the output of the VHDL simulation or of emulate_VHDL.py: output_data.bin, or the feature records (e.g. feature_records.bin in the data directory)')
+    parser.add_argument('--mc-truth-file', default=MC_TRUTH_FILE)
+    parser.add_argument('--plot', action='store_true', help='plot the time and amplitude differences')
+    args = parser.parse_args(argv)
+
+    results = compare_with_truth(args.output_file, args.mc_truth_file)
+    print_results(results)
+    if args.plot:
+        plot_results(results)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+import numpy as np
+from data_format import INPUT_DTYPE, OUTPUT_DTYPE, FEATURE_RECORD_DTYPE, DATA_DIRECTORY, open_data_file, create_data_file, append_rows, make_rows
+from emulate_VHDL import default_coefficients, run_pipeline_stream
+from feature_records import extract_feature_records
+
+## Online (streaming) mode of the feature extraction: the samples arrive as a continuous stream, e.g. from a digitiser, instead of being read from a file. The stream is read in blocks with asyncio, and each block is processed by the bit-exact model of the VHDL code (emulate_VHDL.py) as it arrives, carrying the state of the pipeline (r_sample_buffer, r_baseline_buffer, the OF registers etc.) over from one block to the next (see run_pipeline_stream). One feature record (see feature_records.py) is emitted per final trigger, and the result is identical to processing the whole pulse train in one go (emulate_VHDL.py --feature-records).
+##
+## The stream consists of the raw samples as 16-bit unsigned little-endian integers (INPUT_DTYPE), without any header. It is read from a TCP connection (--connect HOST:PORT), from standard input (--stdin, e.g. piped from another program), or from a local stand-in producer that sends input_data.bin over a TCP connection on localhost (the default; --rate limits the rate at which it sends).
+##
+## Reading and processing are decoupled by a queue of blocks: the reader keeps receiving while a block is processed (in a separate thread). For every block, the processing time and the latency (from the arrival of the block until its records are emitted, including the time waiting in the queue) are measured, and at the end the sustained throughput (samples/s) is printed. The throughput depends strongly on the block size: the model processes a block in parallel segments of SEGMENT_LENGTH samples, so blocks of many segments are much faster per sample.
+
+SEGMENT_LENGTH = 2000
+WARMUP_LENGTH = 500
+
+
+## Read the stream in blocks of block_size samples (the last block may be shorter) and put them in the queue, with their arrival time. None marks the end of the stream.
+async def read_blocks(reader, queue, block_size):
+    while True:
+        try:
+            data = await reader.readexactly(block_size*INPUT_DTYPE.itemsize)
+        except asyncio.IncompleteReadError as error:            ## the end of the stream
+            data = error.partial[:len(error.partial) - len(error.partial) % INPUT_DTYPE.itemsize]
+            if (len(data) > 0):
+                await queue.put((time.perf_counter(), np.frombuffer(data, dtype=INPUT_DTYPE)['sample']))
+            await queue.put(None)
+            return
+        await queue.put((time.perf_counter(), np.frombuffer(data, dtype=INPUT_DTYPE)['sample']))
+
+
+## Process one block: run the pipeline (continuing from the stream state) and make the feature records. stream holds the state of the pipeline ('pipeline', see run_pipeline_stream) and whether the last final trigger is in a pile-up chain that may continue ('in_chain', see extract_feature_records). Returns the records and the new stream state.
+def process_block(samples, stream, coefficients, flush=False):
+    output_data, pipeline_state = run_pipeline_stream(samples, stream['pipeline'], coefficients, flush, SEGMENT_LENGTH, WARMUP_LENGTH)
+    records, in_chain = extract_feature_records(make_rows(output_data, OUTPUT_DTYPE), stream['in_chain'])
+    return records, {'pipeline': pipeline_state, 'in_chain': in_chain}
+
+
+## Take the blocks from the queue, process them (in a thread, so that reading continues meanwhile) and pass the feature records to emit. Returns the statistics: the number of samples and records, the processing time and latency of each block, and the arrival time of the first block and the time the last records were emitted.
+async def process_blocks(queue, emit, coefficients):
+    loop = asyncio.get_running_loop()
+    stream = {'pipeline': None, 'in_chain': False}
+    statistics = {'n_samples': 0, 'n_records': 0, 'processing_time': [], 'latency': [], 'start': None, 'end': None}
+
+    while True:
+        block = await queue.get()
+
+        ## At the end of the stream, the samples still held back by the pipeline are processed (as a block without new samples).
+        arrival_time, samples = block if (block is not None) else (time.perf_counter(), np.zeros(0, dtype=np.uint16))
+        start_time = time.perf_counter()
+        records, stream = await loop.run_in_executor(None, process_block, samples, stream, coefficients, block is None)
+        end_time = time.perf_counter()
+        emit(records)
+
+        statistics['n_samples'] += len(samples)
+        statistics['n_records'] += len(records)
+        statistics['start'] = arrival_time if (statistics['start'] is None) else statistics['start']
+        statistics['end'] = end_time
+        if (block is None):
+            break
+        statistics['processing_time'].append(end_time - start_time)
+        statistics['latency'].append(end_time - arrival_time)
+
+    return statistics
+
+
+## The local stand-in for a digitiser: send the samples in input_path over the connection in blocks of block_size samples, at (at most) rate samples per second (None: as fast as possible).
+async def produce(writer, input_path, block_size, rate=None):
+    header, input_data = open_data_file(input_path)
+    start_time = time.perf_counter()
+    for block_start in range(0, len(input_data), block_size):
+        writer.write(np.ascontiguousarray(input_data[block_start:block_start + block_size]).tobytes())
+        await writer.drain()
+        if rate is not None:
+            await asyncio.sleep(max(start_time + (block_start + block_size)/rate - time.perf_counter(), 0.))
+    writer.close()
+    await writer.wait_closed()
+
+
+## Open the stream: a TCP connection to address (HOST:PORT), standard input, or (if both are None) a local producer sending input_path. Returns the reader, the writer of the connection (None for standard input; it must be kept while reading, since the connection is closed when the writer is garbage collected) and the producer task (None if there is no local producer).
+async def open_stream(address, use_stdin, input_path, block_size, rate):
+    if address is not None:
+        host, port = address.rsplit(':', 1)
+        reader, writer = await asyncio.open_connection(host, int(port))
+        return reader, writer, None
+
+    if use_stdin:
+        reader = asyncio.StreamReader()
+        await asyncio.get_running_loop().connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin.buffer)
+        return reader, None, None
+
+    connected = asyncio.get_running_loop().create_future()
+    server = await asyncio.start_server(lambda reader, writer: connected.set_result(writer), '127.0.0.1', 0)
+    reader, writer = await asyncio.open_connection('127.0.0.1', server.sockets[0].getsockname()[1])
+    producer = asyncio.create_task(produce(await connected, input_path, block_size, rate))
+    server.close()
+    return reader, writer, producer
+
+
+## Read, process and emit the whole stream. Returns the statistics (see process_blocks).
+async def run_stream(emit, address=None, use_stdin=False, input_path=os.path.join(DATA_DIRECTORY, 'input_data.bin'), block_size=65536, rate=None, queue_size=8, coefficients=None):
+    if coefficients is None:
+        coefficients = default_coefficients()
+
+    reader, writer, producer = await open_stream(address, use_stdin, input_path, block_size, rate)
+    queue = asyncio.Queue(queue_size)
+    reader_task = asyncio.create_task(read_blocks(reader, queue, block_size))
+    statistics = await process_blocks(queue, emit, coefficients)
+    await reader_task
+    if producer is not None:
+        await producer
+    if writer is not None:
+        writer.close()
+    return statistics
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Streaming (online) feature extraction: read a stream of samples in blocks, process them as they arrive and write the feature records.')
+    parser.add_argument('--connect', default=None, metavar='HOST:PORT', help='read the stream from a TCP connection')
+    parser.add_argument('--stdin', action='store_true', help='read the stream from standard input')
+    parser.add_argument('--input-file', default=os.path.join(DATA_DIRECTORY, 'input_data.bin'), help='the data sent by the local producer (if neither --connect nor --stdin is given)')
+    parser.add_argument('--rate', type=float, default=None, help='the rate of the local producer, in samples/s (default: as fast as possible)')
+    parser.add_argument('--block-size', type=int, default=65536, help='samples per block')
+    parser.add_argument('--output-file', default=os.path.join(DATA_DIRECTORY, 'feature_records.bin'))
+    args = parser.parse_args(argv)
+
+    ## The header of the output file: the waveform structure is only known for the local producer.
+    if (args.connect is None) and not args.stdin:
+        input_header = open_data_file(args.input_file)[0]
+        header_values = (input_header['N_EMPTY_WAVEFORMS'], input_header['N_REAL_WAVEFORMS'], input_header['N_SAMPLES_PER_WAVEFORM'])
+    else:
+        header_values = (0, 0, 0)
+
+    with create_data_file(args.output_file, FEATURE_RECORD_DTYPE, *header_values) as output_file:
+        statistics = asyncio.run(run_stream(lambda records: append_rows(output_file, records), args.connect, args.stdin, args.input_file, args.block_size, args.rate))
+
+    processing_time = np.array(statistics['processing_time'])
+    latency = np.array(statistics['latency'])
+    print(str(statistics['n_records']) + ' records from ' + str(statistics['n_samples']) + ' samples in ' + str(len(latency)) + ' blocks written to ' + args.output_file)
+    if (len(latency) > 0):
+        print('Processing time per block [ms]: median {:.1f}, 99% {:.1f}, max {:.1f}'.format(*(1e3*np.percentile(processing_time, [50, 99, 100]))))
+        print('Latency per block [ms]:         median {:.1f}, 99% {:.1f}, max {:.1f}'.format(*(1e3*np.percentile(latency, [50, 99, 100]))))
+        print('Sustained throughput: {:.3g} samples/s'.format(statistics['n_samples']/(statistics['end'] - statistics['start'])))
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+import argparse
+import os
+import numpy as np
+from data_format import DATA_DIRECTORY, open_data_file
+from feature_records import extract_feature_records
+
+## Interactive viewer for long pulse trains (the input data and the output of the VHDL simulation or emulate_VHDL.py). visualise_data.py plots every sample, which is fine for the example data but not for pulse trains of 10^8 samples. Here, the data files are opened with np.memmap and only what is needed for the current view is read: when zoomed in, the raw samples in view; when zoomed out, the minimum and maximum in each pixel column (so no pulse disappears, however far out you zoom), taken from a min/max pyramid of the column. Level k of the pyramid holds the minimum and maximum of blocks of PYRAMID_BLOCK^(k+1) samples. It is built once per column, when that column is first viewed zoomed out, and cached in data/viewer_cache.
+##
+## An index of the final triggers (with the pile-up flag, see feature_records.py) and of the BCFD windows (the rows with cfd_time > 0) is made when the viewer starts (also cached), so that you can jump straight to the Nth pile-up event (--pileup N). In the window, the keys n/b jump to the next/previous pile-up event and t/y to the next/previous final trigger (these keys are taken out of matplotlib's own key bindings, rcParams['keymap.*'], while the viewer runs); zoom and pan with the matplotlib toolbar as usual.
+
+## Each pyramid level reduces the previous one by this factor:
+PYRAMID_BLOCK = 16
+
+## Data are read in chunks of this many samples (when building the pyramid and the index):
+CHUNK_SIZE = 1 << 22
+
+## The number of pixel columns to decimate to, the number of samples shown around an event when jumping to it, and the maximum number of event markers drawn (when zoomed out further, no markers are drawn):
+N_PIXEL_COLUMNS = 2000
+EVENT_WINDOW = 400
+MAX_MARKERS = 5000
+
+## The keys that jump to the next/previous pile-up event and final trigger:
+VIEWER_KEYS = {'pileup_event': ('n', 'b'), 'trigger': ('t', 'y')}
+
+CACHE_DIR = os.path.join(DATA_DIRECTORY, 'viewer_cache')
+
+
+## The minimum and maximum of each block of block_size consecutive values (the last block may be shorter).
+def block_min_max(minimum, maximum, block_size):
+    starts = np.arange(0, len(minimum), block_size)
+    return np.minimum.reduceat(minimum, starts), np.maximum.reduceat(maximum, starts)
+
+
+## Build the min/max pyramid of a column (a memory-mapped array), reading it in chunks. Returns a list of (minimum, maximum) arrays, level 0 first.
+def build_pyramid(column, chunk_size=CHUNK_SIZE):
+    chunk_size -= chunk_size % PYRAMID_BLOCK
+    chunks = []
+    for chunk_start in range(0, len(column), chunk_size):
+        chunk = np.asarray(column[chunk_start:chunk_start + chunk_size])
+        chunks.append(block_min_max(chunk, chunk, PYRAMID_BLOCK))
+    levels = [(np.concatenate([chunk[0] for chunk in chunks]), np.concatenate([chunk[1] for chunk in chunks]))]
+    while (len(levels[-1][0]) > N_PIXEL_COLUMNS):
+        levels.append(block_min_max(*levels[-1], PYRAMID_BLOCK))
+    return levels
+
+
+## The pyramid of a column of a data file, from the cache if it is there (the cache file is identified by the name, size and modification time of the data file).
+def load_pyramid(path, rows, name, use_cache=True):
+    cache_path = os.path.join(CACHE_DIR, '{}_{}_{}_{}.npz'.format(os.path.basename(path), name, os.path.getsize(path), int(os.path.getmtime(path))))
+    if use_cache and os.path.exists(cache_path):
+        cached = np.load(cache_path)
+        return [(cached['min_' + str(level)], cached['max_' + str(level)]) for level in range(len(cached.files)//2)]
+
+    levels = build_pyramid(rows[name])
+    if use_cache:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        np.savez(cache_path, **{prefix + str(level): values for level, (minimum, maximum) in enumerate(levels) for prefix, values in (('min_', minimum), ('max_', maximum))})
+    return levels
+
+
+## The points to draw for samples [start, stop) of a column, decimated to (at most) n_pixels pixel columns: the raw samples if there are fewer than two per pixel column, otherwise the minimum and maximum in each pixel column (two points at the same x, so that the line covers the full range). get_pyramid is only called (to build or load the pyramid) if the raw samples would be too many to read for this view.
+def decimate(column, get_pyramid, start, stop, n_pixels=N_PIXEL_COLUMNS):
+    start, stop = max(int(start), 0), min(int(np.ceil(stop)), len(column))
+    if (stop <= start):
+        return np.zeros(0), np.zeros(0)
+    if (stop - start <= 2*n_pixels):
+        return np.arange(start, stop), np.asarray(column[start:stop])
+
+    ## Use the coarsest level with at least one element per pixel column (or the raw samples, if even level 0 is too coarse). The pixel columns are aligned to the elements of that level.
+    samples_per_pixel = (stop - start)/n_pixels
+    level = int(np.floor(np.log(samples_per_pixel)/np.log(PYRAMID_BLOCK))) - 1
+    if (level < 0):
+        block_size = 1
+        minimum = maximum = np.asarray(column[start:stop])
+    else:
+        pyramid = get_pyramid()
+        level = min(level, len(pyramid) - 1)
+        block_size = PYRAMID_BLOCK**(level + 1)
+        minimum, maximum = (values[start//block_size:-(-stop//block_size)] for values in pyramid[level])
+
+    pixel_starts = np.unique((np.arange(n_pixels)*len(minimum))//n_pixels)
+    x = np.repeat((start//block_size + pixel_starts)*block_size if (block_size > 1) else start + pixel_starts, 2)
+    y = np.column_stack([np.minimum.reduceat(minimum, pixel_starts), np.maximum.reduceat(maximum, pixel_starts)]).ravel()
+    return x, y
+
+
+## The index of the events in the output data: the timestamps of the final triggers, their pile-up flags and the timestamps of the BCFD windows (rows with cfd_time > 0; only in the full output). The full output is read in chunks, and the index is cached.
+def build_index(path, rows, use_cache=True):
+    if ('final_trigger' not in rows.dtype.names):               ## feature records
+        return {'final_trigger': np.asarray(rows['timestamp']), 'pileup': np.asarray(rows['pileup']) == 1, 'bcfd': np.zeros(0, dtype=np.int64)}
+
+    cache_path = os.path.join(CACHE_DIR, '{}_index_{}_{}.npz'.format(os.path.basename(path), os.path.getsize(path), int(os.path.getmtime(path))))
+    if use_cache and os.path.exists(cache_path):
+        return dict(np.load(cache_path))
+
+    records, bcfd, in_chain = [], [], False
+    for chunk_start in range(0, len(rows), CHUNK_SIZE):
+        chunk = rows[chunk_start:chunk_start + CHUNK_SIZE]
+        chunk_records, in_chain = extract_feature_records(chunk, in_chain)
+        records.append(chunk_records)
+        bcfd.append(chunk['counter'][chunk['cfd_time'] > 0])
+    records = np.concatenate(records)
+    index = {'final_trigger': records['timestamp'], 'pileup': records['pileup'] == 1, 'bcfd': np.concatenate(bcfd)}
+
+    if use_cache:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        np.savez(cache_path, **index)
+    return index
+
+
+
+def main(argv=None):
+    import matplotlib.pyplot as plt
+
+    ## matplotlib binds some keys itself (e.g. 'r' is keymap.home, 'b' and 't' may be bound in a matplotlibrc); take the viewer keys out of its key maps, so that they only do one thing.
+    viewer_keys = set(key for keys in VIEWER_KEYS.values() for key in keys)
+    for name in plt.rcParams:
+        if name.startswith('keymap.'):
+            plt.rcParams[name] = [key for key in plt.rcParams[name] if key not in viewer_keys]
+
+    parser = argparse.ArgumentParser(description='Interactive viewer for long pulse trains, with min/max decimation and an index of the final triggers and pile-up events.')
+    parser.add_argument('--input-file', default=os.path.join(DATA_DIRECTORY, 'input_data.bin'))
+    parser.add_argument('--output-file', default=os.path.join(DATA_DIRECTORY, 'output_data.bin'), help='output_data.bin (10 columns for every clock cycle) or the feature records (e.g. feature_records.bin in the data directory). With feature records, only the input data and the OF amplitudes at the final triggers are shown.')
+    parser.add_argument('--pileup', type=int, default=None, metavar='N', help='start at the Nth pile-up event (counting from 0)')
+    parser.add_argument('--trigger', type=int, default=None, metavar='N', help='start at the Nth final trigger (counting from 0)')
+    parser.add_argument('--window', type=int, default=EVENT_WINDOW, help='the number of samples shown around an event')
+    parser.add_argument('--no-cache', action='store_true', help='do not read or write the cached pyramids and index')
+    args = parser.parse_args(argv)
+
+    input_header, input_data = open_data_file(args.input_file)
+    output_header, output_data = open_data_file(args.output_file)
+    full_output = ('final_trigger' in output_data.dtype.names)
+
+    index = build_index(args.output_file, output_data, not args.no_cache)
+    pileup_events = index['final_trigger'][index['pileup']]
+    print('{} samples, {} final triggers, {} pile-up events, {} BCFD windows'.format(len(input_data), len(index['final_trigger']), len(pileup_events), len(index['bcfd'])))
+
+    ## The panels: the columns to draw (decimated), each with its own lazily loaded pyramid.
+    panels = [(args.input_file, input_data, 'sample', 'Input data', 'darkorange')]
+    if full_output:
+        panels += [(args.output_file, output_data, 'cfd', 'CFD signal', 'navy'), (args.output_file, output_data, 'u', 'OF amplitude estimate', 'maroon')]
+    pyramids = {}
+
+    def pyramid_getter(path, rows, name):
+        def get_pyramid():
+            if (path, name) not in pyramids:
+                print('Building the min/max pyramid of ' + name + ' in ' + path)
+                pyramids[(path, name)] = load_pyramid(path, rows, name, not args.no_cache)
+            return pyramids[(path, name)]
+        return get_pyramid
+
+    fig, ax = plt.subplots(len(panels) + (0 if full_output else 1), 1, sharex=True, squeeze=False)
+    ax = ax[:, 0]
+    lines = []
+    for axis, (path, rows, name, title, color) in zip(ax, panels):
+        lines.append((axis.plot([], [], color=color, linewidth=0.8)[0], rows[name], pyramid_getter(path, rows, name)))
+        axis.set_title(title)
+
+    ## The final triggers in view, on the last panel (at the OF amplitude from the index or the feature records):
+    trigger_u = np.asarray(output_data['u'][index['final_trigger']] if full_output else output_data['u'])
+    trigger_markers = ax[-1].plot([], [], 'o', color='maroon', markerfacecolor='none', label='Final trigger')[0]
+    pileup_markers = ax[-1].plot([], [], 's', color='green', markerfacecolor='none', label='Final trigger (pile-up)')[0]
+    ax[-1].legend(loc='upper right')
+    ax[-1].set_xlabel('Sample number')
+    if not full_output:
+        ax[-1].set_title('OF amplitude at the final triggers')
+
+    view = {'updating': False, 'pileup_event': -1, 'trigger': -1}
+
+    ## Redraw the decimated data for the current x range (called whenever the view changes):
+    def update(axis=None):
+        if view['updating']:
+            return
+        view['updating'] = True
+        start, stop = ax[0].get_xlim()
+        for (line, column, get_pyramid), axis in zip(lines, ax):
+            x, y = decimate(column, get_pyramid, start, stop + 1)
+            line.set_data(x, y)
+            if (len(y) > 0):
+                margin = 0.05*(y.max() - y.min() + 1)
+                axis.set_ylim(y.min() - margin, y.max() + margin)
+
+        first, last = np.searchsorted(index['final_trigger'], [start, stop + 1])
+        in_view = slice(first, last) if (last - first <= MAX_MARKERS) else slice(0, 0)
+        for markers, selection in [(trigger_markers, ~index['pileup'][in_view]), (pileup_markers, index['pileup'][in_view])]:
+            markers.set_data(index['final_trigger'][in_view][selection], trigger_u[in_view][selection])
+        if not full_output:
+            ax[-1].relim()
+            ax[-1].autoscale_view(scalex=False)
+        view['updating'] = False
+        fig.canvas.draw_idle()
+
+    def show_event(timestamp):
+        ax[0].set_xlim(timestamp - args.window//2, timestamp + args.window//2)
+
+    ## Jump to the next (step = 1) or previous (step = -1) pile-up event or final trigger:
+    def on_key(event):
+        for keys, name, timestamps in [(VIEWER_KEYS['pileup_event'], 'pileup_event', pileup_events), (VIEWER_KEYS['trigger'], 'trigger', index['final_trigger'])]:
+            if (event.key in keys) and (len(timestamps) > 0):
+                view[name] = int(np.clip(view[name] + (1 if (event.key == keys[0]) else -1), 0, len(timestamps) - 1))
+                print(name.replace('_', ' ').capitalize() + ' ' + str(view[name]) + ' at sample ' + str(timestamps[view[name]]))
+                show_event(timestamps[view[name]])
+
+    for axis in ax:
+        axis.callbacks.connect('xlim_changed', update)
+    fig.canvas.mpl_connect('key_press_event', on_key)
+
+    ## Start with the whole pulse train, or at the requested event (then the pyramids are only built when zooming out).
+    start_event = None
+    for name, number, timestamps in [('pileup_event', args.pileup, pileup_events), ('trigger', args.trigger, index['final_trigger'])]:
+        if number is not None:
+            if not (0 <= number < len(timestamps)):
+                parser.error('there are only ' + str(len(timestamps)) + ' ' + name.replace('_', ' ') + 's')
+            view[name] = number
+            start_event = timestamps[number]
+    if start_event is None:
+        ax[0].set_xlim(0, len(input_data))
+    else:
+        show_event(start_event)
+
+    fig.set_size_inches(10, 9)
+    plt.show()
+
+
+
+if __name__ == '__main__':
+    main()
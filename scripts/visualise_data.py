@@ -1,37 +1,111 @@
+import argparse
+import os
 import numpy as np
-import matplotlib.pyplot as plt
+from data_format import open_data_file, DATA_DIRECTORY
+from feature_records import extract_feature_records, snapshot_samples
 
-input_data = np.genfromtxt('../data/input_data.csv', delimiter=',', dtype='int')            ## the generated data
-MC_truth_data = np.genfromtxt('../data/MC_truth_data.csv', delimiter=',')                   ## needed to know the number of waveforms in the data
-VHDL_output_data = np.genfromtxt('../data/output_data.csv', delimiter=',', dtype='int')     ## the output from the VHDL simulation
+## Plot the input data and the output of the VHDL simulation (or of emulate_VHDL.py): the input samples, the CFD signal and the OF amplitude at each final trigger, and optionally the raw-sample snapshots. plot_data() takes the paths of the files, so it can also be called from other code. By default, the figures are written to a file (PLOT_FILE, or the file given with --save), without a display, so the script also runs on a machine without one; with --show, they are shown in a window instead. matplotlib is only imported when plotting.
 
-## Read some file-structure data:
-N_EMPTY_WAVEFORMS = int(MC_truth_data[0,0])
-N_REAL_WAVEFORMS = int(MC_truth_data[0,1])
-N_SAMPLES_PER_WAVEFORM = int(MC_truth_data[0,2])
+## The default files: the generated data (generate_pulse_data.py) and the output of the VHDL simulation.
+INPUT_FILE = os.path.join(DATA_DIRECTORY, 'input_data.bin')
+OUTPUT_FILE = os.path.join(DATA_DIRECTORY, 'output_data.bin')
 
-# This will hold the (global) time, and is used for plotting only:
-t_pulse_train = np.linspace(1, (N_EMPTY_WAVEFORMS + N_REAL_WAVEFORMS)*N_SAMPLES_PER_WAVEFORM, (N_EMPTY_WAVEFORMS + N_REAL_WAVEFORMS)*N_SAMPLES_PER_WAVEFORM)
+## The figures are written to this file by default (the snapshots to the same name with '_snapshots' appended):
+PLOT_FILE = os.path.join(DATA_DIRECTORY, 'visualise_data.png')
 
-## Reading some outputs from the VHDL simulation:
-CFD_signal = VHDL_output_data[:,5]
-OF_u = VHDL_output_data[:,7]
 
+## Plot the data in input_path and output_path (and the snapshots in snapshots_path, if given). If save_path is given, the figures are written to it (the snapshots to the same name with '_snapshots' appended). With show=True, the figures are also shown in a window; otherwise no display is needed. Returns the figures.
+def plot_data(input_path=INPUT_FILE, output_path=OUTPUT_FILE, snapshots_path=None, save_path=PLOT_FILE, show=False):
+    import matplotlib
+    if not show:
+        matplotlib.use('Agg')                   ## no display needed
+    import matplotlib.pyplot as plt
 
-# plot everything:
-fig, ax = plt.subplots(3, 1, sharex=True)
-ax[0].plot(t_pulse_train, input_data, color='darkorange')
-ax[1].plot(t_pulse_train, CFD_signal, color='navy')
-ax[2].plot(t_pulse_train, OF_u, color='maroon')
+    header, input_data = open_data_file(input_path)                                     ## the generated data
+    VHDL_output_header, VHDL_output_data = open_data_file(output_path)                  ## the output from the VHDL simulation
 
-ax[0].set_title('Input data')
-ax[1].set_title('CFD signal (from VHDL simulation)')
-ax[2].set_title('OF amplitude estimate (from VHDL simulation)')
+    ## Read some file-structure data (from the header of the input data file):
+    N_EMPTY_WAVEFORMS = header['N_EMPTY_WAVEFORMS']
+    N_REAL_WAVEFORMS = header['N_REAL_WAVEFORMS']
+    N_SAMPLES_PER_WAVEFORM = header['N_SAMPLES_PER_WAVEFORM']
 
+    # This will hold the (global) time, and is used for plotting only:
+    t_pulse_train = np.linspace(1, (N_EMPTY_WAVEFORMS + N_REAL_WAVEFORMS)*N_SAMPLES_PER_WAVEFORM, (N_EMPTY_WAVEFORMS + N_REAL_WAVEFORMS)*N_SAMPLES_PER_WAVEFORM)
 
-plt.xlim(0, t_pulse_train[-1])
-ax[2].set_xlabel('Sample number')
+    ## Reading some outputs from the VHDL simulation. The feature records (one per final trigger, see feature_records.py) are used as they are, or made from the full output.
+    full_output = ('final_trigger' in VHDL_output_data.dtype.names)
+    feature_records = extract_feature_records(VHDL_output_data)[0] if full_output else VHDL_output_data
+    pileup = (feature_records['pileup'] == 1)
 
-fig.set_size_inches(6, 9)
 
-plt.show()
+    # plot everything:
+    figures = []
+    fig, ax = plt.subplots(3 if full_output else 2, 1, sharex=True)
+    ax[0].plot(t_pulse_train, input_data['sample'], color='darkorange')
+    ax[0].set_title('Input data')
+
+    if full_output:
+        ax[1].plot(t_pulse_train, VHDL_output_data['cfd'], color='navy')
+        ax[1].set_title('CFD signal (from VHDL simulation)')
+
+        ax[2].plot(t_pulse_train, VHDL_output_data['u'], color='maroon')
+
+    ## The OF amplitude at each final trigger (t_pulse_train starts at 1 for the row with counter 0), separately for pulses on the tail of a preceding pulse:
+    ax[-1].plot(feature_records['timestamp'][~pileup] + 1, feature_records['u'][~pileup], 'o', color='maroon', markerfacecolor='none', label='Final trigger')
+    ax[-1].plot(feature_records['timestamp'][pileup] + 1, feature_records['u'][pileup], 's', color='green', markerfacecolor='none', label='Final trigger (pile-up)')
+    ax[-1].set_title('OF amplitude estimate (from VHDL simulation)')
+    ax[-1].legend()
+
+
+    plt.xlim(0, t_pulse_train[-1])
+    ax[-1].set_xlabel('Sample number')
+
+    fig.set_size_inches(6, 9)
+    figures.append(fig)
+
+
+    ## The raw-sample snapshots, aligned on the final trigger (at most MAX_SNAPSHOTS of each kind):
+    if snapshots_path is not None:
+        MAX_SNAPSHOTS = 200
+
+        snapshot_header, snapshots = open_data_file(snapshots_path)
+        samples = snapshot_samples(snapshots)
+        t_snapshot = np.arange(samples.shape[1]) - (snapshots['timestamp'][0] - snapshots['first_timestamp'][0]) if (len(snapshots) > 0) else np.arange(samples.shape[1])
+        snapshot_pileup = np.isin(snapshots['timestamp'], feature_records['timestamp'][pileup])
+
+        fig, ax = plt.subplots(2, 1, sharex=True)
+        ax[0].plot(t_snapshot, samples[~snapshot_pileup][:MAX_SNAPSHOTS].T, color='maroon', alpha=0.2)
+        ax[1].plot(t_snapshot, samples[snapshot_pileup][:MAX_SNAPSHOTS].T, color='green', alpha=0.2)
+        ax[0].set_title('Raw samples around the final trigger')
+        ax[1].set_title('Raw samples around the final trigger (pile-up)')
+        ax[1].set_xlabel('Samples since the final trigger')
+        figures.append(fig)
+
+    if save_path is not None:
+        root, extension = os.path.splitext(save_path)
+        for fig, path in zip(figures, [save_path, root + '_snapshots' + extension]):
+            fig.savefig(path)
+    if show:
+        plt.show()
+
+    return figures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Plot the input data and the output of the VHDL simulation.')
+    parser.add_argument('--input-file', default=INPUT_FILE, help='the generated data')
+    parser.add_argument('--output-file', default=OUTPUT_FILE, help='output_data.bin (10 columns for every clock cycle) or the feature records (e.g. feature_records.bin in the data directory). With feature records, the CFD signal is not available.')
+    parser.add_argument('--snapshots', default=None, help='also plot the raw-sample snapshots around the final triggers (e.g. snapshots.bin in the data directory, from emulate_VHDL.py --feature-records --snapshot)')
+    parser.add_argument('--save', default=None, metavar='FILE', help='write the figures to FILE (default: ' + PLOT_FILE + ', unless --show is given)')
+    parser.add_argument('--show', action='store_true', help='show the figures in a window (needs a display)')
+    args = parser.parse_args(argv)
+
+    save_path = args.save if ((args.save is not None) or args.show) else PLOT_FILE
+    plot_data(args.input_file, args.output_file, args.snapshots, save_path, args.show)
+    if save_path is not None:
+        print('Figures written to ' + save_path)
+
+
+
+if __name__ == '__main__':
+    main()
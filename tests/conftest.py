@@ -0,0 +1,5 @@
+import os
+import sys
+
+## The scripts are plain modules in scripts/ (there is no package), so the tests import them from there.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
@@ -0,0 +1,44 @@
+import os
+import numpy as np
+import pytest
+import OF_calibration
+import get_OF_coefficients
+from get_OF_coefficients import get_delta_BCFD_window_mean
+
+N_BCFD_WINDOWS = 4
+DELTA = np.array([0.1, 0.3, -0.2, 0.4])
+
+
+## Replace the fits by the given BCFD windows (1 to N_BCFD_WINDOWS) and fixed deltas, and the cache by a temporary directory.
+def patch_BCFD_deltas(monkeypatch, tmp_path, T_BCFD_window):
+    monkeypatch.setattr(OF_calibration, 'CACHE_DIRECTORY', str(tmp_path))
+    monkeypatch.setattr(get_OF_coefficients, 'get_fit_results', lambda waveforms, t_waveform, mu, sigma, n_processes, use_cache: None)
+    monkeypatch.setattr(get_OF_coefficients, 'get_BCFD_deltas', lambda waveforms, fit_results, t_waveform, CFD_delay, CFD_attenuation, N_BCFD_WINDOWS: (np.array(T_BCFD_window), DELTA))
+
+def test_empty_BCFD_window(monkeypatch, tmp_path):
+    patch_BCFD_deltas(monkeypatch, tmp_path, [1, 1, 2, 4])
+    with pytest.raises(ValueError, match='BCFD window\\(s\\) 3 of 4'):
+        get_delta_BCFD_window_mean(np.zeros((4, 8)), np.arange(8), 1., 0.5, 2, 0.5, N_BCFD_WINDOWS)
+    assert os.listdir(tmp_path) == []          ## nothing is cached
+
+def test_BCFD_window_mean(monkeypatch, tmp_path):
+    patch_BCFD_deltas(monkeypatch, tmp_path, [1, 1, 2, 3])
+    delta_BCFD_window_mean = get_delta_BCFD_window_mean(np.zeros((4, 8)), np.arange(8), 1., 0.5, 2, 0.5, N_BCFD_WINDOWS - 1)
+    np.testing.assert_allclose(delta_BCFD_window_mean, [0.2, -0.2, 0.4])
+
+def test_BCFD_window_mean_uncached(monkeypatch, tmp_path):
+    patch_BCFD_deltas(monkeypatch, tmp_path, [1, 1, 2, 3])
+    delta_BCFD_window_mean = get_delta_BCFD_window_mean(np.zeros((4, 8)), np.arange(8), 1., 0.5, 2, 0.5, N_BCFD_WINDOWS - 1, use_cache=False)
+    np.testing.assert_allclose(delta_BCFD_window_mean, [0.2, -0.2, 0.4])
+    assert os.listdir(tmp_path) == []          ## nothing is cached
+
+
+## The committed calibration (data/OF_calibration.json) and VHDL package (vhdl/OF_coefficients.vhd) must be what get_OF_coefficients.py writes for the stored BCFD window means and parameters, i.e. not edited by hand.
+def test_committed_calibration(tmp_path):
+    calibration = OF_calibration.load_calibration()
+    recalculated = OF_calibration.calculate_OF_calibration(calibration['delta_BCFD_window_mean'], **calibration['parameters'])
+
+    for name, path, write in [('calibration', OF_calibration.CALIBRATION_FILE, OF_calibration.write_calibration_file), ('VHDL package', OF_calibration.VHDL_PACKAGE_FILE, OF_calibration.write_VHDL_package)]:
+        write(recalculated, str(tmp_path / os.path.basename(path)))
+        with open(path, 'r') as committed_file, open(str(tmp_path / os.path.basename(path)), 'r') as recalculated_file:
+            assert committed_file.read() == recalculated_file.read(), 'the committed ' + name + ' differs from a fresh computation: run get_OF_coefficients.py'
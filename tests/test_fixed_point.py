@@ -0,0 +1,87 @@
+import os
+import re
+import numpy as np
+import pytest
+from fixed_point import fixed_format, value_range, resize, round_shift, quantise, required_width
+from emulate_VHDL import SIGNAL_FORMATS, FIR_LENGTH
+
+VHDL_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vhdl')
+
+
+@pytest.mark.parametrize('signed, low, high', [(True, -128, 127), (False, 0, 255)])
+def test_value_range(signed, low, high):
+    assert value_range(fixed_format(8, signed)) == (low, high)
+
+## One below, at and one above the limits of an 8-bit format: wrapping keeps the 8 least significant bits, saturating clips, and both count the two values that do not fit.
+@pytest.mark.parametrize('signed, values, wrapped, saturated', [(True, [-129, -128, 127, 128], [127, -128, 127, -128], [-128, -128, 127, 127]),
+                                                                (False, [-1, 0, 255, 256], [255, 0, 255, 0], [0, 0, 255, 255])])
+def test_overflow_at_limits(signed, values, wrapped, saturated):
+    for overflow, expected in [('wrap', wrapped), ('saturate', saturated)]:
+        overflow_counters = {}
+        assert resize(values, fixed_format(8, signed, overflow=overflow), overflow_counters, 'x').tolist() == expected
+        assert (overflow_counters['x']['n_values'], overflow_counters['x']['n_overflows']) == (4, 2)
+        assert (overflow_counters['x']['min'], overflow_counters['x']['max']) == (min(values), max(values))
+
+    assert resize(values[1:3], fixed_format(8, signed, overflow='error')).tolist() == values[1:3]
+    with pytest.raises(OverflowError, match='1 value'):
+        resize(values[:3], fixed_format(8, signed, overflow='error'))
+
+
+## Shifting right by one bit: x/2 is -2.5, -2, -1.5, -1, -0.5, 0.5, 1, 1.5, 2.5, 3, 3.5. 'floor' rounds the negative halves down (like shift_right in VHDL), 'truncate' towards zero and 'round' to the nearest even value.
+SHIFTED_VALUES = [-5, -4, -3, -2, -1, 1, 2, 3, 5, 6, 7]
+
+@pytest.mark.parametrize('rounding, expected', [('floor',    [-3, -2, -2, -1, -1, 0, 1, 1, 2, 3, 3]),
+                                                ('truncate', [-2, -2, -1, -1, 0, 0, 1, 1, 2, 3, 3]),
+                                                ('round',    [-2, -2, -2, -1, 0, 0, 1, 2, 2, 3, 4])])
+def test_round_shift_negative_and_ties(rounding, expected):
+    assert round_shift(SHIFTED_VALUES, 1, rounding).tolist() == expected
+    ## quantise rounds in the same way:
+    assert quantise(np.array(SHIFTED_VALUES)/2., fixed_format(8, rounding=rounding)).tolist() == expected
+
+def test_round_shift_left():
+    assert round_shift([-3, 5], -2).tolist() == [-12, 20]
+
+## Quantising with one fraction bit: the scaled values are -2.5, -1.5, -0.5, 0.5, 1.5, 2.5.
+@pytest.mark.parametrize('rounding, expected', [('floor', [-3, -2, -1, 0, 1, 2]), ('truncate', [-2, -1, 0, 0, 1, 2]), ('round', [-2, -2, 0, 0, 2, 2])])
+def test_quantise_fraction_bits(rounding, expected):
+    assert quantise([-1.25, -0.75, -0.25, 0.25, 0.75, 1.25], fixed_format(8, fraction_bits=1, rounding=rounding)).tolist() == expected
+
+
+def read_vhdl(file_name):
+    with open(os.path.join(VHDL_DIRECTORY, file_name), 'r') as vhdl_file:
+        return vhdl_file.read()
+
+## The width of a signal declared as 'signal name : signed(N downto 0)', and of the ports of a component (STD_LOGIC_VECTOR(N DOWNTO 0)).
+def vhdl_signal_width(text, name):
+    return int(re.search(r'signal\s+' + name + r'\s*:\s*signed\s*\(\s*(\d+)\s+downto\s+0\s*\)', text, re.IGNORECASE).group(1)) + 1
+
+def vhdl_component_ports(text, component):
+    block = re.search(r'COMPONENT\s+' + component + r'\b(.*?)END\s+COMPONENT', text, re.IGNORECASE | re.DOTALL).group(1)
+    return {name: int(msb) + 1 for name, msb in re.findall(r'(\w+)\s*:\s*(?:IN|OUT)\s+STD_LOGIC_VECTOR\s*\(\s*(\d+)\s+DOWNTO\s+0\s*\)', block, re.IGNORECASE)}
+
+def test_VHDL_OF_widths():
+    text = read_vhdl('optimal_filter.vhd')
+
+    ## The OF multipliers (mult_gen_0): coefficient times FIR_data, with the full product width, which is exactly the width of the largest product of two signed values.
+    OF_ports = vhdl_component_ports(text, 'mult_gen_0')
+    assert (OF_ports['A'], OF_ports['B']) == (SIGNAL_FORMATS['FIR_coefficients']['width'], SIGNAL_FORMATS['FIR_data']['width']) == (25, 16)
+    coefficient_low, coefficient_high = value_range(SIGNAL_FORMATS['FIR_coefficients'])
+    data_low, data_high = value_range(SIGNAL_FORMATS['FIR_data'])
+    assert OF_ports['P'] == required_width(coefficient_low*data_high, coefficient_low*data_low) == 41
+
+    ## SUM_A and SUM_B (the sum of the FIR_LENGTH products) cannot overflow:
+    assert vhdl_signal_width(text, 'SUM_A') == vhdl_signal_width(text, 'SUM_B') == 51
+    assert required_width(FIR_LENGTH*coefficient_low*data_high, FIR_LENGTH*coefficient_low*data_low) <= vhdl_signal_width(text, 'SUM_A')
+
+    ## The tail reconstruction (Reconstruction_mult_gen): the low 20 bits of the OF sums of a pulse times an 18-bit template value, into 38 bits.
+    reconstruction_ports = vhdl_component_ports(text, 'Reconstruction_mult_gen')
+    assert (reconstruction_ports['A'], reconstruction_ports['B']) == (SIGNAL_FORMATS['SUM_pulse']['width'], SIGNAL_FORMATS['templates']['width']) == (20, 18)
+    assert re.search(r'SUM_A_pulse\(p\)\((\d+) downto 0\)', text).group(1) == str(SIGNAL_FORMATS['SUM_pulse']['width'] - 1)
+    sum_low, sum_high = value_range(SIGNAL_FORMATS['SUM_pulse'])
+    template_low, template_high = value_range(SIGNAL_FORMATS['templates'])
+    assert reconstruction_ports['P'] == SIGNAL_FORMATS['Reconstructed_part']['width'] == required_width(sum_low*template_high, sum_low*template_low) == 38
+
+    ## The types of these signals (my_types.vhd):
+    types_text = read_vhdl('my_types.vhd')
+    for type_name, width in [('t_fir_coefficients_vector', 25), ('t_fir_data', 16), ('t_fir_product', 41), ('t_g_value_aligned_pulse', 18), ('t_pulse_sums', 51), ('t_Reconstructed_part', 38), ('t_Reconstructed', SIGNAL_FORMATS['Reconstructed']['width'])]:
+        assert int(re.search(r'type\s+' + type_name + r'\s+is\s+array\s*\(.*?\)\s*of\s+(?:std_logic_vector|signed)\s*\(\s*(\d+)\s+downto\s+0\s*\)', types_text, re.IGNORECASE).group(1)) + 1 == width, type_name
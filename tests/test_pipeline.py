@@ -0,0 +1,194 @@
+import os
+import numpy as np
+import pytest
+from data_format import INPUT_DTYPE, OUTPUT_DTYPE, MC_truth_dtype, open_data_file, write_data_file, make_rows, as_array, export_binary_to_csv, convert_csv_to_binary
+import emulate_VHDL
+from emulate_VHDL import default_thresholds, run_pipeline, run_pipeline_segmented, run_pipeline_stream
+from feature_records import extract_feature_records, make_feature_records
+from generate_pulse_data import generate_pulse_data
+from reconstruct_A_and_T import MATCH_OFFSET, match_pulses
+from OF_calibration import load_calibration
+
+## Checks of the equivalences that the rest of the code relies on: the segmented and streamed emulation give the same output as one continuous run of the pipeline, the output for a small waveform matches golden rows derived by hand from the VHDL code, the data files survive the binary and .csv round-trips, the pile-up flags do not depend on how the output is cut into blocks, and the matching of reconstructed to true pulses.
+
+## A short pulse train: 60 waveforms (6100 samples) with two pulses each, so there is pile-up, and several segments and stream blocks.
+N_WAVEFORMS = 60
+SEED = 7
+SEGMENT_LENGTH = 700
+WARMUP_LENGTH = 200
+STREAM_BLOCK_LENGTH = 613               ## not a multiple of the segment length, so the blocks are cut at arbitrary points
+
+
+@pytest.fixture(scope='module')
+def pulse_train(tmp_path_factory):
+    data_dir = str(tmp_path_factory.mktemp('data'))
+    generate_pulse_data(data_dir, N_WAVEFORMS, seed=SEED)
+    header, input_data = open_data_file(os.path.join(data_dir, 'input_data.bin'))
+    return input_data['sample'].astype(np.int64)
+
+@pytest.fixture(scope='module')
+def output_data(pulse_train):
+    return run_pipeline(pulse_train)[0]
+
+
+def test_segmented_equals_continuous(pulse_train, output_data):
+    assert np.array_equal(run_pipeline_segmented(pulse_train, SEGMENT_LENGTH, WARMUP_LENGTH), output_data)
+
+def test_stream_equals_batch(pulse_train, output_data):
+    outputs = []
+    stream_state = None
+    for block_start in range(0, len(pulse_train), STREAM_BLOCK_LENGTH):
+        block_output, stream_state = run_pipeline_stream(pulse_train[block_start:block_start + STREAM_BLOCK_LENGTH], stream_state, segment_length=SEGMENT_LENGTH, warmup_length=WARMUP_LENGTH)
+        outputs.append(block_output)
+    block_output, stream_state = run_pipeline_stream(np.zeros(0, dtype=np.int64), stream_state, flush=True, segment_length=SEGMENT_LENGTH, warmup_length=WARMUP_LENGTH)
+    outputs.append(block_output)
+
+    assert np.array_equal(np.concatenate(outputs), output_data)
+
+def test_thresholds_argument(pulse_train, output_data):
+    assert np.array_equal(run_pipeline(pulse_train, thresholds=default_thresholds())[0], output_data)
+
+    ## An OF amplitude threshold above every pulse: no final triggers, in the continuous and the segmented run, and the module constants are left alone.
+    thresholds = {'OF_AMPLITUDE_THRESHOLD': 1 << 20}
+    high_threshold_output = run_pipeline(pulse_train, thresholds=thresholds)[0]
+    assert not high_threshold_output[:, 9].any()
+    assert np.array_equal(run_pipeline_segmented(pulse_train, SEGMENT_LENGTH, WARMUP_LENGTH, thresholds=thresholds), high_threshold_output)
+    assert emulate_VHDL.OF_AMPLITUDE_THRESHOLD == default_thresholds()['OF_AMPLITUDE_THRESHOLD'] == 15
+
+    with pytest.raises(ValueError, match='Unknown threshold'):
+        run_pipeline(pulse_train[:100], thresholds={'THRESHOLD_RISNG': 4})
+
+
+## Golden rows derived by hand (from the VHDL code, not from the emulator) for a small waveform: a constant baseline of 1000 and one short pulse, y = x - 1000 = 100, 200, 150, 100, 50 in cycles 100 to 104. With the latencies of main.vhd, row c of the output (written before the clock edge of cycle c) holds:
+##   average  = 1000 + (y[c-3] + y[c-4]) >> 1                    (baseline_calculator.vhd, the 2-sample average)
+##   trigger  = 1 from the row after the first average > 1003    (THRESHOLD_RISING = 3)
+##   cfd      = y[c-5] - (y[c-3] >> 1)                           (constant_fraction.vhd, CFD_DELAY = 2, attenuation 1/2)
+## The CFD crosses zero between rows 104 (-100) and 105 (25), with a rise above THRESHOLD_CFD = 5. The bisection gives (-100 + 25) >> 1 = -38 < 0 (later half) and (-38 + 25) >> 1 = -7 < 0 (later quarter), i.e. window 4, in cfd_time of row 106. In the same row, u and v are the OF sums of window 4 over y[99], ..., y[102] = 0, 100, 200, 150 (the samples 2 cycles before the CFD, oldest first), shifted right by a_scaling, and u > OF_AMPLITUDE_THRESHOLD = 15 gives the final trigger. The baseline is 1000 until the subtraction of the reconstructed tail starts, two rows after the final trigger.
+GOLDEN_PULSE = {100: 100, 101: 200, 102: 150, 103: 100, 104: 50}
+GOLDEN_WINDOW = 4
+GOLDEN_FIR_DATA = [0, 100, 200, 150]
+##                  counter  data_in  average  baseline  trigger  cfd  cfd_time  u  v  final_trigger
+GOLDEN_ROWS = [[100, 1100, 1000, 1000, 0,    0, 0, 0, 0, 0],
+               [101, 1200, 1000, 1000, 0,    0, 0, 0, 0, 0],
+               [102, 1150, 1000, 1000, 0,    0, 0, 0, 0, 0],
+               [103, 1100, 1050, 1000, 0,  -50, 0, 0, 0, 0],
+               [104, 1050, 1150, 1000, 1, -100, 0, 0, 0, 0],
+               [105, 1000, 1175, 1000, 1,   25, 0, 0, 0, 0],
+               [106, 1000, 1125, 1000, 1,  150, GOLDEN_WINDOW, None, None, 1],          ## u and v: see test_golden_rows
+               [107, 1000, 1075, 1000, 1,  125, 0, 0, 0, 0]]
+
+def test_golden_rows():
+    input_data = np.full(200, 1000, dtype=np.int64)
+    for cycle, y in GOLDEN_PULSE.items():
+        input_data[cycle] += y
+    output_data = run_pipeline(input_data)[0]
+
+    ## u and v with the coefficients of window 4 in data/OF_calibration.json (the default calibration of the emulator), e.g. (-165*0 + 78*100 + 925*200 + 1158*150) >> 11 = 178 for u with a = [-165, 78, 925, 1158] and a_scaling = 11.
+    calibration = load_calibration()
+    u = sum(a*y for a, y in zip(calibration['FIR_coefficients_a'][GOLDEN_WINDOW - 1], GOLDEN_FIR_DATA)) >> calibration['a_scaling']
+    v = sum(b*y for b, y in zip(calibration['FIR_coefficients_b'][GOLDEN_WINDOW - 1], GOLDEN_FIR_DATA)) >> calibration['a_scaling']
+    assert u > 15
+    expected = [list(row) for row in GOLDEN_ROWS]
+    expected[6][7:9] = [u, v]
+
+    assert output_data[[row[0] for row in GOLDEN_ROWS]].tolist() == expected
+    assert np.flatnonzero(output_data[:, 9]).tolist() == [106]              ## the only final trigger
+
+def test_final_trigger_count(output_data):
+    ## Every pulse (two in each waveform after the empty one) gives a final trigger.
+    assert len(output_data) == (1 + N_WAVEFORMS)*100
+    assert np.count_nonzero(output_data[:, 9]) == 2*N_WAVEFORMS
+
+
+def test_binary_round_trip(tmp_path, output_data):
+    path = str(tmp_path/'output_data.bin')
+    write_data_file(path, output_data, OUTPUT_DTYPE, 1, N_WAVEFORMS, 100)
+    header, rows = open_data_file(path)
+
+    assert (header['N_EMPTY_WAVEFORMS'], header['N_REAL_WAVEFORMS'], header['N_SAMPLES_PER_WAVEFORM'], header['n_rows']) == (1, N_WAVEFORMS, 100, len(output_data))
+    assert rows.dtype == OUTPUT_DTYPE
+    assert np.array_equal(rows, make_rows(output_data, OUTPUT_DTYPE))
+
+@pytest.mark.parametrize('dtype', [INPUT_DTYPE, OUTPUT_DTYPE])
+def test_csv_round_trip(tmp_path, output_data, pulse_train, dtype):
+    data = pulse_train[:, np.newaxis] if (dtype == INPUT_DTYPE) else output_data
+    path, csv_path, converted_path = str(tmp_path/'data.bin'), str(tmp_path/'data.csv'), str(tmp_path/'converted.bin')
+    write_data_file(path, data, dtype, 1, N_WAVEFORMS, 100)
+    export_binary_to_csv(path, csv_path)
+    convert_csv_to_binary(csv_path, converted_path, dtype, 1, N_WAVEFORMS, 100)
+
+    with open(path, 'rb') as original_file, open(converted_path, 'rb') as converted_file:
+        assert original_file.read() == converted_file.read()
+
+@pytest.mark.parametrize('MC_truth_data', [np.array([[-1., -1., -1., -1.], [512.25, 12.5, 80.125, 40.75], [1000., 5.03125, -1., -1.]]),
+                                           np.array([[-1., -1.], [512.25, 12.5], [1000., 5.03125]])])           ## one pulse per waveform: fewer columns than the header row
+def test_MC_truth_csv_round_trip(tmp_path, MC_truth_data):
+    path, csv_path, converted_path = str(tmp_path/'MC_truth_data.bin'), str(tmp_path/'MC_truth_data.csv'), str(tmp_path/'converted.bin')
+    write_data_file(path, MC_truth_data, MC_truth_dtype(MC_truth_data.shape[1]//2), 1, 2, 100)
+    export_binary_to_csv(path, csv_path)
+    convert_csv_to_binary(csv_path, converted_path)             ## the header is read from the .csv file
+
+    header, rows = open_data_file(converted_path)
+    assert (header['N_EMPTY_WAVEFORMS'], header['N_REAL_WAVEFORMS'], header['N_SAMPLES_PER_WAVEFORM']) == (1, 2, 100)
+    assert np.array_equal(as_array(rows), MC_truth_data)
+
+def test_single_pulse_csv_round_trip(tmp_path):
+    generate_pulse_data(str(tmp_path), 5, n_pulses_per_waveform=1, seed=SEED)
+    path, csv_path, converted_path = str(tmp_path/'MC_truth_data.bin'), str(tmp_path/'MC_truth_data.csv'), str(tmp_path/'converted.bin')
+    export_binary_to_csv(path, csv_path)
+    convert_csv_to_binary(csv_path, converted_path)
+
+    header, rows = open_data_file(path)
+    converted_header, converted_rows = open_data_file(converted_path)
+    assert converted_header == header
+    assert np.allclose(as_array(converted_rows), as_array(rows), rtol=0, atol=1e-6)            ## the .csv file has 6 decimals
+
+
+## Output rows with the given baseline trigger and final trigger in every cycle.
+def make_output_rows(trigger, final_trigger):
+    rows = np.zeros(len(trigger), dtype=OUTPUT_DTYPE)
+    rows['counter'] = np.arange(len(trigger))
+    rows['trigger'] = trigger
+    rows['final_trigger'] = final_trigger
+    return rows
+
+def test_pileup_flags_across_blocks():
+    ## Three chains: two final triggers in one baseline trigger (the second is a pile-up), a single final trigger, and three final triggers. The baseline trigger is released between the chains.
+    trigger =       [0, 1, 1, 1, 1, 1, 1, 0, 0, 1, 1, 1, 0, 1, 1, 1, 1, 1, 1, 1, 1, 0]
+    final_trigger = [0, 0, 1, 0, 0, 1, 0, 0, 0, 0, 1, 0, 0, 0, 1, 0, 1, 0, 0, 1, 0, 0]
+    rows = make_output_rows(trigger, final_trigger)
+
+    records, in_chain = extract_feature_records(rows)
+    assert records['timestamp'].tolist() == [2, 5, 10, 14, 16, 19]
+    assert records['pileup'].tolist() == [0, 1, 0, 0, 1, 1]
+    assert not in_chain
+
+    ## Any cut into blocks, e.g. between the two final triggers of a chain or right after the release of the baseline trigger, gives the same flags:
+    for block_length in range(1, len(rows) + 1):
+        block_records, block_snapshots = make_feature_records(rows, block_length=block_length)
+        assert np.array_equal(block_records, records), block_length
+
+def test_pileup_flag_continues_chain():
+    ## A block that starts in the middle of a chain (in_chain from the preceding block): its first final trigger is a pile-up unless the baseline trigger was released first.
+    rows = make_output_rows([1, 1, 1], [0, 1, 0])
+    assert extract_feature_records(rows, in_chain=True)[0]['pileup'].tolist() == [1]
+    assert extract_feature_records(rows, in_chain=False)[0]['pileup'].tolist() == [0]
+    rows = make_output_rows([1, 0, 1, 1], [0, 0, 1, 0])
+    assert extract_feature_records(rows, in_chain=True)[0]['pileup'].tolist() == [0]
+
+
+def test_match_pulses():
+    True_T = np.array([10., 20., 30., 40.])
+    Reconstructed_T = MATCH_OFFSET + np.array([10.2,                ## matched to pulse 0
+                                               20.9,                ## matched to pulse 1 (within MATCH_WINDOW)
+                                               31.5,                ## too far from pulse 2
+                                               10.5,                ## also nearest to pulse 0, but farther than the first: a fake
+                                               39.6])               ## matched to pulse 3
+    matched, match = match_pulses(Reconstructed_T, True_T)
+
+    assert matched.tolist() == [True, True, False, False, True]
+    assert match[matched].tolist() == [0, 1, 3]
+
+def test_match_pulses_without_true_pulses():
+    matched, match = match_pulses(np.array([5., 6.]), np.zeros(0))
+    assert not matched.any()
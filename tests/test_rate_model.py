@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+from OF_calibration import load_calibration
+from rate_model import ACCEPTED, LOST_CHAIN_FULL, LOST_UNRESOLVED, template_functions, model_pulses
+
+
+@pytest.fixture(scope='module')
+def template():
+    parameters = load_calibration()['parameters']
+    return template_functions(parameters['mu'], parameters['sigma'])
+
+## The smallest separation at which the second of two noiseless pulses is resolved (see TAIL_DELAY and CFD_RE_ARM): about 4.5 samples, or less if the second pulse is much larger.
+@pytest.mark.parametrize('A_1, min_separation', [(100., 4.5), (500., 4.5), (5000., 2.5)])
+def test_pair_separation(template, A_1, min_separation):
+    for separation in [min_separation - 0.25, min_separation]:
+        outcome, period_start, cycles = model_pulses(np.array([100.3, 100.3 + separation]), np.array([500., A_1]), template)
+        assert outcome[0] == ACCEPTED
+        assert outcome[1] == (ACCEPTED if (separation == min_separation) else LOST_UNRESOLVED)
+
+def test_chain_overflow(template):
+    ## Three pulses in one sleeping period: with MAX_PILEUP_PULSES = 2, the third overflows the chain, and the OF starts again with the fourth.
+    outcome, period_start, cycles = model_pulses(np.array([100., 110., 120., 130.]), np.array([500., 500., 500., 500.]), template, max_pileup_pulses=2)
+    assert period_start.tolist() == [0, 0, 0, 0]
+    assert outcome.tolist() == [ACCEPTED, ACCEPTED, LOST_CHAIN_FULL, ACCEPTED]
+    assert cycles['OF_last_state'] == 10.
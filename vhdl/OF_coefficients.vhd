@@ -0,0 +1,126 @@
+-- Copyright (C) 2021 Markus Preston
+-- This source describes Open Hardware and is licensed under the CERN-OHL-W v2 or later
+-- You may redistribute and modify this documentation and make products
+-- using it under the terms of the CERN-OHL-W v2 or later (https:/cern.ch/cern-ohl).
+--
+-- This documentation is distributed WITHOUT ANY EXPRESS OR IMPLIED
+-- WARRANTY, INCLUDING OF MERCHANTABILITY, SATISFACTORY QUALITY
+-- AND FITNESS FOR A PARTICULAR PURPOSE. Please see the CERN-OHL-W v2
+-- for applicable conditions.
+--
+-- Source location: https://github.com/markuspreston/FeatureExtraction/
+
+
+-- THIS FILE IS GENERATED by scripts/get_OF_coefficients.py (see scripts/OF_calibration.py). Do not edit it by hand: change the parameters in get_OF_coefficients.py and run it again.
+-- The same calibration is written to data/OF_calibration.json, which is used by the Python scripts.
+--
+-- Parameters: mu = 1.47515, sigma = 0.610874, CFD_delay = 2, CFD_attenuation = 0.5, OF_START = -3, OF_LENGTH = 4, M_A = 12, M_B = 22, g_PRECISION = 16, d_g_PRECISION = 14, N_SAMPLES_PER_WAVEFORM = 100
+-- delta_BCFD_window_mean: 3.46268184, 3.47873633, 3.42513086, 3.47061768
+
+library IEEE;
+use IEEE.STD_LOGIC_1164.ALL;
+use IEEE.NUMERIC_STD.ALL;
+
+use work.my_types.all;
+
+package OF_coefficients is
+
+-- Scalings (number of bits) of the quantised values. u and v are shifted right by A_SCALING. The b coefficients have TAU_SCALING more bits than the a coefficients (the precision on tau). G_PRECISION and D_G_PRECISION are the precisions of the templates g and d_g.
+constant A_SCALING : integer := 11;
+constant TAU_SCALING : integer := 9;
+constant G_PRECISION : integer := 16;
+constant D_G_PRECISION : integer := 14;
+
+-- The OF coefficients a and b, one set for each BCFD window (listed starting with the earliest sample).
+constant FIR_COEFFICIENTS_A_1 : t_fir_coefficients := ( 61, 632, 827, 750);
+constant FIR_COEFFICIENTS_A_2 : t_fir_coefficients := (-63, 549, 869, 835);
+constant FIR_COEFFICIENTS_A_3 : t_fir_coefficients := (-192,  319,  916, 1003);
+constant FIR_COEFFICIENTS_A_4 : t_fir_coefficients := (-164,   73,  925, 1161);
+
+constant FIR_COEFFICIENTS_B_1 : t_fir_coefficients := (-1231041,  -330242,   364382,   542728);
+constant FIR_COEFFICIENTS_B_2 : t_fir_coefficients := (-1160320,  -547080,   281673,   546508);
+constant FIR_COEFFICIENTS_B_3 : t_fir_coefficients := ( -962809, -1024810,   179623,   680164);
+constant FIR_COEFFICIENTS_B_4 : t_fir_coefficients := ( -551258, -1351992,    62412,   775947);
+
+-- The quantised pulse template g and its derivative d_g, one for each BCFD window. Needed for reconstructing the pulse tail.
+constant G_VALUES_1 : t_pulse_shape_values := (    0,     0,   107, 27146, 60156, 64605, 54802, 42223, 31182, 22619, 16311, 11768,
+         8524,  6210,  4555,  3365,  2504,  1877,  1417,  1077,   825,   635,   492,   384,
+          301,   237,   188,   149,   119,    96,    77,    63,    51,    41,    34,    28,
+           23,    19,    16,    13,    11,     9,     7,     6,     5,     4,     4,     3,
+            2,     2,     2,     1,     1,     1,     1,     1,     0,     0,     0,     0,
+            0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,
+            0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,
+            0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,
+            0,     0,     0,     0);
+
+constant G_VALUES_2 : t_pulse_shape_values := (    0,     0,     0, 17011, 55180, 65453, 57622, 45108, 33549, 24404, 17610, 12699,
+         9187,  6683,  4894,  3609,  2681,  2007,  1513,  1148,   877,   675,   522,   406,
+          318,   250,   198,   157,   126,   101,    81,    66,    53,    43,    35,    29,
+           24,    20,    16,    13,    11,     9,     8,     6,     5,     4,     4,     3,
+            3,     2,     2,     1,     1,     1,     1,     1,     0,     0,     0,     0,
+            0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,
+            0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,
+            0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,
+            0,     0,     0,     0);
+
+constant G_VALUES_3 : t_pulse_shape_values := (    0,     0,     0,  6236, 45990, 65078, 60936, 48950, 36825, 26915, 19450, 14021,
+        10131,  7356,  5376,  3956,  2932,  2190,  1647,  1247,   951,   730,   564,   438,
+          343,   269,   213,   169,   135,   108,    87,    70,    57,    46,    38,    31,
+           25,    21,    17,    14,    12,    10,     8,     7,     6,     5,     4,     3,
+            3,     2,     2,     1,     1,     1,     1,     1,     0,     0,     0,     0,
+            0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,
+            0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,
+            0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,
+            0,     0,     0,     0);
+
+constant G_VALUES_4 : t_pulse_shape_values := (    0,     0,     0,  1945, 38198, 63636, 62820, 51558, 39155, 28735, 20794, 14990,
+        10823,  7850,  5729,  4209,  3116,  2323,  1745,  1320,  1005,   770,   594,   461,
+          360,   283,   223,   177,   141,   113,    91,    73,    59,    48,    39,    32,
+           26,    22,    18,    15,    12,    10,     8,     7,     6,     5,     4,     3,
+            3,     2,     2,     2,     1,     1,     1,     1,     0,     0,     0,     0,
+            0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,
+            0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,
+            0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,
+            0,     0,     0,     0);
+
+constant D_G_VALUES_1 : t_pulse_shape_values := (    0,     0,   466, 11026,  4358, -1339, -3092, -3035, -2454, -1840, -1335,  -955,
+         -681,  -486,  -348,  -251,  -182,  -133,   -98,   -72,   -54,   -40,   -31,   -23,
+          -18,   -13,   -10,    -8,    -6,    -5,    -4,    -3,    -2,    -2,    -1,    -1,
+           -1,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,
+            0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,
+            0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,
+            0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,
+            0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,
+            0,     0,     0,     0);
+
+constant D_G_VALUES_2 : t_pulse_shape_values := (    0,     0,     0, 10359,  6295,  -432, -2915, -3126, -2603, -1976, -1441, -1034,
+         -737,  -526,  -376,  -271,  -196,  -143,  -105,   -78,   -58,   -43,   -33,   -25,
+          -19,   -14,   -11,    -8,    -7,    -5,    -4,    -3,    -2,    -2,    -1,    -1,
+           -1,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,
+            0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,
+            0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,
+            0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,
+            0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,
+            0,     0,     0,     0);
+
+constant D_G_VALUES_3 : t_pulse_shape_values := (    0,     0,     0,  6918,  8799,  1125, -2503, -3188, -2789, -2161, -1590, -1145,
+         -817,  -583,  -416,  -299,  -216,  -157,  -115,   -85,   -63,   -47,   -35,   -27,
+          -20,   -16,   -12,    -9,    -7,    -5,    -4,    -3,    -2,    -2,    -1,    -1,
+           -1,    -1,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,
+            0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,
+            0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,
+            0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,
+            0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,
+            0,     0,     0,     0);
+
+constant D_G_VALUES_4 : t_pulse_shape_values := (    0,     0,     0,  3545, 10179,  2433, -2080, -3180, -2906, -2289, -1697, -1225,
+         -876,  -624,  -446,  -320,  -231,  -168,  -123,   -90,   -67,   -50,   -38,   -28,
+          -22,   -16,   -13,   -10,    -7,    -6,    -4,    -3,    -3,    -2,    -1,    -1,
+           -1,    -1,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,
+            0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,
+            0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,
+            0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,
+            0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,     0,
+            0,     0,     0,     0);
+
+end package OF_coefficients;
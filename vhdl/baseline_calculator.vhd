@@ -30,7 +30,10 @@ entity baseline_calculator is
            average_out : out integer range 0 to 65535;                  -- The 2-sample MA data
            baseline_out : out integer range 0 to 65535;                 -- The 16-sample MA, used for the baseline.
            baseline_state : out t_baseline_state;                       -- the state of the baseline determination ('setup' during initialisation (no trigger can be issued then), 'awake' when calculating baseline from avg, 'sleeping' when a trigger has been issued and the baseline should be locked.
-           trigger : out std_logic := '0');                             -- The trigger signal, issued when the 2-sample MA goes above the fixed threshold.
+           trigger : out std_logic := '0';                              -- The trigger signal, issued when the 2-sample MA goes above the fixed threshold.
+           debug_rising : out std_logic;                                -- instrumentation (see count_events in main.vhd): '1' if the baseline triggers ('awake' -> 'sleeping') on the next clock edge
+           debug_falling : out std_logic;                               -- instrumentation: '1' if the trigger is released ('sleeping' -> 'awake') on the next clock edge
+           debug_update_blocked : out std_logic);                       -- instrumentation: '1' if the state is 'awake' but the baseline is not updated on the next clock edge, because PULSE_WIDTH_BEFORE_RESET clock cycles have not passed since the last final trigger
 end baseline_calculator;
 
 
@@ -148,5 +151,10 @@ average_out <= to_integer(r_current_average(15 downto 0));
 baseline_out <= to_integer(r_current_baseline(15 downto 0));
 baseline_state <= r_baseline_state;
 
+-- The instrumentation signals. These are decoded from the same registers as in the sequential process above, so they tell what happens on the next clock edge.
+debug_rising <= '1' when ((r_baseline_state = awake) and (to_integer(r_current_average) - to_integer(r_current_baseline) > THRESHOLD_RISING)) else '0';
+debug_falling <= '1' when ((r_baseline_state = sleeping) and (to_integer(r_current_average) - to_integer(r_current_baseline) < THRESHOLD_FALLING)) else '0';
+debug_update_blocked <= '1' when ((r_baseline_state = awake) and (to_integer(r_current_average) - to_integer(r_current_baseline) <= THRESHOLD_RISING) and (r_final_trigger_counter_state /= idle)) else '0';
+
 
 end Behavioral;
@@ -22,8 +22,8 @@ use work.my_types.all;
 entity baseline_selector is
     Port ( clk : in STD_LOGIC;
        baseline_from_average : in integer range 0 to 65535;                     -- the baseline, as calculated using the 16-sample MA in baseline_calculator
-       reconstructed_pulse_0 : in t_reconstructed_pulse;                        -- the reconstructed pulse from the optimal_filter.
-       OF_state : in t_OF_state;                                                -- the OF state, i.e. either 'waiting', 'triggered_pulse_0' or 'triggered_pulse_1'.
+       reconstructed_tail : in t_reconstructed_pulse;                           -- the reconstructed tail (of all pulses in the pile-up chain so far) from the optimal_filter.
+       OF_state : in t_OF_state;                                                -- the OF state, i.e. either OF_WAITING or p + 1 for 'triggered_pulse_p' (see my_types.vhd).
        baseline_out : out t_baseline_sel_buffer := (others => 0));              -- the baseline that is sent out. Will be selected by this code.
 end baseline_selector;
 
@@ -41,13 +41,13 @@ variable v_buffer_fill_counter : integer := 0;
 
 begin
     if rising_edge(clk) then
-        if (OF_state = waiting) then			-- i. e. no detection signalled by the OF.
+        if (OF_state = OF_WAITING) then			-- i. e. no detection signalled by the OF.
             baseline_temp(8 downto 0) <= (others => baseline_from_average);                         -- use the 16-sample MA baseline
-        elsif (OF_state = triggered_pulse_0) then	-- a pulse has been found by the OF. Tail should be reconstructed.
+        elsif (OF_state < MAX_PILEUP_PULSES) then	-- one or more pulses have been found by the OF, and a further pulse can still be analysed. Tail should be reconstructed.
             for i in 0 to 8 loop
-                baseline_temp(i) <= baseline_from_average + reconstructed_pulse_0(i);             -- Get the baseline from the one calculated pre-trigger (the 16-sample MA) PLUS the reconstructed tail. This is done if the OF has identified a pulse, which should then be subtracted.
+                baseline_temp(i) <= baseline_from_average + reconstructed_tail(i);             -- Get the baseline from the one calculated pre-trigger (the 16-sample MA) PLUS the reconstructed tail. This is done if the OF has identified a pulse, which should then be subtracted.
             end loop;
-        else
+        else						-- the last pulse of the chain (MAX_PILEUP_PULSES) has been found.
             baseline_temp(8 downto 0) <= (others => baseline_from_average);                          -- use the 16-sample MA baseline
         end if;
     end if;
@@ -27,7 +27,9 @@ entity constant_fraction is
        baseline : in t_baseline_sel_buffer;                             -- the current baseline buffer. Comes from the baseline selector, which sends out either the 16-sample MA baseline or a reconstructed tail (if a preceding pulse has been detected)
        baseline_state : in t_baseline_state;                            -- the baseline state (i.e. 'setup', 'awake' or 'sleeping')
        cfd_time : out integer;                                          -- will return the # of the determined BCFD zero-crossing interval. That is, cfd_time is either '1', '2', '3' or '4' in this implementation, since there are four sub-sample intervals.
-       data_out : out integer);                                          -- the actual CFD signal (i.e. the sum of the delayed and the attenuated+inverted)
+       data_out : out integer;                                          -- the actual CFD signal (i.e. the sum of the delayed and the attenuated+inverted)
+       debug_crossing : out std_logic;                                  -- instrumentation (see count_events in main.vhd): '1' if there is a CFD zero crossing while the BCFD is armed (i.e. it is checked against THRESHOLD_CFD on the next clock edge)
+       debug_crossing_rejected : out std_logic);                        -- instrumentation: '1' if that zero crossing is rejected, because the derivative is not above THRESHOLD_CFD
 end constant_fraction;
 
 architecture Behavioral of constant_fraction is
@@ -138,6 +140,10 @@ r_delayed <= to_integer(data_in(CFD_DELAY)) - baseline(CFD_DELAY);
 cfd_time <= r_bisection;                    -- the BCFD zero-crossing interval (1, 2, 3, or 4)
 data_out <= r_cfd;                          -- the actual CFD data
 
+-- The instrumentation signals, decoded from the same registers as in the sequential process above:
+debug_crossing <= '1' when ((r_cfd_state = waiting) and (baseline_state = sleeping) and (r_bisection = 0) and (r_cfd_buffer(0) < 0) and (r_cfd >= 0)) else '0';
+debug_crossing_rejected <= '1' when ((r_cfd_state = waiting) and (baseline_state = sleeping) and (r_bisection = 0) and (r_cfd_buffer(0) < 0) and (r_cfd >= 0) and (r_cfd - r_cfd_buffer(0) <= THRESHOLD_CFD)) else '0';
+
 
 
 end Behavioral;
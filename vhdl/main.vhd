@@ -32,7 +32,8 @@ entity main is
 	   trigger : out std_logic;				-- for debugging - the 'trigger' signal from the baseline calculator
            u_out : out integer;					-- the first output from the OF. u = A
            v_out : out integer;					-- the second output from the OF. v = A*tau
-	   final_trigger_out : out std_logic);			-- the 'final trigger' signals that a pulse has been successfully identified and processed. Can be used to trigger readout of data.
+	   final_trigger_out : out std_logic;			-- the 'final trigger' signals that a pulse has been successfully identified and processed. Can be used to trigger readout of data.
+	   debug_counters : out t_debug_counters);		-- for debugging - the instrumentation counters (see the count_events process below, and t_debug_counters in my_types.vhd)
 end main;
 
 architecture Behavioral of main is
@@ -52,11 +53,21 @@ architecture Behavioral of main is
     signal of_u_output : integer;						-- stores the OF output u (=A)
     signal of_v_output : integer;						-- stores the OF output v (=A*tau)
     
-    signal OF_state : t_OF_state := waiting;					-- stores the state of the OF. Initialise as 'waiting', but can be 'waiting', 'triggered_pulse_0' or 'triggered_pulse_1' (to denote whether a pulse has been detected by the OF. Declared in main because the OF trigger is needed by the baseline_selector (to know whether to reconstruct pulse tail)
+    signal OF_state : t_OF_state := OF_WAITING;					-- stores the state of the OF. Initialise as OF_WAITING, but can be OF_WAITING or p + 1 for 'triggered_pulse_p' (to denote whether pulse p of a pile-up chain has been detected by the OF, see my_types.vhd. Declared in main because the OF trigger is needed by the baseline_selector (to know whether to reconstruct pulse tail)
     
-    signal reconstructed_pulse_0 : t_reconstructed_pulse;			-- stores the reconstructed pulse (from the optimal_filter). Needed here because the reconstructed pulse is used by the baseline_selector.
+    signal reconstructed_tail : t_reconstructed_pulse;			-- stores the reconstructed tail (from the optimal_filter). Needed here because the reconstructed pulse is used by the baseline_selector.
     
     
+    signal r_debug_counters : t_debug_counters := DEBUG_COUNTERS_ZERO;		-- the instrumentation counters
+    -- the instrumentation signals from the components ('1' if the event happens on the next clock edge, see count_events):
+    signal debug_rising : std_logic;
+    signal debug_falling : std_logic;
+    signal debug_update_blocked : std_logic;
+    signal debug_crossing : std_logic;
+    signal debug_crossing_rejected : std_logic;
+    signal debug_rejected_amplitude : std_logic;
+    signal debug_rejected_fraction : std_logic;
+    signal debug_chain_overflow : std_logic;
     signal of_final_trigger : std_logic;					-- set to '1' if the OF has identified a pulse (which is reasonable). Defined here because the OF trigger is used by the baseline_calculator (because the baseline_calculator starts to calculate the baseline from average a certain number of samples after the last pulse, to avoid the sytem being stuck in a state)
     
     --- Define the different components used:
@@ -65,7 +76,7 @@ architecture Behavioral of main is
     component baseline_selector is
         Port ( clk : in STD_LOGIC;
            baseline_from_average : in integer range 0 to 65535;
-           reconstructed_pulse_0 : in t_reconstructed_pulse;
+           reconstructed_tail : in t_reconstructed_pulse;
            OF_state : in t_OF_state;
            baseline_out : out t_baseline_sel_buffer);
     end component;
@@ -78,7 +89,10 @@ architecture Behavioral of main is
                average_out : out integer range 0 to 65535;
                baseline_out : out integer range 0 to 65535;
                baseline_state : out t_baseline_state;
-               trigger : out std_logic);
+               trigger : out std_logic;
+               debug_rising : out std_logic;
+               debug_falling : out std_logic;
+               debug_update_blocked : out std_logic);
     end component;
     
     -- The CFD algorithm, used to determine the BCFD zero crossing window.
@@ -88,7 +102,9 @@ architecture Behavioral of main is
                baseline : in t_baseline_sel_buffer;
                baseline_state : in t_baseline_state;
                cfd_time : out integer;
-               data_out : out integer);
+               data_out : out integer;
+               debug_crossing : out std_logic;
+               debug_crossing_rejected : out std_logic);
     end component;
     
     -- The optimal filter, used to determine the pulse amplitude and phase shift, and to provide the 'final trigger', signalling data ready for readout.
@@ -101,8 +117,11 @@ architecture Behavioral of main is
        OF_state : out t_OF_state;
        u_out : out integer;
        v_out : out integer;
-       reconstructed_pulse_0 : out t_reconstructed_pulse;
-       final_trigger : out std_logic);
+       reconstructed_tail : out t_reconstructed_pulse;
+       final_trigger : out std_logic;
+       debug_rejected_amplitude : out std_logic;
+       debug_rejected_fraction : out std_logic;
+       debug_chain_overflow : out std_logic);
     end component;
 
     
@@ -123,15 +142,63 @@ begin
     end process;
     
 
+    -- The instrumentation counters, for debugging and for measuring the dead time and the losses in each stage (see scripts/dead_time.py). On every clock edge, count the clock cycles in each state and the events signalled by the components. scripts/emulate_VHDL.py has the same counters (initial_counters), so the two can be compared.
+    count_events : process(clk)
+    begin
+        if rising_edge(clk) then
+            case r_baseline_state is
+                when setup =>
+                    r_debug_counters.cycles_setup <= r_debug_counters.cycles_setup + 1;
+                when awake =>
+                    r_debug_counters.cycles_awake <= r_debug_counters.cycles_awake + 1;
+                when sleeping =>
+                    r_debug_counters.cycles_sleeping <= r_debug_counters.cycles_sleeping + 1;
+            end case;
+            if (debug_update_blocked = '1') then
+                r_debug_counters.cycles_update_blocked <= r_debug_counters.cycles_update_blocked + 1;
+            end if;
+            if (debug_rising = '1') then
+                r_debug_counters.baseline_triggers <= r_debug_counters.baseline_triggers + 1;
+            end if;
+            if (debug_falling = '1') then
+                r_debug_counters.baseline_releases <= r_debug_counters.baseline_releases + 1;
+            end if;
+            if (debug_crossing = '1') then
+                r_debug_counters.cfd_crossings <= r_debug_counters.cfd_crossings + 1;
+                if (debug_crossing_rejected = '1') then
+                    r_debug_counters.cfd_rejected_threshold <= r_debug_counters.cfd_rejected_threshold + 1;
+                else
+                    r_debug_counters.cfd_triggers <= r_debug_counters.cfd_triggers + 1;
+                end if;
+            end if;
+            if ((r_baseline_state = sleeping) and (cfd_time_output > 0)) then
+                r_debug_counters.of_candidates <= r_debug_counters.of_candidates + 1;
+            end if;
+            if (debug_rejected_amplitude = '1') then
+                r_debug_counters.of_rejected_amplitude <= r_debug_counters.of_rejected_amplitude + 1;
+            end if;
+            if (debug_rejected_fraction = '1') then
+                r_debug_counters.of_rejected_fraction <= r_debug_counters.of_rejected_fraction + 1;
+            end if;
+            if (of_final_trigger = '1') then
+                r_debug_counters.final_triggers <= r_debug_counters.final_triggers + 1;
+            end if;
+            if (debug_chain_overflow = '1') then
+                r_debug_counters.chain_overflows <= r_debug_counters.chain_overflows + 1;
+            end if;
+            r_debug_counters.cycles_OF_state(OF_state) <= r_debug_counters.cycles_OF_state(OF_state) + 1;
+        end if;
+    end process;
+
     -- The port maps:
 
-    baseline_selector0: baseline_selector port map(clk => clk, baseline_from_average => baseline_from_average, reconstructed_pulse_0 => reconstructed_pulse_0, OF_state => OF_state, baseline_out => baseline);
+    baseline_selector0: baseline_selector port map(clk => clk, baseline_from_average => baseline_from_average, reconstructed_tail => reconstructed_tail, OF_state => OF_state, baseline_out => baseline);
     
-    baseline_calculator0: baseline_calculator port map(clk => clk, data_in => r_sample_buffer, of_final_trigger => of_final_trigger, average_out => average_out, baseline_out => baseline_from_average, baseline_state => r_baseline_state, trigger => trigger);
+    baseline_calculator0: baseline_calculator port map(clk => clk, data_in => r_sample_buffer, of_final_trigger => of_final_trigger, average_out => average_out, baseline_out => baseline_from_average, baseline_state => r_baseline_state, trigger => trigger, debug_rising => debug_rising, debug_falling => debug_falling, debug_update_blocked => debug_update_blocked);
     
-    constant_fraction0: constant_fraction port map(clk => clk, data_in => r_sample_buffer, baseline => baseline, baseline_state => r_baseline_state, cfd_time => cfd_time_output, data_out => cfd_output);
+    constant_fraction0: constant_fraction port map(clk => clk, data_in => r_sample_buffer, baseline => baseline, baseline_state => r_baseline_state, cfd_time => cfd_time_output, data_out => cfd_output, debug_crossing => debug_crossing, debug_crossing_rejected => debug_crossing_rejected);
     
-    optimal_filter0: optimal_filter port map(clk => clk, data_in => r_sample_buffer, baseline => baseline, baseline_state => r_baseline_state, cfd_time => cfd_time_output, OF_state => OF_state, u_out => of_u_output, v_out => of_v_output, reconstructed_pulse_0 => reconstructed_pulse_0, final_trigger => of_final_trigger);
+    optimal_filter0: optimal_filter port map(clk => clk, data_in => r_sample_buffer, baseline => baseline, baseline_state => r_baseline_state, cfd_time => cfd_time_output, OF_state => OF_state, u_out => of_u_output, v_out => of_v_output, reconstructed_tail => reconstructed_tail, final_trigger => of_final_trigger, debug_rejected_amplitude => debug_rejected_amplitude, debug_rejected_fraction => debug_rejected_fraction, debug_chain_overflow => debug_chain_overflow);
     
     
 
@@ -146,5 +213,6 @@ begin
     v_out <= of_v_output;
     
     final_trigger_out <= of_final_trigger;		-- The final trigger output
+    debug_counters <= r_debug_counters;
     
 end Behavioral;
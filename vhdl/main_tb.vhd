@@ -16,11 +16,14 @@ USE IEEE.STD_LOGIC_TEXTIO.ALL;
 USE STD.TEXTIO.ALL;
 use IEEE.numeric_std.all;
 
+-- library containing some defined data types used in the code (here, the instrumentation counters):
+use work.my_types.all;
+
 
 -- This is the test bench, i. e. the simulation code. Here, the input file input_data.csv (from generate_pulse_data.py) is clocked in as input to the main program. Also here is where the output of the VHDL code is written to output_data.csv.
 
 entity main_tb is
-          Generic ( );
+          Generic (FEATURE_RECORDS : boolean := false);         -- if true, only one line (a feature record: counter, cfd_time, of_u, of_v and the pile-up flag) is written per final trigger, instead of the 10 columns for every clock cycle. This makes the output file ~100 times smaller (see scripts/feature_records.py).
 --  Port ( );
 end main_tb;
 
@@ -38,7 +41,8 @@ architecture Behavioral of main_tb is
                trigger : out std_logic;
                u_out : out integer;
                v_out : out integer;
-               final_trigger_out : out std_logic);
+               final_trigger_out : out std_logic;
+               debug_counters : out t_debug_counters);
     end component;
 
     -- internal signals:
@@ -56,6 +60,7 @@ architecture Behavioral of main_tb is
     
     
     signal final_trigger : std_logic;
+    signal debug_counters : t_debug_counters;
 
     signal counter : integer := 0;
     
@@ -64,13 +69,23 @@ architecture Behavioral of main_tb is
    
     -- Because the actual timing of the samples in the testbench simulation doesn't matter (we are only clocking in  and out data at one frequency, we make the clock period *unrealistically short* here (i. e. 0.25 ns). This is to limit the size of a temporary .xilwvdat file which is produced during simulation. The size of this file can become significant if simulating a large number of waveforms.
     constant period: time := 0.25 ns;         -- the inverse of the sampling frequency. For sampling frequency of 160 MHz, period is 6.25 ns
+
+    -- Write one instrumentation counter to the counters file, as a 'name,value' line:
+    procedure write_counter(file counters_file : TEXT; name : in string; value : in t_debug_counter) is
+        variable counter_line : LINE;
+    begin
+        WRITE(counter_line, name);
+        WRITE(counter_line, ',');
+        WRITE(counter_line, to_integer(value));
+        WRITELINE(counters_file, counter_line);
+    end procedure;
     
     
 
 begin
 
 	-- map ports to main.vhd
-    UUT: main port map(clk => clk, ready => ready, data_in => data_from_file, average_out => average_out, baseline_out => baseline_out, cfd_out => cfd_out, cfd_time => cfd_time, trigger => trigger, u_out => of_u, v_out => of_v, final_trigger_out => final_trigger);
+    UUT: main port map(clk => clk, ready => ready, data_in => data_from_file, average_out => average_out, baseline_out => baseline_out, cfd_out => cfd_out, cfd_time => cfd_time, trigger => trigger, u_out => of_u, v_out => of_v, final_trigger_out => final_trigger, debug_counters => debug_counters);
     
     
     -- to generate the clock:
@@ -104,10 +119,15 @@ begin
         FILE out_file : TEXT;			-- the output file (to be analysed by reconstruct_A_and_T.py)
         VARIABLE out_line : LINE;
         
+        variable v_in_chain : boolean := false;     -- true if there has been a final trigger since the baseline_calculator last triggered. A following final trigger is then a pile-up (the pulse is on the tail of the preceding one).
+        
 
-	-- Here, specify the locations of the input data (from generate_pulse_data.py) and output data (to be analysed by reconstruct_A_and_T.py). Note: absolute paths needed. Set the length of the string (e.g. (1 to 41) to match the actual length of the string
+	-- Here, specify the locations of the input data (from generate_pulse_data.py) and output data (to be analysed by reconstruct_A_and_T.py; call it feature_records.csv if FEATURE_RECORDS is set). Note: absolute paths needed. Set the length of the string (e.g. (1 to 41) to match the actual length of the string
         variable INPUT_FILE_NAME : string(1 to 41) := "/home/markus/Dokument/Work/input_data.csv";
         variable OUTPUT_FILE_NAME : string(1 to 42) := "/home/markus/Dokument/Work/output_data.csv";        
+        -- The instrumentation counters (see main.vhd) are written here at the end of the simulation, one 'name,value' line per counter (compare with scripts/dead_time.py):
+        FILE counters_file : TEXT;
+        variable COUNTERS_FILE_NAME : string(1 to 45) := "/home/markus/Dokument/Work/debug_counters.csv";
                 
     BEGIN
     
@@ -140,26 +160,52 @@ begin
         -- Write output to a text file - much of this is just for diagnostics/debugging. The most interesting are final_trigger (issued whenever the full algorithm has identified and processed a pulse), cfd_time (the BCFD window), of_u and of_v (contain the results of the OF - i.e. the final estimates on A and A*tau).
         
 
-        WRITE(out_line, counter);                       -- Keeps track of the clock-cycle number
-        WRITE(out_line, ',');
-        WRITE(out_line, str_stimulus_in);               -- The data used as input to the algorithm (i.e. coming from the Geant4 model)
-        WRITE(out_line, ',');
-        WRITE(out_line, average_out);
-        WRITE(out_line, ',');
-        WRITE(out_line, baseline_out);
-        WRITE(out_line, ',');
-        WRITE(out_line, trigger);
-        WRITE(out_line, ',');
-        WRITE(out_line, cfd_out);                       
-        WRITE(out_line, ',');
-        WRITE(out_line, cfd_time);                      -- the BCFD window/interval (i. e. 1, 2, 3 or 4)
-        WRITE(out_line, ',');     
-        WRITE(out_line, of_u);                          -- the result of the first OF calculation, i.e. the amplitude
-        WRITE(out_line, ',');
-        WRITE(out_line, of_v);                          -- the result of the second OF calculation, i.e. the amplitude*tau (A*tau)
-        WRITE(out_line, ',');
-        WRITE(out_line, final_trigger);                 -- the final trigger (issued by the OF when pulse is identified and processed (see Fig. 11.6 in thesis, where it is referred to as the "pulse trigger").
-        WRITELINE(out_file, out_line);
+        if (FEATURE_RECORDS) then
+            -- Zero-suppressed output: one feature record per final trigger, and nothing for the other clock cycles.
+            if (trigger = '0') then
+                v_in_chain := false;
+            end if;
+
+            if (final_trigger = '1') then
+                WRITE(out_line, counter);                   -- the timestamp
+                WRITE(out_line, ',');
+                WRITE(out_line, cfd_time);                  -- the BCFD window/interval (i. e. 1, 2, 3 or 4)
+                WRITE(out_line, ',');
+                WRITE(out_line, of_u);                      -- the amplitude
+                WRITE(out_line, ',');
+                WRITE(out_line, of_v);                      -- the amplitude*tau (A*tau)
+                WRITE(out_line, ',');
+                if (v_in_chain) then                        -- the pile-up flag
+                    WRITE(out_line, 1);
+                else
+                    WRITE(out_line, 0);
+                end if;
+                WRITELINE(out_file, out_line);
+
+                v_in_chain := true;
+            end if;
+        else
+            WRITE(out_line, counter);                       -- Keeps track of the clock-cycle number
+            WRITE(out_line, ',');
+            WRITE(out_line, str_stimulus_in);               -- The data used as input to the algorithm (i.e. coming from the Geant4 model)
+            WRITE(out_line, ',');
+            WRITE(out_line, average_out);
+            WRITE(out_line, ',');
+            WRITE(out_line, baseline_out);
+            WRITE(out_line, ',');
+            WRITE(out_line, trigger);
+            WRITE(out_line, ',');
+            WRITE(out_line, cfd_out);                       
+            WRITE(out_line, ',');
+            WRITE(out_line, cfd_time);                      -- the BCFD window/interval (i. e. 1, 2, 3 or 4)
+            WRITE(out_line, ',');     
+            WRITE(out_line, of_u);                          -- the result of the first OF calculation, i.e. the amplitude
+            WRITE(out_line, ',');
+            WRITE(out_line, of_v);                          -- the result of the second OF calculation, i.e. the amplitude*tau (A*tau)
+            WRITE(out_line, ',');
+            WRITE(out_line, final_trigger);                 -- the final trigger (issued by the OF when pulse is identified and processed (see Fig. 11.6 in thesis, where it is referred to as the "pulse trigger").
+            WRITELINE(out_file, out_line);
+        end if;
         
         
         
@@ -167,6 +213,28 @@ begin
     
     file_close(in_file);
     file_close(out_file);
+
+    -- Write the instrumentation counters, once the last clock edge has been counted:
+    wait for period/4;
+    file_open(counters_file,COUNTERS_FILE_NAME,WRITE_MODE);
+    write_counter(counters_file, "cycles_setup", debug_counters.cycles_setup);
+    write_counter(counters_file, "cycles_awake", debug_counters.cycles_awake);
+    write_counter(counters_file, "cycles_sleeping", debug_counters.cycles_sleeping);
+    write_counter(counters_file, "cycles_update_blocked", debug_counters.cycles_update_blocked);
+    write_counter(counters_file, "baseline_triggers", debug_counters.baseline_triggers);
+    write_counter(counters_file, "baseline_releases", debug_counters.baseline_releases);
+    write_counter(counters_file, "cfd_crossings", debug_counters.cfd_crossings);
+    write_counter(counters_file, "cfd_rejected_threshold", debug_counters.cfd_rejected_threshold);
+    write_counter(counters_file, "cfd_triggers", debug_counters.cfd_triggers);
+    write_counter(counters_file, "of_candidates", debug_counters.of_candidates);
+    write_counter(counters_file, "of_rejected_amplitude", debug_counters.of_rejected_amplitude);
+    write_counter(counters_file, "of_rejected_fraction", debug_counters.of_rejected_fraction);
+    write_counter(counters_file, "final_triggers", debug_counters.final_triggers);
+    write_counter(counters_file, "chain_overflows", debug_counters.chain_overflows);
+    for state in 0 to MAX_PILEUP_PULSES loop
+        write_counter(counters_file, "cycles_OF_state_" & integer'image(state), debug_counters.cycles_OF_state(state));
+    end loop;
+    file_close(counters_file);
     
     WAIT; --allows the simulation to halt!
     END PROCESS;
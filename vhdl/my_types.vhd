@@ -48,20 +48,58 @@ type t_u_buffer is array (3 downto 0) of integer;
 
 --------------
 
-type t_OF_state is (waiting, triggered_pulse_0, triggered_pulse_1, triggered_pulse_2);              -- Note: 'triggered_pulse_2' is NOT used in the current version.
+-- The maximum number of overlapping pulses (a pile-up chain) handled by the optimal_filter. The tails of the first MAX_PILEUP_PULSES - 1 pulses of a chain are reconstructed (each with its own 4 + 4 Reconstruction_mult_gen multipliers) and subtracted from the baseline, so that the next pulse can be analysed. The last pulse of the chain is still analysed, but a further pulse on its tail is not. MAX_PILEUP_PULSES = 2 is the original design (one pile-up pulse on the tail of pulse 0). See scripts/pileup_depth_scan.py for the resolution and cost as a function of MAX_PILEUP_PULSES.
+constant MAX_PILEUP_PULSES : integer := 2;
+
+-- The OF state: OF_WAITING (0), or p + 1 when pulse p of a pile-up chain has been accepted ('triggered_pulse_p', i.e. 1 = 'triggered_pulse_0', 2 = 'triggered_pulse_1', ...).
+subtype t_OF_state is integer range 0 to MAX_PILEUP_PULSES;
+constant OF_WAITING : t_OF_state := 0;
 
 
 type t_g_value_aligned_pulse is array(0 to 3) of STD_LOGIC_VECTOR(17 DOWNTO 0);
 type t_d_g_value_aligned_pulse is array(0 to 3) of STD_LOGIC_VECTOR(17 DOWNTO 0);
 
+-- One element per pulse of a pile-up chain (the counters), or per pulse whose tail is reconstructed (the others):
+type t_pulse_counters is array (0 to MAX_PILEUP_PULSES - 1) of integer;
+type t_pulse_sums is array (0 to MAX_PILEUP_PULSES - 2) of signed(50 downto 0);
+type t_pulse_cfd_windows is array (0 to MAX_PILEUP_PULSES - 2) of t_cfd_window;
+type t_g_value_aligned_pulses is array (0 to MAX_PILEUP_PULSES - 2) of t_g_value_aligned_pulse;
+
 
 
 type t_pulse_shape_values is array (0 to 99) of integer;
 type t_reconstructed_pulse is array (8 downto 0) of integer;
 
 type t_Reconstructed_part is array(3 downto 0) of STD_LOGIC_VECTOR(37 DOWNTO 0);
+type t_Reconstructed_parts is array (0 to MAX_PILEUP_PULSES - 2) of t_Reconstructed_part;
 type t_Reconstructed is array(3 downto 0) of signed(37 DOWNTO 0);
 
+------------
+-- The instrumentation counters (the debug_counters output of main.vhd, see the count_events process there and initial_counters in scripts/emulate_VHDL.py). All counters are incremented on the rising clock edge, and count either clock cycles (cycles_...) or events:
+
+subtype t_debug_counter is unsigned(31 downto 0);
+type t_OF_state_counters is array (0 to MAX_PILEUP_PULSES) of t_debug_counter;       -- one counter per OF state (OF_WAITING first)
+
+type t_debug_counters is record
+    cycles_setup : t_debug_counter;                     -- clock cycles in each state of the baseline_calculator
+    cycles_awake : t_debug_counter;
+    cycles_sleeping : t_debug_counter;
+    cycles_update_blocked : t_debug_counter;            -- clock cycles in state 'awake' without a baseline update, because of PULSE_WIDTH_BEFORE_RESET
+    baseline_triggers : t_debug_counter;                -- transitions 'awake' -> 'sleeping' (THRESHOLD_RISING)
+    baseline_releases : t_debug_counter;                -- transitions 'sleeping' -> 'awake' (THRESHOLD_FALLING)
+    cfd_crossings : t_debug_counter;                    -- CFD zero crossings while the BCFD is armed
+    cfd_rejected_threshold : t_debug_counter;           -- ... of which rejected by THRESHOLD_CFD
+    cfd_triggers : t_debug_counter;                     -- ... and accepted (giving a BCFD window)
+    of_candidates : t_debug_counter;                    -- BCFD windows seen by the OF while the baseline is 'sleeping'
+    of_rejected_amplitude : t_debug_counter;            -- ... rejected by OF_AMPLITUDE_THRESHOLD
+    of_rejected_fraction : t_debug_counter;             -- ... rejected by OF_AMPLITUDE_THRESHOLD_FRACTION
+    final_triggers : t_debug_counter;
+    chain_overflows : t_debug_counter;                  -- pulses accepted by the OF but lost, because the pile-up chain was already MAX_PILEUP_PULSES long
+    cycles_OF_state : t_OF_state_counters;              -- clock cycles in each OF state
+end record;
+
+constant DEBUG_COUNTERS_ZERO : t_debug_counters := (cycles_OF_state => (others => (others => '0')), others => (others => '0'));
+
 ------------
 -- For baseline selector:
 